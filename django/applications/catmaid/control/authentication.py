@@ -21,6 +21,7 @@ from django.contrib.auth import authenticate, logout, login
 from django.contrib.auth.models import User, Group
 from django.contrib.auth.forms import UserCreationForm
 from django.db import connection
+from django.db.models.signals import post_save, post_delete, m2m_changed
 from django.http import HttpResponseRedirect, JsonResponse
 from django.core.exceptions import ObjectDoesNotExist
 from django.shortcuts import _get_queryset, render
@@ -30,6 +31,7 @@ from rest_framework.authtoken.serializers import AuthTokenSerializer
 
 from catmaid.models import Project, UserRole, ClassInstance, \
         ClassInstanceClassInstance
+from catmaid.util import VersionedCache
 
 
 class PermissionError(Exception):
@@ -37,6 +39,41 @@ class PermissionError(Exception):
     pass
 
 
+_permission_cache = None
+
+def get_permission_cache():
+    """Return the process local cache for the project permissions and the edit
+    domain of users or None, if it is disabled. Entries are invalidated in all
+    processes when permissions, users, groups or projects change.
+    """
+    global _permission_cache
+    if not getattr(settings, 'PERMISSION_CACHE_MAX_AGE', 0):
+        return None
+    if _permission_cache is None:
+        _permission_cache = VersionedCache('permissions',
+                settings.PERMISSION_CACHE_SIZE, settings.PERMISSION_CACHE_MAX_AGE)
+    return _permission_cache
+
+
+def invalidate_permission_cache(*args, **kwargs):
+    """Drop all entries of the process local permission cache. The cache
+    version in the database is incremented by triggers, this makes sure the
+    current request reads the new version.
+    """
+    if _permission_cache is not None:
+        _permission_cache.invalidate()
+
+
+# Project permissions and edit domains depend on these models
+for model in (UserObjectPermission, GroupObjectPermission, User, Group, Project):
+    post_save.connect(invalidate_permission_cache, sender=model,
+            dispatch_uid='permission_cache_save_{}'.format(model.__name__))
+    post_delete.connect(invalidate_permission_cache, sender=model,
+            dispatch_uid='permission_cache_delete_{}'.format(model.__name__))
+m2m_changed.connect(invalidate_permission_cache, sender=User.groups.through,
+        dispatch_uid='permission_cache_user_groups')
+
+
 def login_user(request):
     profile_context = {}
     if request.method == 'POST':
@@ -95,17 +132,39 @@ def user_context_response(user, additional_fields=None):
     return JsonResponse(context)
 
 
+def get_user_project_permissions(user, project):
+    """Return the set of permission codenames the passed in user has on the
+    passed in project, which can be a Project instance or a project ID. Like
+    guardian's permission checks, this includes group permissions, superusers
+    have all permissions and inactive users none. Results are cached if the
+    permission cache is enabled.
+    """
+    def compute():
+        project_obj = project if isinstance(project, Project) else \
+                Project.objects.get(pk=project)
+        checker = ObjectPermissionChecker(user)
+        return frozenset(checker.get_perms(project_obj))
+
+    cache = get_permission_cache()
+    if cache is None or user.id is None:
+        return compute()
+
+    project_id = project.id if isinstance(project, Project) else int(project)
+    key = ('project', user.id, user.is_active, user.is_superuser, project_id)
+    return cache.get(key, compute)
+
+
 def check_user_role(user, project, roles):
-    """Check that a user has one of a set of roles for a project.
+    """Check that a user has one of a set of roles for a project, which can be
+    a Project instance or a project ID.
 
     Administrator role satisfies any requirement.
     """
 
-    # Prefetch all user permissions for project.
-    checker = ObjectPermissionChecker(user)
+    permissions = get_user_project_permissions(user, project)
 
     # Check for admin privs in all cases.
-    has_role = checker.has_perm('can_administer', project)
+    has_role = 'can_administer' in permissions
 
     if not has_role:
         # Check the indicated role(s)
@@ -113,11 +172,11 @@ def check_user_role(user, project, roles):
             roles = [roles]
         for role in roles:
             if role == UserRole.Annotate:
-                has_role = checker.has_perm('can_annotate', project)
+                has_role = 'can_annotate' in permissions
             elif role == UserRole.Browse:
-                has_role = checker.has_perm('can_browse', project)
+                has_role = 'can_browse' in permissions
             elif role == UserRole.Import:
-                has_role = checker.has_perm('can_import', project)
+                has_role = 'can_import' in permissions
             if has_role:
                 break
 
@@ -132,10 +191,9 @@ def requires_user_role(roles):
 
     def decorated_with_requires_user_role(f):
         def inner_decorator(request, roles=roles, *args, **kwargs):
-            p = Project.objects.get(pk=kwargs['project_id'])
             u = request.user
 
-            has_role = check_user_role(u, p, roles)
+            has_role = check_user_role(u, int(kwargs['project_id']), roles)
 
             if has_role:
                 # The user can execute the function.
@@ -391,6 +449,10 @@ def user_can_edit(cursor, user_id, other_user_id):
     # The group with identical name to the username is implicit, doesn't have to exist. Therefore, check this edge case before querying:
     if user_id == other_user_id:
         return True
+    cache = get_permission_cache()
+    if cache is not None:
+        return other_user_id in cache.get(('domain', int(user_id)),
+                lambda: frozenset(_user_domain(cursor, user_id)))
     # Retrieve a row when the user_id belongs to a group with name equal to that associated with other_user_id
     cursor.execute("""
     SELECT 1
@@ -410,6 +472,14 @@ def user_domain(cursor, user_id):
     """ This function returns the set of all other user_id, including the self, that the user has edit rights on via group membership.
     A user can edit nodes of other user(s) when the user belongs to a group named like that other user(s). Belonging to the self group is implicit, and therefore the self group--a group named like the user--doesn't have to exist; the user_id is added to the set in all cases.
     If a user can only edit its own nodes, then the returned set contains only its own user_id. """
+    cache = get_permission_cache()
+    if cache is not None:
+        return set(cache.get(('domain', int(user_id)),
+                lambda: frozenset(_user_domain(cursor, user_id))))
+    return _user_domain(cursor, user_id)
+
+
+def _user_domain(cursor, user_id):
     cursor.execute("""
     SELECT u2.id
     FROM auth_user u1,
@@ -0,0 +1,243 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import logging
+import sys
+
+from django.db import connection, transaction
+
+from catmaid.control.stats import populate_stats_summary
+
+
+logger = logging.getLogger(__name__)
+
+
+# The statement level triggers that keep summary tables up to date and are
+# suspended during a bulk maintenance session. Each entry lists the trigger
+# name, the table, the trigger event and its transition tables along with the
+# trigger function.
+summary_triggers = [
+    ('on_insert_treenode_update_summary_and_edges', 'treenode', 'INSERT',
+        'REFERENCING NEW TABLE as inserted_treenode',
+        'on_insert_treenode_update_summary_and_edges'),
+    ('on_edit_treenode_update_summary_and_edges', 'treenode', 'UPDATE',
+        'REFERENCING NEW TABLE as new_treenode OLD TABLE as old_treenode',
+        'on_edit_treenode_update_summary_and_edges'),
+    ('on_delete_treenode_update_summary_and_edges', 'treenode', 'DELETE',
+        'REFERENCING OLD TABLE as deleted_treenode',
+        'on_delete_treenode_update_summary_and_edges'),
+    ('on_insert_treenode_connector_update_synapse_edges', 'treenode_connector',
+        'INSERT', 'REFERENCING NEW TABLE AS new_link',
+        'on_change_treenode_connector_update_synapse_edges'),
+    ('on_edit_treenode_connector_update_synapse_edges', 'treenode_connector',
+        'UPDATE', 'REFERENCING NEW TABLE AS new_link OLD TABLE AS old_link',
+        'on_change_treenode_connector_update_synapse_edges'),
+    ('on_delete_treenode_connector_update_synapse_edges', 'treenode_connector',
+        'DELETE', 'REFERENCING OLD TABLE AS old_link',
+        'on_change_treenode_connector_update_synapse_edges'),
+    ('on_insert_cici_update_annotation_closure', 'class_instance_class_instance',
+        'INSERT', 'REFERENCING NEW TABLE AS new_cici',
+        'on_change_cici_update_annotation_closure'),
+    ('on_edit_cici_update_annotation_closure', 'class_instance_class_instance',
+        'UPDATE', 'REFERENCING NEW TABLE AS new_cici OLD TABLE AS old_cici',
+        'on_change_cici_update_annotation_closure'),
+    ('on_delete_cici_update_annotation_closure', 'class_instance_class_instance',
+        'DELETE', 'REFERENCING OLD TABLE AS old_cici',
+        'on_change_cici_update_annotation_closure'),
+]
+
+# The triggers that record changes during a bulk maintenance session, they use
+# the same format as summary_triggers.
+recording_triggers = [
+    ('on_{}_{}_record_bulk_change'.format(event.lower(), alias), table, event,
+            transition_tables, 'on_change_{}_record_bulk_change'.format(alias))
+    for table, alias in (('treenode', 'treenode'),
+            ('treenode_connector', 'treenode_connector'),
+            ('class_instance_class_instance', 'cici'))
+    for event, transition_tables in (
+            ('INSERT', 'REFERENCING NEW TABLE AS new_rows'),
+            ('UPDATE', 'REFERENCING NEW TABLE AS new_rows OLD TABLE AS old_rows'),
+            ('DELETE', 'REFERENCING OLD TABLE AS old_rows'))
+]
+
+# Live tables whose history tracking can be suspended during a session
+history_tables = ['treenode', 'connector', 'treenode_connector',
+        'class_instance', 'class_instance_class_instance',
+        'treenode_class_instance', 'review']
+
+
+def drop_triggers(cursor, triggers):
+    cursor.execute(''.join('DROP TRIGGER {} ON {};'.format(t[0], t[1])
+            for t in triggers))
+
+
+def create_triggers(cursor, triggers):
+    cursor.execute(''.join("""
+        CREATE TRIGGER {0} AFTER {2} ON {1} {3}
+        FOR EACH STATEMENT EXECUTE PROCEDURE {4}();
+    """.format(*t) for t in triggers))
+
+
+class BulkMaintenanceSession(object):
+    """A context manager for bulk writes to tracing data. Within a session,
+    the statement level triggers that maintain treenode edges, skeleton
+    summaries, synapse edges and the annotation closure are replaced with
+    triggers that only record which skeletons and projects are affected.
+    When the session is closed, the regular triggers are restored and the
+    summary tables are rebuilt for just the affected skeletons and projects,
+    followed by a statistics update of the session's project. Statistics are
+    aggregated per user and hour rather than per skeleton and bulk changes
+    often carry old timestamps, which is why they are recomputed for the whole
+    project.
+    Optionally, history tracking can be suspended for the tracing tables,
+    changes in such a session aren't part of the history then.
+
+    The session runs in a transaction and holds exclusive locks on the
+    treenode, treenode_connector and class_instance_class_instance tables, so
+    that other connections can't write to them while triggers are suspended.
+    If an exception is raised, all changes are rolled back.
+
+        with BulkMaintenanceSession(project_id):
+            cursor.execute("UPDATE treenode ...")
+
+    Code that already runs in a transaction can call start() and finish()
+    instead of using the session as context manager.
+    """
+
+    def __init__(self, project_id, track_history=True, update_stats=True,
+            batch_size=10000, log=None):
+        self.project_id = int(project_id)
+        self.track_history = track_history
+        self.update_stats = update_stats
+        self.batch_size = max(1, batch_size)
+        self.log = log or (lambda msg: logger.info(msg))
+        self.atomic = None
+
+    def __enter__(self):
+        self.atomic = transaction.atomic()
+        self.atomic.__enter__()
+        try:
+            self.start()
+        except:
+            self.atomic.__exit__(*sys.exc_info())
+            raise
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            try:
+                self.finish()
+            except:
+                self.atomic.__exit__(*sys.exc_info())
+                raise
+        return self.atomic.__exit__(exc_type, exc_value, traceback)
+
+    def start(self):
+        """Suspend summary triggers and optionally history tracking. This has
+        to be called in a transaction.
+        """
+        cursor = connection.cursor()
+        cursor.execute("""
+            CREATE TEMPORARY TABLE bulk_treenode_skeleton (
+                skeleton_id bigint PRIMARY KEY);
+            CREATE TEMPORARY TABLE bulk_deleted_treenode (id bigint);
+            CREATE TEMPORARY TABLE bulk_link_skeleton (
+                skeleton_id bigint PRIMARY KEY);
+            CREATE TEMPORARY TABLE bulk_cici_project (
+                project_id integer PRIMARY KEY);
+        """)
+        drop_triggers(cursor, summary_triggers)
+        create_triggers(cursor, recording_triggers)
+
+        if not self.track_history:
+            cursor.execute("""
+                SELECT disable_history_tracking_for_table(live_table_name,
+                    history_table_name)
+                FROM catmaid_history_table
+                WHERE live_table_name = ANY(%(tables)s::regclass[])
+            """, {
+                'tables': history_tables,
+            })
+            self.log("Suspended history tracking")
+
+    def add_skeletons(self, skeleton_ids):
+        """Mark the passed in skeletons as changed, so that their summary
+        information is rebuilt when the session is closed.
+        """
+        cursor = connection.cursor()
+        cursor.execute("""
+            INSERT INTO bulk_treenode_skeleton (skeleton_id)
+            SELECT UNNEST(%(skeleton_ids)s::bigint[])
+            ON CONFLICT DO NOTHING;
+            INSERT INTO bulk_link_skeleton (skeleton_id)
+            SELECT UNNEST(%(skeleton_ids)s::bigint[])
+            ON CONFLICT DO NOTHING;
+        """, {
+            'skeleton_ids': list(skeleton_ids),
+        })
+
+    def get_batches(self, cursor, table_name):
+        cursor.execute("SELECT skeleton_id FROM {} ORDER BY skeleton_id".format(
+                table_name))
+        skeleton_ids = [row[0] for row in cursor.fetchall()]
+        return [skeleton_ids[i:i + self.batch_size]
+                for i in range(0, len(skeleton_ids), self.batch_size)]
+
+    def finish(self):
+        """Restore all triggers and rebuild the summary information of all
+        recorded skeletons and projects.
+        """
+        cursor = connection.cursor()
+        drop_triggers(cursor, recording_triggers)
+        create_triggers(cursor, summary_triggers)
+
+        if not self.track_history:
+            cursor.execute("""
+                SELECT enable_history_tracking_for_table(live_table_name,
+                    history_table_name, false)
+                FROM catmaid_history_table
+                WHERE live_table_name = ANY(%(tables)s::regclass[])
+            """, {
+                'tables': history_tables,
+            })
+            self.log("Resumed history tracking")
+
+        cursor.execute("""
+            DELETE FROM treenode_edge e
+            USING bulk_deleted_treenode d
+            WHERE e.id = d.id
+        """)
+
+        batches = self.get_batches(cursor, 'bulk_treenode_skeleton')
+        for batch in batches:
+            cursor.execute("SELECT refresh_skeleton_summary_and_edges(%s::bigint[])",
+                    (batch,))
+        self.log("Updated edges and summaries of {} skeletons".format(
+                sum(len(b) for b in batches)))
+
+        batches = self.get_batches(cursor, 'bulk_link_skeleton')
+        for batch in batches:
+            cursor.execute("SELECT refresh_skeleton_synapse_edges(%s::bigint[])",
+                    (batch,))
+        self.log("Updated synapse edges of {} skeletons".format(
+                sum(len(b) for b in batches)))
+
+        cursor.execute("SELECT project_id FROM bulk_cici_project")
+        project_ids = [row[0] for row in cursor.fetchall()]
+        if project_ids:
+            cursor.execute("SELECT refresh_annotation_closure(%s::integer[])",
+                    (project_ids,))
+            self.log("Updated annotation closure of {} projects".format(
+                    len(project_ids)))
+
+        cursor.execute("""
+            DROP TABLE bulk_treenode_skeleton;
+            DROP TABLE bulk_deleted_treenode;
+            DROP TABLE bulk_link_skeleton;
+            DROP TABLE bulk_cici_project;
+        """)
+
+        if self.update_stats:
+            populate_stats_summary(self.project_id, delete=True,
+                    incremental=False)
+            self.log("Updated statistics of project {}".format(self.project_id))
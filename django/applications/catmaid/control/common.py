@@ -9,12 +9,14 @@ import six
 from collections import defaultdict
 
 from django.conf import settings
+from django.db.models.signals import post_save, post_delete
 from django.http import JsonResponse
 
 from catmaid.fields import Double3D
 from catmaid.models import Log, NeuronSearch, CELL_BODY_CHOICES, \
         SORT_ORDERS_DICT, Relation, Class, ClassInstance, \
         ClassInstanceClassInstance
+from catmaid.util import VersionedCache
 
 from six.moves import range
 
@@ -288,45 +290,101 @@ def cursor_fetch_dictionary(cursor):
             for row in cursor.fetchall()
             ]
 
-def get_relation_to_id_map(project_id, name_constraints=None, cursor=None):
+_id_map_cache = None
+
+def get_id_map_cache():
+    """Return the process local cache for relation and class ID maps or None,
+    if it is disabled. Entries are invalidated in all processes when relations
+    or classes change.
+    """
+    global _id_map_cache
+    if not getattr(settings, 'ID_MAP_CACHE_MAX_AGE', 0):
+        return None
+    if _id_map_cache is None:
+        _id_map_cache = VersionedCache('id_maps', settings.ID_MAP_CACHE_SIZE,
+                settings.ID_MAP_CACHE_MAX_AGE)
+    return _id_map_cache
+
+
+def invalidate_id_map_cache(*args, **kwargs):
+    """Drop all entries of the process local relation and class ID map cache.
+    The cache version in the database is incremented by triggers, this makes
+    sure the current request reads the new version.
+    """
+    if _id_map_cache is not None:
+        _id_map_cache.invalidate()
+
+
+for model in (Relation, Class):
+    post_save.connect(invalidate_id_map_cache, sender=model,
+            dispatch_uid='id_map_cache_save_{}'.format(model.__name__))
+    post_delete.connect(invalidate_id_map_cache, sender=model,
+            dispatch_uid='id_map_cache_delete_{}'.format(model.__name__))
+
+
+def _get_id_map(table, name_column, model, project_id, name_constraints,
+        cursor, use_cache):
+    """Return a mapping of names to IDs of the passed in table. Complete maps
+    are cached per project. If a requested name isn't found in a cached map, it
+    is loaded again, because the name might have been added by another
+    process. This is done only once per name and cache version, names that
+    are still missing afterwards are remembered.
+    """
+    def compute(name_constraints=None):
+        if cursor:
+            query = "SELECT {}, id  FROM {} WHERE project_id = %s".format(
+                    name_column, table)
+            params = [int(project_id)]
+            if name_constraints:
+                query += " AND (%s)" % ' OR '.join(('{} = %s'.format(name_column),) * len(name_constraints))
+                params += (name_constraints)
+            cursor.execute(query, params)
+            return dict(cursor.fetchall())
+        else:
+            query = model.objects.filter(project=project_id)
+            if name_constraints:
+                query = query.filter(**{name_column + '__in': name_constraints})
+            return {name: ID for name, ID in query.values_list(name_column, "id")}
+
+    cache = get_id_map_cache() if use_cache else None
+    if cache is None:
+        return compute(name_constraints)
+
+    key = (table, int(project_id))
+    id_map = cache.get(key, compute)
+    if name_constraints:
+        unknown_names = [name for name in name_constraints if name not in id_map]
+        if unknown_names:
+            missing_names = cache.get(key + ('missing',), set)
+            if any(name not in missing_names for name in unknown_names):
+                missing_names.update(unknown_names)
+                cache.remove(key)
+                id_map = cache.get(key, compute)
+        return {name: id_map[name] for name in name_constraints if name in id_map}
+    return dict(id_map)
+
+
+def get_relation_to_id_map(project_id, name_constraints=None, cursor=None,
+        use_cache=True):
     """
     Return a mapping of relation names to relation IDs. If a list of names is
     provided, only relations with those names will be included. If a cursor is
-    provided, this cursor will be used.
+    provided, this cursor will be used. Results are cached per project, unless
+    use_cache is False.
     """
-    if cursor:
-        query = "SELECT relation_name, id  FROM relation WHERE project_id = %s"
-        params = [int(project_id)]
-        if name_constraints:
-            query += " AND (%s)" % ' OR '.join(('relation_name = %s',) * len(name_constraints))
-            params += (name_constraints)
-        cursor.execute(query, params)
-        return dict(cursor.fetchall())
-    else:
-        query = Relation.objects.filter(project=project_id)
-        if name_constraints:
-            query = query.filter(relation_name__in=name_constraints)
-        return {rname: ID for rname, ID in query.values_list("relation_name", "id")}
+    return _get_id_map('relation', 'relation_name', Relation, project_id,
+            name_constraints, cursor, use_cache)
 
-def get_class_to_id_map(project_id, name_constraints=None, cursor=None):
+def get_class_to_id_map(project_id, name_constraints=None, cursor=None,
+        use_cache=True):
     """
     Return a mapping of class names to relation IDs. If a list of names is
     provided, only classes with those names will be included. If a cursor is
-    provided, this cursor will be used.
+    provided, this cursor will be used. Results are cached per project, unless
+    use_cache is False.
     """
-    if cursor:
-        query = "SELECT class_name, id  FROM class WHERE project_id = %s"
-        params = [int(project_id)]
-        if name_constraints:
-            query += " AND (%s)" % ' OR '.join(('class_name = %s',) * len(name_constraints))
-            params += (name_constraints)
-        cursor.execute(query, params)
-        return dict(cursor.fetchall())
-    else:
-        query = Class.objects.filter(project=project_id)
-        if name_constraints:
-            query = query.filter(class_name__in=name_constraints)
-        return {cname: ID for cname, ID in query.values_list("class_name", "id")}
+    return _get_id_map('class', 'class_name', Class, project_id,
+            name_constraints, cursor, use_cache)
 
 def urljoin(a, b):
     """ Joins to URL parts a and b while making sure this
@@ -200,34 +200,74 @@ def _many_to_many_synapses(skids1, skids2, relation_name, project_id):
     cursor = connection.cursor()
 
     relations = get_relation_to_id_map(project_id, cursor=cursor)
-    gapjunction_id = relations.get('gapjunction_with', -1)
 
-    cursor.execute('''
-    SELECT tc1.connector_id, c.location_x, c.location_y, c.location_z,
-           tc1.treenode_id, tc1.skeleton_id, tc1.confidence, tc1.user_id,
-           t1.location_x, t1.location_y, t1.location_z,
-           tc2.treenode_id, tc2.skeleton_id, tc2.confidence, tc2.user_id,
-           t2.location_x, t2.location_y, t2.location_z
-    FROM treenode_connector tc1,
-         treenode_connector tc2,
-         treenode t1,
-         treenode t2,
-         relation r1,
-         connector c
-    WHERE tc1.skeleton_id IN (%s)
-      AND tc1.connector_id = c.id
-      AND tc2.skeleton_id IN (%s)
-      AND tc1.connector_id = tc2.connector_id
-      AND tc1.relation_id = r1.id
-      AND r1.relation_name = '%s'
-      AND (tc1.relation_id != tc2.relation_id OR tc1.relation_id = %d)
-      AND tc1.id != tc2.id
-      AND tc1.treenode_id = t1.id
-      AND tc2.treenode_id = t2.id
-    ''' % (','.join(map(str, skids1)),
-           ','.join(map(str, skids2)),
-           relation_name,
-           gapjunction_id))
+    if relation_name == 'gapjunction_with':
+        gapjunction_id = relations.get('gapjunction_with', -1)
+        cursor.execute('''
+        SELECT tc1.connector_id, c.location_x, c.location_y, c.location_z,
+               tc1.treenode_id, tc1.skeleton_id, tc1.confidence, tc1.user_id,
+               t1.location_x, t1.location_y, t1.location_z,
+               tc2.treenode_id, tc2.skeleton_id, tc2.confidence, tc2.user_id,
+               t2.location_x, t2.location_y, t2.location_z
+        FROM treenode_connector tc1,
+             treenode_connector tc2,
+             treenode t1,
+             treenode t2,
+             connector c
+        WHERE tc1.skeleton_id IN (%s)
+          AND tc1.connector_id = c.id
+          AND tc2.skeleton_id IN (%s)
+          AND tc1.connector_id = tc2.connector_id
+          AND tc1.relation_id = %d
+          AND tc1.id != tc2.id
+          AND tc1.treenode_id = t1.id
+          AND tc2.treenode_id = t2.id
+        ''' % (','.join(map(str, skids1)),
+               ','.join(map(str, skids2)),
+               gapjunction_id))
+    else:
+        # Synapses are only looked up for skeleton pairs that are connected,
+        # which is known from the precomputed synapse edges.
+        if relation_name == 'presynaptic_to':
+            skeleton_1, skeleton_2 = 'pre_skeleton_id', 'post_skeleton_id'
+            partner_relation_name = 'postsynaptic_to'
+        else:
+            skeleton_1, skeleton_2 = 'post_skeleton_id', 'pre_skeleton_id'
+            partner_relation_name = 'presynaptic_to'
+
+        cursor.execute('''
+        WITH partner AS (
+            SELECT DISTINCT {skeleton_1} AS skeleton_1, {skeleton_2} AS skeleton_2
+            FROM catmaid_skeleton_synapse_edge
+            WHERE {skeleton_1} = ANY(%(skids1)s::bigint[])
+              AND {skeleton_2} = ANY(%(skids2)s::bigint[])
+        )
+        SELECT tc1.connector_id, c.location_x, c.location_y, c.location_z,
+               tc1.treenode_id, tc1.skeleton_id, tc1.confidence, tc1.user_id,
+               t1.location_x, t1.location_y, t1.location_z,
+               tc2.treenode_id, tc2.skeleton_id, tc2.confidence, tc2.user_id,
+               t2.location_x, t2.location_y, t2.location_z
+        FROM partner p
+        JOIN treenode_connector tc1
+            ON tc1.skeleton_id = p.skeleton_1
+        JOIN treenode_connector tc2
+            ON tc2.connector_id = tc1.connector_id
+            AND tc2.skeleton_id = p.skeleton_2
+        JOIN connector c
+            ON c.id = tc1.connector_id
+        JOIN treenode t1
+            ON t1.id = tc1.treenode_id
+        JOIN treenode t2
+            ON t2.id = tc2.treenode_id
+        WHERE tc1.relation_id = %(relation_id)s
+          AND tc2.relation_id = %(partner_relation_id)s
+        ORDER BY tc1.connector_id, tc1.id, tc2.id
+        '''.format(skeleton_1=skeleton_1, skeleton_2=skeleton_2), {
+            'skids1': list(skids1),
+            'skids2': list(skids2),
+            'relation_id': relations[relation_name],
+            'partner_relation_id': relations[partner_relation_name],
+        })
 
     return tuple((row[0], (row[1], row[2], row[3]),
                   row[4], row[5], row[6], row[7],
@@ -0,0 +1,273 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import gzip
+import json
+import os
+import six
+
+from datetime import datetime
+
+
+ARCHIVE_FORMAT = 'catmaid-copy-archive'
+ARCHIVE_VERSION = 1
+MANIFEST_FILE = 'manifest.json'
+
+# The tables a COPY archive can contain, in import order, along with the ID
+# sequence of each table. Each column is listed with the kind of reference it
+# holds, which defines how it is mapped to the target database on import:
+# "id" columns are the IDs of the table itself, "concept" and "location"
+# columns reference rows of tables that use the respective ID sequence,
+# "user" columns reference users and "project" columns the project.
+archive_tables = [
+    ('class', 'concept', [
+        ('id', 'id'), ('user_id', 'user'), ('creation_time', None),
+        ('edition_time', None), ('project_id', 'project'),
+        ('class_name', None), ('description', None)]),
+    ('relation', 'concept', [
+        ('id', 'id'), ('user_id', 'user'), ('creation_time', None),
+        ('edition_time', None), ('project_id', 'project'),
+        ('relation_name', None), ('uri', None), ('description', None),
+        ('isreciprocal', None)]),
+    ('class_instance', 'concept', [
+        ('id', 'id'), ('user_id', 'user'), ('creation_time', None),
+        ('edition_time', None), ('project_id', 'project'),
+        ('class_id', 'concept'), ('name', None)]),
+    ('class_instance_class_instance', 'concept', [
+        ('id', 'id'), ('user_id', 'user'), ('creation_time', None),
+        ('edition_time', None), ('project_id', 'project'),
+        ('relation_id', 'concept'), ('class_instance_a', 'concept'),
+        ('class_instance_b', 'concept')]),
+    ('treenode', 'location', [
+        ('id', 'id'), ('user_id', 'user'), ('creation_time', None),
+        ('edition_time', None), ('project_id', 'project'),
+        ('editor_id', 'user'), ('location_x', None), ('location_y', None),
+        ('location_z', None), ('parent_id', 'location'), ('radius', None),
+        ('confidence', None), ('skeleton_id', 'concept')]),
+    ('connector', 'location', [
+        ('id', 'id'), ('user_id', 'user'), ('creation_time', None),
+        ('edition_time', None), ('project_id', 'project'),
+        ('editor_id', 'user'), ('location_x', None), ('location_y', None),
+        ('location_z', None), ('confidence', None)]),
+    ('treenode_connector', 'concept', [
+        ('id', 'id'), ('user_id', 'user'), ('creation_time', None),
+        ('edition_time', None), ('project_id', 'project'),
+        ('relation_id', 'concept'), ('treenode_id', 'location'),
+        ('connector_id', 'location'), ('skeleton_id', 'concept'),
+        ('confidence', None)]),
+    ('treenode_class_instance', 'concept', [
+        ('id', 'id'), ('user_id', 'user'), ('creation_time', None),
+        ('edition_time', None), ('project_id', 'project'),
+        ('relation_id', 'concept'), ('treenode_id', 'location'),
+        ('class_instance_id', 'concept')]),
+]
+
+archive_table_index = dict((name, (sequence, columns))
+        for name, sequence, columns in archive_tables)
+
+# The NULL representation of PostgreSQL's COPY text format
+COPY_NULL = '\\N'
+
+
+class CopyRowStream(object):
+    """A read-only file-like object over an iterator of byte strings, which
+    allows to stream generated data into a COPY statement.
+    """
+
+    def __init__(self, chunks):
+        self.chunks = iter(chunks)
+        self.buffer = b''
+
+    def read(self, size=-1):
+        while size < 0 or len(self.buffer) < size:
+            try:
+                self.buffer += next(self.chunks)
+            except StopIteration:
+                break
+        if size < 0:
+            size = len(self.buffer)
+        data, self.buffer = self.buffer[:size], self.buffer[size:]
+        return data
+
+    def readline(self, size=-1):
+        return self.read(size)
+
+
+def unescape_copy_text(value):
+    """Return the plain text of a field in PostgreSQL's COPY text format."""
+    if '\\' not in value:
+        return value
+    escapes = {'\\': '\\', 't': '\t', 'n': '\n', 'r': '\r', 'b': '\b',
+            'f': '\f', 'v': '\v'}
+    chars = []
+    i = 0
+    while i < len(value):
+        c = value[i]
+        if c == '\\' and i + 1 < len(value):
+            i += 1
+            chars.append(escapes.get(value[i], value[i]))
+        else:
+            chars.append(c)
+        i += 1
+    return ''.join(chars)
+
+
+def escape_copy_text(value):
+    """Return the passed in value as field in PostgreSQL's COPY text format."""
+    if value is None:
+        return COPY_NULL
+    return six.text_type(value).replace('\\', '\\\\').replace('\t', '\\t') \
+            .replace('\n', '\\n').replace('\r', '\\r')
+
+
+def copy_rows(cursor, table_name, columns, rows):
+    """Stream the passed in iterable of value tuples into the passed in
+    columns of a table, using a single COPY statement. Columns that aren't
+    listed get their default value.
+    """
+    def lines():
+        for row in rows:
+            yield ('\t'.join(escape_copy_text(v) for v in row) + '\n').encode('utf-8')
+
+    cursor.copy_expert("COPY {} ({}) FROM STDIN".format(table_name,
+            ', '.join(columns)), CopyRowStream(lines()))
+
+
+def get_table_columns(table_name):
+    """Return the column names of the passed in archive table."""
+    return [c for c, _ in archive_table_index[table_name][1]]
+
+
+def export_table(cursor, archive_path, table_name, query, params=None):
+    """Write the result of the passed in query, which has to select the
+    archive columns of the passed in table, as gzip compressed COPY stream into
+    the archive directory. Returned is the manifest entry of the table, which
+    contains the number of rows, the ID range and all referenced users. The
+    query is run twice, once for the manifest entry and once for the COPY
+    stream. Both only see the same rows if the transaction uses a single
+    snapshot, i.e. if it is run with the isolation level REPEATABLE READ or
+    SERIALIZABLE.
+    """
+    sequence, columns = archive_table_index[table_name]
+    user_columns = [c for c, kind in columns if kind == 'user']
+
+    cursor.execute("""
+        WITH exported AS ({query})
+        SELECT (SELECT COUNT(*) FROM exported),
+            (SELECT MIN(id) FROM exported),
+            (SELECT MAX(id) FROM exported),
+            ARRAY({users})
+    """.format(query=query, users=' UNION '.join(
+            "SELECT {} FROM exported".format(c) for c in user_columns)),
+            params)
+    n_rows, min_id, max_id, user_ids = cursor.fetchone()
+
+    file_name = '{}.copy.gz'.format(table_name)
+    copy_query = cursor.mogrify(query, params)
+    if isinstance(copy_query, bytes):
+        copy_query = copy_query.decode('utf-8')
+    with gzip.open(os.path.join(archive_path, file_name), 'wb') as f:
+        cursor.copy_expert("COPY ({}) TO STDOUT".format(copy_query), f)
+
+    return {
+        'name': table_name,
+        'file': file_name,
+        'sequence': sequence,
+        'columns': [c for c, _ in columns],
+        'rows': n_rows,
+        'min_id': min_id,
+        'max_id': max_id,
+        'user_ids': sorted(u for u in user_ids if u is not None),
+    }
+
+
+def write_manifest(archive_path, project, tables, users):
+    """Write the manifest of an archive, which lists all tables in import
+    order, the ID range of each ID sequence and all referenced users.
+    """
+    id_ranges = {}
+    for t in tables:
+        if not t['rows']:
+            continue
+        id_range = id_ranges.get(t['sequence'])
+        if id_range:
+            id_range[0] = min(id_range[0], t['min_id'])
+            id_range[1] = max(id_range[1], t['max_id'])
+        else:
+            id_ranges[t['sequence']] = [t['min_id'], t['max_id']]
+
+    manifest = {
+        'format': ARCHIVE_FORMAT,
+        'version': ARCHIVE_VERSION,
+        'created': datetime.now().isoformat(),
+        'project': {
+            'id': project.id,
+            'title': project.title,
+        },
+        'id_ranges': id_ranges,
+        'tables': tables,
+        'users': users,
+    }
+    with open(os.path.join(archive_path, MANIFEST_FILE), 'w') as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+    return manifest
+
+
+def is_archive(path):
+    """Whether the passed in path is a COPY archive directory."""
+    return os.path.isfile(os.path.join(path, MANIFEST_FILE))
+
+
+def read_manifest(archive_path):
+    """Read and validate the manifest of an archive. Only known tables and
+    columns are accepted.
+    """
+    with open(os.path.join(archive_path, MANIFEST_FILE), 'r') as f:
+        manifest = json.load(f)
+
+    if manifest.get('format') != ARCHIVE_FORMAT:
+        raise ValueError("{} is no CATMAID COPY archive".format(archive_path))
+    if manifest.get('version') != ARCHIVE_VERSION:
+        raise ValueError("Unsupported archive version: {}".format(
+                manifest.get('version')))
+
+    known_tables = [name for name, _, _ in archive_tables]
+    last_index = -1
+    for t in manifest['tables']:
+        if t['name'] not in archive_table_index:
+            raise ValueError("Unknown table in archive: {}".format(t['name']))
+        index = known_tables.index(t['name'])
+        if index <= last_index:
+            raise ValueError("Tables in archive are out of order")
+        last_index = index
+        unknown_columns = set(t['columns']) - set(get_table_columns(t['name']))
+        if unknown_columns:
+            raise ValueError("Unknown columns of table {} in archive: {}".format(
+                    t['name'], ', '.join(sorted(unknown_columns))))
+        if os.path.basename(t['file']) != t['file']:
+            raise ValueError("Invalid file name in archive: {}".format(t['file']))
+
+    return manifest
+
+
+def import_table(cursor, archive_path, table, map_row):
+    """Stream the rows of the passed in manifest table entry into the database.
+    The map_row function is called with a list of the text fields of each row
+    and can return a modified list or None to skip the row. Rows are read,
+    mapped and written one at a time. Returns the number of imported rows.
+    """
+    path = os.path.join(archive_path, table['file'])
+    n_imported = [0]
+
+    def rows():
+        with gzip.open(path, 'rb') as f:
+            for line in f:
+                fields = map_row(line.decode('utf-8').rstrip('\n').split('\t'))
+                if fields is not None:
+                    n_imported[0] += 1
+                    yield ('\t'.join(fields) + '\n').encode('utf-8')
+
+    cursor.copy_expert("COPY {} ({}) FROM STDIN".format(table['name'],
+            ', '.join(table['columns'])), CopyRowStream(rows()))
+
+    return n_imported[0]
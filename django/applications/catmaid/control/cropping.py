@@ -4,6 +4,7 @@ from __future__ import unicode_literals
 import os
 import json
 import logging
+import threading
 
 from django.conf import settings
 from django.http import HttpResponse, JsonResponse
@@ -16,24 +17,21 @@ from catmaid.control.common import (id_generator, json_error_response,
         get_request_bool, get_request_list)
 from catmaid.control.tile import get_tile_source
 from catmaid.control.message import notify_user
+from catmaid.util import LRUCache
 
 from PIL import Image as PILImage, TiffImagePlugin
 
+import numpy as np
 import requests
 import os.path
 import glob
+from io import BytesIO
+from multiprocessing.pool import ThreadPool
 from time import time
 from math import cos, sin, radians
 
 logger = logging.getLogger(__name__)
 
-try:
-    from pgmagick import Blob, Image, ImageList, Geometry, ChannelType, \
-            CompositeOperator as co, ColorRGB
-except ImportError:
-    logger.warning("CATMAID was unable to load the pgmagick module. "
-        "Cropping will not be available")
-
 from celery.task import task
 
 # Prefix for stored microstacks
@@ -45,6 +43,14 @@ crop_output_path = os.path.join(settings.MEDIA_ROOT,
     settings.MEDIA_CROPPING_SUBDIRECTORY)
 # Whether SSL certificates should be verified
 verify_ssl = getattr(settings, 'CROPPING_VERIFY_CERTIFICATES', True)
+# The number of tiles that are fetched in parallel
+fetch_workers = max(1, getattr(settings, 'CROPPING_FETCH_WORKERS', 8))
+# A process local cache for the content of fetched tiles, bounded by the total
+# size in bytes.
+tile_cache = LRUCache(getattr(settings, 'CROPPING_TILE_CACHE_SIZE', 0),
+        size_fn=len)
+# Each fetching thread keeps its own HTTP session to reuse connections.
+_thread_data = threading.local()
 
 
 class CropJob(object):
@@ -106,6 +112,8 @@ class ImageRetrievalError(IOError):
 class ImagePart:
     """ A part of a 2D image where height and width are not necessarily
     of the same size. Provides readout of the defined sub-area of the image.
+    The source area includes the minimum and excludes the maximum pixel
+    position.
     """
     def __init__( self, path, x_min_src, x_max_src, y_min_src, y_max_src, x_dst, y_dst ):
         self.path = path
@@ -117,40 +125,67 @@ class ImagePart:
         self.y_dst = y_dst
         self.width = x_max_src - x_min_src
         self.height = y_max_src - y_min_src
-        self.estimated_size = 0
         # Complain if the width or the height is zero
-        if self.width == 0 or self.height == 0:
+        if self.width <= 0 or self.height <= 0:
             raise ValueError( "An image part must have an area, hence no " \
                     "extent should be zero!" )
 
-    def get_image( self ):
-        # Open the image
-        try:
-            r = requests.get(self.path, allow_redirects=True, verify=verify_ssl)
-            if not r:
-                raise ValueError("Could not get " + self.path)
-            if r.status_code != 200:
-                raise ValueError("Unexpected status code ({}) for {}".format(r.status_code, self.path))
-            img_data = r.content
-            bytes_read = len(img_data)
-        except requests.exceptions.RequestException as e:
-            raise ImageRetrievalError(self.path, str(e))
-
-        blob = Blob( img_data )
-        image = Image( blob )
-        # Check if the whole image should be used and cropped if necessary.
-        src_width = image.size().width()
-        src_height = image.size().height()
-        if self.width != src_width or self.height != src_height:
-            box = Geometry( self.width, self.height, self.x_min_src, self.y_min_src )
-            image.crop( box )
-
-        # Estimates the size in Bytes of this image part by scaling the number
-        # of Bytes read with the ratio between the needed part of the image and
-        # its actual size.
-        self.estimated_size = bytes_read * abs(float(self.width * self.height) /
-                                               float(src_width * src_height))
-        return image
+    def get_image( self, tile=None ):
+        """ Return the defined sub-area of the image as NumPy array. If the
+        whole image has been loaded already, it can be passed in.
+        """
+        if tile is None:
+            tile = load_tile(self.path)
+        return tile[self.y_min_src:self.y_max_src,
+                    self.x_min_src:self.x_max_src]
+
+def fetch_tile(path):
+    """ Return the content of the tile at the passed in URL. Tiles are cached
+    in a process local cache.
+    """
+    content = tile_cache.get(path)
+    if content is not None:
+        return content
+
+    session = getattr(_thread_data, 'session', None)
+    if session is None:
+        session = requests.Session()
+        _thread_data.session = session
+    try:
+        r = session.get(path, allow_redirects=True, verify=verify_ssl)
+        if not r:
+            raise ValueError("Could not get " + path)
+        if r.status_code != 200:
+            raise ValueError("Unexpected status code ({}) for {}".format(r.status_code, path))
+        content = r.content
+    except requests.exceptions.RequestException as e:
+        raise ImageRetrievalError(path, str(e))
+
+    tile_cache.set(path, content)
+    return content
+
+def load_tile(path):
+    """ Fetch and decode the tile at the passed in URL. Image data is returned
+    as NumPy array with the shape (height, width) for grayscale images and
+    (height, width, channels) for color images.
+    """
+    try:
+        image = PILImage.open(BytesIO(fetch_tile(path)))
+        if image.mode == '1':
+            image = image.convert('L')
+        elif image.mode not in ('L', 'I;16', 'I', 'F', 'RGB'):
+            image = image.convert('RGB')
+        return np.asarray(image)
+    except IOError as e:
+        if isinstance(e, ImageRetrievalError):
+            raise
+        raise ImageRetrievalError(path, str(e))
+
+def write_image(data, path):
+    """ Write image data, as it is returned by extract_substack(), to the
+    passed in path. The file format is determined by the file extension.
+    """
+    PILImage.fromarray(data).save(path)
 
 def to_x_index( x, stack, zoom_level, enforce_bounds=True ):
     """ Converts a real world position to a x pixel position.
@@ -179,11 +214,12 @@ def to_z_index( z, stack, zoom_level, enforce_bounds=True ):
         section = min(max(section, 0.0), stack.dimension.z - 1.0)
     return int( section )
 
-def addMetaData( path, job, result ):
-    """ Use this method to add meta data to the image. Due to a bug in
-    exiv2, its python wrapper pyexiv2 is of no use to us. This bug
-    (http://dev.exiv2.org/issues/762) hinders us to work on multi-page
-    TIFF files. Instead, we use Pillow to write meta data.
+def create_tiff_info( job, n_images ):
+    """ Create the TIFF tags that are written to each page of the output
+    image, which contains <n_images> pages. Due to a bug in exiv2, its python
+    wrapper pyexiv2 is of no use to us. This bug (http://dev.exiv2.org/issues/762)
+    hinders us to work on multi-page TIFF files. Instead, we use Pillow to
+    write meta data.
     """
     # Add resolution information in pixel per nanometer. The stack info
     # available is nm/px and refers to a zoom-level of zero.
@@ -192,7 +228,6 @@ def addMetaData( path, job, result ):
     res_x_nm_px = 1.0 / res_x_scaled
     res_y_nm_px = 1.0 / res_y_scaled
     res_z_nm_px = 1.0 / job.ref_stack.resolution.z
-    ifd = dict()
     ifd = TiffImagePlugin.ImageFileDirectory_v2()
     ifd[TiffImagePlugin.X_RESOLUTION] = res_x_nm_px
     ifd[TiffImagePlugin.Y_RESOLUTION] = res_y_nm_px
@@ -200,7 +235,6 @@ def addMetaData( path, job, result ):
 
     # ImageJ specific meta data to allow easy embedding of units and
     # display options.
-    n_images = len(result)
     ij_version= "1.51n"
     unit = "nm"
 
@@ -208,7 +242,7 @@ def addMetaData( path, job, result ):
     if n_images % n_channels != 0:
         raise ValueError( "Meta data creation: the number of images " \
                 "modulo the channel count is not zero" )
-    n_slices = n_images / n_channels
+    n_slices = n_images // n_channels
 
     # sample with (the actual is a line break instead of a .):
     # ImageJ=1.45p.images={0}.channels=1.slices=2.hyperstack=true.mode=color.unit=micron.finterval=1.spacing=1.5.loop=false.min=0.0.max=4095.0.
@@ -233,41 +267,61 @@ def addMetaData( path, job, result ):
     # Information about the software used
     ifd[TiffImagePlugin.SOFTWARE] = "CATMAID {}".format(settings.VERSION)
 
-    image = PILImage.open(path)
-    # Can't use libtiff for saving non core libtiff exif tags, therefore
-    # compression="raw" is used. Also, we don't want to re-encode.
-    tmp_path = path + ".tmp"
-    image.save(tmp_path, "tiff", compression="raw", tiffinfo=ifd, save_all=True)
-    os.remove(path)
-    os.rename(tmp_path, path)
+    return ifd
+
+def write_tiff_stack( path, images, tiffinfo ):
+    """ Write each image of the passed in iterable as a page of a multi-page
+    TIFF file, as soon as it is available. Pages aren't compressed, because
+    Pillow can only write non core libtiff tags this way. Returns the number of
+    written pages.
+    """
+    n_pages = 0
+    with TiffImagePlugin.AppendingTiffWriter(path, True) as tf:
+        for data in images:
+            PILImage.fromarray(data).save(tf, "tiff", compression="raw",
+                    tiffinfo=tiffinfo)
+            tf.newFrame()
+            n_pages += 1
+    return n_pages
+
+def check_output_size( estimated_size ):
+    """ Raise a ValueError if the passed in size exceeds the maximum allowed
+    file size.
+    """
+    if estimated_size > settings.GENERATED_FILES_MAXIMUM_SIZE:
+        raise ValueError("The estimated size of the requested image "
+                         "region is larger than the maximum allowed "
+                         "file size: %0.2f > %s Bytes" % \
+                         (estimated_size,
+                          settings.GENERATED_FILES_MAXIMUM_SIZE))
+
+def count_substack_images( job ):
+    """ Return the number of images extract_substack() creates for the passed
+    in job.
+    """
+    return len(get_crop_units(job))
 
-def extract_substack(job ):
+def extract_substack( job ):
     """ Extracts a sub-stack as specified in the passed job while respecting
-    rotation requests. A list of pgmagick images is returned -- one for each
-    slice, starting on top.
+    rotation requests. An iterator over NumPy arrays is returned -- one for
+    each slice and channel, starting on top. Each image is only created once
+    it is requested, which allows to write it before the next one is fetched.
+    A ValueError is raised as soon as the first image shows that the result
+    would exceed the maximum allowed file size.
     """
     # Treat rotation requests special
     if abs(job.rotation_cw) < 0.00001:
         # No rotation, create the sub-stack
         cropped_stack = extract_substack_no_rotation( job )
-    elif abs(job.rotation_cw - 90.0) < 0.00001:
-        # 90 degree rotation, create the sub-stack and do a simple rotation
-        cropped_stack = extract_substack_no_rotation( job )
-        for img in cropped_stack:
-            img.rotate(270.0)
-    elif abs(job.rotation_cw - 180.0) < 0.00001:
-        # 180 degree rotation, create the sub-stack and do a simple rotation
-        cropped_stack = extract_substack_no_rotation( job )
-        for img in cropped_stack:
-            img.rotate(180.0)
-    elif abs(job.rotation_cw - 270.0) < 0.00001:
-        # 270 degree rotation, create the sub-stack and do a simple rotation
-        cropped_stack = extract_substack_no_rotation( job )
-        for img in cropped_stack:
-            img.rotate(90.0)
+    elif abs(job.rotation_cw - 90.0) < 0.00001 or \
+            abs(job.rotation_cw - 180.0) < 0.00001 or \
+            abs(job.rotation_cw - 270.0) < 0.00001:
+        # Multiples of 90 degree, create the sub-stack and do a simple
+        # counter-clockwise rotation of the image data.
+        n_rotations = int(round(job.rotation_cw / 90.0))
+        cropped_stack = (np.rot90(img, n_rotations) for img in
+                extract_substack_no_rotation( job ))
     else:
-        # Some methods do counter-clockwise rotation
-        rotation_ccw = 360.0 - job.rotation_cw
         # There is rotation requested. First, backup the cropping
         # coordinates and manipulate the job to create a cropped
         # stack of the bounding box of the rotated box.
@@ -275,6 +329,8 @@ def extract_substack(job ):
         real_x_max = job.x_max
         real_y_min = job.y_min
         real_y_max = job.y_max
+        # Some methods do counter-clockwise rotation
+        rotation_ccw = 360.0 - job.rotation_cw
         # Rotate bounding box counter-clockwise around center.
         center = [0.5 * (job.x_max + job.x_min),
             0.5 * (job.y_max + job.y_min)]
@@ -287,68 +343,53 @@ def extract_substack(job ):
         rot_p4 = rotate2d(rotation_ccw,
             [real_x_max, real_y_min], center)
         # Find new (larger) bounding box of rotated ROI and write
-        # them into the job
+        # them into the job. The tiles to fetch are determined right away,
+        # so that the original job parameters can be restored.
         job.x_min = min([rot_p1[0], rot_p2[0], rot_p3[0], rot_p4[0]])
         job.y_min = min([rot_p1[1], rot_p2[1], rot_p3[1], rot_p4[1]])
         job.x_max = max([rot_p1[0], rot_p2[0], rot_p3[0], rot_p4[0]])
         job.y_max = max([rot_p1[1], rot_p2[1], rot_p3[1], rot_p4[1]])
-        # Create the enlarged sub-stack
-        cropped_stack = extract_substack_no_rotation( job )
-
-        # Next, rotate the whole result stack counterclockwise to have the
-        # actual ROI axis aligned.
-        for img in cropped_stack:
-            img.rotate(rotation_ccw)
-
-        # Last, do a second crop to remove the not needed parts. The region
-        # to crop is defined by the relative original crop-box coordinates to
-        # to the rotated bounding box.
-        rot_bb_p1 = rotate2d(rotation_ccw,
-            [job.x_min, job.y_min], center)
-        rot_bb_p2 = rotate2d(rotation_ccw,
-            [job.x_min, job.y_max], center)
-        rot_bb_p3 = rotate2d(rotation_ccw,
-            [job.x_max, job.y_max], center)
-        rot_bb_p4 = rotate2d(rotation_ccw,
-            [job.x_max, job.y_min], center)
-        # Get bounding box minimum coordinates in world space
-        bb_x_min = min([rot_bb_p1[0], rot_bb_p2[0], rot_bb_p3[0], rot_bb_p4[0]])
-        bb_y_min = min([rot_bb_p1[1], rot_bb_p2[1], rot_bb_p3[1], rot_bb_p4[1]])
-        # Create relative final crop coordinates
-        crop_p1 = [abs(real_x_min - bb_x_min), abs(real_y_min - bb_y_min)]
-        crop_p2 = [abs(real_x_min - bb_x_min), abs(real_y_max - bb_y_min)]
-        crop_p3 = [abs(real_x_max - bb_x_min), abs(real_y_min - bb_y_min)]
-        crop_p4 = [abs(real_x_max - bb_x_min), abs(real_y_max - bb_y_min)]
-        crop_x_min = min([crop_p1[0], crop_p2[0], crop_p3[0], crop_p4[0]])
-        crop_y_min = min([crop_p1[1], crop_p2[1], crop_p3[1], crop_p4[1]])
-        crop_x_max = max([crop_p1[0], crop_p2[0], crop_p3[0], crop_p4[0]])
-        crop_y_max = max([crop_p1[1], crop_p2[1], crop_p3[1], crop_p4[1]])
-        crop_x_min_px = to_x_index(crop_x_min, job.ref_stack, job.zoom_level, False)
-        crop_y_min_px = to_y_index(crop_y_min, job.ref_stack, job.zoom_level, False)
-        crop_x_max_px = to_x_index(crop_x_max, job.ref_stack, job.zoom_level, False)
-        crop_y_max_px = to_y_index(crop_y_max, job.ref_stack, job.zoom_level, False)
-        crop_width_px = crop_x_max_px - crop_x_min_px
-        crop_height_px = crop_y_max_px - crop_y_min_px
-        # Crop all images (Geometry: width, height, xOffset, yOffset)
-        crop_geometry = Geometry(crop_width_px, crop_height_px,
-            crop_x_min_px, crop_y_min_px)
-        for img in cropped_stack:
-            img.crop(crop_geometry)
-
-        # Reset the original job parameters
-        job.x_min = real_x_min
-        job.x_max = real_x_max
-        job.y_min = real_y_min
-        job.y_max = real_y_max
-
-    return cropped_stack
-
-def extract_substack_no_rotation( job ):
-    """ Extracts a sub-stack as specified in the passed job without respecting
-    rotation requests. A list of pgmagick images is returned -- one for each
-    slice, starting on top.
+        try:
+            enlarged_stack = extract_substack_no_rotation( job )
+        finally:
+            # Reset the original job parameters
+            job.x_min = real_x_min
+            job.x_max = real_x_max
+            job.y_min = real_y_min
+            job.y_max = real_y_max
+
+        # Rotate each image of the enlarged stack counter-clockwise around its
+        # center, which is also the center of the requested region, and keep
+        # only the requested region.
+        width = to_x_index(real_x_max - real_x_min, job.ref_stack,
+                job.zoom_level, False)
+        height = to_y_index(real_y_max - real_y_min, job.ref_stack,
+                job.zoom_level, False)
+        cropped_stack = (rotate_image(img, job.rotation_cw, width, height)
+                for img in enlarged_stack)
+
+    return _limit_output_size(cropped_stack, count_substack_images(job))
+
+def _limit_output_size( images, n_images ):
+    """ Pass through all images, but check the expected output size based on
+    the first one.
     """
+    for n, img in enumerate(images):
+        if n == 0:
+            check_output_size(img.nbytes * n_images)
+        yield img
+
+class CropBoundingBox(object):
+    """ The pixel bounds of a cropping job in a single stack. The minimum
+    values are included and the maximum values are excluded.
+    """
+    pass
 
+def get_crop_units( job ):
+    """ Return a list of (stack mirror, bounding box, z index) tuples, one for
+    each image of the sub-stack of the passed in job. Stacks whose bounded
+    bounding box has no area, i.e. lies outside the stack, are skipped.
+    """
     # The actual bounding boxes used for creating the images of each stack
     # depend not only on the request, but also on the translation of the stack
     # wrt. the project. Therefore, a dictionary with bounding box information for
@@ -382,12 +423,9 @@ def extract_substack_no_rotation( job ):
         px_y_max_nobound = to_y_index(y_max_t, stack, job.zoom_level, False)
         width = px_x_max_nobound - px_x_min_nobound
         height = px_y_max_nobound - px_y_min_nobound
-        px_x_offset = abs(px_x_min_nobound) if px_x_min_nobound < 0 else 0
-        px_y_offset = abs(px_y_min_nobound) if px_y_min_nobound < 0 else 0
-        # Create a dictionary entry with a simple object
-        class BB:
-            pass
-        bb = BB()
+        px_x_offset = px_x_min - px_x_min_nobound
+        px_y_offset = px_y_min - px_y_min_nobound
+        bb = CropBoundingBox()
         bb.px_x_min = px_x_min
         bb.px_x_max = px_x_max
         bb.px_y_min = px_y_min
@@ -405,107 +443,136 @@ def extract_substack_no_rotation( job ):
     px_z_max = to_z_index(job.z_max, job.ref_stack, job.zoom_level)
     n_slices = px_z_max + 1 - px_z_min
 
-    # The images are generated per slice, so most of the following
-    # calculations refer to 2d images.
-
     # Each stack to export is treated as a separate channel. The order
     # of the exported dimensions is XYCZ. This means all the channels of
     # one slice are exported, then the next slice follows, etc.
-    cropped_stack = []
-    # Accumulator for estimated result size
-    estimated_total_size = 0
-    # Iterate over all slices
+    units = []
     for nz in range(n_slices):
         for mirror in job.stack_mirrors:
-            stack = mirror.stack
-            bb = s_to_bb[stack.id]
-            # Shortcut for tile width and height
-            tile_width = mirror.tile_width
-            tile_height = mirror.tile_height
-            # Get indices for bounding tiles (0 indexed)
-            tile_x_min = int(bb.px_x_min / tile_width)
-            tile_x_max = int(bb.px_x_max / tile_width)
-            tile_y_min = int(bb.px_y_min / tile_height)
-            tile_y_max = int(bb.px_y_max / tile_height)
-            # Get the number of needed tiles for each direction
-            num_x_tiles = tile_x_max - tile_x_min + 1
-            num_y_tiles = tile_y_max - tile_y_min + 1
-            # Associate image parts with all tiles
-            image_parts = []
-            x_dst = bb.px_x_offset
-            for nx, x in enumerate( range(tile_x_min, tile_x_max + 1) ):
-                # The min x,y for the image part in the current tile are 0
-                # for all tiles except the first one.
-                cur_px_x_min = 0 if nx > 0 else bb.px_x_min - x * tile_width
-                # The max x,y for the image part of current tile are the tile
-                # size minus one except for the last one.
-                if nx < (num_x_tiles - 1):
-                    cur_px_x_max = tile_width - 1
-                else:
-                    cur_px_x_max = bb.px_x_max - x * tile_width
-                # Reset y destination component
-                y_dst = bb.px_y_offset
-                for ny, y in enumerate( range(tile_y_min, tile_y_max + 1) ):
-                    cur_px_y_min = 0 if ny > 0 else bb.px_y_min - y * tile_height
-                    if ny < (num_y_tiles - 1):
-                        cur_px_y_max = tile_height - 1
-                    else:
-                        cur_px_y_max = bb.px_y_max - y * tile_height
-                    # Create an image part definition
-                    z = bb.px_z_min + nz
-                    path = job.get_tile_path(stack, mirror, (x, y, z))
-                    try:
-                        part = ImagePart(path, cur_px_x_min, cur_px_x_max,
-                                cur_px_y_min, cur_px_y_max, x_dst, y_dst)
-                        image_parts.append( part )
-                    except:
-                        # ignore failed slices
-                        pass
-                    # Update y component of destination position
-                    y_dst += cur_px_y_max - cur_px_y_min
-                # Update x component of destination position
-                x_dst += cur_px_x_max - cur_px_x_min
-
-            # Write out the image parts and make sure the maximum allowed file
-            # size isn't exceeded.
-            cropped_slice = None
-            for ip in image_parts:
-                # Get (correctly cropped) image
-                image = ip.get_image()
-
-                # Estimate total file size and abort if this exceeds the
-                # maximum allowed file size.
-                estimated_total_size = estimated_total_size + ip.estimated_size
-                if estimated_total_size > settings.GENERATED_FILES_MAXIMUM_SIZE:
-                    raise ValueError("The estimated size of the requested image "
-                                     "region is larger than the maximum allowed "
-                                     "file size: %0.2f > %s Bytes" % \
-                                     (estimated_total_size,
-                                      settings.GENERATED_FILES_MAXIMUM_SIZE))
-
-                # It is unfortunately not possible to create proper composite
-                # images based on a canvas image newly created like this:
-                # cropped_slice = Image( Geometry(bb.width, bb.height), Color("black"))
-                # Therefore, this workaround is used.
-                if not cropped_slice:
-                    cropped_slice = Image(image)
-                    cropped_slice.backgroundColor(ColorRGB(0,0,0))
-                    cropped_slice.erase()
-                    # The '!' makes sure the aspect ration is ignored
-                    cropped_slice.scale(Geometry(bb.width, bb.height))
-                # Draw the image onto result image
-                cropped_slice.composite( image, ip.x_dst, ip.y_dst, co.OverCompositeOp )
-                # Delete tile image - it's not needed anymore
-                del image
-
-            if cropped_slice:
-                # Optionally, use only a single channel
-                if job.single_channel:
-                    cropped_slice.channel( ChannelType.RedChannel )
-                # Add the image to the cropped stack
-                cropped_stack.append( cropped_slice )
-
-    return cropped_stack
+            bb = s_to_bb[mirror.stack.id]
+            if bb.px_x_max <= bb.px_x_min or bb.px_y_max <= bb.px_y_min:
+                continue
+            units.append((mirror, bb, bb.px_z_min + nz))
+    return units
+
+def get_image_parts( job, mirror, bb, z ):
+    """ Return the image parts of all tiles of the passed in stack mirror that
+    intersect with the passed in bounding box in section <z>.
+    """
+    stack = mirror.stack
+    # Shortcut for tile width and height
+    tile_width = mirror.tile_width
+    tile_height = mirror.tile_height
+    # Get indices for bounding tiles (0 indexed)
+    tile_x_min = int(bb.px_x_min / tile_width)
+    tile_x_max = int((bb.px_x_max - 1) / tile_width)
+    tile_y_min = int(bb.px_y_min / tile_height)
+    tile_y_max = int((bb.px_y_max - 1) / tile_height)
+    # Associate image parts with all tiles
+    image_parts = []
+    for x in range(tile_x_min, tile_x_max + 1):
+        # The image part of each tile is the intersection of the tile with the
+        # bounding box.
+        cur_px_x_min = max(bb.px_x_min - x * tile_width, 0)
+        cur_px_x_max = min(bb.px_x_max - x * tile_width, tile_width)
+        x_dst = bb.px_x_offset + x * tile_width + cur_px_x_min - bb.px_x_min
+        for y in range(tile_y_min, tile_y_max + 1):
+            cur_px_y_min = max(bb.px_y_min - y * tile_height, 0)
+            cur_px_y_max = min(bb.px_y_max - y * tile_height, tile_height)
+            y_dst = bb.px_y_offset + y * tile_height + cur_px_y_min - bb.px_y_min
+            path = job.get_tile_path(stack, mirror, (x, y, z))
+            image_parts.append(ImagePart(path, cur_px_x_min, cur_px_x_max,
+                    cur_px_y_min, cur_px_y_max, x_dst, y_dst))
+    return image_parts
+
+def assemble_image( job, bb, image_parts, tiles ):
+    """ Draw the passed in image parts onto a black image of the size of the
+    unbounded bounding box. The decoded tiles are expected in a dictionary,
+    indexed by path.
+    """
+    cropped_slice = None
+    for ip in image_parts:
+        data = ip.get_image(tiles[ip.path])
+        # Optionally, use only a single channel
+        if job.single_channel and data.ndim == 3:
+            data = data[:, :, 0]
+        if cropped_slice is None:
+            cropped_slice = np.zeros((bb.height, bb.width) + data.shape[2:],
+                    dtype=data.dtype)
+        elif data.ndim > cropped_slice.ndim:
+            data = data[:, :, 0]
+        elif data.ndim < cropped_slice.ndim:
+            data = data[:, :, np.newaxis]
+        # Tiles at the stack border can be smaller than the tile size
+        height = min(data.shape[0], bb.height - ip.y_dst)
+        width = min(data.shape[1], bb.width - ip.x_dst)
+        cropped_slice[ip.y_dst:ip.y_dst + height,
+                      ip.x_dst:ip.x_dst + width] = data[:height, :width]
+    return cropped_slice
+
+def extract_substack_no_rotation( job ):
+    """ Extracts a sub-stack as specified in the passed job without respecting
+    rotation requests. An iterator over NumPy arrays is returned -- one for
+    each slice and channel, starting on top. The tiles needed for the images
+    are determined right away. Tiles are fetched by a bounded pool of threads
+    for a few images at a time, to keep memory use bounded.
+    """
+    units = get_crop_units(job)
+    return _iter_substack(job, units)
+
+def _iter_substack( job, units ):
+    if not units:
+        return
+    pool = ThreadPool(fetch_workers)
+    try:
+        for start in range(0, len(units), fetch_workers):
+            window = units[start:start + fetch_workers]
+            window_parts = [get_image_parts(job, mirror, bb, z)
+                    for mirror, bb, z in window]
+            paths = list(set(ip.path for parts in window_parts for ip in parts))
+            tiles = dict(zip(paths, pool.map(load_tile, paths)))
+            for (mirror, bb, z), image_parts in zip(window, window_parts):
+                yield assemble_image(job, bb, image_parts, tiles)
+            del tiles
+    finally:
+        pool.terminate()
+        pool.join()
+
+def rotate_image( data, degrees, width, height ):
+    """ Rotate the passed in image data counter-clockwise by the passed in
+    angle around its center and return the centered region of <width> x
+    <height> pixels. Pixel values are interpolated bilinearly, areas outside
+    of the input image are black.
+    """
+    angle = radians(degrees)
+    c, s = cos(angle), sin(angle)
+    src_height, src_width = data.shape[:2]
+    # Map each output pixel to its source location
+    out_x, out_y = np.meshgrid(np.arange(width) - (width - 1) / 2.0,
+                               np.arange(height) - (height - 1) / 2.0)
+    src_x = c * out_x - s * out_y + (src_width - 1) / 2.0
+    src_y = s * out_x + c * out_y + (src_height - 1) / 2.0
+    x0 = np.floor(src_x).astype(np.int64)
+    y0 = np.floor(src_y).astype(np.int64)
+    fx = src_x - x0
+    fy = src_y - y0
+
+    result = np.zeros((height, width) + data.shape[2:], dtype=np.float64)
+    for dx, dy in ((0, 0), (1, 0), (0, 1), (1, 1)):
+        xi = x0 + dx
+        yi = y0 + dy
+        weight = (fx if dx else 1.0 - fx) * (fy if dy else 1.0 - fy)
+        inside = (xi >= 0) & (xi < src_width) & (yi >= 0) & (yi < src_height)
+        weight[~inside] = 0.0
+        values = data[np.clip(yi, 0, src_height - 1), np.clip(xi, 0, src_width - 1)]
+        if data.ndim == 3:
+            weight = weight[:, :, np.newaxis]
+        result += weight * values
+
+    if np.issubdtype(data.dtype, np.integer):
+        info = np.iinfo(data.dtype)
+        result = np.clip(np.rint(result), info.min, info.max)
+    return result.astype(data.dtype)
 
 def rotate2d(degrees, point, origin):
     """ A rotation function that rotates a point counter-clockwise around
@@ -525,24 +592,16 @@ def rotate2d(degrees, point, origin):
 def process_crop_job(job, create_message=True):
     """ This method does the actual cropping. It controls the data extraction
     and the creation of the sub-stack. It can be executed as Celery task.
+    Each image is written to the output file as soon as it is available.
     """
+    no_error_occured = True
+    error_message = ""
     try:
-        # Create the sub-stack
-        cropped_stack = extract_substack(job)
-
-        # Create tho output image
-        outputImage = ImageList()
-        for img in cropped_stack:
-            outputImage.append( img )
-
-        # Save the resulting micro_stack to a temporary location
-        no_error_occured = True
-        error_message = ""
+        n_images = count_substack_images(job)
         # Only produce an image if parts of stacks are within the output
-        if len( cropped_stack ) > 0:
-            outputImage.writeImages( job.output_path.encode('ascii', 'ignore') )
-            # Add some meta data to the image
-            addMetaData( job.output_path, job, cropped_stack )
+        if n_images > 0:
+            tiffinfo = create_tiff_info(job, n_images)
+            write_tiff_stack(job.output_path, extract_substack(job), tiffinfo)
         else:
             no_error_occured = False
             error_message = "A region outside the stack has been selected. " \
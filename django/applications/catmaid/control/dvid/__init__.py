@@ -1,21 +1,12 @@
 # -*- coding: utf-8 -*-
 from __future__ import unicode_literals
 
-import json
-
-try:
-    # Python 2
-    from urllib2 import build_opener, Request, HTTPError, URLError
-except ImportError:
-    # Python 3
-    from urllib.request import Request, build_opener
-    from urllib.error import HTTPError, URLError
-
 from django.http import JsonResponse
 
 from collections import defaultdict
 
 from catmaid.models import Stack
+from catmaid.control.remote_metadata import get_metadata_client
 
 # These DVID instance types are supported by CATMAID
 SUPPORTED_INSTANCE_TYPES = ('imagetile', 'imageblk')
@@ -148,16 +139,13 @@ class DVIDClient:
 
 
 def get_server_info(url):
-    """Return the parsed JSON result of a DVID server's info endpoint.
+    """Return the parsed JSON result of a DVID server's info endpoint. Results
+    are cached by the metadata client of this process and must not be
+    modified.
     """
     try:
-        info_url = '%s/api/repos/info' % url
-        req = Request(info_url, headers={'Content-Type': 'application/json'})
-        opener = build_opener()
-        info_json = opener.open(req).read()
-    except HTTPError as e:
+        info_url = '%s/api/repos/info' % url.rstrip('/')
+        return get_metadata_client().get_json(info_url,
+                headers={'Content-Type': 'application/json'})
+    except ValueError as e:
         raise ValueError("Couldn't retrieve DVID project information from %s" % url)
-    except URLError as e:
-        raise ValueError("Couldn't retrieve DVID project information from %s" % url)
-
-    return json.loads(info_json)
@@ -166,3 +166,39 @@ def rebuild_edge_tables(project_ids=None, log=None):
             log('Created edge information for all projects: '
                     '%s treenode edges, %s connector edges, %s connectors' % \
                     (num_new_tn_edges, num_new_c_edges, num_new_c_geoms))
+
+
+def rebuild_synapse_edge_table(project_ids=None, log=None):
+    """Rebuild the skeleton to skeleton synapse edges for all passed in project
+    IDs. If no project IDs are passed in, synapse edges of all projects are
+    rebuilt.
+    """
+    if not log:
+        # Assign no-op function if no log function is passed in
+        log = lambda x: None
+
+    cursor = connection.cursor()
+
+    with transaction.atomic():
+        if project_ids:
+            project_ids = [int(project_id) for project_id in project_ids]
+            for project_id in project_ids:
+                if not Project.objects.filter(pk=project_id).exists():
+                    raise ValueError('Project "%s" does not exist' % project_id)
+            cursor.execute("SELECT refresh_skeleton_synapse_edge_table(%(project_ids)s::integer[])", {
+                'project_ids': project_ids,
+            })
+            cursor.execute('''
+                SELECT count(*) FROM catmaid_skeleton_synapse_edge
+                WHERE project_id = ANY(%(project_ids)s::integer[])
+            ''', {
+                'project_ids': project_ids,
+            })
+            log('Created synapse edge information for projects %s: %s skeleton '
+                    'pairs and confidences' % (', '.join(map(str, project_ids)),
+                    cursor.fetchone()[0]))
+        else:
+            cursor.execute("SELECT refresh_skeleton_synapse_edge_table()")
+            cursor.execute("SELECT count(*) FROM catmaid_skeleton_synapse_edge")
+            log('Created synapse edge information for all projects: %s '
+                    'skeleton pairs and confidences' % cursor.fetchone()[0])
@@ -37,28 +37,42 @@ def basic_graph(project_id, skeleton_ids, relations=None,
         raise ValueError("No skeleton IDs provided")
 
     cursor = connection.cursor()
+    edges = defaultdict(partial(defaultdict, make_new_synapse_count_array))
 
-    if not relations:
-        relations = get_relation_to_id_map(project_id, (source_link, target_link), cursor)
-    source_rel_id, target_rel_id = relations[source_link], relations[target_link]
+    if (source_link, target_link) == ('presynaptic_to', 'postsynaptic_to'):
+        # Synapse counts are precomputed for each pair of skeletons and
+        # confidence.
+        cursor.execute('''
+            SELECT pre_skeleton_id, post_skeleton_id, confidence, n_synapses
+            FROM catmaid_skeleton_synapse_edge
+            WHERE pre_skeleton_id = ANY(%(skeleton_ids)s::bigint[])
+              AND post_skeleton_id = ANY(%(skeleton_ids)s::bigint[])
+        ''', {
+            'skeleton_ids': list(skeleton_ids),
+        })
+        for pre, post, confidence, n_synapses in cursor.fetchall():
+            edges[pre][post][confidence - 1] += n_synapses
+    else:
+        if not relations:
+            relations = get_relation_to_id_map(project_id, (source_link, target_link), cursor)
+        source_rel_id, target_rel_id = relations[source_link], relations[target_link]
 
-    cursor.execute('''
-    SELECT t1.skeleton_id, t2.skeleton_id, LEAST(t1.confidence, t2.confidence)
-    FROM treenode_connector t1,
-         treenode_connector t2
-    WHERE t1.skeleton_id IN (%(skids)s)
-      AND t1.relation_id = %(source_rel)s
-      AND t1.connector_id = t2.connector_id
-      AND t2.skeleton_id IN (%(skids)s)
-      AND t2.relation_id = %(target_rel)s
-      AND t1.id <> t2.id
-    ''' % {'skids': ','.join(map(str, skeleton_ids)),
-           'source_rel': source_rel_id,
-           'target_rel': target_rel_id})
+        cursor.execute('''
+        SELECT t1.skeleton_id, t2.skeleton_id, LEAST(t1.confidence, t2.confidence)
+        FROM treenode_connector t1,
+             treenode_connector t2
+        WHERE t1.skeleton_id IN (%(skids)s)
+          AND t1.relation_id = %(source_rel)s
+          AND t1.connector_id = t2.connector_id
+          AND t2.skeleton_id IN (%(skids)s)
+          AND t2.relation_id = %(target_rel)s
+          AND t1.id <> t2.id
+        ''' % {'skids': ','.join(map(str, skeleton_ids)),
+               'source_rel': source_rel_id,
+               'target_rel': target_rel_id})
 
-    edges = defaultdict(partial(defaultdict, make_new_synapse_count_array))
-    for row in cursor.fetchall():
-        edges[row[0]][row[1]][row[2] - 1] += 1
+        for row in cursor.fetchall():
+            edges[row[0]][row[1]][row[2] - 1] += 1
 
     return {
         'edges': tuple((s, t, count)
@@ -1,19 +1,12 @@
 # -*- coding: utf-8 -*-
 from __future__ import unicode_literals
 
-import json
 import logging
 
-try:
-    # Python 2
-    from urllib2 import urlopen, Request, HTTPError, URLError
-except ImportError:
-    # Python 3
-    from urllib.request import Request, urlopen
-    from urllib.error import HTTPError, URLError
-
 from django.conf import settings
 
+from catmaid.control.remote_metadata import get_metadata_client
+
 logger = logging.getLogger(__name__)
 
 
@@ -22,11 +15,21 @@ def load_json(url):
     logger.debug("janelia_render.models.load_json: entry, url=%s" % url)
 
     try:
-        json_text = urlopen(url).read()
-    except (HTTPError, URLError) as e:
+        return get_metadata_client().get_json(url)
+    except ValueError as e:
         raise ValueError("Failed to retrieve render service web data from %s. Error: %s" % (url, e))
 
-    return json.loads(json_text)
+
+def load_json_many(urls):
+    """Like load_json(), but load all passed in URLs in parallel. The results
+    are returned in the order of the URLs.
+    """
+    logger.debug("janelia_render.models.load_json_many: entry, urls=%s" % urls)
+
+    try:
+        return get_metadata_client().get_many(urls)
+    except ValueError as e:
+        raise ValueError("Failed to retrieve render service web data. Error: %s" % e)
 
 
 class JaneliaRenderDimension:
@@ -53,9 +56,11 @@ class JaneliaRenderProject:
         self.id = '%s__%s' % (owner_name, project_name)
         self.title = project_name
 
+    def get_stacks_url(self):
+        return '%s/stacks' % self.project_url
+
     def get_stacks_json(self):
-        stacks_url = '%s/stacks' % self.project_url
-        return load_json(stacks_url)
+        return load_json(self.get_stacks_url())
 
 
 class JaneliaRenderStackMirror:
@@ -98,7 +103,10 @@ class JaneliaRenderStack:
 
         self.description = ''
 
-        stack_meta_json = load_json(self.stack_url)
+        # The z values are needed in any case, fetch them along with the stack
+        # metadata.
+        stack_meta_json, z_values_json = load_json_many([self.stack_url,
+                '%s/zValues' % self.stack_url])
         self.metadata = stack_meta_json
 
         bounds_json = None
@@ -120,8 +128,6 @@ class JaneliaRenderStack:
                                                          current_version['stackResolutionY'],
                                                          current_version['stackResolutionZ'])
 
-        url = '%s/zValues' % self.stack_url
-        z_values_json = load_json(url)
         z_values = [int(v) for v in z_values_json]
         z_values.sort()
 
@@ -175,10 +181,20 @@ class JaneliaRenderProjectStacks:
     def get_all_projects():
         owners_url = '%s/owners' % settings.JANELIA_RENDER_SERVICE_URL
 
+        owner_names = load_json(owners_url)
+        projects_urls = ['%s/owner/%s/projects' % (settings.JANELIA_RENDER_SERVICE_URL, owner_name)
+                         for owner_name in owner_names]
+
         projects = []
-        for owner_name in load_json(owners_url):
-            projects_url = '%s/owner/%s/projects' % (settings.JANELIA_RENDER_SERVICE_URL, owner_name)
-            for project_name in load_json(projects_url):
+        for owner_name, project_names in zip(owner_names, load_json_many(projects_urls)):
+            for project_name in project_names:
                 projects.append(JaneliaRenderProject(owner_name, project_name))
 
         return projects
+
+    @staticmethod
+    def get_all_stacks_json(projects):
+        """Return a list with the stacks JSON of each passed in project, in
+        the same order. All listings are loaded in parallel.
+        """
+        return load_json_many([p.get_stacks_url() for p in projects])
@@ -9,10 +9,12 @@ def projects(request):
     user and that have at least one stack linked to it.
     """
 
-    render_projects = JaneliaRenderProjectStacks().get_all_projects()
+    project_stacks = JaneliaRenderProjectStacks()
+    render_projects = project_stacks.get_all_projects()
+    render_stacks = project_stacks.get_all_stacks_json(render_projects)
 
     catmaid_projects = {}
-    for project in render_projects:
+    for project, stacks_json in zip(render_projects, render_stacks):
         p = {
             'id': project.id,
             'title': project.title,
@@ -22,7 +24,7 @@ def projects(request):
         }
         catmaid_projects[project.id] = p
 
-        for stack_json in project.get_stacks_json():
+        for stack_json in stacks_json:
             stack_name = stack_json['stackId']['stack']
             p['stacks'].append({
                 'id': stack_name,
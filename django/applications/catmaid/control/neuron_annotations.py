@@ -59,7 +59,6 @@ def get_annotated_entities(project, params, relations, classes,
     annotation_sets = set()
     not_annotation_sets = set()
     annotation_sets_to_expand = set()
-    not_annotation_sets = set()
 
     # Get name, annotator and time constraints, if available
     name = params.get('name', "").strip()
@@ -147,148 +146,131 @@ def get_annotated_entities(project, params, relations, classes,
         else:
             filters.append("ci.name {op} %(name)s".format(op=op))
 
-    # Map annotation sets to their expanded sub-annotations
-    sub_annotation_ids = get_sub_annotation_ids(project, annotation_sets_to_expand,
-            relations, classes)
-
-    # Collect all annotations and their sub-annotation IDs (if requested) in a
-    # set each. For the actual query each set is connected with AND while
-    # for everything within one set OR is used.
-    annotation_id_sets = []
-    for annotation_set in annotation_sets:
-        current_annotation_ids = set(annotation_set)
-        # Add sub annotations, if requested
-        sa_ids = sub_annotation_ids.get(annotation_set)
-        if sa_ids and len(sa_ids):
-            current_annotation_ids.update(sa_ids)
-        annotation_id_sets.append(current_annotation_ids)
-
-    not_annotation_id_sets = []
-    for not_annotation_set in not_annotation_sets:
-        current_not_annotation_ids = set(not_annotation_set)
-        # Add sub annotations, if requested
-        sa_ids = sub_annotation_ids.get(not_annotation_set)
-        if sa_ids and len(sa_ids):
-           current_not_annotation_ids.update(sa_ids)
-        not_annotation_id_sets.append(current_not_annotation_ids)
-
-    # Build needed joins for annotated_with search criteria
-    joins = []
-    for n, annotation_id_set in enumerate(annotation_id_sets):
-        joins.append("""
-            INNER JOIN class_instance_class_instance cici{n}
-                    ON ci.id = cici{n}.class_instance_a
-        """.format(n=n))
-
-        filters.append("""
-            cici{n}.relation_id = %(annotated_with)s AND
+    # Each annotation set is a separate constraint. For the actual query all
+    # sets are connected with AND while for everything within one set OR is
+    # used. Sub-annotations of expanded sets are looked up in the annotation
+    # closure table as part of the query.
+    def annotation_constraint(n, annotation_set):
+        params['cici{}_ann'.format(n)] = list(annotation_set)
+        if annotation_set in annotation_sets_to_expand:
+            return """
+                (cici{n}.class_instance_b = ANY (%(cici{n}_ann)s) OR
+                 cici{n}.class_instance_b IN (
+                    SELECT ac.descendant_id
+                    FROM catmaid_annotation_closure ac
+                    WHERE ac.ancestor_id = ANY (%(cici{n}_ann)s)))
+            """.format(n=n)
+        return """
             cici{n}.class_instance_b = ANY (%(cici{n}_ann)s)
-        """.format(n=n))
+        """.format(n=n)
 
-        params['cici{}_ann'.format(n)] = list(annotation_id_set)
+    # Entities need to be linked to at least one annotation of each
+    # annotation set.
+    for n, annotation_set in enumerate(annotation_sets):
+        constraints = [
+            "cici{n}.class_instance_a = ci.id".format(n=n),
+            "cici{n}.relation_id = %(annotated_with)s".format(n=n),
+            annotation_constraint(n, annotation_set),
+        ]
 
         # Add annotator and time constraints, if available
         if annotator_ids:
-            filters.append("""
+            constraints.append("""
                 cici{n}.user_id = ANY (%(annotator_ids)s)
             """.format(n=n))
         if start_date:
-            filters.append("""
+            constraints.append("""
                 cici{n}.creation_time >= %(start_date)s
             """.format(n=n))
         if end_date:
-            filters.append("""
+            constraints.append("""
                 cici{n}.creation_time <= %(end_date)s
              """.format(n=n))
 
-    # To exclude class instsances that are linked to particular annotation, all
-    # annotations are collected and if in this list of annotations contains an
-    # exclusion annotation, it is removed.
-    if not_annotation_sets:
-        joins.append("""
-            LEFT JOIN LATERAL (
-                SELECT cici_a.class_instance_a AS id,
-                        array_agg(cici_a.class_instance_b) AS annotations
-                FROM class_instance_class_instance cici_a
-                WHERE cici_a.class_instance_a = ci.id
-                  AND cici_a.relation_id = %(annotated_with)s
-                GROUP BY 1
-            ) ann_link ON ci.id = ann_link.id
-        """)
-        for n, annotation_id_set in enumerate(not_annotation_sets):
-            filters.append("""
-                NOT (ann_link.annotations && %(cici_ex{n}_ann)s)
-            """.format(n=n))
-            params['cici_ex{n}_ann'.format(n=n)] = list(annotation_id_set)
-
-    # The bassic query
+        filters.append("""
+            EXISTS (
+                SELECT 1 FROM class_instance_class_instance cici{n}
+                WHERE {constraints}
+            )
+        """.format(n=n, constraints=' AND '.join(constraints)))
+
+    # To exclude class instances that are linked to particular annotations,
+    # entities must not be linked to any annotation of an exclusion set.
+    for n, not_annotation_set in enumerate(not_annotation_sets,
+            len(annotation_sets)):
+        filters.append("""
+            NOT EXISTS (
+                SELECT 1 FROM class_instance_class_instance cici{n}
+                WHERE cici{n}.class_instance_a = ci.id
+                  AND cici{n}.relation_id = %(annotated_with)s
+                  AND {constraint}
+            )
+        """.format(n=n, constraint=annotation_constraint(n, not_annotation_set)))
+
+    # The bassic query. Skeleton IDs are only looked up for the entities of
+    # the requested range.
     query = """
-        SELECT {fields}
-        FROM class_instance ci
-        {joins}
-        WHERE {where}
+        SELECT page.id, page.user_id, page.creation_time, page.edition_time,
+            page.project_id, page.class_id, page.name, skel_link.skeletons
+            {outer_total_field}
+        FROM (
+            SELECT ci.id, ci.user_id, ci.creation_time, ci.edition_time,
+                ci.project_id, ci.class_id, ci.name {total_field}
+            FROM class_instance ci
+            WHERE {where}
+            {inner_sort}
+            {offset}
+        ) page
+        LEFT JOIN LATERAL (
+            SELECT array_agg(cici_n.class_instance_a) AS skeletons
+            FROM class_instance_class_instance cici_n
+            WHERE cici_n.class_instance_b = page.id
+              AND cici_n.relation_id = %(model_of)s
+        ) skel_link ON TRUE
         {sort}
-        {offset}
     """
 
     cursor = connection.cursor()
 
-    # If there are range limits and given that it is likely that there are many
-    # entities returned, it is more efficient to get the total result number
-    # with two queries: 1. Get total number of neurons 2. Get limited set. The
-    # (too expensive) alternative would be to get all neurons for counting and
-    # limiting on the Python side.
-    num_total_records = None
+    # If there are range limits, the total number of results is computed by
+    # the same query as a window function over all results, so that
+    # constraints are only evaluated once.
+    paged = range_start is not None and range_length is not None
+    total_field, outer_total_field = "", ""
     offset = ""
-    if range_start is not None and range_length is not None:
-        # Get total number of results with separate query. No sorting or offset
-        # is needed for this.
-        query_fmt_params = {
-            'fields': 'COUNT(*)',
-            'joins': '\n'.join(joins),
-            'where': ' AND '.join(filters),
-            'sort': '',
-            'offset': ''
-        }
-        cursor.execute(query.format(**query_fmt_params), params)
-        num_total_records = cursor.fetchone()[0]
-
+    if paged:
+        total_field = ", COUNT(*) OVER () AS total"
+        outer_total_field = ", page.total"
         offset = "OFFSET %(range_start)s LIMIT %(range_length)s"
         params['range_start'] = int(range_start)
         params['range_length'] = int(range_length)
 
-    # Add skeleton ID info (if available)
-    joins.append("""
-        LEFT JOIN LATERAL (
-            SELECT cici_n.class_instance_b AS id,
-                    array_agg(cici_n.class_instance_a) AS skeletons
-            FROM class_instance_class_instance cici_n
-            WHERE cici_n.class_instance_b = ci.id
-              AND cici_n.relation_id = %(model_of)s
-            GROUP BY 1
-        ) skel_link ON ci.id = skel_link.id
-    """)
+    # Sort if requested. Ties are broken by ID to make paging stable.
+    sort_cols = []
+    if sort_dir and sort_by:
+        sort_cols = [sort_by] if sort_by == 'id' else [sort_by, 'id']
+
+    def order_by(alias):
+        if not sort_cols:
+            return ""
+        return "ORDER BY " + ", ".join("{}.{} {}".format(alias, col,
+                sort_dir.upper()) for col in sort_cols)
 
     query_fmt_params = {
-        "joins": "\n".join(joins),
         "where": " AND ".join(filters),
-        "sort": "",
+        "total_field": total_field,
+        "outer_total_field": outer_total_field,
+        "inner_sort": order_by('ci'),
+        "sort": order_by('page'),
         "offset": offset,
-        "fields": "ci.id, ci.user_id, ci.creation_time, " \
-            "ci.edition_time, ci.project_id, ci.class_id, ci.name, " \
-            "skel_link.skeletons"
     }
 
-    # Sort if requested
-    if sort_dir and sort_by:
-        query_fmt_params['sort'] = "ORDER BY {sort_col} {sort_dir}".format(
-                sort_col=sort_by, sort_dir=sort_dir.upper())
-
     # Execute quert and build result data structure
     cursor.execute(query.format(**query_fmt_params), params)
+    rows = cursor.fetchall()
 
     entities = []
-    for e in cursor.fetchall():
+    for e in rows:
         class_name = allowed_class_idx[e[5]]
         entity_info = {
             'id': e[0],
@@ -302,8 +284,19 @@ def get_annotated_entities(project, params, relations, classes,
 
         entities.append(entity_info)
 
-    if num_total_records is None:
+    if not paged:
         num_total_records = len(entities)
+    elif rows:
+        num_total_records = rows[0][8]
+    elif params['range_start'] > 0:
+        # A page after the last result has no rows to read the total number of
+        # results from.
+        cursor.execute("""
+            SELECT COUNT(*) FROM class_instance ci WHERE {where}
+        """.format(where=' AND '.join(filters)), params)
+        num_total_records = cursor.fetchone()[0]
+    else:
+        num_total_records = 0
 
     if with_annotations:
         entity_ids = [e['id'] for e in entities]
@@ -336,46 +329,32 @@ def get_sub_annotation_ids(project_id, annotation_sets, relations, classes):
     if not annotation_sets:
         return {}
 
-    aaa_tuples = ClassInstanceClassInstance.objects.filter(
-            project_id=project_id,
-            class_instance_a__class_column=classes['annotation'],
-            class_instance_b__class_column=classes['annotation'],
-            relation_id = relations['annotated_with']).values_list(
-                    'class_instance_b', 'class_instance_a')
-
-    # A set wrapper to keep a set in a dictionary
-    class set_wrapper:
-        def __init__(self):
-            self.data = set()
-
-    # Create a dictionary of all annotations annotating a set of annotations
-    aaa = {}
-    for aa in aaa_tuples:
-        sa_set = aaa.get(aa[0])
-        if sa_set is None:
-            sa_set = set_wrapper()
-            aaa[aa[0]] = sa_set
-        sa_set.data.add(aa[1])
-
-    # Collect all sub-annotations by following the annotation hierarchy for
-    # every annotation in the annotation set passed.
+    # The annotation closure table contains all transitive sub-annotations of
+    # each annotation.
+    annotation_ids = set()
+    for annotation_set in annotation_sets:
+        annotation_ids.update(annotation_set)
+
+    cursor = connection.cursor()
+    cursor.execute("""
+        SELECT ancestor_id, descendant_id
+        FROM catmaid_annotation_closure
+        WHERE ancestor_id = ANY (%(annotation_ids)s)
+          AND project_id = %(project_id)s
+    """, {
+        'annotation_ids': list(annotation_ids),
+        'project_id': getattr(project_id, 'id', project_id),
+    })
+
+    descendants = defaultdict(set)
+    for ancestor_id, descendant_id in cursor.fetchall():
+        descendants[ancestor_id].add(descendant_id)
+
     sa_ids = {}
     for annotation_set in annotation_sets:
-        # Start with an empty result set for each requested annotation set
         ls = set()
         for a in annotation_set:
-            working_set = set([a])
-            while working_set:
-                parent_id = working_set.pop()
-                # Try to get the sub-annotations for this parent
-                child_ids = aaa.get(parent_id) or set_wrapper()
-                for child_id in child_ids.data:
-                    if child_id not in sa_ids:
-                        if child_id not in ls:
-                            # Add all children as sub annotations
-                            ls.add(child_id)
-                            working_set.add(child_id)
-        # Store the result list for this ID
+            ls.update(descendants[a])
         sa_ids[annotation_set] = list(ls)
 
     return sa_ids
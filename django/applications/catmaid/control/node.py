@@ -3,16 +3,22 @@ from __future__ import unicode_literals
 
 import copy
 import json
+import math
 import msgpack
+import multiprocessing
+import os
+import random
+import threading
+import time
 import ujson
 import psycopg2.extras
 
-from collections import defaultdict
+from collections import defaultdict, OrderedDict
 from abc import ABCMeta
 
 from django.core.serializers.json import DjangoJSONEncoder
 from django.conf import settings
-from django.db import connection
+from django.db import connection, transaction
 from django.http import HttpResponse, JsonResponse
 from django.utils import timezone
 from django.shortcuts import get_object_or_404
@@ -26,9 +32,10 @@ from catmaid.control.authentication import requires_user_role, \
         can_edit_all_or_fail
 from catmaid.control.common import (get_relation_to_id_map, get_request_bool,
         get_request_list)
+from catmaid.util import LRUCache
 
-from PIL import Image, ImageDraw
-from aggdraw import Draw, Pen, Brush, Font
+import numpy as np
+from PIL import Image
 
 from six.moves import map as imap
 from six import add_metaclass, print_
@@ -40,6 +47,28 @@ ORIENTATIONS = {
     'zy': 2
 }
 
+# The cache table column in which each data type is stored
+CACHE_DATA_TYPE_COLUMNS = {
+    'json': 'json_data',
+    'json_text': 'json_text_data',
+    'msgpack': 'msgpack_data',
+    'columnar': 'columnar_data',
+}
+
+GRID_CACHE_DATA_TYPE_COLUMNS = {
+    'json': 'json_data',
+    'msgpack': 'msgpack_data',
+    'columnar': 'columnar_data',
+}
+
+# The cached data type that can be sent without any conversion for each target
+# format of a node query response.
+RAW_RESPONSE_DATA_TYPES = {
+    'json': 'json_text',
+    'msgpack': 'msgpack',
+    'columnar': 'columnar',
+}
+
 class BasicNodeProvider(object):
 
     def __init__(self, *args, **kwargs):
@@ -82,7 +111,8 @@ class BasicNodeProvider(object):
         return matches
 
     def get_tuples(self, params, project_id, explicit_treenode_ids,
-                explicit_connector_ids, include_labels, with_relation_map):
+                explicit_connector_ids, include_labels, with_relation_map,
+                target_format=None):
         return _node_list_tuples_query(params, project_id,
                 self, explicit_treenode_ids, explicit_connector_ids,
                 include_labels, with_relation_map), 'json'
@@ -105,126 +135,525 @@ def get_extra_nodes(params, project_id, explicit_treenode_ids,
         explicit_treenode_ids, explicit_connector_ids, include_labels,
         with_relation_map)
 
-class CachedJsonNodeNodeProvder(BasicNodeProvider):
-    """Retrieve cached msgpack data from the node_query_cache table.
+def inject_extra_nodes(data, data_type, extra_tuples):
+    """Add the passed in extra node tuples to cached node query data of the
+    passed in type. Encoded data is extended without decoding it. A tuple of
+    the new data and its type is returned.
     """
+    if data_type == 'json':
+        if len(data) == 5:
+            data.append([extra_tuples])
+        elif len(data) == 6:
+            data[5].append(extra_tuples)
+        else:
+            raise ValueError("Unexpected cached JSON tuple format")
+    elif data_type == 'json_text':
+        extra_tuples_json = json.dumps(extra_tuples)
+        if data[-2] == '}':
+            # If cached response doesn't contain any extra nodes, add a
+            # new field
+            data = data[0:-1] + ', [' + extra_tuples_json + ']]'
+        elif data[-2] == ']':
+            data = data[0:-2] + ', ' + extra_tuples_json + ']]'
+        else:
+            raise ValueError("Unexpected cached JSON text tuple format")
+    elif data_type == 'msgpack':
+        # To inject msgpack data, we expect a five element list, which
+        # means the first byte is '\x95'. For now an error is raised if,
+        # the first byte is something else.
+        if bytes(data[0:1]) != b'\x95':
+            raise ValueError("Unexpected cached Msgpack tuple format")
+
+        extra_msgpack = msgpack.packb([extra_tuples])
+
+        # Extend the five-element list with extra tuples by making it a
+        # six element list and just appending the extra list
+        data = b'\x96' + bytes(data[1:]) + extra_msgpack
+    elif data_type == 'columnar':
+        # Only the outer map is decoded, column data is kept as is.
+        columnar = msgpack.unpackb(bytes(data), raw=False)
+        columnar['extra'].append(_encode_columnar_result(extra_tuples))
+        data = msgpack.packb(columnar, use_bin_type=True)
+    else:
+        raise ValueError("Unknown data type: " + data_type)
+
+    return data, data_type
+
+
+class CachedNodeProvider(BasicNodeProvider):
+    """Retrieve cached data from the node_query_cache table. Subclasses define
+    the data type they provide. If the cache stores the data also in a format
+    that can be sent as is for the requested target format, this data is
+    returned instead, which avoids decoding and re-encoding it.
+    """
+
+    data_type = None
 
     def get_tuples(self, params, project_id, explicit_treenode_ids,
-            explicit_connector_ids, include_labels, with_relation_map):
+            explicit_connector_ids, include_labels, with_relation_map,
+            target_format=None):
+        data_types = get_preferred_cache_data_types(self.data_type,
+                target_format, CACHE_DATA_TYPE_COLUMNS)
         cursor = connection.cursor()
         # For JSONB type cache, use ujson to decode, this is roughly 2x faster
         psycopg2.extras.register_default_jsonb(loads=ujson.loads)
         cursor.execute("""
-            SELECT json_data FROM node_query_cache
+            SELECT {} FROM node_query_cache
             WHERE project_id = %s AND depth = %s
             LIMIT 1
-        """, (project_id, params['z1']))
-        rows = cursor.fetchone()
-
-        if rows and rows[0]:
-            tuples = rows[0]
-            # If there are exta nodes required, query them explicitely using a
-            # regular Postgis 2D query. Inject the result into cached data.
-            if explicit_treenode_ids or explicit_connector_ids:
-                extra_tuples, extra_type = get_extra_nodes(params, project_id,
-                    explicit_treenode_ids, explicit_connector_ids, include_labels,
-                    with_relation_map)
-                if extra_type != 'json':
-                    raise ValueError("Unexpected type")
-
-                if len(tuples) == 5:
-                    tuples.append([extra_tuples])
-                elif len(tuples) == 6:
-                    tuples[5].append(extra_tuples)
-                else:
-                    raise ValueError("Unexpected cached JSON tuple format")
-
-            return tuples, 'json'
+        """.format(', '.join(CACHE_DATA_TYPE_COLUMNS[t] for t in data_types)),
+            (project_id, params['z1']))
+        row = cursor.fetchone()
+        if not row:
+            return None, None
+
+        for data_type, data in zip(data_types, row):
+            if data:
+                break
         else:
             return None, None
 
+        # If there are exta nodes required, query them explicitely using a
+        # regular Postgis 2D query. Inject the result into cached data.
+        if explicit_treenode_ids or explicit_connector_ids:
+            extra_tuples, extra_type = get_extra_nodes(params, project_id,
+                explicit_treenode_ids, explicit_connector_ids, include_labels,
+                with_relation_map)
+            if extra_type != 'json':
+                raise ValueError("Unexpected type")
+            data, data_type = inject_extra_nodes(data, data_type, extra_tuples)
+
+        if data_type in ('msgpack', 'columnar'):
+            data = bytes(data)
 
-class CachedJsonTextNodeProvder(BasicNodeProvider):
-    """Retrieve cached msgpack data from the node_query_cache table.
+        return data, data_type
+
+
+class CachedJsonNodeNodeProvder(CachedNodeProvider):
+    """Retrieve cached JSON data from the node_query_cache table.
     """
 
-    def get_tuples(self, params, project_id, explicit_treenode_ids,
-                explicit_connector_ids, include_labels, with_relation_map):
-        cursor = connection.cursor()
-        cursor.execute("""
-            SELECT json_text_data FROM node_query_cache
-            WHERE project_id = %s AND depth = %s
-            LIMIT 1
-        """, (project_id, params['z1']))
-        rows = cursor.fetchone()
-
-        if rows and rows[0]:
-            tuples = rows[0]
-            # If there are exta nodes required, query them explicitely using a
-            # regular Postgis 2D query. Inject the result into cached data.
-            if explicit_treenode_ids or explicit_connector_ids:
-                extra_tuples, extra_type = get_extra_nodes(params, project_id,
-                    explicit_treenode_ids, explicit_connector_ids, include_labels,
-                    with_relation_map)
-                if extra_type != 'json':
-                    raise ValueError("Unexpected type")
-
-                extra_tuples_json = json.dumps(extra_tuples)
-                if tuples[-2] == '}':
-                    # If cached response doesn't contain any extra nodes, add a
-                    # new field
-                    tuples = tuples[0:-1] + ', [' + extra_tuples_json + ']]'
-                elif tuples[-2] == ']':
-                    tuples = tuples[0:-2] + ', ' + extra_tuples_json + ']]'
-                else:
-                    raise ValueError("Unexpected cached JSON text tuple format")
-
-            return tuples, 'json_text'
-        else:
-            return None, None
+    data_type = 'json'
 
 
-class CachedMsgpackNodeProvder(BasicNodeProvider):
+class CachedJsonTextNodeProvder(CachedNodeProvider):
+    """Retrieve cached JSON text data from the node_query_cache table.
+    """
+
+    data_type = 'json_text'
+
+
+class CachedMsgpackNodeProvder(CachedNodeProvider):
     """Retrieve cached msgpack data from the node_query_cache table.
     """
 
-    def get_tuples(self, params, project_id, explicit_treenode_ids,
-                explicit_connector_ids, include_labels, with_relation_map):
-        cursor = connection.cursor()
+    data_type = 'msgpack'
+
+
+class CachedColumnarNodeProvider(CachedNodeProvider):
+    """Retrieve cached columnar data from the node_query_cache table.
+    """
+
+    data_type = 'columnar'
+
+
+def get_preferred_cache_data_types(data_type, target_format, columns):
+    """Return a list of cached data types to load for a node provider of the
+    passed in data type, ordered by preference. If a data type that can be
+    sent without re-encoding is available in <columns> for the passed in target
+    format, it is tried first.
+    """
+    data_types = [data_type]
+    raw_data_type = RAW_RESPONSE_DATA_TYPES.get(target_format)
+    if raw_data_type and raw_data_type != data_type and raw_data_type in columns:
+        data_types.insert(0, raw_data_type)
+    return data_types
+
+
+class CachedGridNodeProvider(BasicNodeProvider):
+    """Retrieve cached data from a regular 3D grid of cells, stored in the
+    node_grid_cache_cell table. Only cells that intersect with the query
+    bounding box are loaded and their results are merged. Cells without any
+    data aren't stored, i.e. if a grid exists for a project and orientation,
+    missing cells are considered empty. Subclasses define the data column.
+    """
+
+    data_type = None
+
+    def __init__(self, connection=None, **kwargs):
+        super(CachedGridNodeProvider, self).__init__(**kwargs)
+        self.cell_width = kwargs.get('cell_width')
+        self.cell_height = kwargs.get('cell_height')
+        self.cell_depth = kwargs.get('cell_depth')
+
+    def get_grid(self, cursor, project_id, orientation):
+        """Find the grid for the passed in project and orientation, optionally
+        constrained by the configured cell dimensions. Returns a tuple of grid
+        ID, cell width, cell height and cell depth or None, if there is no such
+        grid.
+        """
+        constraints = []
+        params = {
+            'project_id': project_id,
+            'orientation': ORIENTATIONS.get(orientation, 0),
+        }
+        for dim in ('cell_width', 'cell_height', 'cell_depth'):
+            value = getattr(self, dim)
+            if value:
+                constraints.append('AND {} = %({})s'.format(dim, dim))
+                params[dim] = value
+
         cursor.execute("""
-            SELECT msgpack_data FROM node_query_cache
-            WHERE project_id = %s AND depth = %s
+            SELECT id, cell_width, cell_height, cell_depth
+            FROM node_grid_cache
+            WHERE project_id = %(project_id)s
+            AND orientation = %(orientation)s
+            {}
+            ORDER BY id
             LIMIT 1
-        """, (project_id, params['z1']))
-        rows = cursor.fetchone()
-
-        if rows and rows[0]:
-            tuples = rows[0]
-            # If there are exta nodes required, query them explicitely using a
-            # regular Postgis 2D query. Inject the result into cached data.
-            if explicit_treenode_ids or explicit_connector_ids:
-                extra_tuples, extra_type = get_extra_nodes(params, project_id,
-                    explicit_treenode_ids, explicit_connector_ids, include_labels,
-                    with_relation_map)
-                if extra_type != 'json':
-                    raise ValueError("Unexpected type")
-
-                # To inject msgpack data, we expect a five element list, which
-                # means the first byte is '\x95'. For now an error is raised if,
-                # the first byte is something else.
-                if tuples[0] != b'\x95':
-                    raise ValueError("Unexpected cached Msgpack tuple format")
-
-                extra_msgpack = msgpack.packb([extra_tuples])
-
-                # Extend the five-element list with extra tuples by making it a
-                # six element list and just appending the extra list
-                tuples = b'\x96' + tuples[1:] + extra_msgpack
-
-            return bytes(tuples), 'msgpack'
-        else:
+        """.format('\n'.join(constraints)), params)
+        return cursor.fetchone()
+
+    def get_tuples(self, params, project_id, explicit_treenode_ids,
+                explicit_connector_ids, include_labels, with_relation_map,
+                target_format=None):
+        cursor = connection.cursor()
+        grid = self.get_grid(cursor, project_id, params.get('orientation', 'xy'))
+        if not grid:
             return None, None
 
+        grid_id, cell_width, cell_height, cell_depth = grid
+        min_x, max_x = get_cell_index_range(params['left'], params['right'], cell_width)
+        min_y, max_y = get_cell_index_range(params['top'], params['bottom'], cell_height)
+        min_z, max_z = get_cell_index_range(params['z1'], params['z2'], cell_depth)
+
+        psycopg2.extras.register_default_jsonb(loads=ujson.loads)
+        cursor.execute("""
+            SELECT {}
+            FROM node_grid_cache_cell
+            WHERE grid_id = %(grid_id)s
+            AND x_index BETWEEN %(min_x)s AND %(max_x)s
+            AND y_index BETWEEN %(min_y)s AND %(max_y)s
+            AND z_index BETWEEN %(min_z)s AND %(max_z)s
+        """.format(GRID_CACHE_DATA_TYPE_COLUMNS[self.data_type]), {
+            'grid_id': grid_id,
+            'min_x': min_x,
+            'max_x': max_x,
+            'min_y': min_y,
+            'max_y': max_y,
+            'min_z': min_z,
+            'max_z': max_z,
+        })
+
+        # Cells cover more space than the query bounding box, which is why the
+        # merged result is constrained to the query bounding box before the
+        # node limit is applied to it.
+        tuples = merge_node_query_results(
+                decode_node_query_data(row[0], self.data_type)
+                for row in cursor.fetchall() if row[0])
+        tuples = filter_node_query_result(tuples, params)
+        limit_node_query_result(tuples, params.get('limit'))
+
+        # If there are exta nodes required, add them as extra nodes.
+        if explicit_treenode_ids or explicit_connector_ids:
+            extra_tuples, extra_type = get_extra_nodes(params, project_id,
+                explicit_treenode_ids, explicit_connector_ids, include_labels,
+                with_relation_map)
+            if extra_type != 'json':
+                raise ValueError("Unexpected type")
+            tuples.append([extra_tuples])
+
+        return tuples, 'json'
+
+
+class CachedGridJsonNodeProvider(CachedGridNodeProvider):
+    """Retrieve cached JSON data from the node_grid_cache_cell table.
+    """
+
+    data_type = 'json'
+
+
+class CachedGridMsgpackNodeProvider(CachedGridNodeProvider):
+    """Retrieve cached msgpack data from the node_grid_cache_cell table.
+    """
+
+    data_type = 'msgpack'
+
+
+class CachedGridColumnarNodeProvider(CachedGridNodeProvider):
+    """Retrieve cached columnar data from the node_grid_cache_cell table.
+    """
+
+    data_type = 'columnar'
+
+
+# Columns of the columnar node data format for treenodes, connectors and
+# connector links, each with its name and type. Columns of type "id" use the
+# smallest type that can represent all IDs of a table, which is either "int32"
+# or "float64". Missing parent IDs are represented as -1.
+COLUMNAR_TREENODE_COLUMNS = (('id', 'id'), ('parent_id', 'id'), ('x', 'float32'),
+        ('y', 'float32'), ('z', 'float32'), ('confidence', 'uint8'),
+        ('radius', 'float32'), ('skeleton_id', 'id'), ('edition_time', 'float64'),
+        ('user_id', 'int32'))
+COLUMNAR_CONNECTOR_COLUMNS = (('id', 'id'), ('x', 'float32'), ('y', 'float32'),
+        ('z', 'float32'), ('confidence', 'uint8'), ('edition_time', 'float64'),
+        ('user_id', 'int32'))
+COLUMNAR_LINK_COLUMNS = (('connector_index', 'uint32'), ('treenode_id', 'id'),
+        ('relation_id', 'int32'), ('confidence', 'uint8'),
+        ('edition_time', 'float64'), ('id', 'id'))
+
+COLUMNAR_FORMAT_VERSION = 1
+
+
+def _encode_columns(rows, columns):
+    """Encode the passed in rows as a map with the number of rows and a map
+    with a (type, little endian bytes) tuple for each column.
+    """
+    values = list(zip(*rows)) if rows else [()] * len(columns)
+    id_values = [v for (name, dtype), col in zip(columns, values)
+            if dtype == 'id' for v in col if v is not None]
+    id_type = 'int32'
+    if id_values and (max(id_values) >= 2**31 or min(id_values) < -2**31):
+        id_type = 'float64'
+
+    encoded = {}
+    for (name, dtype), col in zip(columns, values):
+        if dtype == 'id':
+            dtype = id_type
+            col = [-1 if v is None else v for v in col]
+        data = np.array(col, dtype=np.dtype(dtype).newbyteorder('<'))
+        encoded[name] = (dtype, data.tobytes())
+
+    return {
+        'n': len(rows),
+        'columns': encoded,
+    }
+
+
+def _decode_columns(table, columns):
+    """Decode a map created by _encode_columns() into a list of column value
+    lists in the order of the passed in column definitions.
+    """
+    decoded = []
+    for name, _ in columns:
+        dtype, data = table['columns'][name]
+        decoded.append(np.frombuffer(data, dtype=np.dtype(dtype).newbyteorder('<')).tolist())
+    return decoded
+
+
+def _encode_columnar_result(result):
+    """Encode a single node query result (without extra nodes) as columnar map.
+    """
+    treenodes, connectors = result[0], result[1]
+    links = []
+    for i, c in enumerate(connectors):
+        for link in c[7]:
+            links.append((i,) + tuple(link))
+
+    return {
+        'treenodes': _encode_columns([tn[0:10] for tn in treenodes],
+                COLUMNAR_TREENODE_COLUMNS),
+        'connectors': _encode_columns([c[0:7] for c in connectors],
+                COLUMNAR_CONNECTOR_COLUMNS),
+        'links': _encode_columns(links, COLUMNAR_LINK_COLUMNS),
+        'labels': result[2],
+        'limit_reached': result[3],
+        'relation_map': result[4],
+    }
+
+
+def encode_columnar_node_data(result):
+    """Encode a node query result as msgpack map, in which treenodes,
+    connectors and connector links are stored as typed column arrays. Labels
+    and relations are stored as regular maps. Extra nodes are stored as list
+    of additional columnar results.
+    """
+    data = _encode_columnar_result(result)
+    data['format'] = 'columnar'
+    data['version'] = COLUMNAR_FORMAT_VERSION
+    data['extra'] = [_encode_columnar_result(r) for r in result[5]] \
+            if len(result) > 5 else []
+    return msgpack.packb(data, use_bin_type=True)
+
+
+def _decode_columnar_result(data):
+    """Decode a single columnar map into a node query result list.
+    """
+    treenodes = list(zip(*_decode_columns(data['treenodes'],
+            COLUMNAR_TREENODE_COLUMNS)))
+    treenodes = [list(tn) for tn in treenodes]
+    for tn in treenodes:
+        if tn[1] == -1:
+            tn[1] = None
+
+    connectors = [list(c) + [[]] for c in zip(*_decode_columns(
+            data['connectors'], COLUMNAR_CONNECTOR_COLUMNS))]
+    for link in zip(*_decode_columns(data['links'], COLUMNAR_LINK_COLUMNS)):
+        connectors[link[0]][7].append(list(link[1:]))
+
+    return [treenodes, connectors, data['labels'], data['limit_reached'],
+            data['relation_map']]
+
+
+def decode_columnar_node_data(data):
+    """Decode columnar node data, created by encode_columnar_node_data(), into
+    a regular node query result list.
+    """
+    data = msgpack.unpackb(bytes(data), raw=False)
+    result = _decode_columnar_result(data)
+    if data.get('extra'):
+        result.append([_decode_columnar_result(e) for e in data['extra']])
+    return result
+
+
+def decode_node_query_data(data, data_type):
+    """Decode cached node query data of the passed in type into Python lists.
+    """
+    if data_type == 'json':
+        return data
+    elif data_type == 'json_text':
+        return ujson.loads(data)
+    elif data_type == 'msgpack':
+        return msgpack.unpackb(bytes(data), raw=False)
+    elif data_type == 'columnar':
+        return decode_columnar_node_data(data)
+    else:
+        raise ValueError("Unknown data type: " + data_type)
+
+
+def get_node_query_limit_reached(data, data_type):
+    """Return whether the node limit was reached for the passed in node query
+    data. Binary data is only decoded as far as needed to read the flag,
+    everything else is skipped.
+    """
+    if data_type == 'msgpack':
+        unpacker = msgpack.Unpacker(raw=False)
+        unpacker.feed(bytes(data))
+        unpacker.read_array_header()
+        for _ in range(3):
+            unpacker.skip()
+        return unpacker.unpack()
+    elif data_type == 'columnar':
+        unpacker = msgpack.Unpacker(raw=False)
+        unpacker.feed(bytes(data))
+        for _ in range(unpacker.read_map_header()):
+            if unpacker.unpack() == 'limit_reached':
+                return unpacker.unpack()
+            unpacker.skip()
+        return False
+    else:
+        return decode_node_query_data(data, data_type)[3]
+
+
+def get_cell_index_range(min_value, max_value, cell_size):
+    """Return the first and last index of all grid cells that intersect with
+    the half open interval [min_value, max_value).
+    """
+    first = int(math.floor(min_value / cell_size))
+    last = max(first, int(math.ceil(max_value / cell_size)) - 1)
+    return first, last
+
+
+def merge_node_query_results(results):
+    """Merge multiple node query results into a single one. Treenodes and
+    connectors that are part of multiple results are only included once, links
+    of connectors are merged. The node limit is considered reached, if it was
+    reached in one of the results.
+    """
+    treenodes = []
+    seen_treenodes = set()
+    connectors = []
+    connector_links = dict()
+    seen_links = set()
+    labels = defaultdict(list)
+    limit_reached = False
+    relation_map = {}
+
+    for result in results:
+        for tn in result[0]:
+            if tn[0] not in seen_treenodes:
+                seen_treenodes.add(tn[0])
+                treenodes.append(tn)
+        for c in result[1]:
+            links = connector_links.get(c[0])
+            if links is None:
+                links = connector_links[c[0]] = []
+                connectors.append(list(c[0:7]) + [links])
+            for link in c[7]:
+                if link[4] not in seen_links:
+                    seen_links.add(link[4])
+                    links.append(link)
+        for node_id, node_labels in result[2].items():
+            for label in node_labels:
+                if label not in labels[node_id]:
+                    labels[node_id].append(label)
+        limit_reached = limit_reached or result[3]
+        relation_map.update(result[4])
+
+    return [treenodes, connectors, labels, limit_reached, relation_map]
+
+
+
+def filter_node_query_result(result, params):
+    """Constrain a node query result to the bounding box in <params>, like the
+    edge based PostGIS node providers do: treenodes are kept if the bounding
+    box of their edge to their parent intersects with the query bounding box,
+    along with their parents. Connectors are kept if they are in the query
+    bounding box or if the bounding box of one of their links does, only such
+    links are kept. Treenodes of kept links are kept as well.
+    """
+    left, right = params['left'], params['right']
+    top, bottom = params['top'], params['bottom']
+    z1, z2 = params['z1'], params['z2']
+
+    def intersects(a, b):
+        return min(a[0], b[0]) <= right and max(a[0], b[0]) >= left and \
+            min(a[1], b[1]) <= bottom and max(a[1], b[1]) >= top and \
+            min(a[2], b[2]) < z2 and max(a[2], b[2]) >= z1
+
+    treenodes, connectors, labels = result[0], result[1], result[2]
+    locations = dict((tn[0], tn[2:5]) for tn in treenodes)
+    kept_treenode_ids = set()
+    for tn in treenodes:
+        # Parents that aren't part of the result aren't needed, because an
+        # edge to them wouldn't intersect with any cell.
+        location = tn[2:5]
+        parent_location = location if tn[1] is None else locations.get(tn[1])
+        if parent_location is not None and intersects(location, parent_location):
+            kept_treenode_ids.add(tn[0])
+            if tn[1] is not None:
+                kept_treenode_ids.add(tn[1])
+
+    kept_connectors = []
+    for c in connectors:
+        location = c[1:4]
+        links = [link for link in c[7] if link[0] in locations and
+                intersects(location, locations[link[0]])]
+        if links or intersects(location, location):
+            kept_connectors.append(list(c[0:7]) + [links])
+            kept_treenode_ids.update(link[0] for link in links)
+
+    kept_connector_ids = set(c[0] for c in kept_connectors)
+    kept_labels = defaultdict(list)
+    for node_id, node_labels in labels.items():
+        if node_id in kept_treenode_ids or node_id in kept_connector_ids:
+            kept_labels[node_id] = node_labels
+
+    return [[tn for tn in treenodes if tn[0] in kept_treenode_ids],
+            kept_connectors, kept_labels, result[3], result[4]]
+
+
+def limit_node_query_result(result, limit):
+    """Apply a node limit to the treenodes and connectors of a node query
+    result, like the LIMIT clause of the PostGIS node providers does. The node
+    limit is marked as reached if there are at least <limit> treenodes.
+    """
+    if not limit:
+        return
+    if len(result[0]) >= limit:
+        del result[0][limit:]
+        result[3] = True
+    del result[1][limit:]
 
 @add_metaclass(ABCMeta)
 class PostgisNodeProvider(BasicNodeProvider):
@@ -836,14 +1265,33 @@ AVAILABLE_NODE_PROVIDERS = {
     'cached_json': CachedJsonNodeNodeProvder,
     'cached_json_text': CachedJsonTextNodeProvder,
     'cached_msgpack': CachedMsgpackNodeProvder,
+    'cached_columnar': CachedColumnarNodeProvider,
+    'cached_grid_json': CachedGridJsonNodeProvider,
+    'cached_grid_msgpack': CachedGridMsgpackNodeProvider,
+    'cached_grid_columnar': CachedGridColumnarNodeProvider,
 }
 
 
+# Changes to tracing data that were recorded at most this long before a cached
+# section was updated are still considered to make this section outdated. This
+# accounts for edits that were committed while the section was computed.
+DIRTY_SECTION_GRACE_PERIOD = '1 minute'
+
+
 # The database cache identifier for each cache node provider
 CACHE_NODE_PROVIDER_DATA_TYPES = {
     'cached_json': 'json',
     'cached_json_text': 'json_text',
     'cached_msgpack': 'msgpack',
+    'cached_columnar': 'columnar',
+}
+
+
+# The database cache identifier for each grid cache node provider
+GRID_CACHE_NODE_PROVIDER_DATA_TYPES = {
+    'cached_grid_json': 'json',
+    'cached_grid_msgpack': 'msgpack',
+    'cached_grid_columnar': 'columnar',
 }
 
 
@@ -862,52 +1310,100 @@ def get_configured_node_providers(provider_entries, connection=None):
 
         Provider = AVAILABLE_NODE_PROVIDERS.get(key)
         if Provider:
-            node_providers.append(Provider(connection, **options))
+            node_provider = Provider(connection, **options)
+            # Identify the configuration entry of this provider, e.g. for
+            # latency statistics.
+            node_provider.config_key = '{}:{}'.format(len(node_providers), key)
+            node_providers.append(node_provider)
         else:
             raise ValueError('Unknown node provider: ' + key)
 
     return node_providers
 
 
-def update_node_query_cache(node_providers=None, log=print_):
+def update_node_query_cache(node_providers=None, incremental=False, n_jobs=1,
+        updated_before=None, log=print_):
+    """Update the node query cache for all caching node providers in the passed
+    in list or, if none are given, in the NODE_PROVIDERS setting. If
+    <incremental> is true, only sections that have been changed since their
+    last update will be recomputed, unless a node provider is configured to
+    clean its cache before an update. If <updated_before> is a datetime,
+    sections that have been updated at or after this point in time are
+    skipped, which is only supported for section caches. With <n_jobs> larger
+    than one, sections are computed in parallel by a pool of worker processes.
+    Grid cache node providers need to define the cell dimensions of their grid.
+
+    Node providers that use the same cache, i.e. the same sections or grid,
+    are updated together and the data types of all of them are stored side by
+    side. Additional data types can be requested with the "data_types" option
+    of a node provider, which allows to send cached data in other formats
+    without converting it first.
+    """
     if not node_providers:
         node_providers = settings.NODE_PROVIDERS
 
-    for np in node_providers:
-        log("Checking node provder {}".format(np))
-        if type(np) in (list, tuple):
-            key = np[0]
-            options = np[1]
+    # Collect the data types of all node providers that share a cache.
+    caches = OrderedDict()
+    for entry in node_providers:
+        log("Checking node provder {}".format(entry))
+        if type(entry) in (list, tuple):
+            key = entry[0]
+            options = entry[1]
         else:
-            key = np
+            key = entry
             options = {}
 
-        project_id = options.get('project_id')
+        grid_data_type = GRID_CACHE_NODE_PROVIDER_DATA_TYPES.get(key)
+        data_type = CACHE_NODE_PROVIDER_DATA_TYPES.get(key)
+        if grid_data_type:
+            cell_dims = tuple(options.get(d) for d in ('cell_width', 'cell_height', 'cell_depth'))
+            if not all(cell_dims):
+                raise ValueError("Need 'cell_width', 'cell_height' and " +
+                        "'cell_depth' parameters in grid node provider configuration")
+            if updated_before:
+                raise ValueError("Resuming an update is only supported for " +
+                        "section caches, not for grid node provider: {}".format(key))
+            cache_type, dims, data_type = 'grid', cell_dims, grid_data_type
+        elif data_type:
+            if not options.get('step'):
+                raise ValueError("Need 'step' parameter in node provider configuration")
+            cache_type, dims = 'section', options.get('step')
+        else:
+            log("Skipping non-caching node provider: {}".format(key))
+            continue
+
+        cache_key = (cache_type, dims, options.get('project_id'),
+                options.get('orientation', 'xy'), options.get('node_limit', None),
+                options.get('n_largest_skeletons_limit', None),
+                options.get('clean', False))
+        data_types = caches.setdefault(cache_key, [])
+        for dt in [data_type] + list(options.get('data_types', [])):
+            if dt not in data_types:
+                data_types.append(dt)
+
+    for cache_key, data_types in caches.items():
+        cache_type, dims, project_id, orientation, node_limit, \
+                n_largest_skeletons_limit, clean_cache = cache_key
         if project_id:
             project_ids = [project_id]
         else:
             project_ids = list(Project.objects.all().order_by('id').values_list('id', flat=True))
 
-        clean_cache = options.get('clean', False)
-
-        n_largest_skeletons_limit = options.get('n_largest_skeletons_limit', None)
-
-        data_type = CACHE_NODE_PROVIDER_DATA_TYPES.get(key)
-        if not data_type:
-            log("Skipping non-caching node provider: {}".format(key))
-            continue
-
         for project_id in project_ids:
-            log("Updating cache for project {}".format(project_id))
-            orientations = [options.get('orientation', 'xy')]
-            steps = [options.get('step')]
-            if not steps:
-                raise ValueError("Need 'step' parameter in node provider configuration")
-            node_limit = options.get('node_limit', None)
-            update_cache(project_id, data_type, orientations, steps,
-                    node_limit=node_limit,
-                    n_largest_skeletons_limit=n_largest_skeletons_limit,
-                    delete=clean_cache, log=log)
+            if cache_type == 'grid':
+                log("Updating grid cache for project {}".format(project_id))
+                update_grid_cache(project_id, data_types, orientation, *dims,
+                        node_limit=node_limit,
+                        n_largest_skeletons_limit=n_largest_skeletons_limit,
+                        delete=clean_cache, incremental=incremental,
+                        n_jobs=n_jobs, log=log)
+            else:
+                log("Updating cache for project {}".format(project_id))
+                update_cache(project_id, data_types, [orientation], [dims],
+                        node_limit=node_limit,
+                        n_largest_skeletons_limit=n_largest_skeletons_limit,
+                        delete=clean_cache, incremental=incremental,
+                        n_jobs=n_jobs, updated_before=updated_before, log=log)
 
 
 def get_tracing_bounding_box(project_id, cursor=None):
@@ -933,11 +1429,110 @@ def get_tracing_bounding_box(project_id, cursor=None):
 
     return row
 
+def get_outdated_cache_sections(project_id, orientation_id, step, cursor=None):
+    """Return the depths of all cached sections of the passed in project and
+    orientation, for which the node_query_cache_dirty_section table lists a
+    change after the section's last update. Each section covers the range
+    [depth, depth + step). A grace period is subtracted from a section's update
+    time, so that edits which were committed while the section was computed
+    aren't missed.
+    """
+    if not cursor:
+        cursor = connection.cursor()
+
+    cursor.execute("""
+        SELECT c.depth
+        FROM node_query_cache c
+        WHERE c.project_id = %(project_id)s
+        AND c.orientation = %(orientation)s
+        AND EXISTS (
+            SELECT 1 FROM node_query_cache_dirty_section d
+            WHERE d.project_id = c.project_id
+            AND d.edition_time >= c.update_time - %(grace_period)s::interval
+            AND d.max_z >= c.depth
+            AND d.min_z < c.depth + %(step)s
+        )
+    """, {
+        'project_id': project_id,
+        'orientation': orientation_id,
+        'step': step,
+        'grace_period': DIRTY_SECTION_GRACE_PERIOD,
+    })
+
+    return [row[0] for row in cursor.fetchall()]
+
+
+def clean_dirty_cache_sections(project_id, cursor=None):
+    """Remove all dirty section entries of a project that are older than the
+    oldest node query cache section or grid of this project (minus the grace
+    period).
+    These entries can't mark any cached section as outdated anymore. If node
+    query results are cached in memory, entries are additionally kept as long
+    as cached results can become outdated by them.
+    """
+    if not cursor:
+        cursor = connection.cursor()
+
+    if settings.NODE_LIST_RESULT_CACHE_SIZE:
+        max_age = settings.NODE_LIST_RESULT_CACHE_MAX_AGE
+    else:
+        max_age = 0
+
+    cursor.execute("""
+        DELETE FROM node_query_cache_dirty_section d
+        WHERE d.project_id = %(project_id)s
+        AND d.edition_time < COALESCE((
+            SELECT MIN(cache.update_time)
+            FROM (
+                SELECT c.update_time
+                FROM node_query_cache c
+                WHERE c.project_id = %(project_id)s
+                UNION ALL
+                SELECT g.update_time
+                FROM node_grid_cache g
+                WHERE g.project_id = %(project_id)s
+            ) cache
+        ), now()) - %(grace_period)s::interval
+        AND d.edition_time < now() - %(max_age)s * interval '1 second'
+    """, {
+        'project_id': project_id,
+        'grace_period': DIRTY_SECTION_GRACE_PERIOD,
+        'max_age': max_age,
+    })
+
+    return cursor.rowcount
+
+
+def _find_section_index(depth, min_z, step, n_sections):
+    """Return the index of the section in the regular grid starting at min_z,
+    which starts at the passed in depth. Depths are stored as single precision
+    floats, which is why a tolerance of a thousandth of a step is accepted. If
+    there is no such section, None is returned.
+    """
+    index = int(round((depth - min_z) / step))
+    if index < 0 or index >= n_sections:
+        return None
+    if abs(min_z + index * step - depth) > step * 0.001:
+        return None
+    return index
+
+
 def update_cache(project_id, data_type, orientations, steps,
         node_limit=None, n_largest_skeletons_limit=None, delete=False,
-        bb_limits=None, log=print_):
-    if data_type not in ('json', 'json_text', 'msgpack'):
-        raise ValueError('Type must be one of: json, json_text, msgpack')
+        bb_limits=None, incremental=False, n_jobs=1, updated_before=None,
+        log=print_):
+    """Populate the node query cache of a project for the passed in data type
+    and orientations, each with its own depth resolution (step). A list of data
+    types can be passed in to store multiple formats side by side. If
+    <incremental> is true and <delete> is false, only sections that don't exist
+    yet or that are marked as changed in the node_query_cache_dirty_section
+    table are recomputed. If <updated_before> is a datetime, sections that have
+    been updated at or after this point in time are skipped, which allows to
+    resume an interrupted update. With <n_jobs> larger than one, sections of
+    all orientations are computed by a pool of worker processes, each with its
+    own database connection.
+    """
+    data_types = get_cache_data_types(data_type, CACHE_DATA_TYPE_COLUMNS)
     if len(steps) != len(orientations):
         raise ValueError('Need one depth resolution flag per orientation')
     if project_id is None:
@@ -997,52 +1592,668 @@ def update_cache(project_id, data_type, orientations, steps,
     min_z = bb[0][2]
     max_z = bb[1][2]
 
-    data_types = [data_type]
-    update_json_cache = 'json' in data_types
-    update_json_text_cache = 'json_text' in data_types
-    update_msgpack_cache = 'msgpack' in data_types
-
-    provider = Postgis2dNodeProvider()
     types = ', '.join(data_types)
 
+    incremental = incremental and not delete
+
+    # Collect all sections that need an update, for all orientations.
+    tasks = []
     for o, step in zip(orientations, steps):
         orientation_id = ORIENTATIONS[o]
-        log(' -> Populating cache for orientation {} with depth resolution {} for types: {}'.format(o, step, types))
+
+        # Compute all section start depths the same way they have been computed
+        # when the cache was populated initially.
+        depths = []
         z = min_z
         while z < max_z:
-            params['z1'] = z
-            params['z2'] = z + step
-            result_tuple = _node_list_tuples_query(params, project_id, provider)
-
-            if update_json_cache:
-                data = ujson.dumps(result_tuple)
-                cursor.execute("""
-                    INSERT INTO node_query_cache (project_id, orientation, depth, update_time, json_data)
-                    VALUES (%s, %s, %s, now(), %s)
-                    ON CONFLICT (project_id, orientation, depth)
-                    DO UPDATE SET json_data = EXCLUDED.json_data, update_time = EXCLUDED.update_time;
-                """, (project_id, orientation_id, z, json.dumps(result_tuple)))
-
-            if update_json_text_cache:
-                data = ujson.dumps(result_tuple)
-                cursor.execute("""
-                    INSERT INTO node_query_cache (project_id, orientation, depth, update_time, json_text_data)
-                    VALUES (%s, %s, %s, now(), %s)
-                    ON CONFLICT (project_id, orientation, depth)
-                    DO UPDATE SET json_text_data = EXCLUDED.json_text_data, update_time = EXCLUDED.update_time;
-                """, (project_id, orientation_id, z, json.dumps(result_tuple)))
-
-            if update_msgpack_cache:
-                data = msgpack.packb(result_tuple)
-                cursor.execute("""
-                    INSERT INTO node_query_cache (project_id, orientation, depth, update_time, msgpack_data)
-                    VALUES (%s, %s, %s, now(), %s)
-                    ON CONFLICT (project_id, orientation, depth)
-                    DO UPDATE SET msgpack_data = EXCLUDED.msgpack_data, update_time = EXCLUDED.update_time;
-                """, (project_id, orientation_id, z, psycopg2.Binary(data)))
-
+            depths.append(z)
             z += step
 
+        if incremental or updated_before:
+            # Only update sections that either don't exist yet, lack one of
+            # the requested data types, have been marked as outdated or haven't
+            # been updated since a particular point in time.
+            outdated = [False] * len(depths)
+            existing = [False] * len(depths)
+            cursor.execute("""
+                SELECT depth, update_time FROM node_query_cache
+                WHERE project_id = %s AND orientation = %s
+                {}
+            """.format(''.join('AND {} IS NOT NULL '.format(
+                    CACHE_DATA_TYPE_COLUMNS[t]) for t in data_types)),
+                (project_id, orientation_id))
+            for row in cursor.fetchall():
+                index = _find_section_index(row[0], min_z, step, len(depths))
+                if index is not None:
+                    existing[index] = not updated_before or row[1] >= updated_before
+            if incremental:
+                for depth in get_outdated_cache_sections(project_id,
+                        orientation_id, step, cursor):
+                    index = _find_section_index(depth, min_z, step, len(depths))
+                    if index is not None:
+                        outdated[index] = True
+            depths = [d for i, d in enumerate(depths)
+                    if not existing[i] or (incremental and outdated[i])]
+            log(' -> Found {} sections to update in orientation {}'.format(len(depths), o))
+
+        log(' -> Populating cache for orientation {} with depth resolution {} for types: {}'.format(o, step, types))
+        # Split the sections of this orientation into chunks, so that work can
+        # be distributed evenly between workers.
+        chunk_size = max(1, int(math.ceil(len(depths) / float(max(1, n_jobs) * 4))))
+        for i in range(0, len(depths), chunk_size):
+            tasks.append((project_id, orientation_id, step,
+                    depths[i:i + chunk_size], params, data_types))
+
+    run_cache_update_tasks(_update_cache_sections_task, tasks, n_jobs,
+            'sections', log)
+    cursor = connection.cursor()
+
+    if incremental:
+        n_removed = clean_dirty_cache_sections(project_id, cursor)
+        log(' -> Removed {} processed dirty section entries'.format(n_removed))
+
+
+def run_cache_update_tasks(task_fn, tasks, n_jobs=1, unit='sections',
+        log=print_):
+    """Run all passed in cache update tasks using <task_fn>, either in this
+    process or, if <n_jobs> is larger than one, using a pool of worker
+    processes. Each task has to return a three-tuple of the worker's process
+    ID, the number of updated units and the processing time in seconds. The
+    throughput of each worker is reported at the end.
+    """
+    if n_jobs > 1 and len(tasks) > 1:
+        if connection.in_atomic_block:
+            raise ValueError("Parallel cache updates can't be run in a transaction")
+        log(' -> Distributing {} tasks to {} workers'.format(len(tasks), n_jobs))
+        # Forked workers must not share the database connection of this
+        # process. Closing it makes workers open their own connection.
+        connection.close()
+        pool = multiprocessing.Pool(n_jobs)
+        try:
+            results = list(pool.imap_unordered(task_fn, tasks))
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        results = [task_fn(t) for t in tasks]
+
+    # Report throughput for each worker
+    worker_stats = defaultdict(lambda: [0, 0.0])
+    for worker, n_units, duration in results:
+        worker_stats[worker][0] += n_units
+        worker_stats[worker][1] += duration
+    for worker, (n_units, duration) in sorted(worker_stats.items()):
+        log(' -> Worker {}: {} {} in {:.2f}s ({:.2f} {}/s)'.format(
+                worker, n_units, unit, duration,
+                n_units / duration if duration else 0.0, unit))
+
+
+def _update_cache_sections_task(task):
+    """Compute and store the cache sections described by the passed in task
+    tuple (project_id, orientation_id, step, depths, params, data_types). A
+    three-tuple of the worker's process ID, the number of updated sections and
+    the processing time in seconds is returned.
+    """
+    start = time.time()
+    project_id, orientation_id, step, depths, params, data_types = task
+    update_cache_sections(project_id, orientation_id, step, depths, params,
+            data_types)
+    return os.getpid(), len(depths), time.time() - start
+
+
+def update_cache_sections(project_id, orientation_id, step, depths, params,
+        data_types, cursor=None):
+    """Compute the node query result for each section in <depths> and store it
+    in the node query cache for all passed in data types.
+    """
+    if not cursor:
+        cursor = connection.cursor()
+
+    provider = Postgis2dNodeProvider()
+    params = copy.copy(params)
+
+    for z in depths:
+        params['z1'] = z
+        params['z2'] = z + step
+        result_tuple = _node_list_tuples_query(params, project_id, provider)
+        encoded = encode_node_query_data(result_tuple, data_types)
+
+        # All formats are written at once, formats that aren't requested are
+        # removed, so that no outdated data is stored side by side.
+        cursor.execute("""
+            INSERT INTO node_query_cache (project_id, orientation, depth,
+                update_time, {columns})
+            VALUES (%s, %s, %s, now(), {values})
+            ON CONFLICT (project_id, orientation, depth)
+            DO UPDATE SET {updates}, update_time = EXCLUDED.update_time;
+        """.format(**get_cache_upsert_sql(CACHE_DATA_TYPE_COLUMNS)),
+            [project_id, orientation_id, z] +
+            [encoded.get(t) for t in sorted(CACHE_DATA_TYPE_COLUMNS)])
+
+
+def get_cache_data_types(data_type, columns):
+    """Return the passed in data type or list of data types as list and make
+    sure all of them can be stored in the passed in column set.
+    """
+    data_types = list(data_type) if type(data_type) in (list, tuple) else [data_type]
+    if not data_types:
+        raise ValueError('Need at least one data type')
+    for dt in data_types:
+        if dt not in columns:
+            raise ValueError('Type must be one of: {}'.format(
+                    ', '.join(sorted(columns.keys()))))
+    return data_types
+
+
+def encode_node_query_data(result_tuple, data_types):
+    """Encode the passed in node query result in each of the passed in data
+    types. A dictionary mapping each data type to its encoded data is
+    returned, ready to be passed to the database.
+    """
+    encoded = {}
+    if 'json' in data_types or 'json_text' in data_types:
+        json_text = json.dumps(result_tuple)
+        if 'json' in data_types:
+            encoded['json'] = json_text
+        if 'json_text' in data_types:
+            encoded['json_text'] = json_text
+    if 'msgpack' in data_types:
+        encoded['msgpack'] = psycopg2.Binary(msgpack.packb(result_tuple))
+    if 'columnar' in data_types:
+        encoded['columnar'] = psycopg2.Binary(encode_columnar_node_data(result_tuple))
+    return encoded
+
+
+def get_cache_upsert_sql(columns):
+    """Return the column list, value placeholders and update assignments for
+    an upsert of all data type columns in the passed in map, ordered by data
+    type.
+    """
+    names = [columns[t] for t in sorted(columns)]
+    return {
+        'columns': ', '.join(names),
+        'values': ', '.join(['%s'] * len(names)),
+        'updates': ', '.join('{0} = EXCLUDED.{0}'.format(n) for n in names),
+    }
+
+
+def update_grid_cache(project_id, data_type, orientation, cell_width,
+        cell_height, cell_depth, node_limit=None, n_largest_skeletons_limit=None,
+        delete=False, bb_limits=None, incremental=False, n_jobs=1, log=print_):
+    """Populate the grid cache of a project for the passed in data type (or
+    list of data types), orientation and cell dimensions. Cells are aligned to
+    the project space origin and only cells that intersect with the tracing
+    data bounding box, optionally constrained by <bb_limits>, are computed.
+    Cells outside of this bounding box are removed. Cells without any nodes
+    aren't stored. If <incremental> is true and <delete> is false, only cells
+    that intersect with changes tracked since the grid's last update are
+    recomputed.
+    """
+    data_types = get_cache_data_types(data_type, GRID_CACHE_DATA_TYPE_COLUMNS)
+    if project_id is None:
+        raise ValueError('Need project ID')
+    if not (cell_width > 0 and cell_height > 0 and cell_depth > 0):
+        raise ValueError('Need positive cell dimensions')
+
+    orientation_id = ORIENTATIONS[orientation]
+    cell_dims = (cell_width, cell_height, cell_depth)
+    cursor = connection.cursor()
+
+    log(' -> Finding tracing data bounding box')
+    row = get_tracing_bounding_box(project_id, cursor)
+    bb = [row[0], row[1]]
+    if None in bb[0] or None in bb[1]:
+        log(' -> Found no valid bounding box, skipping project: {}'.format(bb))
+        return
+    else:
+        log(' -> Found bounding box: {}'.format(bb))
+
+    if bb_limits:
+        for i in range(3):
+            bb[0][i] = max(bb[0][i], bb_limits[0][i])
+            bb[1][i] = min(bb[1][i], bb_limits[1][i])
+        log(' -> Applied limits to bounding box: {}'.format(bb))
+
+    # Remember when this update started, changes after this point in time will
+    # be considered by the next incremental update.
+    cursor.execute("SELECT now()")
+    start_time = cursor.fetchone()[0]
+
+    cursor.execute("""
+        SELECT id, update_time FROM node_grid_cache
+        WHERE project_id = %s AND orientation = %s AND cell_width = %s
+        AND cell_height = %s AND cell_depth = %s
+    """, (project_id, orientation_id, cell_width, cell_height, cell_depth))
+    grid = cursor.fetchone()
+
+    if grid and delete:
+        log(' -> Deleting existing grid {}'.format(grid[0]))
+        cursor.execute("DELETE FROM node_grid_cache WHERE id = %s", (grid[0],))
+        grid = None
+
+    if grid:
+        grid_id, last_update_time = grid
+    else:
+        cursor.execute("""
+            INSERT INTO node_grid_cache (project_id, orientation, cell_width,
+                cell_height, cell_depth, update_time)
+            VALUES (%s, %s, %s, %s, %s, %s)
+            RETURNING id
+        """, (project_id, orientation_id, cell_width, cell_height, cell_depth,
+                start_time))
+        grid_id, last_update_time = cursor.fetchone()[0], None
+        incremental = False
+
+    index_ranges = [get_cell_index_range(bb[0][i], bb[1][i], cell_dims[i])
+            for i in range(3)]
+
+    # Cells of an earlier update with a larger bounding box would otherwise
+    # still be used by queries.
+    cursor.execute("""
+        DELETE FROM node_grid_cache_cell
+        WHERE grid_id = %(grid_id)s
+        AND NOT (x_index BETWEEN %(min_x)s AND %(max_x)s
+            AND y_index BETWEEN %(min_y)s AND %(max_y)s
+            AND z_index BETWEEN %(min_z)s AND %(max_z)s)
+    """, {
+        'grid_id': grid_id,
+        'min_x': index_ranges[0][0],
+        'max_x': index_ranges[0][1],
+        'min_y': index_ranges[1][0],
+        'max_y': index_ranges[1][1],
+        'min_z': index_ranges[2][0],
+        'max_z': index_ranges[2][1],
+    })
+    if cursor.rowcount:
+        log(' -> Removed {} cells outside of the bounding box'.format(cursor.rowcount))
+
+    if incremental and not delete:
+        # Collect all cells in the tracing data bounding box, which intersect
+        # with changes that happened since the last update.
+        cursor.execute("""
+            SELECT min_x, min_y, min_z, max_x, max_y, max_z
+            FROM node_query_cache_dirty_section
+            WHERE project_id = %(project_id)s
+            AND edition_time >= %(update_time)s - %(grace_period)s::interval
+        """, {
+            'project_id': project_id,
+            'update_time': last_update_time,
+            'grace_period': DIRTY_SECTION_GRACE_PERIOD,
+        })
+        cells = set()
+        for row in cursor.fetchall():
+            ranges = []
+            for i in range(3):
+                first, last = get_cell_index_range(row[i], row[i + 3], cell_dims[i])
+                # Changes on the upper cell boundary belong to the next cell.
+                if row[i + 3] >= (last + 1) * cell_dims[i]:
+                    last += 1
+                first = max(first, index_ranges[i][0])
+                last = min(last, index_ranges[i][1])
+                ranges.append((first, last))
+            for zi in range(ranges[2][0], ranges[2][1] + 1):
+                for yi in range(ranges[1][0], ranges[1][1] + 1):
+                    for xi in range(ranges[0][0], ranges[0][1] + 1):
+                        cells.add((xi, yi, zi))
+        # Cells that lack one of the requested data types are updated as well.
+        cursor.execute("""
+            SELECT x_index, y_index, z_index
+            FROM node_grid_cache_cell
+            WHERE grid_id = %s
+            AND ({})
+        """.format(' OR '.join('{} IS NULL'.format(
+                GRID_CACHE_DATA_TYPE_COLUMNS[t]) for t in data_types)),
+            (grid_id,))
+        cells.update(cursor.fetchall())
+        cells = sorted(cells, key=lambda c: (c[2], c[1], c[0]))
+        log(' -> Found {} changed cells'.format(len(cells)))
+    else:
+        cells = [(xi, yi, zi)
+            for zi in range(index_ranges[2][0], index_ranges[2][1] + 1)
+            for yi in range(index_ranges[1][0], index_ranges[1][1] + 1)
+            for xi in range(index_ranges[0][0], index_ranges[0][1] + 1)]
+        log(' -> Populating {} cells of size {} for types: {}'.format(
+                len(cells), cell_dims, ', '.join(data_types)))
+
+    params = {
+        'project_id': project_id,
+        'limit': node_limit,
+    }
+    if n_largest_skeletons_limit:
+        params['n_largest_skeletons_limit'] = int(n_largest_skeletons_limit)
+
+    chunk_size = max(1, int(math.ceil(len(cells) / float(max(1, n_jobs) * 4))))
+    tasks = [(grid_id, project_id, cell_dims, cells[i:i + chunk_size], params,
+            data_types) for i in range(0, len(cells), chunk_size)]
+    run_cache_update_tasks(_update_grid_cache_cells_task, tasks, n_jobs,
+            'cells', log)
+
+    cursor = connection.cursor()
+    cursor.execute("""
+        UPDATE node_grid_cache SET update_time = %s WHERE id = %s
+    """, (start_time, grid_id))
+
+    if incremental:
+        n_removed = clean_dirty_cache_sections(project_id, cursor)
+        log(' -> Removed {} processed dirty section entries'.format(n_removed))
+
+
+def _update_grid_cache_cells_task(task):
+    """Compute and store the grid cells described by the passed in task tuple
+    (grid_id, project_id, cell_dims, cells, params, data_types). A three-tuple
+    of the worker's process ID, the number of updated cells and the processing
+    time in seconds is returned.
+    """
+    start = time.time()
+    grid_id, project_id, cell_dims, cells, params, data_types = task
+    update_grid_cache_cells(grid_id, project_id, cell_dims, cells, params,
+            data_types)
+    return os.getpid(), len(cells), time.time() - start
+
+
+def update_grid_cache_cells(grid_id, project_id, cell_dims, cells, params,
+        data_types, cursor=None):
+    """Compute the node query result for each passed in (x, y, z) cell index
+    and store it in the grid cache for all passed in data types. Cells without
+    nodes are removed from the cache.
+    """
+    if not cursor:
+        cursor = connection.cursor()
+
+    provider = Postgis2dNodeProvider()
+    params = copy.copy(params)
+    cell_width, cell_height, cell_depth = cell_dims
+
+    for xi, yi, zi in cells:
+        params['left'] = xi * cell_width
+        params['right'] = (xi + 1) * cell_width
+        params['top'] = yi * cell_height
+        params['bottom'] = (yi + 1) * cell_height
+        params['z1'] = zi * cell_depth
+        params['z2'] = (zi + 1) * cell_depth
+        result_tuple = _node_list_tuples_query(params, project_id, provider)
+
+        if not result_tuple[0] and not result_tuple[1]:
+            cursor.execute("""
+                DELETE FROM node_grid_cache_cell
+                WHERE grid_id = %s AND x_index = %s AND y_index = %s
+                AND z_index = %s
+            """, (grid_id, xi, yi, zi))
+            continue
+
+        encoded = encode_node_query_data(result_tuple, data_types)
+
+        cursor.execute("""
+            INSERT INTO node_grid_cache_cell (grid_id, x_index, y_index,
+                z_index, update_time, {columns})
+            VALUES (%s, %s, %s, %s, now(), {values})
+            ON CONFLICT (grid_id, z_index, y_index, x_index)
+            DO UPDATE SET {updates}, update_time = EXCLUDED.update_time;
+        """.format(**get_cache_upsert_sql(GRID_CACHE_DATA_TYPE_COLUMNS)),
+            [grid_id, xi, yi, zi] +
+            [encoded.get(t) for t in sorted(GRID_CACHE_DATA_TYPE_COLUMNS)])
+
+
+class NodeListResultCache(object):
+    """A process local, size bounded cache for complete node query responses.
+    Entries are stored along with their bounding box and the point in time
+    they were computed. An entry is only returned if no change that intersects
+    its bounding box has been recorded in the node_query_cache_dirty_section
+    table since then. To have changes recorded for a project, it is added to
+    the node_query_cache_dirty_tracking table when it is used for the first
+    time. Besides responses, entries can record that a query reached the node
+    limit, see set_limit_reached().
+    """
+
+    def __init__(self, max_size, max_age):
+        self.max_age = max_age
+        self.cache = LRUCache(max_size, size_fn=lambda e: len(e['content']) or 1)
+        self.tracked_projects = set()
+        self.last_cleanup = {}
+        self.hits = 0
+        self.misses = 0
+
+    def enable_tracking(self, project_id, cursor):
+        """Make sure changes in the passed in project are tracked. Return
+        whether tracking was already enabled before this call.
+        """
+        if project_id in self.tracked_projects:
+            return True
+        cursor.execute("""
+            INSERT INTO node_query_cache_dirty_tracking (project_id)
+            VALUES (%s)
+            ON CONFLICT (project_id) DO NOTHING
+        """, (project_id,))
+        # Only rely on tracking once the respective transaction is committed.
+        transaction.on_commit(lambda: self.tracked_projects.add(project_id))
+        return False
+
+    def cleanup(self, project_id, cursor):
+        """Remove dirty section entries that are too old to affect any cached
+        result. This is done at most once per maximum entry age for each
+        project.
+        """
+        now = time.time()
+        if now - self.last_cleanup.get(project_id, 0) > self.max_age:
+            self.last_cleanup[project_id] = now
+            clean_dirty_cache_sections(project_id, cursor)
+
+    def get_query_time(self, cursor):
+        cursor.execute("SELECT clock_timestamp()")
+        return cursor.fetchone()[0]
+
+    def get(self, key, params, explicit_node_ids, cursor):
+        """Return the cached response for the passed in key, if it is still
+        valid. Otherwise, None is returned.
+        """
+        entry = self.cache.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+
+        if time.time() - entry['created'] > self.max_age or \
+                self.is_outdated(entry, params, explicit_node_ids, cursor):
+            self.cache.remove(key)
+            self.misses += 1
+            return None
+
+        self.hits += 1
+        return entry
+
+    def is_outdated(self, entry, params, explicit_node_ids, cursor):
+        """Test if any change intersecting the bounding box of a cache
+        entry has been recorded since the entry was created or if any of the
+        explicitly requested nodes changed.
+        """
+        cursor.execute("""
+            SELECT EXISTS (
+                SELECT 1 FROM node_query_cache_dirty_section d
+                WHERE d.project_id = %(project_id)s
+                AND d.edition_time >= %(query_time)s - %(grace_period)s::interval
+                AND d.max_x >= %(left)s AND d.min_x <= %(right)s
+                AND d.max_y >= %(top)s AND d.min_y <= %(bottom)s
+                AND d.max_z >= %(z1)s AND d.min_z <= %(z2)s
+            ) OR EXISTS (
+                SELECT 1 FROM location l
+                WHERE l.id = ANY(%(node_ids)s::bigint[])
+                AND l.edition_time >= %(query_time)s - %(grace_period)s::interval
+            )
+        """, {
+            'project_id': params['project_id'],
+            'query_time': entry['query_time'],
+            'grace_period': DIRTY_SECTION_GRACE_PERIOD,
+            'left': params['left'],
+            'right': params['right'],
+            'top': params['top'],
+            'bottom': params['bottom'],
+            'z1': params['z1'],
+            'z2': params['z2'],
+            'node_ids': list(explicit_node_ids),
+        })
+        return cursor.fetchone()[0]
+
+    def set(self, key, response, query_time):
+        self.cache.set(key, {
+            'content': response.content,
+            'content_type': response['Content-Type'],
+            'limit_reached': False,
+            'query_time': query_time,
+            'created': time.time(),
+        })
+
+    def set_limit_reached(self, key, query_time):
+        """Remember that the query for the passed in key reached the node
+        limit. Such an entry has no content and expires like regular entries.
+        """
+        self.cache.set(key, {
+            'content': b'',
+            'content_type': None,
+            'limit_reached': True,
+            'query_time': query_time,
+            'created': time.time(),
+        })
+
+    def stats(self):
+        """Return cache statistics. Outdated entries count as misses.
+        """
+        stats = self.cache.stats()
+        stats['hits'] = self.hits
+        stats['misses'] = self.misses
+        return stats
+
+
+_node_list_result_cache = None
+
+def get_node_list_result_cache():
+    """Return the process local node list result cache or None, if it is
+    disabled.
+    """
+    global _node_list_result_cache
+    if not settings.NODE_LIST_RESULT_CACHE_SIZE:
+        return None
+    if _node_list_result_cache is None:
+        _node_list_result_cache = NodeListResultCache(
+                settings.NODE_LIST_RESULT_CACHE_SIZE,
+                settings.NODE_LIST_RESULT_CACHE_MAX_AGE)
+    return _node_list_result_cache
+
+
+class NodeProviderSelector(object):
+    """Record the latency of node queries for each configured node provider
+    and bounding box size class and order matching node providers for new
+    queries by their historic latency. The latency of a query is attributed to
+    the node provider that was asked first, i.e. it includes the time needed by
+    fallback providers if the first one didn't return a result. Each provider
+    is tried first <min_samples> times per size class before its average is
+    trusted. Afterwards a random provider is tried first for a fraction of
+    <exploration_rate> of all queries, to notice changes over time. Latencies
+    are averaged with an exponential moving average, weighted by <smoothing>.
+    """
+
+    def __init__(self, min_samples=5, exploration_rate=0.05, smoothing=0.2):
+        self.min_samples = min_samples
+        self.exploration_rate = exploration_rate
+        self.smoothing = smoothing
+        # Map (size class, provider key) to a [count, mean latency] list.
+        self.latencies = {}
+        self.lock = threading.Lock()
+
+    def get_size_class(self, params):
+        """Group bounding boxes by project, orientation and the magnitude of
+        their area. Each size class covers a four times larger area than the
+        previous one.
+        """
+        width = params['right'] - params['left']
+        height = params['bottom'] - params['top']
+        area = max(1.0, width * height)
+        return (params.get('project_id'), params.get('orientation'),
+                int(math.log(area, 4)))
+
+    def order(self, node_providers, params):
+        """Return the passed in node providers, ordered by the preference for
+        a query with the passed in parameters. Only the first node provider is
+        chosen based on its statistics, fallbacks keep their configured order.
+        """
+        if len(node_providers) < 2:
+            return list(node_providers)
+
+        size_class = self.get_size_class(params)
+        with self.lock:
+            samples = [self.latencies.get((size_class, p.config_key))
+                    for p in node_providers]
+
+        unexplored = [p for p, s in zip(node_providers, samples)
+                if not s or s[0] < self.min_samples]
+        if unexplored:
+            first = unexplored[0]
+        elif random.random() < self.exploration_rate:
+            first = random.choice(node_providers)
+        else:
+            first = min(zip(node_providers, samples), key=lambda x: x[1][1])[0]
+
+        return [first] + [p for p in node_providers if p is not first]
+
+    def record(self, params, node_provider, latency):
+        """Record the latency (in seconds) of a query with the passed in
+        parameters, for which the passed in node provider was asked first.
+        """
+        key = (self.get_size_class(params), node_provider.config_key)
+        with self.lock:
+            entry = self.latencies.get(key)
+            if entry is None:
+                self.latencies[key] = [1, latency]
+            else:
+                entry[0] += 1
+                entry[1] += self.smoothing * (latency - entry[1])
+
+    def stats(self):
+        with self.lock:
+            return [{
+                'project_id': size_class[0],
+                'orientation': size_class[1],
+                'size_class': size_class[2],
+                'provider': provider_key,
+                'samples': entry[0],
+                'latency': entry[1],
+            } for (size_class, provider_key), entry in sorted(
+                    self.latencies.items(), key=lambda x: str(x[0]))]
+
+
+_node_provider_selector = None
+
+def get_node_provider_selector():
+    """Return the process local node provider selector or None, if node
+    providers aren't selected adaptively.
+    """
+    global _node_provider_selector
+    if settings.NODE_PROVIDER_SELECTION != 'adaptive':
+        return None
+    if _node_provider_selector is None:
+        _node_provider_selector = NodeProviderSelector(
+                settings.NODE_PROVIDER_SELECTION_MIN_SAMPLES,
+                settings.NODE_PROVIDER_SELECTION_EXPLORATION_RATE)
+    return _node_provider_selector
+
+
+def quantize_bounding_box(params, quantum):
+    """Return a copy of the passed in query parameters, whose bounding box is
+    extended in X and Y to the next multiple of <quantum>. This makes requests
+    for similar views share cache entries. If the bounding box doesn't change,
+    the passed in parameters are returned.
+    """
+    if not quantum:
+        return params
+    quantized = dict(params)
+    for p in ('left', 'top'):
+        quantized[p] = math.floor(params[p] / quantum) * quantum
+    for p in ('right', 'bottom'):
+        quantized[p] = math.ceil(params[p] / quantum) * quantum
+    if all(quantized[p] == params[p] for p in ('left', 'top', 'right', 'bottom')):
+        return params
+    quantized['width'] = quantized['right'] - quantized['left']
+    quantized['height'] = quantized['bottom'] - quantized['top']
+    return quantized
+
 
 def prepare_db_statements(connection):
     node_providers = get_configured_node_providers(settings.NODE_PROVIDERS, connection)
@@ -1151,10 +2362,37 @@ def node_list_tuples(request, project_id=None, provider=None):
       paramType: form
     - name: format
       description: |
-        Either "json" (default) or "msgpack", optional.
+        Either "json" (default), "msgpack", "columnar", "png" or "gif",
+        optional. The "columnar" format is a msgpack encoded map, in which
+        treenodes, connectors and connector links are stored as typed column
+        arrays (little endian). Each table is a map with the number of rows
+        ("n") and a map of columns, each column a tuple of type name and
+        bytes. Labels and relations are regular maps.
       required: false
       type: string
       paramType: form
+    - name: view_width
+      description: |
+        Width of the rendered image in pixels, only used for "png" and "gif".
+      required: false
+      type: integer
+      defaultValue: 1000
+      paramType: form
+    - name: view_height
+      description: |
+        Height of the rendered image in pixels, only used for "png" and "gif".
+      required: false
+      type: integer
+      defaultValue: 1000
+      paramType: form
+    - name: lod
+      description: |
+        If larger than zero, at most one node is rendered per square of this
+        many pixels, only used for "png" and "gif".
+      required: false
+      type: integer
+      defaultValue: 0
+      paramType: form
     - name: with_relation_map
       description: |
         Whether an ID to name mapping for the used relations should be included
@@ -1190,15 +2428,18 @@ def node_list_tuples(request, project_id=None, provider=None):
     connector_ids = get_request_list(data, 'connector_ids', tuple(), int)
     for p in ('top', 'left', 'bottom', 'right', 'z1', 'z2'):
         params[p] = float(data.get(p, 0))
+    # Results with labels aren't cached, because label changes aren't tracked.
+    include_labels = get_request_bool(data, 'labels', False)
+    result_cache = None if include_labels else get_node_list_result_cache()
     # Limit the number of retrieved treenodes within the section
     params['limit'] = settings.NODE_LIST_MAXIMUM_COUNT
     params['n_largest_skeletons_limit'] = int(data.get('n_largest_skeletons_limit', 0))
     params['project_id'] = project_id
-    include_labels = get_request_bool(data, 'labels', False)
     target_format = data.get('format', 'json')
     target_options = {
         'view_width': int(data.get('view_width', 1000)),
         'view_height': int(data.get('view_height', 1000)),
+        'lod': int(data.get('lod', 0)),
     }
     override_provider = data.get('src')
     with_relation_map = data.get('with_relation_map', 'used')
@@ -1229,12 +2470,125 @@ def node_list_tuples(request, project_id=None, provider=None):
 
     if override_provider:
         node_providers = get_configured_node_providers([override_provider])
+        selector = None
     else:
         node_providers = get_configured_node_providers(settings.NODE_PROVIDERS)
+        selector = get_node_provider_selector()
+
+    if not result_cache:
+        return compile_node_list_result(project_id, node_providers, params,
+            treenode_ids, connector_ids, include_labels, target_format,
+            target_options, with_relation_map, selector)
+
+    cursor = connection.cursor()
+    tracked = result_cache.enable_tracking(project_id, cursor)
+    result_cache.cleanup(project_id, cursor)
+    explicit_node_ids = [n for n in list(treenode_ids) + list(connector_ids)
+            if n != -1]
+
+    def get_cache_key(p):
+        return (project_id, override_provider, target_format,
+            tuple(sorted(target_options.items())) if target_format in ('png', 'gif') else None,
+            p['left'], p['top'], p['z1'], p['right'], p['bottom'], p['z2'],
+            p['n_largest_skeletons_limit'], orientation, with_relation_map,
+            tuple(sorted(treenode_ids)), tuple(sorted(connector_ids)))
+
+    # Images are rendered for the requested bounding box, other formats are
+    # queried for a quantized one to let similar views share cache entries.
+    if target_format in ('png', 'gif'):
+        query_params = params
+    else:
+        query_params = quantize_bounding_box(params,
+                settings.NODE_LIST_RESULT_CACHE_QUANTUM)
+
+    entry = result_cache.get(get_cache_key(query_params), query_params,
+            explicit_node_ids, cursor)
+    if entry and entry['limit_reached']:
+        # The quantized bounding box contains too many nodes, use the
+        # requested one.
+        query_params = params
+        entry = result_cache.get(get_cache_key(query_params), query_params,
+                explicit_node_ids, cursor)
+    if entry:
+        return HttpResponse(entry['content'], content_type=entry['content_type'])
+
+    query_time = result_cache.get_query_time(cursor)
+    start = time.time()
+    result, data_type, first_provider = query_node_list(project_id,
+            node_providers, query_params, treenode_ids, connector_ids,
+            include_labels, target_format, with_relation_map, selector)
+    if query_params is not params and \
+            get_node_query_limit_reached(result, data_type):
+        # The node limit is applied to the whole quantized bounding box and
+        # could drop nodes of the requested one in favor of nodes outside of
+        # it. Remember this and query the requested bounding box instead.
+        if tracked:
+            result_cache.set_limit_reached(get_cache_key(query_params),
+                    query_time)
+        query_params = params
+        result, data_type, first_provider = query_node_list(project_id,
+                node_providers, query_params, treenode_ids, connector_ids,
+                include_labels, target_format, with_relation_map, selector)
+    response = create_node_response(result, query_params, target_format,
+            target_options, data_type)
+    if selector:
+        selector.record(query_params, first_provider, time.time() - start)
+
+    # Changes are only guaranteed to be tracked, if tracking was enabled
+    # before this query.
+    if tracked:
+        result_cache.set(get_cache_key(query_params), response, query_time)
+
+    return response
+
+
+@api_view(['GET'])
+@requires_user_role([UserRole.Browse])
+def node_list_result_cache_stats(request, project_id=None):
+    """Get statistics on the node query result cache of the process handling
+    this request.
+
+    Besides the number of cache hits and misses, the number of entries as well
+    as the current and maximum size (in bytes) are returned. If the cache is
+    disabled, only the field "enabled" is returned and set to false.
+    """
+    result_cache = get_node_list_result_cache()
+    if not result_cache:
+        return JsonResponse({
+            'enabled': False
+        })
+
+    stats = result_cache.stats()
+    stats['enabled'] = True
+    stats['pid'] = os.getpid()
+    return JsonResponse(stats)
 
-    return compile_node_list_result(project_id, node_providers, params,
-        treenode_ids, connector_ids, include_labels, target_format,
-        target_options, with_relation_map)
+
+@api_view(['GET'])
+@requires_user_role([UserRole.Browse])
+def node_provider_stats(request, project_id=None):
+    """Get node query latency statistics of the process handling this request.
+
+    If node providers are selected adaptively (NODE_PROVIDER_SELECTION is set
+    to "adaptive"), the average latency and the number of samples is returned
+    for each node provider and bounding box size class of this project. A size
+    class covers areas between 4^n and 4^(n+1) square nanometers. Node
+    providers are identified by their index in the NODE_PROVIDERS setting and
+    their name. If adaptive selection is disabled, only the field "enabled" is
+    returned and set to false.
+    """
+    selector = get_node_provider_selector()
+    if not selector:
+        return JsonResponse({
+            'enabled': False
+        })
+
+    project_id = int(project_id)
+    return JsonResponse({
+        'enabled': True,
+        'pid': os.getpid(),
+        'latencies': [s for s in selector.stats() if s['project_id'] == project_id],
+    })
 
 
 def _node_list_tuples_query(params, project_id, node_provider,
@@ -1249,10 +2603,7 @@ def _node_list_tuples_query(params, project_id, node_provider,
         cursor = connection.cursor()
 
         if with_relation_map or include_labels:
-            cursor.execute('''
-            SELECT relation_name, id FROM relation WHERE project_id=%s
-            ''' % project_id)
-            relation_map = dict(cursor.fetchall())
+            relation_map = get_relation_to_id_map(project_id, cursor=cursor)
             id_to_relation = {v: k for k, v in relation_map.items()}
 
         # A set of extra treenode and connector IDs
@@ -1351,6 +2702,11 @@ def _node_list_tuples_query(params, project_id, node_provider,
                     labels[row[0]].append(row[1])
 
         if with_relation_map == 'used':
+            if not used_relations.issubset(id_to_relation):
+                # Relations might have been added by another process
+                relation_map = get_relation_to_id_map(project_id,
+                        cursor=cursor, use_cache=False)
+                id_to_relation = {v: k for k, v in relation_map.items()}
             export_relation_map = {r:id_to_relation[r] for r in used_relations}
         elif with_relation_map == 'all':
             export_relation_map = id_to_relation
@@ -1373,64 +2729,84 @@ def node_list_tuples_query(params, project_id, node_provider,
 
     result_tuple, data_type = node_provider.get_tuples(params, project_id,
         explicit_treenode_ids, explicit_connector_ids, include_labels,
-        with_relation_map)
+        with_relation_map, target_format)
 
     return create_node_response(result_tuple, params, target_format, target_options, data_type)
 
 def compile_node_list_result(project_id, node_providers, params,
         explicit_treenode_ids=tuple(), explicit_connector_ids=tuple(),
         include_labels=False, target_format='json', target_options=None,
-        with_relation_map=True):
+        with_relation_map=True, selector=None):
     """Create a valid HTTP response for the provided node query. If
     override_provider is not passed in, the list of node_providers will be
-    iterated until a result is found.
+    iterated until a result is found. If a NodeProviderSelector is passed in,
+    matching node providers are tried in the order it suggests and the time
+    needed to create the response is recorded.
+    """
+    start = time.time()
+    result_tuple, data_type, first_provider = query_node_list(project_id,
+            node_providers, params, explicit_treenode_ids,
+            explicit_connector_ids, include_labels, target_format,
+            with_relation_map, selector)
+
+    response = create_node_response(result_tuple, params, target_format,
+            target_options, data_type)
+
+    if selector:
+        selector.record(params, first_provider, time.time() - start)
+
+    return response
+
+def query_node_list(project_id, node_providers, params,
+        explicit_treenode_ids=tuple(), explicit_connector_ids=tuple(),
+        include_labels=False, target_format='json', with_relation_map=True,
+        selector=None):
+    """Return the result of the first matching node provider that has one,
+    along with its data type and the first matching node provider, which is
+    the one the query time is recorded for.
     """
+    matching_providers = [p for p in node_providers if p.matches(params)]
+    if selector:
+        matching_providers = selector.order(matching_providers, params)
+
     result_tuple, data_type = None, None
-    for node_provider in node_providers:
-        if node_provider.matches(params):
-            result = node_provider.get_tuples(params, project_id,
-                explicit_treenode_ids, explicit_connector_ids, include_labels,
-                with_relation_map)
-            result_tuple, data_type =  result
+    for node_provider in matching_providers:
+        result = node_provider.get_tuples(params, project_id,
+            explicit_treenode_ids, explicit_connector_ids, include_labels,
+            with_relation_map, target_format)
+        result_tuple, data_type =  result
 
-            if result_tuple and data_type:
-                break
+        if result_tuple and data_type:
+            break
 
     if not (result_tuple and data_type):
         raise ValueError("Could not find matching node provider for request")
 
-    return create_node_response(result_tuple, params, target_format, target_options, data_type)
+    return result_tuple, data_type, matching_providers[0]
 
 def create_node_response(result, params, target_format, target_options, data_type):
+    # Data that is already encoded in the target format, e.g. cached data, is
+    # sent as is.
     if target_format == 'json':
-        if data_type == 'json':
-            data = ujson.dumps(result)
-        elif data_type == 'json_text':
+        if data_type == 'json_text':
             data = result
-        elif data_type == 'msgpack':
-            data = ujson.dumps(msgpack.unpackb(result, use_list=False))
         else:
-            raise ValueError("Unknown data type: " + data_type)
+            data = ujson.dumps(decode_node_query_data(result, data_type))
         return HttpResponse(data, content_type='application/json')
     elif target_format == 'msgpack':
-        if data_type == 'json':
-            data = msgpack.packb(result)
-        elif data_type == 'json_text':
-            data = msgpack.packb(ujson.loads(result))
-        elif data_type == 'msgpack':
+        if data_type == 'msgpack':
             data = result
         else:
-            raise ValueError("Unknown data type: " + data_type)
+            data = msgpack.packb(decode_node_query_data(result, data_type))
         return HttpResponse(data, content_type='application/octet-stream')
-    elif target_format == 'png' or target_format == 'gif':
-        if data_type == 'json':
+    elif target_format == 'columnar':
+        if data_type == 'columnar':
             data = result
-        elif data_type == 'json_text':
-            data = ujson.loads(result)
-        elif data_type == 'msgpack':
-            data = msgpack.unpackb(result, use_list=False)
         else:
-            raise ValueError("Unknown data type: " + data_type)
+            data = encode_columnar_node_data(decode_node_query_data(result, data_type))
+        return HttpResponse(data, content_type='application/octet-stream')
+    elif target_format == 'png' or target_format == 'gif':
+        data = decode_node_query_data(result, data_type)
         width = target_options['view_width']
         height = target_options['view_height']
         view_min_x = params['left']
@@ -1438,7 +2814,7 @@ def create_node_response(result, params, target_format, target_options, data_typ
         xscale = width / (params['right'] - params['left'])
         yscale = height / (params['bottom'] - params['top'])
         image = render_nodes_xy(data, params, width, height, view_min_x,
-                view_min_y, xscale, yscale)
+                view_min_y, xscale, yscale, target_options.get('lod', 0))
         # serialize to HTTP response
         if target_format == 'png':
             response = HttpResponse(content_type="image/png")
@@ -1451,87 +2827,167 @@ def create_node_response(result, params, target_format, target_options, data_typ
         raise ValueError("Unknown target format: {}".format(target_format))
 
 def render_nodes_xy(node_data, params, width, height, view_min_x=0, view_min_y=0,
-        xscale=1.0, yscale=1.0):
-    """Render the passed in node data to an image.
+        xscale=1.0, yscale=1.0, lod=0):
+    """Render the passed in node data to an image. All coordinates are
+    transformed at once and nodes as well as edges to their parents are drawn
+    using NumPy arrays. Nodes outside of the query bounding box, whose parent
+    is outside as well, are represented by a virtual node in the first section
+    of the query bounding box, if their edge intersects it. If <lod> is larger
+    than zero, at most one node is drawn per square of <lod> pixels, edges are
+    drawn nonetheless.
     """
-    import random
     background = (255, 0, 0, 0)
-    image = Image.new('RGBA', (width, height), background)
+    node_color = (255, 0, 255, 255)
+    root_color = (255, 0, 0, 255)
+    radius = 2
+    virtual_nodes = True
 
-    radius = 4
-    hr = radius / 2.0
-    node_pen = Pen((255, 0, 255), 1)
-    root_pen = Pen('red', 1)
-    #leaf_pen = Pen('red', 1)
-    node_brush = Brush((255, 0, 255))
-    root_brush = Brush('red')
-    #leaf_brush = Brush('red')
+    pixels = np.zeros((height, width, 4), dtype=np.uint8)
+    pixels[:, :] = background
 
-    virtual_nodes = True
+    treenodes = node_data[0]
+    if not treenodes:
+        return Image.fromarray(pixels, 'RGBA')
 
     left, right = params['left'], params['right']
     top, bottom = params['top'], params['bottom']
     z1, z2 = params['z1'], params['z2']
 
-    # Map parents to children
-    nodes = dict()
-    treenodes = node_data[0]
-    for tn in treenodes:
-        nodes[tn[0]] = tn
-
-    draw = Draw(image)
-    # Add treenodes:
-    for tn in treenodes:
-        parent_id = tn[1]
-        x, y, z = tn[2], tn[3], tn[4]
-        xs, ys = None, None
-        virtual_node_created = False
-
-        is_outside = x < left or x >= right or y < top \
-                or y >= bottom or z < z1 or z >= z2
-
-        # If this node and its parent are outside, create a virtual node
-        # location and replace current coordinates.
-        if is_outside:
-            if virtual_nodes and parent_id:
-                parent_node = nodes.get(parent_id)
-                if parent_node:
-                    px, py, pz = parent_node[2], parent_node[3], parent_node[4]
-                    p_is_outside = px < left or px >= right or py < top \
-                            or py >= bottom or pz < z1 or pz >= z2
-
-                    # If the parent ist outside, too, find virtual node
-                    # location.
-                    if p_is_outside:
-                        dx, dy, dz = px - x, py - y, pz - z
-                        if dz > -0.0001 and dz < 0.0001:
-                            continue
-                        t = (z1 - z) / dz
-
-                        x = x + t * dx
-                        y = y + t * dy
-                        z = z1
-                        virtual_node_created = True
-
-            if not virtual_node_created:
-                continue
-
-        xs = xscale * (x - view_min_x)
-        ys = yscale * (y - view_min_y)
-
-        if parent_id:
-            pen = node_pen
-            brush = node_brush
-        else:
-            pen = root_pen
-            brush = root_brush
-
-        # Render node or virtual node
-        draw.ellipse((xs - hr, ys - hr, xs + hr, ys + hr), pen, brush)
-
-    draw.flush()
+    n_nodes = len(treenodes)
+    ids = np.fromiter((tn[0] for tn in treenodes), dtype=np.int64, count=n_nodes)
+    parent_ids = np.fromiter((tn[1] or -1 for tn in treenodes), dtype=np.int64,
+            count=n_nodes)
+    locations = np.array([tn[2:5] for tn in treenodes], dtype=np.float64)
+    x, y, z = locations[:, 0], locations[:, 1], locations[:, 2]
+
+    # Find the index of each parent node, -1 if it isn't part of the data.
+    order = np.argsort(ids)
+    sorted_ids = ids[order]
+    parent_pos = np.clip(np.searchsorted(sorted_ids, parent_ids), 0, n_nodes - 1)
+    has_parent = (parent_ids != -1) & (sorted_ids[parent_pos] == parent_ids)
+    parent_index = np.where(has_parent, order[parent_pos], -1)
+
+    inside = (x >= left) & (x < right) & (y >= top) & (y < bottom) & \
+            (z >= z1) & (z < z2)
+
+    # If a node and its parent are outside, create a virtual node location on
+    # the edge between both.
+    px, py, pz = x[parent_index], y[parent_index], z[parent_index]
+    visible = inside.copy()
+    if virtual_nodes:
+        dz = pz - z
+        virtual = ~inside & has_parent & ~inside[parent_index] & \
+                (np.abs(dz) >= 0.0001)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            t = np.where(virtual, (z1 - z) / dz, 0.0)
+        # Only edges that actually cross the first section get a virtual node.
+        virtual &= (t >= 0.0) & (t <= 1.0)
+        x = np.where(virtual, x + t * (px - x), x)
+        y = np.where(virtual, y + t * (py - y), y)
+        visible |= virtual
+
+    # Transform all coordinates into view space
+    xs = xscale * (x - view_min_x)
+    ys = yscale * (y - view_min_y)
+    pxs = xscale * (px - view_min_x)
+    pys = yscale * (py - view_min_y)
+
+    # Draw edges between visible nodes and their parents
+    edges = visible & has_parent
+    _draw_lines(pixels, xs[edges], ys[edges], pxs[edges], pys[edges], node_color)
+
+    node_xs = np.floor(xs[visible]).astype(np.int64)
+    node_ys = np.floor(ys[visible]).astype(np.int64)
+    # Nodes whose parent isn't part of the data aren't roots.
+    is_root = (parent_ids == -1)[visible]
+
+    # Level of detail: only draw the first node in each square of <lod> pixels,
+    # preferring root nodes. Nodes outside of the image are assigned to the
+    # squares at its border, so that they don't alias squares of other rows.
+    if lod and lod > 0:
+        roots_first = np.argsort(~is_root, kind='mergesort')
+        node_xs, node_ys = node_xs[roots_first], node_ys[roots_first]
+        is_root = is_root[roots_first]
+        cell_xs = np.clip(node_xs, 0, width) // lod
+        cell_ys = np.clip(node_ys, 0, height) // lod
+        cells = cell_ys * (width // lod + 1) + cell_xs
+        _, first = np.unique(cells, return_index=True)
+        node_xs, node_ys, is_root = node_xs[first], node_ys[first], is_root[first]
+
+    # Root nodes are drawn last, so that they are on top.
+    _draw_discs(pixels, node_xs[~is_root], node_ys[~is_root], radius, node_color)
+    _draw_discs(pixels, node_xs[is_root], node_ys[is_root], radius, root_color)
+
+    return Image.fromarray(pixels, 'RGBA')
+
+
+def _draw_discs(pixels, xs, ys, radius, color):
+    """Draw filled discs of the passed in radius around all passed in pixel
+    locations into the passed in RGBA array.
+    """
+    if not len(xs):
+        return
+    height, width = pixels.shape[0:2]
+    offsets = np.arange(-radius, radius + 1)
+    dx, dy = np.meshgrid(offsets, offsets)
+    in_disc = dx ** 2 + dy ** 2 <= radius ** 2
+    dx, dy = dx[in_disc], dy[in_disc]
+
+    all_xs = (xs[:, np.newaxis] + dx).ravel()
+    all_ys = (ys[:, np.newaxis] + dy).ravel()
+    valid = (all_xs >= 0) & (all_xs < width) & (all_ys >= 0) & (all_ys < height)
+    pixels[all_ys[valid], all_xs[valid]] = color
+
+
+def _draw_lines(pixels, x0, y0, x1, y1, color, max_samples=2**20):
+    """Draw all lines from (x0, y0) to (x1, y1) into the passed in RGBA array.
+    Lines are clipped to the image first and then sampled once per pixel
+    along their major axis. To limit memory use, lines are sampled in batches
+    of at most about <max_samples> pixels.
+    """
+    if not len(x0):
+        return
+    height, width = pixels.shape[0:2]
+    x0, y0, x1, y1, valid = _clip_lines(x0, y0, x1, y1, 0, 0, width, height)
+    x0, y0, x1, y1 = x0[valid], y0[valid], x1[valid], y1[valid]
+    if not len(x0):
+        return
 
-    return image
+    n_samples = np.ceil(np.maximum(np.abs(x1 - x0), np.abs(y1 - y0))).astype(np.int64) + 1
+    batch_index = np.cumsum(n_samples) // max_samples
+    batch_bounds = np.flatnonzero(np.diff(batch_index)) + 1
+    for batch in np.split(np.arange(len(x0)), batch_bounds):
+        samples = n_samples[batch]
+        line_index = np.repeat(batch, samples)
+        starts = np.cumsum(samples) - samples
+        step = np.arange(samples.sum()) - np.repeat(starts, samples)
+        t = step / np.maximum(n_samples[line_index] - 1, 1).astype(np.float64)
+
+        xs = np.floor(x0[line_index] + t * (x1 - x0)[line_index]).astype(np.int64)
+        ys = np.floor(y0[line_index] + t * (y1 - y0)[line_index]).astype(np.int64)
+        inside = (xs >= 0) & (xs < width) & (ys >= 0) & (ys < height)
+        pixels[ys[inside], xs[inside]] = color
+
+
+def _clip_lines(x0, y0, x1, y1, min_x, min_y, max_x, max_y):
+    """Clip all passed in lines to the passed in rectangle, using the
+    Liang-Barsky algorithm for all lines at once. Returns the clipped
+    coordinates along with a mask of lines that intersect the rectangle.
+    """
+    dx, dy = x1 - x0, y1 - y0
+    t0 = np.zeros(len(x0))
+    t1 = np.ones(len(x0))
+    valid = np.ones(len(x0), dtype=bool)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        for p, q in ((-dx, x0 - min_x), (dx, max_x - x0),
+                (-dy, y0 - min_y), (dy, max_y - y0)):
+            parallel = p == 0
+            valid &= ~(parallel & (q < 0))
+            r = q / p
+            t0 = np.where(~parallel & (p < 0), np.maximum(t0, r), t0)
+            t1 = np.where(~parallel & (p > 0), np.minimum(t1, r), t1)
+    valid &= t0 <= t1
+    return (x0 + t0 * dx, y0 + t0 * dy, x0 + t1 * dx, y0 + t1 * dy, valid)
 
 
 @requires_user_role(UserRole.Annotate)
@@ -1653,8 +3109,151 @@ def node_update(request, project_id=None):
     })
 
 
+# Selects all treenodes of a project within a Euclidean distance of a point,
+# along with their squared distance to it. The bounding box test on the
+# treenode_edge table is answered by its n-dimensional GiST index. Because every
+# edge starts at its child treenode (roots have a zero length edge), no
+# treenode in the box is missed.
+NODES_WITHIN_DISTANCE_QUERY = '''
+    SELECT t.id, t.location_x, t.location_y, t.location_z, t.skeleton_id,
+        (t.location_x - %(x)s) * (t.location_x - %(x)s) +
+        (t.location_y - %(y)s) * (t.location_y - %(y)s) +
+        (t.location_z - %(z)s) * (t.location_z - %(z)s) AS sq_distance
+    FROM treenode_edge te
+    JOIN treenode t
+        ON t.id = te.id
+    WHERE te.edge &&& ST_MakeLine(ARRAY[
+            ST_MakePoint(%(x)s - %(distance)s, %(y)s - %(distance)s, %(z)s - %(distance)s),
+            ST_MakePoint(%(x)s + %(distance)s, %(y)s + %(distance)s, %(z)s + %(distance)s)
+        ]::geometry[])
+      AND te.project_id = %(project_id)s
+      AND (t.location_x - %(x)s) * (t.location_x - %(x)s) +
+          (t.location_y - %(y)s) * (t.location_y - %(y)s) +
+          (t.location_z - %(z)s) * (t.location_z - %(z)s) <= %(distance)s * %(distance)s
+'''
+
+
+def get_proximity_query_limit(limit):
+    """Return the passed in result limit, capped by the
+    NODE_PROXIMITY_QUERY_MAXIMUM_COUNT setting.
+    """
+    max_limit = getattr(settings, 'NODE_PROXIMITY_QUERY_MAXIMUM_COUNT', None)
+    if limit < 1:
+        raise ValueError('The result limit has to be positive')
+    if max_limit:
+        return min(limit, max_limit)
+    return limit
+
+
+def find_nodes_within_distance(project_id, x, y, z, distance, limit=None,
+        offset=0, cursor=None):
+    """Find all treenodes of a project within the passed in Euclidean distance
+    of a location. Returns a list of (id, x, y, z, skeleton_id, distance)
+    tuples, ordered by distance and ID.
+    """
+    if not cursor:
+        cursor = connection.cursor()
+    cursor.execute('''
+        SELECT n.id, n.location_x, n.location_y, n.location_z, n.skeleton_id,
+            sqrt(n.sq_distance)
+        FROM ({}) n
+        ORDER BY n.sq_distance, n.id
+        LIMIT %(limit)s
+        OFFSET %(offset)s
+    '''.format(NODES_WITHIN_DISTANCE_QUERY), {
+        'project_id': project_id,
+        'x': x,
+        'y': y,
+        'z': z,
+        'distance': distance,
+        'limit': limit,
+        'offset': offset,
+    })
+    return cursor.fetchall()
+
+
+def find_nearest_nodes(project_id, x, y, z, limit=1, offset=0,
+        skeleton_ids=None, cursor=None):
+    """Find the treenodes closest to the passed in location, ordered by their
+    Euclidean distance and ID. Returns a list of (id, x, y, z, skeleton_id,
+    distance) tuples. If skeleton IDs are passed in, only their treenodes are
+    considered.
+
+    Without skeleton constraint, the nearest neighbor index ordering of the
+    treenode_edge table is used to find the required number of candidate nodes.
+    The largest distance of a candidate is an upper bound for the distance of
+    all result nodes, which are then found with an exact radius query.
+    """
+    if not cursor:
+        cursor = connection.cursor()
+
+    if skeleton_ids is not None:
+        cursor.execute('''
+            SELECT t.id, t.location_x, t.location_y, t.location_z,
+                t.skeleton_id, sqrt(
+                    (t.location_x - %(x)s) * (t.location_x - %(x)s) +
+                    (t.location_y - %(y)s) * (t.location_y - %(y)s) +
+                    (t.location_z - %(z)s) * (t.location_z - %(z)s)) AS distance
+            FROM treenode t
+            WHERE t.project_id = %(project_id)s
+              AND t.skeleton_id = ANY(%(skeleton_ids)s::bigint[])
+            ORDER BY distance, t.id
+            LIMIT %(limit)s
+            OFFSET %(offset)s
+        ''', {
+            'project_id': project_id,
+            'skeleton_ids': list(skeleton_ids),
+            'x': x,
+            'y': y,
+            'z': z,
+            'limit': limit,
+            'offset': offset,
+        })
+        return cursor.fetchall()
+
+    cursor.execute('''
+        SELECT max(sqrt(
+            (t.location_x - %(x)s) * (t.location_x - %(x)s) +
+            (t.location_y - %(y)s) * (t.location_y - %(y)s) +
+            (t.location_z - %(z)s) * (t.location_z - %(z)s)))
+        FROM (
+            SELECT te.id
+            FROM treenode_edge te
+            WHERE te.project_id = %(project_id)s
+            ORDER BY te.edge <<->> ST_MakePoint(%(x)s, %(y)s, %(z)s)
+            LIMIT %(n_candidates)s
+        ) candidate
+        JOIN treenode t
+            ON t.id = candidate.id
+    ''', {
+        'project_id': project_id,
+        'x': x,
+        'y': y,
+        'z': z,
+        'n_candidates': limit + offset,
+    })
+    max_distance = cursor.fetchone()[0]
+    if max_distance is None:
+        return []
+
+    # Make sure rounding doesn't exclude the farthest candidate. Additional
+    # nodes are cut off by the limit anyway.
+    max_distance = max_distance * (1 + 1e-9) + 1e-6
+
+    return find_nodes_within_distance(project_id, x, y, z, max_distance,
+            limit, offset, cursor)
+
+
 @requires_user_role([UserRole.Annotate, UserRole.Browse])
 def node_nearest(request, project_id=None):
+    """Find the treenode closest to a location in Euclidean distance.
+
+    The search can be constrained to a skeleton or to the skeletons of a
+    neuron, otherwise all treenodes of the project are considered. If a limit
+    is passed in, a list of the closest treenodes is returned, which can be
+    paged through with an offset. The limit is capped by the
+    NODE_PROXIMITY_QUERY_MAXIMUM_COUNT setting.
+    """
     params = {}
     param_float_defaults = {
         'x': 0,
@@ -1662,27 +3261,30 @@ def node_nearest(request, project_id=None):
         'z': 0}
     param_int_defaults = {
         'skeleton_id': -1,
-        'neuron_id': -1}
+        'neuron_id': -1,
+        'limit': 1,
+        'offset': 0}
     for p in param_float_defaults.keys():
         params[p] = float(request.POST.get(p, param_float_defaults[p]))
     for p in param_int_defaults.keys():
         params[p] = int(request.POST.get(p, param_int_defaults[p]))
-    relation_map = get_relation_to_id_map(project_id)
+    return_list = 'limit' in request.POST
+    limit = get_proximity_query_limit(params['limit'])
+    offset = max(0, params['offset'])
 
-    if params['skeleton_id'] < 0 and params['neuron_id'] < 0:
-        raise Exception('You must specify either a skeleton or a neuron')
-
-    for rel in ['part_of', 'model_of']:
-        if rel not in relation_map:
-            raise Exception('Could not find required relation %s for project %s.' % (rel, project_id))
-
-    skeletons = []
+    skeletons = None
+    if params['skeleton_id'] > 0 or params['neuron_id'] > 0:
+        skeletons = []
     if params['skeleton_id'] > 0:
         skeletons.append(params['skeleton_id'])
 
     response_on_error = ''
     try:
         if params['neuron_id'] > 0:  # Add skeletons related to specified neuron
+            relation_map = get_relation_to_id_map(project_id, ('model_of',))
+            if 'model_of' not in relation_map:
+                raise Exception('Could not find required relation model_of '
+                        'for project %s.' % project_id)
             # Assumes that a cici 'model_of' relationship always involves a
             # skeleton as ci_a and a neuron as ci_b.
             response_on_error = 'Finding the skeletons failed.'
@@ -1692,37 +3294,26 @@ def node_nearest(request, project_id=None):
             for neur_skel_relation in neuron_skeletons:
                 skeletons.append(neur_skel_relation.class_instance_a_id)
 
-        # Get all treenodes connected to skeletons
         response_on_error = 'Finding the treenodes failed.'
-        treenodes = Treenode.objects.filter(project=project_id, skeleton__in=skeletons)
-
-        def getNearestTreenode(x, y, z, treenodes):
-            minDistance = -1
-            nearestTreenode = None
-            for tn in treenodes:
-                xdiff = x - tn.location_x
-                ydiff = y - tn.location_y
-                zdiff = z - tn.location_z
-                distanceSquared = xdiff ** 2 + ydiff ** 2 + zdiff ** 2
-                if distanceSquared < minDistance or minDistance < 0:
-                    nearestTreenode = tn
-                    minDistance = distanceSquared
-            return nearestTreenode
-
-        nearestTreenode = getNearestTreenode(
-            params['x'],
-            params['y'],
-            params['z'],
-            treenodes)
-        if nearestTreenode is None:
+        nearest_nodes = find_nearest_nodes(project_id, params['x'],
+                params['y'], params['z'], limit, offset, skeletons)
+
+        nodes = [{
+            'treenode_id': n[0],
+            'x': int(n[1]),
+            'y': int(n[2]),
+            'z': int(n[3]),
+            'skeleton_id': n[4]} for n in nearest_nodes]
+
+        if return_list:
+            return JsonResponse(nodes, safe=False)
+
+        if not nodes:
+            if skeletons is None:
+                raise Exception('No treenodes were found in project %s' % project_id)
             raise Exception('No treenodes were found for skeletons in %s' % skeletons)
 
-        return JsonResponse({
-            'treenode_id': nearestTreenode.id,
-            'x': int(nearestTreenode.location_x),
-            'y': int(nearestTreenode.location_y),
-            'z': int(nearestTreenode.location_z),
-            'skeleton_id': nearestTreenode.skeleton_id})
+        return JsonResponse(nodes[0])
 
     except Exception as e:
         raise Exception(response_on_error + ':' + str(e))
@@ -0,0 +1,157 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import logging
+import threading
+import time
+
+from multiprocessing.pool import ThreadPool
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from django.conf import settings
+
+
+logger = logging.getLogger(__name__)
+
+
+class MetadataClient(object):
+    """Load JSON metadata from remote services like the Janelia Render service
+    or DVID. Connections are kept alive in a shared pool and parsed responses
+    are cached by URL. Entries younger than max_age are returned as they are.
+    Entries younger than max_age + stale_age are returned as well, but are
+    refreshed in a background thread (stale-while-revalidate). All other
+    requests block until a response is available. Failed requests are never
+    cached and raise a ValueError. If both max_age and stale_age are zero,
+    nothing is cached.
+
+    Returned objects are shared between callers and must not be modified.
+    """
+
+    def __init__(self, max_age=60, stale_age=600, timeout=30, workers=8,
+            session=None):
+        self.max_age = max_age
+        self.stale_age = stale_age
+        self.timeout = timeout
+        self.workers = max(1, workers)
+        if session is None:
+            session = requests.Session()
+            adapter = HTTPAdapter(
+                    pool_connections=self.workers, pool_maxsize=self.workers)
+            session.mount('http://', adapter)
+            session.mount('https://', adapter)
+        self.session = session
+        self._entries = {}
+        self._refreshing = set()
+        self._lock = threading.Lock()
+
+    def _get_key(self, url, headers):
+        return (url, tuple(sorted(headers.items())) if headers else None)
+
+    def _fetch(self, url, headers):
+        try:
+            r = self.session.get(url, headers=headers, timeout=self.timeout)
+            r.raise_for_status()
+            data = r.json()
+        except (requests.exceptions.RequestException, ValueError) as e:
+            raise ValueError("Couldn't retrieve metadata from %s: %s" % (url, e))
+
+        if self.max_age + self.stale_age > 0:
+            with self._lock:
+                self._entries[self._get_key(url, headers)] = (time.time(), data)
+        return data
+
+    def _refresh(self, key, url, headers):
+        try:
+            self._fetch(url, headers)
+        except ValueError as e:
+            # The stale entry is served until it expires completely
+            logger.warning("Could not refresh metadata: %s" % e)
+        finally:
+            with self._lock:
+                self._refreshing.discard(key)
+
+    def _get_cached(self, url, headers):
+        """Return a (hit, data) tuple. Stale hits trigger a background
+        refresh, unless one is running already.
+        """
+        key = self._get_key(url, headers)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return False, None
+            age = time.time() - entry[0]
+            if age < self.max_age:
+                return True, entry[1]
+            if age >= self.max_age + self.stale_age:
+                del self._entries[key]
+                return False, None
+            refresh = key not in self._refreshing
+            if refresh:
+                self._refreshing.add(key)
+
+        if refresh:
+            t = threading.Thread(target=self._refresh, args=(key, url, headers))
+            t.daemon = True
+            t.start()
+        return True, entry[1]
+
+    def get_json(self, url, headers=None):
+        """Return the parsed JSON response of the passed in URL.
+        """
+        hit, data = self._get_cached(url, headers)
+        if hit:
+            return data
+        return self._fetch(url, headers)
+
+    def get_many(self, urls, headers=None):
+        """Return a list of parsed JSON responses for the passed in URLs, in
+        the same order. Responses that aren't cached are fetched in parallel.
+        """
+        results = [None] * len(urls)
+        missing = []
+        for n, url in enumerate(urls):
+            hit, data = self._get_cached(url, headers)
+            if hit:
+                results[n] = data
+            else:
+                missing.append(n)
+
+        if len(missing) == 1:
+            n = missing[0]
+            results[n] = self._fetch(urls[n], headers)
+        elif missing:
+            pool = ThreadPool(min(self.workers, len(missing)))
+            try:
+                fetched = pool.map(lambda n: self._fetch(urls[n], headers),
+                        missing)
+            finally:
+                pool.close()
+                pool.join()
+            for n, data in zip(missing, fetched):
+                results[n] = data
+
+        return results
+
+    def invalidate(self):
+        """Remove all cached responses.
+        """
+        with self._lock:
+            self._entries.clear()
+
+
+_metadata_client = None
+
+def get_metadata_client():
+    """Return the metadata client of this process, which is configured through
+    the REMOTE_METADATA_* settings.
+    """
+    global _metadata_client
+    if _metadata_client is None:
+        _metadata_client = MetadataClient(
+                max_age=settings.REMOTE_METADATA_CACHE_MAX_AGE,
+                stale_age=settings.REMOTE_METADATA_STALE_MAX_AGE,
+                timeout=settings.REMOTE_METADATA_TIMEOUT,
+                workers=settings.REMOTE_METADATA_WORKERS)
+    return _metadata_client
@@ -67,14 +67,18 @@ def get_review_count(skeleton_ids):
     """ Returns a dictionary that maps skelton IDs to dictonaries that map
     user_ids to a review count for this particular skeleton.
     """
-    # Count nodes that have been reviewed by each user in each partner skeleton
+    # Count nodes that have been reviewed by each user in each partner
+    # skeleton, based on the review summary table.
     cursor = connection.cursor()
     cursor.execute('''
-    SELECT skeleton_id, reviewer_id, count(*)
-    FROM review
-    WHERE skeleton_id IN (%s)
-    GROUP BY reviewer_id, skeleton_id
-    ''' % ",".join(map(str, skeleton_ids)))
+    SELECT rs.skeleton_id, reviewer.id, SUM(rs.num_reviewed_nodes)
+    FROM catmaid_skeleton_review_summary rs
+    CROSS JOIN LATERAL UNNEST(rs.reviewer_ids) reviewer(id)
+    WHERE rs.skeleton_id = ANY(%(skeleton_ids)s::bigint[])
+    GROUP BY rs.skeleton_id, reviewer.id
+    ''', {
+        'skeleton_ids': list(skeleton_ids),
+    })
     # Build dictionary
     reviews = defaultdict(lambda: defaultdict(int))
     for row in cursor.fetchall():
@@ -90,7 +94,8 @@ def get_review_status(skeleton_ids, project_id=None, whitelist_id=False,
     according to the user's whitelist. Otherwise, if <user_ids>
     evaluates to false a union review is returned. Otherwise a list of
     user IDs is expected to create a review status for a sub-union or a
-    single user.
+    single user. Review counts are read from the review summary tables,
+    which are maintained by the database.
     """
     if user_ids and excluding_user_ids:
         raise ValueError("user_ids and excluding_user_ids can't be used at the same time")
@@ -126,47 +131,41 @@ def get_review_status(skeleton_ids, project_id=None, whitelist_id=False,
         'skeleton_ids': skeleton_ids
     }
 
-    query_joins = []
-    extra_conditions = ''
-    # Optionally, add a filter
     if whitelist_id:
+        # Count number of nodes reviewed by the reviewers of a whitelist
+        # after their respective accept date, per skeleton.
         query_params['whitelist_id'] = whitelist_id
-        query_joins.append("""
-            JOIN reviewer_whitelist wl
-                ON (wl.user_id = %(whitelist_id)s AND wl.project_id = %(project_id)s
-                    AND r.reviewer_id = wl.reviewer_id
-                    AND r.review_time >= wl.accept_after)
-        """)
-    elif user_ids:
-        # Count number of nodes reviewed by a certain set of users, per
-        # skeleton.
-        query_params['user_ids'] = list(user_ids)
-        query_joins.append("""
-            JOIN (
-                SELECT * FROM UNNEST(%(user_ids)s::int[])
-            ) allowed_user(id)
-                ON r.reviewer_id = allowed_user.id
-        """)
-    elif excluding_user_ids:
-        # Count number of nodes reviewed by all users excluding the
-        # specified ones, per skeleton.
-        query_params['excluding_user_ids'] = list(excluding_user_ids)
-        extra_conditions = "WHERE NOT (r.reviewer_id = ANY (%(excluding_user_ids)s::int[]))"
+        cursor.execute('''
+            SELECT skeleton_id, num_reviewed_nodes
+            FROM catmaid_skeleton_whitelist_review
+            WHERE project_id = %(project_id)s
+              AND user_id = %(whitelist_id)s
+              AND skeleton_id = ANY(%(skeleton_ids)s::bigint[])
+        ''', query_params)
+    else:
+        # Each reviewed node is counted in exactly one summary row of its
+        # skeleton, the one of the set of all its reviewers. A node is
+        # reviewed by a set of users if its reviewer set overlaps with it.
+        extra_conditions = ''
+        if user_ids:
+            # Count number of nodes reviewed by a certain set of users, per
+            # skeleton.
+            query_params['user_ids'] = list(user_ids)
+            extra_conditions = "AND rs.reviewer_ids && %(user_ids)s::int[]"
+        elif excluding_user_ids:
+            # Count number of nodes reviewed by all users excluding the
+            # specified ones, per skeleton.
+            query_params['excluding_user_ids'] = list(excluding_user_ids)
+            extra_conditions = "AND NOT (rs.reviewer_ids <@ %(excluding_user_ids)s::int[])"
+
+        cursor.execute('''
+            SELECT rs.skeleton_id, SUM(rs.num_reviewed_nodes)
+            FROM catmaid_skeleton_review_summary rs
+            WHERE rs.skeleton_id = ANY(%(skeleton_ids)s::bigint[])
+            {}
+            GROUP BY rs.skeleton_id
+        '''.format(extra_conditions), query_params)
 
-    cursor.execute('''
-    SELECT skeleton_id, count(*)
-    FROM (SELECT skeleton_id, treenode_id
-          FROM review r
-          {}
-          JOIN (
-              SELECT * FROM UNNEST(%(skeleton_ids)s::bigint[])
-          ) query_skeleton(id)
-            ON r.skeleton_id = query_skeleton.id
-          GROUP BY skeleton_id, treenode_id
-          {}
-    ) AS sub
-    GROUP BY skeleton_id
-    '''.format('\n'.join(query_joins), extra_conditions), query_params)
     for row in cursor.fetchall():
         skeletons[row[0]][1] = row[1]
 
@@ -3,19 +3,19 @@ from __future__ import unicode_literals
 
 import json
 import networkx as nx
+import os
 import pytz
 import re
 import six
 
 from datetime import datetime, timedelta
 from collections import defaultdict
-from itertools import chain
 
 from django.conf import settings
 from django.http import HttpResponse, HttpResponseBadRequest, Http404, \
         JsonResponse
 from django.shortcuts import get_object_or_404
-from django.db import connection
+from django.db import connection, transaction
 from django.db.models import Q
 from django.views.decorators.cache import never_cache
 
@@ -30,13 +30,15 @@ from catmaid.objects import Skeleton, SkeletonGroup, \
 from catmaid.control.authentication import requires_user_role, \
         can_edit_class_instance_or_fail, can_edit_or_fail
 from catmaid.control.common import (insert_into_log, get_class_to_id_map,
-        get_relation_to_id_map, _create_relation, get_request_bool,
-        get_request_list)
+        get_relation_to_id_map, get_request_bool, get_request_list)
+from catmaid.control.copy_archive import copy_rows
 from catmaid.control.neuron import _delete_if_empty
 from catmaid.control.neuron_annotations import (annotations_for_skeleton,
         create_annotation_query, _annotate_entities, _update_neuron_annotations)
+from catmaid.control.node import (_fetch_location, get_proximity_query_limit,
+        NODES_WITHIN_DISTANCE_QUERY)
 from catmaid.control.review import get_review_status
-from catmaid.control.tree_util import find_root, reroot, edge_count_to_root
+from catmaid.control.tree_util import reroot, edge_count_to_root
 from catmaid.control.volume import get_volume_details
 
 
@@ -293,9 +295,12 @@ def find_labels(request, project_id=None, skeleton_id=None):
 @api_view(['POST'])
 @requires_user_role(UserRole.Browse)
 def within_spatial_distance(request, project_id=None):
-    """Find skeletons within a given L-infinity distance of a treenode.
+    """Find skeletons within a given Euclidean distance of a treenode.
 
-    Returns at most 100 results.
+    Skeletons are ordered by the distance of their closest node in the search
+    area. By default, at most 100 results are returned, a different limit can
+    be passed in. It is capped by the NODE_PROXIMITY_QUERY_MAXIMUM_COUNT
+    setting. Together with an offset, this allows to page through results.
     ---
     parameters:
         - name: treenode_id
@@ -304,7 +309,7 @@ def within_spatial_distance(request, project_id=None):
           type: integer
           paramType: form
         - name: distance
-          description: L-infinity distance in nanometers within which to search
+          description: Euclidean distance in nanometers within which to search
           required: false
           default: 0
           type: integer
@@ -317,9 +322,21 @@ def within_spatial_distance(request, project_id=None):
           default: 0
           type: integer
           paramType: form
+        - name: limit
+          description: Maximum number of skeletons to return
+          required: false
+          default: 100
+          type: integer
+          paramType: form
+        - name: offset
+          description: Number of skeletons to skip, for paging
+          required: false
+          default: 0
+          type: integer
+          paramType: form
     type:
       reached_limit:
-        description: Whether the limit of at most 100 skeletons was reached
+        description: Whether more skeletons than the limit were found
         type: boolean
         required: true
       skeletons:
@@ -338,6 +355,8 @@ def within_spatial_distance(request, project_id=None):
     if 0 == distance:
         return JsonResponse({"skeletons": []})
     size_mode = int(request.POST.get("size_mode", 0))
+    limit = get_proximity_query_limit(int(request.POST.get('limit', 100)))
+    offset = max(0, int(request.POST.get('offset', 0)))
     having = ""
 
     if 0 == size_mode:
@@ -346,39 +365,34 @@ def within_spatial_distance(request, project_id=None):
         having = "HAVING count(*) = 1"
     # else, no constraint
 
+    pos = _fetch_location(project_id, tnid)
+
+    # One more skeleton than requested is fetched to know if there are more
+    # results.
     cursor = connection.cursor()
-    cursor.execute('SELECT location_x, location_y, location_z FROM treenode WHERE id=%s' % tnid)
-    pos = cursor.fetchone()
-
-    limit = 100
-    x0 = pos[0] - distance
-    x1 = pos[0] + distance
-    y0 = pos[1] - distance
-    y1 = pos[1] + distance
-    z0 = pos[2] - distance
-    z1 = pos[2] + distance
-
-    # Cheap emulation of the distance
     cursor.execute('''
-SELECT skeleton_id, count(*)
-FROM treenode
-WHERE project_id = %s
-  AND location_x > %s
-  AND location_x < %s
-  AND location_y > %s
-  AND location_y < %s
-  AND location_z > %s
-  AND location_z < %s
-GROUP BY skeleton_id
-%s
-LIMIT %s
-''' % (project_id, x0, x1, y0, y1, z0, z1, having, limit))
-
+        SELECT n.skeleton_id
+        FROM ({query}) n
+        GROUP BY n.skeleton_id
+        {having}
+        ORDER BY min(n.sq_distance), n.skeleton_id
+        LIMIT %(limit)s
+        OFFSET %(offset)s
+    '''.format(query=NODES_WITHIN_DISTANCE_QUERY, having=having), {
+        'project_id': project_id,
+        'x': pos[1],
+        'y': pos[2],
+        'z': pos[3],
+        'distance': distance,
+        'limit': limit + 1,
+        'offset': offset,
+    })
 
-    skeletons = tuple(row[0] for row in cursor.fetchall())
+    skeletons = [row[0] for row in cursor.fetchall()]
+    reached_limit = len(skeletons) > limit
 
-    return JsonResponse({"skeletons": skeletons,
-                         "reached_limit": limit == len(skeletons)})
+    return JsonResponse({"skeletons": skeletons[:limit],
+                         "reached_limit": reached_limit})
 
 
 @requires_user_role([UserRole.Annotate, UserRole.Browse])
@@ -1231,46 +1245,43 @@ def get_connectivity_matrix(project_id, row_skeleton_ids, col_skeleton_ids,
     synapse counts.
     """
     cursor = connection.cursor()
-    relation_map = get_relation_to_id_map(project_id)
-    post_rel_id = relation_map['postsynaptic_to']
-    pre_rel_id = relation_map['presynaptic_to']
-
-    if with_locations:
-      extra_select = ', c.id, c.location_x, c.location_y, c.location_z'
-      extra_join = 'JOIN connector c ON c.id = t2.connector_id'
-    else:
-      extra_select = ''
-      extra_join = ''
-
-    # Obtain all synapses made between row skeletons and column skeletons.
-    cursor.execute('''
-    SELECT t1.skeleton_id, t2.skeleton_id
-        {extra_select}
-    FROM treenode_connector t1,
-         treenode_connector t2
-        {extra_join}
-    WHERE t1.skeleton_id = ANY(%(row_skeleton_ids)s::integer[])
-      AND t2.skeleton_id = ANY(%(col_skeleton_ids)s::integer[])
-      AND t1.connector_id = t2.connector_id
-      AND t1.relation_id = %(pre_rel_id)s
-      AND t2.relation_id = %(post_rel_id)s
-    '''.format(**{
-      'extra_select': extra_select,
-      'extra_join': extra_join,
-    }), {
-      'row_skeleton_ids': list(row_skeleton_ids),
-      'col_skeleton_ids': list(col_skeleton_ids),
-      'pre_rel_id': pre_rel_id,
-      'post_rel_id': post_rel_id
-    })
 
     # Build a sparse connectivity representation. For all skeletons requested
     # map a dictionary of partner skeletons and the number of synapses
     # connecting to each partner. If locations should be returned as well, an
     # object with the fields 'count' and 'locations' is returned instead of a
     # single count.
+    outgoing = defaultdict(dict)
     if with_locations:
-      outgoing = defaultdict(dict)
+      relation_map = get_relation_to_id_map(project_id)
+      # Obtain all synapses made between row skeletons and column skeletons,
+      # only connected skeleton pairs are looked at.
+      cursor.execute('''
+      WITH partner AS (
+          SELECT DISTINCT pre_skeleton_id, post_skeleton_id
+          FROM catmaid_skeleton_synapse_edge
+          WHERE pre_skeleton_id = ANY(%(row_skeleton_ids)s::bigint[])
+            AND post_skeleton_id = ANY(%(col_skeleton_ids)s::bigint[])
+      )
+      SELECT t1.skeleton_id, t2.skeleton_id, c.id, c.location_x,
+          c.location_y, c.location_z
+      FROM partner p
+      JOIN treenode_connector t1
+          ON t1.skeleton_id = p.pre_skeleton_id
+      JOIN treenode_connector t2
+          ON t2.connector_id = t1.connector_id
+          AND t2.skeleton_id = p.post_skeleton_id
+      JOIN connector c
+          ON c.id = t2.connector_id
+      WHERE t1.relation_id = %(pre_rel_id)s
+        AND t2.relation_id = %(post_rel_id)s
+      ''', {
+        'row_skeleton_ids': list(row_skeleton_ids),
+        'col_skeleton_ids': list(col_skeleton_ids),
+        'pre_rel_id': relation_map['presynaptic_to'],
+        'post_rel_id': relation_map['postsynaptic_to'],
+      })
+
       for r in cursor.fetchall():
           source, target = r[0], r[1]
           mapping = outgoing[source]
@@ -1291,12 +1302,20 @@ def get_connectivity_matrix(project_id, row_skeleton_ids, col_skeleton_ids,
           else:
             info['locations'][connector_id]['count'] += 1
     else:
-      outgoing = defaultdict(dict)
-      for r in cursor.fetchall():
-          source, target = r[0], r[1]
-          mapping = outgoing[source]
-          count = mapping.get(target, 0)
-          mapping[target] = count + 1
+      # Synapse counts are precomputed for each pair of skeletons
+      cursor.execute('''
+      SELECT pre_skeleton_id, post_skeleton_id, SUM(n_synapses)
+      FROM catmaid_skeleton_synapse_edge
+      WHERE pre_skeleton_id = ANY(%(row_skeleton_ids)s::bigint[])
+        AND post_skeleton_id = ANY(%(col_skeleton_ids)s::bigint[])
+      GROUP BY pre_skeleton_id, post_skeleton_id
+      ''', {
+        'row_skeleton_ids': list(row_skeleton_ids),
+        'col_skeleton_ids': list(col_skeleton_ids),
+      })
+
+      for source, target, count in cursor.fetchall():
+          outgoing[source][target] = int(count)
 
     return outgoing
 
@@ -1750,11 +1769,105 @@ def import_skeleton(request, project_id=None):
     return HttpResponseBadRequest('No file received.')
 
 
+@api_view(['POST'])
+@requires_user_role(UserRole.Import)
+def import_skeletons(request, project_id=None):
+    """Import many neurons modeled by skeletons from uploaded files at once.
+
+    Each file is imported as a new neuron and skeleton, which are named after
+    the file name without extension. SWC files (.swc) and compact skeleton
+    JSON files (.json) are supported, the latter as returned by the
+    compact-detail and compact-arbor endpoints. All skeletons are imported in
+    a single transaction, either all or none of them are created.
+    ---
+    consumes: multipart/form-data
+    parameters:
+      - name: with_node_id_map
+        description: >
+            Whether a map from node IDs in the import files to IDs of the
+            created nodes should be returned for each skeleton.
+        paramType: form
+        type: boolean
+        defaultValue: false
+      - name: files
+        required: true
+        description: The skeleton representation files to import.
+        paramType: body
+        dataType: File
+    type:
+        skeletons:
+            type: array
+            required: true
+            description: >
+                An object for each imported file, with the fields file,
+                neuron_id, skeleton_id and n_nodes and optionally
+                node_id_map, in the order of the uploaded files.
+    """
+    with_node_id_map = get_request_bool(request.POST, 'with_node_id_map', False)
+
+    if not request.FILES:
+        return HttpResponseBadRequest('No file received.')
+
+    skeletons = []
+    file_names = []
+    for uploadedfile in request.FILES.values():
+        if uploadedfile.size > settings.IMPORTED_SKELETON_FILE_MAXIMUM_SIZE:
+            return HttpResponse('File {} too large. Maximum file size is {} bytes.'.format(
+                    uploadedfile.name, settings.IMPORTED_SKELETON_FILE_MAXIMUM_SIZE), status=413)
+
+        name, extension = os.path.splitext(uploadedfile.name)
+        extension = extension.strip().lower()
+        content = uploadedfile.read().decode('utf-8')
+        if extension == '.swc':
+            nodes = parse_swc(content)
+        elif extension == '.json':
+            nodes = parse_compact_skeleton(content)
+        else:
+            return HttpResponse('File type "{}" not understood. Known file types: swc, json'.format(
+                    extension), status=415)
+        skeletons.append({'name': name, 'nodes': nodes})
+        file_names.append(uploadedfile.name)
+
+    import_info = _import_skeletons(request.user, project_id, skeletons)
+
+    result = []
+    for file_name, skeleton, info in zip(file_names, skeletons, import_info):
+        entry = {
+            'file': file_name,
+            'neuron_id': info['neuron_id'],
+            'skeleton_id': info['skeleton_id'],
+            'n_nodes': len(skeleton['nodes']),
+        }
+        if with_node_id_map:
+            entry['node_id_map'] = info['node_id_map']
+        result.append(entry)
+
+    return JsonResponse({
+        'skeletons': result
+    })
+
+
 def import_skeleton_swc(user, project_id, swc_string, neuron_id=None, name=None):
     """Import a neuron modeled by a skeleton in SWC format.
     """
+    import_info = _import_skeletons(user, project_id, [{
+        'name': name,
+        'neuron_id': neuron_id,
+        'nodes': parse_swc(swc_string),
+    }])[0]
 
-    g = nx.DiGraph()
+    return JsonResponse({
+            'neuron_id': import_info['neuron_id'],
+            'skeleton_id': import_info['skeleton_id'],
+            'node_id_map': import_info['node_id_map'],
+        })
+
+
+def parse_swc(swc_string):
+    """Return a list of (node_id, parent_id, x, y, z, radius, confidence)
+    tuples for the passed in SWC text. Root nodes have a parent ID of None.
+    """
+    nodes = []
     for line in swc_string.splitlines():
         if line.startswith('#') or not line.strip():
             continue
@@ -1762,144 +1875,173 @@ def import_skeleton_swc(user, project_id, swc_string, neuron_id=None, name=None)
         if len(row) != 7:
             raise ValueError('SWC has a malformed line: {}'.format(line))
 
-        node_id = int(row[0])
         parent_id = int(row[6])
-        g.add_node(node_id, {'x': float(row[2]),
-                             'y': float(row[3]),
-                             'z': float(row[4]),
-                             'radius': float(row[5])})
+        nodes.append((int(row[0]), None if parent_id == -1 else parent_id,
+                float(row[2]), float(row[3]), float(row[4]), float(row[5]), 5))
+    return nodes
 
-        if parent_id != -1:
-            g.add_edge(parent_id, node_id)
 
-    if not nx.is_directed_acyclic_graph(g):
-        raise ValueError('SWC skeleton is malformed: it contains a cycle.')
-
-    import_info = _import_skeleton(user, project_id, g, neuron_id, name)
-    node_id_map = {n: d['id'] for n, d in import_info['graph'].nodes_iter(data=True)}
-
-    return JsonResponse({
-            'neuron_id': import_info['neuron_id'],
-            'skeleton_id': import_info['skeleton_id'],
-            'node_id_map': node_id_map,
-        })
+def parse_compact_skeleton(json_string):
+    """Return a list of (node_id, parent_id, x, y, z, radius, confidence)
+    tuples for the passed in compact skeleton JSON. Only the first element,
+    the node list, is read. Its rows are expected to have the format [id,
+    parent_id, user_id, x, y, z, radius, confidence].
+    """
+    try:
+        data = json.loads(json_string)
+        return [(int(n[0]), None if n[1] is None else int(n[1]), float(n[3]),
+                float(n[4]), float(n[5]), float(n[6]), int(n[7]))
+                for n in data[0]]
+    except (ValueError, TypeError, IndexError, KeyError) as e:
+        raise ValueError('Compact skeleton is malformed: {}'.format(e))
 
 
-def _import_skeleton(user, project_id, arborescence, neuron_id=None, name=None):
-    """Create a skeleton from a networkx directed tree.
+def _check_arborescence(nodes):
+    """Raise a ValueError if the passed in node tuples don't form a single
+    tree with exactly one root. Returns the index of the root node.
+    """
+    if not nodes:
+        raise ValueError('Skeleton is empty')
+
+    children = defaultdict(list)
+    index = {}
+    root = None
+    for i, node in enumerate(nodes):
+        if node[0] in index:
+            raise ValueError('Skeleton is malformed: node {} is listed twice'.format(node[0]))
+        index[node[0]] = i
+        if node[1] is None:
+            if root is not None:
+                raise ValueError('Skeleton is malformed: it has more than one root')
+            root = i
+        else:
+            children[node[1]].append(node[0])
 
-    Associate the skeleton to the specified neuron, or a new one if none is
-    provided. Returns a dictionary of the neuron and skeleton IDs, and the
-    original arborescence with attributes added for treenode IDs.
+    if root is None:
+        raise ValueError('No root, skeleton is malformed!')
+
+    for parent_id in children:
+        if parent_id not in index:
+            raise ValueError('Skeleton is malformed: parent {} is missing'.format(parent_id))
+
+    # Every node has to be reachable from the root, which is not the case
+    # for nodes in cycles.
+    n_reached = 0
+    working_set = [nodes[root][0]]
+    while working_set:
+        node_id = working_set.pop()
+        n_reached += 1
+        working_set.extend(children[node_id])
+    if n_reached != len(nodes):
+        raise ValueError('Skeleton is malformed: it contains a cycle.')
+
+    return root
+
+
+@transaction.atomic
+def _import_skeletons(user, project_id, skeletons):
+    """Create many skeletons at once from lists of node tuples. Each passed in
+    skeleton is a dictionary with a "nodes" field, which lists (node_id,
+    parent_id, x, y, z, radius, confidence) tuples, and optional "name" and
+    "neuron_id" fields. Skeletons are associated with the specified neuron,
+    or a new one if none is provided.
+
+    IDs are allocated for all objects with one query per ID sequence and all
+    rows are written with one COPY statement per table. This way, the
+    statement level triggers that maintain edge and summary tables run only
+    once for all skeletons. Returned is a list of dictionaries with the neuron
+    and skeleton ID as well as a map from imported node IDs to new treenode
+    IDs for each skeleton.
     """
-    # TODO: There is significant reuse here of code from create_treenode that
-    # could be DRYed up.
     relation_map = get_relation_to_id_map(project_id)
     class_map = get_class_to_id_map(project_id)
+    project_id = int(project_id)
 
-    new_skeleton = ClassInstance()
-    new_skeleton.user = user
-    new_skeleton.project_id = project_id
-    new_skeleton.class_column_id = class_map['skeleton']
-    if name is not None:
-        new_skeleton.name = name
-    else:
-        new_skeleton.name = 'skeleton'
-        new_skeleton.save()
-        new_skeleton.name = 'skeleton %d' % new_skeleton.id
-    new_skeleton.save()
-
-    def relate_neuron_to_skeleton(neuron, skeleton):
-        return _create_relation(user, project_id,
-                relation_map['model_of'], skeleton, neuron)
-
-    if neuron_id is not None:
-        # Check that the neuron to use exists
-        if 0 == ClassInstance.objects.filter(pk=neuron_id).count():
-            neuron_id = None
+    roots = [_check_arborescence(s['nodes']) for s in skeletons]
 
-    if neuron_id is not None:
-        # Raise an Exception if the user doesn't have permission to
-        # edit the existing neuron.
+    # Use existing neurons if they exist and can be edited
+    neuron_ids = [s.get('neuron_id') for s in skeletons]
+    requested_neuron_ids = set(int(n) for n in neuron_ids if n is not None)
+    existing_neuron_ids = set(ClassInstance.objects.filter(
+            pk__in=requested_neuron_ids).values_list('id', flat=True))
+    for neuron_id in existing_neuron_ids:
         can_edit_class_instance_or_fail(user, neuron_id, 'neuron')
+    neuron_ids = [int(n) if n is not None and int(n) in existing_neuron_ids else None
+            for n in neuron_ids]
 
-    else:
-        # A neuron does not exist, therefore we put the new skeleton
-        # into a new neuron.
-        new_neuron = ClassInstance()
-        new_neuron.user = user
-        new_neuron.project_id = project_id
-        new_neuron.class_column_id = class_map['neuron']
-        if name is not None:
-            new_neuron.name = name
-        else:
-            new_neuron.name = 'neuron'
-            new_neuron.save()
-            new_neuron.name = 'neuron %d' % new_neuron.id
-        new_neuron.save()
-
-        neuron_id = new_neuron.id
-
-    relate_neuron_to_skeleton(neuron_id, new_skeleton.id)
-
-    # For pathological networks this can error, so do it before inserting
+    # Allocate the IDs of all skeletons, new neurons, model_of links and
     # treenodes.
-    root = find_root(arborescence)
-    if root is None:
-        raise Exception('No root, provided graph is malformed!')
-
-    # Bulk create the required number of treenodes. This must be done in two
-    # steps because treenode IDs are not known.
+    n_concepts = 2 * len(skeletons) + sum(1 for n in neuron_ids if n is None)
+    n_treenodes = sum(len(s['nodes']) for s in skeletons)
     cursor = connection.cursor()
     cursor.execute("""
-        INSERT INTO treenode (project_id, location_x, location_y, location_z,
-            editor_id, user_id, skeleton_id)
-        SELECT t.project_id, t.x, t.x, t.x, t.user_id, t.user_id, t.skeleton_id
-        FROM (VALUES (%(project_id)s, 0, %(user_id)s, %(skeleton_id)s))
-            AS t (project_id, x, user_id, skeleton_id),
-            generate_series(1, %(num_treenodes)s)
-        RETURNING treenode.id;
-        """ % {
-            'project_id': project_id,
-            'user_id': user.id,
-            'skeleton_id': new_skeleton.id,
-            'num_treenodes': arborescence.number_of_nodes()})
-    treenode_ids = cursor.fetchall()
-    # Flatten IDs
-    treenode_ids = list(chain.from_iterable(treenode_ids))
-    nx.set_node_attributes(arborescence, 'id', dict(zip(arborescence.nodes(), treenode_ids)))
-
-    # Set parent node ID
-    for n, nbrs in arborescence.adjacency_iter():
-        for nbr in nbrs:
-            arborescence.node[nbr]['parent_id'] = arborescence.node[n]['id']
-            if not 'radius' in arborescence.node[nbr]:
-                arborescence.node[nbr]['radius'] = -1
-    arborescence.node[root]['parent_id'] = 'NULL::bigint'
-    if not 'radius' in arborescence.node[root]:
-        arborescence.node[root]['radius'] = -1
-    new_location = tuple([arborescence.node[root][k] for k in ('x', 'y', 'z')])
-
-    treenode_values = \
-            '),('.join([','.join(map(str, [d[k] for k in ('id', 'x', 'y', 'z', 'parent_id', 'radius')])) \
-            for n, d in arborescence.nodes_iter(data=True)])
+        SELECT nextval('concept_id_seq') FROM generate_series(1, %(n)s)
+    """, {
+        'n': n_concepts,
+    })
+    concept_ids = iter(row[0] for row in cursor.fetchall())
     cursor.execute("""
-        UPDATE treenode SET
-            location_x = v.x,
-            location_y = v.y,
-            location_z = v.z,
-            parent_id = v.parent_id,
-            radius = v.radius
-        FROM (VALUES (%s)) AS v(id, x, y, z, parent_id, radius)
-        WHERE treenode.id = v.id AND treenode.skeleton_id = %s
-        """ % (treenode_values, new_skeleton.id)) # Include skeleton ID for index performance.
+        SELECT nextval('location_id_seq') FROM generate_series(1, %(n)s)
+    """, {
+        'n': n_treenodes,
+    })
+    treenode_ids = iter(row[0] for row in cursor.fetchall())
+
+    class_instances = []
+    links = []
+    import_info = []
+    for skeleton, neuron_id in zip(skeletons, neuron_ids):
+        name = skeleton.get('name')
+        skeleton_id = next(concept_ids)
+        class_instances.append((skeleton_id, user.id, project_id,
+                class_map['skeleton'], name if name is not None else
+                'skeleton %d' % skeleton_id))
+        if neuron_id is None:
+            neuron_id = next(concept_ids)
+            class_instances.append((neuron_id, user.id, project_id,
+                    class_map['neuron'], name if name is not None else
+                    'neuron %d' % neuron_id))
+        links.append((next(concept_ids), user.id, project_id,
+                relation_map['model_of'], skeleton_id, neuron_id))
+        import_info.append({
+            'neuron_id': neuron_id,
+            'skeleton_id': skeleton_id,
+            'node_id_map': dict((n[0], next(treenode_ids)) for n in skeleton['nodes']),
+        })
+
+    def treenode_rows():
+        for skeleton, info in zip(skeletons, import_info):
+            node_id_map = info['node_id_map']
+            for node_id, parent_id, x, y, z, radius, confidence in skeleton['nodes']:
+                yield (node_id_map[node_id], project_id, user.id, user.id,
+                        info['skeleton_id'],
+                        None if parent_id is None else node_id_map[parent_id],
+                        x, y, z, radius, confidence)
+
+    copy_rows(cursor, 'class_instance', ('id', 'user_id', 'project_id',
+            'class_id', 'name'), class_instances)
+    copy_rows(cursor, 'class_instance_class_instance', ('id', 'user_id',
+            'project_id', 'relation_id', 'class_instance_a',
+            'class_instance_b'), links)
+    copy_rows(cursor, 'treenode', ('id', 'project_id', 'user_id',
+            'editor_id', 'skeleton_id', 'parent_id', 'location_x',
+            'location_y', 'location_z', 'radius', 'confidence'),
+            treenode_rows())
 
     # Log import.
-    insert_into_log(project_id, user.id, 'create_neuron',
-                    new_location, 'Create neuron %d and skeleton '
-                    '%d via import' % (new_neuron.id, new_skeleton.id))
+    first_root = skeletons[0]['nodes'][roots[0]]
+    new_location = tuple(first_root[2:5])
+    if len(skeletons) == 1:
+        insert_into_log(project_id, user.id, 'create_neuron',
+                new_location, 'Create neuron %d and skeleton '
+                '%d via import' % (import_info[0]['neuron_id'],
+                import_info[0]['skeleton_id']))
+    else:
+        insert_into_log(project_id, user.id, 'create_neuron',
+                new_location, 'Create %d skeletons with %d nodes via '
+                'import' % (len(skeletons), n_treenodes))
 
-    return {'neuron_id': neuron_id, 'skeleton_id': new_skeleton.id, 'graph': arborescence}
+    return import_info
 
 
 @requires_user_role(UserRole.Annotate)
@@ -2,22 +2,26 @@
 from __future__ import unicode_literals
 
 import array
+import itertools
 import json
 import logging
 import msgpack
 import networkx as nx
+import numpy as np
 import pytz
 import six
 import struct
+import threading
 
 from functools import partial
-from collections import defaultdict, deque
-from math import sqrt
+from collections import defaultdict, namedtuple
 from datetime import datetime
+from multiprocessing.pool import ThreadPool
 
+from django.conf import settings
 from django.core.serializers.json import DjangoJSONEncoder
-from django.db import connection
-from django.http import HttpResponse, JsonResponse
+from django.db import connection, transaction
+from django.http import HttpResponse, JsonResponse, StreamingHttpResponse
 
 from rest_framework.decorators import api_view
 
@@ -32,7 +36,7 @@ from catmaid.control.review import get_treenodes_to_reviews, \
 
 from psycopg2.extras import DateTimeTZRange
 
-from catmaid.control.tree_util import edge_count_to_root, partition
+from catmaid.control.tree_util import edge_count_to_root
 
 # Python 2 and 3 compatible map and zip iterator
 from six.moves import map, zip
@@ -71,59 +75,202 @@ def get_treenodes_qs(project_id=None, skeleton_id=None, with_labels=True):
     return treenode_qs, labels_qs, labelconnector_qs
 
 
-def get_swc_string(treenodes_qs, linearize_ids=False):
-    all_rows = []
-    for tn in treenodes_qs:
-        swc_row = [tn.id]
-        swc_row.append(0)
-        swc_row.append(tn.location_x)
-        swc_row.append(tn.location_y)
-        swc_row.append(tn.location_z)
-        swc_row.append(max(tn.radius, 0))
-        swc_row.append(-1 if tn.parent_id is None else tn.parent_id)
-        all_rows.append(swc_row)
-
-    if linearize_ids:
-        # Find successors for each node
-        successors = defaultdict(list)
-        root = None
-        for tn in all_rows:
-            node, parent = tn[0], tn[6]
-            if parent == -1:
-                root = node
+# The number of rows that are read at once from server-side cursors during
+# streaming exports. Only a single chunk of rows is kept in memory.
+EXPORT_CHUNK_SIZE = 10000
+
+_export_cursor_ids = itertools.count(1)
+
+
+class RowStream(object):
+    """A query result that is read lazily in chunks through a server-side
+    (named) cursor, so that only a single chunk of rows is held in memory at
+    any time. An optional transform function is applied to each row. If a
+    row stream is consumed within a transaction, rows are produced by the
+    database as they are fetched. Otherwise a WITH HOLD cursor is used, which
+    is materialized on the server.
+    """
+
+    def __init__(self, query, params=None, transform=None,
+            chunk_size=EXPORT_CHUNK_SIZE):
+        self.query = query
+        self.params = params
+        self.transform = transform
+        self.chunk_size = chunk_size
+
+    def _open(self, scrollable=False):
+        """Declare a new server-side cursor for this query. If server-side
+        cursors are disabled for the database connection, e.g. due to a
+        transaction pooler, a regular cursor is used.
+        """
+        if connection.settings_dict.get('DISABLE_SERVER_SIDE_CURSORS'):
+            cursor = connection.cursor()
+            name = None
+        else:
+            connection.ensure_connection()
+            name = 'catmaid_export_{}_{}'.format(threading.current_thread().ident,
+                    next(_export_cursor_ids))
+            cursor = connection.connection.cursor(name, scrollable=scrollable,
+                    withhold=connection.get_autocommit())
+        cursor.execute(self.query, self.params)
+        return cursor, name
+
+    def _read(self, cursor):
+        transform = self.transform
+        while True:
+            rows = cursor.fetchmany(self.chunk_size)
+            if not rows:
+                break
+            if transform:
+                rows = [transform(row) for row in rows]
+            yield rows
+
+    def chunks(self):
+        """Yield lists of at most <chunk_size> (transformed) rows.
+        """
+        cursor, _ = self._open()
+        try:
+            for rows in self._read(cursor):
+                yield rows
+        finally:
+            cursor.close()
+
+    def counted_chunks(self):
+        """Return the total number of rows along with a chunk generator like
+        chunks(). Both are read from the same cursor and therefore the same
+        snapshot, which makes the count consistent with the returned rows.
+        Counting requires the complete result to be computed by the database
+        before the first row can be read.
+        """
+        cursor, name = self._open(scrollable=True)
+        try:
+            if name is None:
+                count = cursor.rowcount
             else:
-                successors[parent].append(node)
-        # Map each node to a new incremental ID
-        id_map = dict()
-        working_set = deque([root])
-        count = 1
-        while working_set:
-            node = working_set.popleft()
-            id_map[node] = count
-            count += 1
-            working_set.extend(successors[node])
-        # Replace each original ID with the mapped ID
-        for tn in all_rows:
-            tn[0] = id_map[tn[0]]
-            tn[6] = id_map[tn[6]] if tn[6] != -1 else -1
-        # Sort based on node ID
-        all_rows.sort(key=lambda tn: tn[0])
-
-    result = ""
-    for row in all_rows:
-        result += " ".join(map(str, row)) + "\n"
-    return result
+                move_cursor = connection.cursor()
+                move_cursor.execute('MOVE FORWARD ALL IN "{}"'.format(name))
+                count = move_cursor.rowcount
+                move_cursor.execute('MOVE ABSOLUTE 0 IN "{}"'.format(name))
+        except:
+            cursor.close()
+            raise
+
+        def read():
+            try:
+                for rows in self._read(cursor):
+                    yield rows
+            finally:
+                cursor.close()
+
+        return count, read()
+
+    def __iter__(self):
+        for rows in self.chunks():
+            for row in rows:
+                yield row
+
+
+def _treenode_to_swc_row(row):
+    return (row[0], 0, row[1], row[2], row[3], max(row[4], 0),
+            -1 if row[5] is None else row[5])
+
+
+def _swc_row_to_line(row):
+    return " ".join(map(str, row)) + "\n"
+
+
+def get_swc_chunks(skeleton_id, linearize_ids=False):
+    """Yield the SWC representation of a skeleton in chunks of lines. Nodes are
+    ordered by ID. If <linearize_ids> is true, node IDs are replaced with
+    incremental IDs in breadth-first order, starting from the root. Otherwise
+    the treenodes are streamed without being kept in memory.
+    """
+    stream = RowStream('''
+        SELECT id, location_x, location_y, location_z, radius, parent_id
+        FROM treenode
+        WHERE skeleton_id = %s
+        ORDER BY id
+    ''', (skeleton_id,))
+
+    if not linearize_ids:
+        for rows in stream.chunks():
+            yield "".join(_swc_row_to_line(_treenode_to_swc_row(row)) for row in rows)
+        return
+
+    # The topology needs to be known for the new IDs, keep all nodes in
+    # compact arrays.
+    id_chunks, parent_chunks, location_chunks = [], [], []
+    for rows in stream.chunks():
+        id_chunks.append(np.fromiter((r[0] for r in rows), np.int64, len(rows)))
+        parent_chunks.append(np.fromiter((-1 if r[5] is None else r[5] for r in rows),
+                np.int64, len(rows)))
+        location_chunks.append(np.array([r[1:5] for r in rows], np.float64))
+    if not id_chunks:
+        return
+    ids = np.concatenate(id_chunks)
+    parents = np.concatenate(parent_chunks)
+    locations = np.concatenate(location_chunks)
+    del id_chunks, parent_chunks, location_chunks
+
+    n_nodes = len(ids)
+    is_root = parents == -1
+    roots = np.flatnonzero(is_root)
+    if not len(roots):
+        raise ValueError("Skeleton #{} has no root node".format(skeleton_id))
+    parent_index = np.full(n_nodes, -1, np.int64)
+    parent_index[~is_root] = np.searchsorted(ids, parents[~is_root])
+
+    # Children of each node, ordered by ID, as contiguous ranges of a single
+    # array.
+    child_order = np.argsort(np.where(is_root, n_nodes, parent_index), kind='stable')
+    n_children = np.bincount(parent_index[~is_root], minlength=n_nodes)
+    child_start = np.cumsum(n_children) - n_children
+
+    # Assign incremental IDs level by level, which is the same as a breadth
+    # first traversal starting from the root.
+    new_ids = np.zeros(n_nodes, np.int64)
+    levels = []
+    level = roots[-1:]
+    next_id = 1
+    while len(level):
+        levels.append(level)
+        new_ids[level] = np.arange(next_id, next_id + len(level))
+        next_id += len(level)
+        counts = n_children[level]
+        total = counts.sum()
+        offsets = np.repeat(child_start[level] - (np.cumsum(counts) - counts), counts)
+        level = child_order[offsets + np.arange(total)]
+    order = np.concatenate(levels)
+
+    new_parent_ids = np.where(is_root, -1, new_ids[parent_index])
+    for start in range(0, len(order), EXPORT_CHUNK_SIZE):
+        chunk = order[start:start + EXPORT_CHUNK_SIZE]
+        yield "".join(_swc_row_to_line((node_id, 0, x, y, z, max(r, 0), parent_id))
+                for node_id, (x, y, z, r), parent_id in zip(new_ids[chunk].tolist(),
+                    locations[chunk].tolist(), new_parent_ids[chunk].tolist()))
+
+
+def _stream_in_transaction(chunks):
+    """Evaluate a generator in a transaction, which allows server-side cursors
+    to produce rows lazily.
+    """
+    with transaction.atomic():
+        for chunk in chunks:
+            yield chunk
+
 
 def export_skeleton_response(request, project_id=None, skeleton_id=None, format=None):
+    if format == 'swc':
+        linearize_ids = get_request_bool(request.GET, 'linearize_ids', False)
+        return StreamingHttpResponse(_stream_in_transaction(
+                get_swc_chunks(skeleton_id, linearize_ids)), content_type='text/plain')
+
     treenode_qs, labels_qs, labelconnector_qs = get_treenodes_qs(project_id, skeleton_id)
 
     # Make sure we export in consistent order
     treenode_qs = treenode_qs.order_by('id')
 
-    if format == 'swc':
-        linearize_ids = get_request_bool(request.GET, 'linearize_ids', False)
-        return HttpResponse(get_swc_string(treenode_qs, linearize_ids), content_type='text/plain')
-    elif format == 'json':
+    if format == 'json':
         return JsonResponse(treenode_qs)
     else:
         raise Exception("Unknown format ('%s') in export_skeleton_response" % (format,))
@@ -231,19 +378,11 @@ def compact_skeleton_detail(request, project_id=None, skeleton_id=None):
     with_user_info = get_request_bool(request.GET, "with_user_info", False)
     return_format = request.GET.get('format', 'json')
 
-    result = _compact_skeleton(project_id, skeleton_id, with_connectors,
-                               with_tags, with_history, with_merge_history,
-                               with_reviews, with_annotations, with_user_info)
+    parts = _compact_skeleton_parts(project_id, skeleton_id, with_connectors,
+            with_tags, with_history, with_merge_history, with_reviews,
+            with_annotations, with_user_info)
 
-    if return_format == 'msgpack':
-        data = msgpack.packb(result)
-        return HttpResponse(data, content_type='application/octet-stream')
-    else:
-        return JsonResponse(result, safe=False,
-                json_dumps_params={
-                    'separators': (',', ':'),
-                    'default': default
-                })
+    return compact_skeleton_response(parts, return_format)
 
 @requires_user_role(UserRole.Browse)
 def compact_skeleton(request, project_id=None, skeleton_id=None,
@@ -267,15 +406,11 @@ def compact_skeleton(request, project_id=None, skeleton_id=None,
     with_annotations = get_request_bool(request.GET, "with_annotations", False)
     with_user_info = get_request_bool(request.GET, "with_user_info", False)
 
-    result = _compact_skeleton(project_id, skeleton_id, with_connectors,
-                               with_tags, with_history, with_merge_history,
-                               with_reviews, with_annotations, with_user_info)
+    parts = _compact_skeleton_parts(project_id, skeleton_id, with_connectors,
+            with_tags, with_history, with_merge_history, with_reviews,
+            with_annotations, with_user_info)
 
-    return JsonResponse(result, safe=False,
-            json_dumps_params={
-                'separators': (',', ':'),
-                'default': default
-            })
+    return compact_skeleton_response(parts)
 
 
 @api_view(['POST'])
@@ -284,13 +419,15 @@ def compact_skeleton_detail_many(request, project_id=None):
     """Get a compact treenode representation of a list of skeletons, optionally
     with the history of individual nodes and connectors.
 
-    Returns, in JSON, [[nodes], [connectors], {nodeID: [tags]}], with
-    connectors and tags being empty when 0 == with_connectors and 0 ==
-    with_tags, respectively.
+    Returns, in JSON, {"skeletons": {skeletonID: [[nodes], [connectors],
+    {nodeID: [tags]}, [reviews], [annotations]]}}, with connectors and tags
+    being empty when 0 == with_connectors and 0 == with_tags, respectively.
+    All skeletons are read using a few set based queries and each skeleton is
+    streamed as soon as its data is available.
 
     Each element in the [nodes] array has the following form:
 
-    [skeleton_id, id, parent_id, user_id, location_x, location_y, location_z, radius, confidence].
+    [id, parent_id, user_id, location_x, location_y, location_z, radius, confidence].
 
     Each element in the [connectors] array has the following form, with the
     third element representing the connector link as 0 = presynaptic, 1 =
@@ -386,71 +523,61 @@ def compact_skeleton_detail_many(request, project_id=None):
     if not skeleton_ids:
         raise ValueError("No skeleton IDs provided")
 
-    skeletons = {}
-    for skeleton_id in skeleton_ids:
-        skeletons[skeleton_id] = _compact_skeleton(project_id, skeleton_id,
-                with_connectors, with_tags, with_history, with_merge_history,
-                with_reviews, with_annotations, with_user_info)
+    skeletons = _compact_skeletons(project_id, skeleton_ids, with_connectors,
+            with_tags, with_history, with_merge_history, with_reviews,
+            with_annotations, with_user_info)
 
-    result = {
-        "skeletons": skeletons
-    }
-
-    if return_format == 'msgpack':
-        data = msgpack.packb(result)
-        return HttpResponse(data, content_type='application/octet-stream')
-    else:
-        return JsonResponse(result, safe=False, json_dumps_params={
-            'separators': (',', ':'),
-            'default': default
-        })
+    return compact_skeletons_response(skeletons, len(set(skeleton_ids)),
+            return_format)
 
 
 def _compact_skeleton(project_id, skeleton_id, with_connectors=True,
         with_tags=True, with_history=False, with_merge_history=True,
         with_reviews=False, with_annotations=False, with_user_info=False):
-    """Get a compact treenode representation of a skeleton, optionally with the
-    history of individual nodes and connector, reviews and annotationss. Note
-    this function is performance critical! Returns, in JSON:
+    """Get a compact treenode representation of a skeleton like
+    _compact_skeleton_parts(), but with all rows read into memory.
+    """
+    nodes, connectors, tags, reviews, annotations = _compact_skeleton_parts(
+            project_id, skeleton_id, with_connectors, with_tags, with_history,
+            with_merge_history, with_reviews, with_annotations, with_user_info)
 
-      [[nodes], [connectors], {nodeID: [tags]}, [reviews], [annotations]]
+    return [tuple(nodes), tuple(connectors), tags, list(reviews), annotations]
 
-    with connectors and tags being empty when 0 == with_connectors and 0 ==
-    with_tags, respectively.
 
-    If history data is requested, each row contains a validity interval. Note
-    that for the live table entry (the currently valid version), there are
-    special semantics for this interval: The upper bound is older than or the
-    same as the lower bound. This is done to encode the information of this row
-    being the most recent version and including the original creation time at
-    the same time, plus it requires less queries on the back-end to retireve
-    data. This requires the client to do slightly more work, but unfortunately
-    the original creation time is needed for data that was created without
-    history tables enabled.
+def _compact_skeleton_streams(project_id, skeleton_ids, with_connectors=True,
+        with_tags=True, with_history=False, with_merge_history=True,
+        with_reviews=False, with_annotations=False, with_user_info=False,
+        ordered=False):
+    """Get RowStream instances for the nodes, connectors, tags, reviews and
+    annotations of all passed in skeletons, as they are returned by
+    _compact_skeleton_parts(). Each part is read with a single query for all
+    skeletons and the first column of each row is the skeleton ID. If
+    <ordered> is true, rows are ordered by skeleton ID. Parts that were not
+    requested are missing from the returned dictionary.
     """
-
-    cursor = connection.cursor()
+    params = {
+        'skeleton_ids': list(skeleton_ids),
+    }
+    order = 'ORDER BY 1' if ordered else ''
+    streams = {}
 
     if not with_history:
-        cursor.execute('''
-            SELECT id, parent_id, user_id,
+        streams['nodes'] = RowStream('''
+            SELECT skeleton_id, id, parent_id, user_id,
                 location_x, location_y, location_z,
                 radius, confidence
             FROM treenode
-            WHERE skeleton_id = %s
-        ''', (skeleton_id,))
-
-        nodes = tuple(cursor.fetchall())
+            WHERE skeleton_id = ANY(%(skeleton_ids)s::bigint[])
+            {order}
+        '''.format(order=order), params)
     else:
-        params = {
-            'skeleton_id': skeleton_id
-        }
         # Get present and historic nodes. If a historic validity range is empty
         # (e.g. due to a change in the same transaction), the edition time is
         # taken for both start and end validity, because this is what actually
         # happened.
         query = '''
             SELECT
+                treenode.skeleton_id,
                 treenode.id,
                 treenode.parent_id,
                 treenode.user_id,
@@ -462,9 +589,10 @@ def _compact_skeleton(project_id, skeleton_id, with_connectors=True,
                 treenode.edition_time,
                 treenode.creation_time
             FROM treenode
-            WHERE treenode.skeleton_id = %(skeleton_id)s
+            WHERE treenode.skeleton_id = ANY(%(skeleton_ids)s::bigint[])
             UNION ALL
             SELECT
+                treenode__history.skeleton_id,
                 treenode__history.id,
                 treenode__history.parent_id,
                 treenode__history.user_id,
@@ -476,14 +604,17 @@ def _compact_skeleton(project_id, skeleton_id, with_connectors=True,
                 COALESCE(lower(treenode__history.sys_period), treenode__history.edition_time),
                 COALESCE(upper(treenode__history.sys_period), treenode__history.edition_time)
             FROM treenode__history
-            WHERE treenode__history.skeleton_id = %(skeleton_id)s
+            WHERE treenode__history.skeleton_id = ANY(%(skeleton_ids)s::bigint[])
         '''
 
         if with_merge_history:
+            # Historic versions of nodes that were merged into a skeleton are
+            # listed for the skeleton the node is now part of.
             query =  '''
                 {}
                 UNION ALL
                 SELECT
+                    t.skeleton_id,
                     th.id,
                     th.parent_id,
                     th.user_id,
@@ -497,26 +628,15 @@ def _compact_skeleton(project_id, skeleton_id, with_connectors=True,
                 FROM treenode__history th
                 JOIN treenode t
                     ON th.id = t.id
-                    AND t.skeleton_id = %(skeleton_id)s
+                    AND t.skeleton_id = ANY(%(skeleton_ids)s::bigint[])
                     AND th.skeleton_id <> t.skeleton_id
             '''.format(query)
 
-        cursor.execute(query, params)
-
-        nodes = tuple(cursor.fetchall())
-
-    if 0 == len(nodes):
-        # Check if the skeleton exists
-        if 0 == ClassInstance.objects.filter(pk=skeleton_id).count():
-            raise Exception("Skeleton #%s doesn't exist" % skeleton_id)
-        # Otherwise returns an empty list of nodes
-
-    connectors = ()
-    tags = defaultdict(list)
-    reviews = []
+        streams['nodes'] = RowStream(query + order, params)
 
     if with_connectors or with_tags or with_annotations:
         # postgres is caching this query
+        cursor = connection.cursor()
         cursor.execute("SELECT relation_name, id FROM relation WHERE project_id=%s" % project_id)
         relations = dict(cursor.fetchall())
 
@@ -526,30 +646,26 @@ def _compact_skeleton(project_id, skeleton_id, with_connectors=True,
         post = relations['postsynaptic_to']
         gj = relations.get('gapjunction_with', -1)
         relation_index = {pre: 0, post: 1, gj: 2}
+        connector_params = dict(params, pre=pre, post=post, gj=gj)
+
+        def to_connector_row(row):
+            return (row[0], row[1], row[2], relation_index.get(row[3], -1)) + tuple(row[4:])
+
         if not with_history:
             user_select = ', tc.user_id' if with_user_info else ''
-            cursor.execute('''
-                SELECT tc.treenode_id, tc.connector_id, tc.relation_id,
-                    c.location_x, c.location_y, c.location_z
+            streams['connectors'] = RowStream('''
+                SELECT tc.skeleton_id, tc.treenode_id, tc.connector_id,
+                    tc.relation_id, c.location_x, c.location_y, c.location_z
                     {user_select}
                 FROM treenode_connector tc,
                     connector c
-                WHERE tc.skeleton_id = %s
+                WHERE tc.skeleton_id = ANY(%(skeleton_ids)s::bigint[])
                 AND tc.connector_id = c.id
-                AND (tc.relation_id = %s OR tc.relation_id = %s OR tc.relation_id = %s)
-            '''.format(user_select=user_select), (skeleton_id, pre, post, gj))
-
-            if with_user_info:
-                connectors = tuple((row[0], row[1], relation_index.get(row[2], -1), row[3], row[4], row[5], row[6]) for row in cursor.fetchall())
-            else:
-                connectors = tuple((row[0], row[1], relation_index.get(row[2], -1), row[3], row[4], row[5]) for row in cursor.fetchall())
+                AND (tc.relation_id = %(pre)s OR tc.relation_id = %(post)s OR tc.relation_id = %(gj)s)
+                {order}
+            '''.format(user_select=user_select, order=order), connector_params,
+                to_connector_row)
         else:
-            params = {
-                'skeleton_id': skeleton_id,
-                'pre': pre,
-                'post': post,
-                'gj': gj
-            }
             user_select = ', links.user_id' if with_user_info else ''
 
             # Get present and historic connectors. If a historic validity range
@@ -557,126 +673,332 @@ def _compact_skeleton(project_id, skeleton_id, with_connectors=True,
             # edition time is taken for both start and end validity, because
             # this is what actually happened.
             query = '''
-                SELECT links.treenode_id, links.connector_id, links.relation_id,
-                        c.location_x, c.location_y, c.location_z,
+                SELECT links.skeleton_id, links.treenode_id, links.connector_id,
+                        links.relation_id, c.location_x, c.location_y, c.location_z,
                         links.valid_from, links.valid_to
                         {user_select}
                 FROM (
-                    SELECT tc.treenode_id, tc.connector_id, tc.relation_id,
-                        tc.edition_time, tc.creation_time, tc.user_id
+                    SELECT tc.skeleton_id, tc.treenode_id, tc.connector_id,
+                        tc.relation_id, tc.edition_time, tc.creation_time, tc.user_id
                     FROM treenode_connector tc
-                    WHERE tc.skeleton_id = %(skeleton_id)s
+                    WHERE tc.skeleton_id = ANY(%(skeleton_ids)s::bigint[])
                     UNION ALL
-                    SELECT tc.treenode_id, tc.connector_id, tc.relation_id,
+                    SELECT tc.skeleton_id, tc.treenode_id, tc.connector_id,
+                        tc.relation_id,
                         COALESCE(lower(tc.sys_period), tc.edition_time),
                         COALESCE(upper(tc.sys_period), tc.edition_time),
                         tc.user_id
                     FROM treenode_connector__history tc
-                    WHERE tc.skeleton_id = %(skeleton_id)s
+                    WHERE tc.skeleton_id = ANY(%(skeleton_ids)s::bigint[])
                     {extra_query}
-                ) links(treenode_id, connector_id, relation_id, valid_from, valid_to, user_id)
+                ) links(skeleton_id, treenode_id, connector_id, relation_id, valid_from, valid_to, user_id)
                 JOIN connector__with_history c
                     ON links.connector_id = c.id
                 WHERE (links.relation_id = %(pre)s OR links.relation_id = %(post)s OR links.relation_id = %(gj)s)
+                {order}
             '''
 
             if with_merge_history:
-                merge_user_select = ', tch.user_id' if with_user_info else ''
                 extra_query = '''
                     UNION ALL
-                    SELECT tch.treenode_id, tch.connector_id, tch.relation_id,
+                    SELECT tc.skeleton_id, tch.treenode_id, tch.connector_id,
+                        tch.relation_id,
                         COALESCE(lower(tch.sys_period), tch.edition_time),
                         COALESCE(upper(tch.sys_period), tch.edition_time),
                         tch.user_id
                     FROM treenode_connector__history tch
                     JOIN treenode_connector tc
                         ON tc.id = tch.id
-                        AND tc.skeleton_id = %(skeleton_id)s
+                        AND tc.skeleton_id = ANY(%(skeleton_ids)s::bigint[])
                         AND tch.skeleton_id <> tc.skeleton_id
-                '''.format(user_select=merge_user_select)
+                '''
             else:
                 extra_query = ''
 
-            cursor.execute(query.format(extra_query=extra_query, user_select=user_select), params)
-
-            if with_user_info:
-                connectors = tuple((row[0], row[1], relation_index.get(row[2], -1), row[3], row[4], row[5], row[6], row[7], row[8]) for row in cursor.fetchall())
-            else:
-                connectors = tuple((row[0], row[1], relation_index.get(row[2], -1), row[3], row[4], row[5], row[6], row[7]) for row in cursor.fetchall())
+            streams['connectors'] = RowStream(query.format(extra_query=extra_query,
+                    user_select=user_select, order=order), connector_params,
+                    to_connector_row)
 
     if with_tags:
         history_suffix = '__with_history' if with_history else ''
         t_history_query = ', tci.edition_time' if with_history else ''
         user_select = ', tci.user_id' if with_user_info else ''
         # Fetch all node tags
-        cursor.execute('''
-            SELECT c.name, tci.treenode_id
+        streams['tags'] = RowStream('''
+            SELECT t.skeleton_id, c.name, tci.treenode_id
                    {0}
                    {user_select}
             FROM treenode{1} t,
                  treenode_class_instance{1} tci,
                  class_instance{1} c
-            WHERE t.skeleton_id = %s
+            WHERE t.skeleton_id = ANY(%(skeleton_ids)s::bigint[])
               AND t.id = tci.treenode_id
-              AND tci.relation_id = %s
+              AND tci.relation_id = %(labeled_as)s
               AND c.id = tci.class_instance_id
-        '''.format(t_history_query, history_suffix, user_select=user_select),
-        (skeleton_id, relations['labeled_as']))
-
-        if with_history:
-            if with_user_info:
-                for row in cursor.fetchall():
-                    tags[row[0]].append([row[1], row[2], row[3]])
-            else:
-                for row in cursor.fetchall():
-                    tags[row[0]].append([row[1], row[2]])
-        else:
-            if with_user_info:
-                for row in cursor.fetchall():
-                    tags[row[0]].append([row[1], row[2]])
-            else:
-                for row in cursor.fetchall():
-                    tags[row[0]].append(row[1])
+            {order}
+        '''.format(t_history_query, history_suffix, user_select=user_select,
+                order=order), dict(params, labeled_as=relations['labeled_as']))
 
     if with_reviews:
         r_history_query = ', r.review_time' if with_history else ''
         history_suffix = '__with_history' if with_history else ''
-        cursor.execute("""
-            SELECT r.treenode_id, r.id, r.reviewer_id{0}
+        streams['reviews'] = RowStream("""
+            SELECT r.skeleton_id, r.treenode_id, r.id, r.reviewer_id{0}
             FROM review{1} r
-            WHERE r.skeleton_id = %s
-        """.format(r_history_query, history_suffix), [skeleton_id])
+            WHERE r.skeleton_id = ANY(%(skeleton_ids)s::bigint[])
+            {order}
+        """.format(r_history_query, history_suffix, order=order), params)
 
-        for r in cursor.fetchall():
-            reviews.append(r)
-
-    annotations = []
     if with_annotations:
         history_suffix = '__with_history' if with_history else ''
         link_history_query = ', annotation_link.edition_time' if with_history else ''
         user_select = ', neuron_link.user_id' if with_user_info else ''
-        # Fetch all node tags
-        cursor.execute('''
-            SELECT annotation_link.class_instance_b
+        # Fetch all skeleton annotations
+        streams['annotations'] = RowStream('''
+            SELECT neuron_link.class_instance_a, annotation_link.class_instance_b
                    {0}
                    {user_select}
             FROM class_instance_class_instance{1} neuron_link
             JOIN class_instance_class_instance{1} annotation_link
                 ON annotation_link.class_instance_a = neuron_link.class_instance_b
-            WHERE neuron_link.class_instance_a = %(skeleton_id)s
+            WHERE neuron_link.class_instance_a = ANY(%(skeleton_ids)s::bigint[])
               AND neuron_link.relation_id = %(model_of)s
               AND annotation_link.relation_id = %(annotated_with)s
-        '''.format(link_history_query, history_suffix, user_select=user_select), {
-            'skeleton_id': skeleton_id,
-            'model_of': relations['model_of'],
-            'annotated_with': relations['annotated_with']
-        })
+            {order}
+        '''.format(link_history_query, history_suffix, user_select=user_select,
+                order=order), dict(params, model_of=relations['model_of'],
+                annotated_with=relations['annotated_with']))
+
+    return streams
+
+
+def _group_tags(rows, with_history=False, with_user_info=False):
+    """Map tag names to the tagged nodes of the passed in tag rows, which are
+    expected to be (name, treenode_id[, edition_time][, user_id]).
+    """
+    tags = defaultdict(list)
+    if with_history or with_user_info:
+        for row in rows:
+            tags[row[0]].append(list(row[1:]))
+    else:
+        for row in rows:
+            tags[row[0]].append(row[1])
+    return tags
+
+
+def _without_skeleton_id(stream):
+    """Get a copy of a RowStream of _compact_skeleton_streams(), which doesn't
+    include the leading skeleton ID column.
+    """
+    transform = stream.transform
+    if transform:
+        strip = lambda row: transform(row)[1:]
+    else:
+        strip = lambda row: row[1:]
+    return RowStream(stream.query, stream.params, strip, stream.chunk_size)
 
-        annotations = list(cursor.fetchall())
+
+def _compact_skeleton_parts(project_id, skeleton_id, with_connectors=True,
+        with_tags=True, with_history=False, with_merge_history=True,
+        with_reviews=False, with_annotations=False, with_user_info=False):
+    """Get a compact treenode representation of a skeleton, optionally with the
+    history of individual nodes and connector, reviews and annotationss. Note
+    this function is performance critical! Returns:
+
+      [[nodes], [connectors], {nodeID: [tags]}, [reviews], [annotations]]
+
+    with connectors and tags being empty when 0 == with_connectors and 0 ==
+    with_tags, respectively.
+
+    If history data is requested, each row contains a validity interval. Note
+    that for the live table entry (the currently valid version), there are
+    special semantics for this interval: The upper bound is older than or the
+    same as the lower bound. This is done to encode the information of this row
+    being the most recent version and including the original creation time at
+    the same time, plus it requires less queries on the back-end to retireve
+    data. This requires the client to do slightly more work, but unfortunately
+    the original creation time is needed for data that was created without
+    history tables enabled.
+
+    Nodes, connectors and reviews are returned as RowStream instances, which
+    read their rows lazily in chunks. Tags and annotations are read right away.
+    """
+    # Check if the skeleton exists, before any row is streamed.
+    if not ClassInstance.objects.filter(pk=skeleton_id).exists():
+        raise Exception("Skeleton #%s doesn't exist" % skeleton_id)
+
+    streams = _compact_skeleton_streams(project_id, [skeleton_id],
+            with_connectors, with_tags, with_history, with_merge_history,
+            with_reviews, with_annotations, with_user_info)
+
+    nodes = _without_skeleton_id(streams['nodes'])
+    connectors = _without_skeleton_id(streams['connectors']) \
+            if 'connectors' in streams else ()
+    reviews = _without_skeleton_id(streams['reviews']) \
+            if 'reviews' in streams else ()
+
+    if 'tags' in streams:
+        tags = _group_tags(_without_skeleton_id(streams['tags']), with_history,
+                with_user_info)
+    else:
+        tags = defaultdict(list)
+
+    if 'annotations' in streams:
+        annotations = list(_without_skeleton_id(streams['annotations']))
+    else:
+        annotations = []
 
     return [nodes, connectors, tags, reviews, annotations]
 
 
+class _SkeletonRows(object):
+    """Read the rows of a RowStream that is ordered by its first column, the
+    skeleton ID, one skeleton at a time.
+    """
+
+    def __init__(self, stream):
+        self.rows = iter(stream)
+        self.next_row = next(self.rows, None)
+
+    def take(self, skeleton_id):
+        """Return the rows of the passed in skeleton without the skeleton ID
+        column. Skeletons need to be requested in ascending order.
+        """
+        result = []
+        while self.next_row is not None and self.next_row[0] <= skeleton_id:
+            if self.next_row[0] == skeleton_id:
+                result.append(self.next_row[1:])
+            self.next_row = next(self.rows, None)
+        return result
+
+
+def _compact_skeletons(project_id, skeleton_ids, with_connectors=True,
+        with_tags=True, with_history=False, with_merge_history=True,
+        with_reviews=False, with_annotations=False, with_user_info=False):
+    """Get the compact representation of multiple skeletons, like
+    _compact_skeleton() does for single skeletons. Each part is read for all
+    skeletons at once using a single query, ordered by skeleton ID. Returns a
+    generator of (skeleton_id, [nodes, connectors, tags, reviews,
+    annotations]) tuples in ascending skeleton ID order, which only keeps the
+    data of a single skeleton in memory. Raises an exception right away if a
+    skeleton doesn't exist.
+    """
+    skeleton_ids = sorted(set(skeleton_ids))
+    existing_skeleton_ids = set(ClassInstance.objects.filter(
+            pk__in=skeleton_ids).values_list('id', flat=True))
+    missing_skeleton_ids = [s for s in skeleton_ids if s not in existing_skeleton_ids]
+    if missing_skeleton_ids:
+        raise Exception("Skeleton #%s doesn't exist" % missing_skeleton_ids[0])
+
+    streams = _compact_skeleton_streams(project_id, skeleton_ids,
+            with_connectors, with_tags, with_history, with_merge_history,
+            with_reviews, with_annotations, with_user_info, ordered=True)
+
+    def read_skeletons():
+        parts = dict((k, _SkeletonRows(v)) for k, v in six.iteritems(streams))
+        for skeleton_id in skeleton_ids:
+            nodes = tuple(parts['nodes'].take(skeleton_id))
+            connectors = tuple(parts['connectors'].take(skeleton_id)) \
+                    if 'connectors' in parts else ()
+            if 'tags' in parts:
+                tags = _group_tags(parts['tags'].take(skeleton_id),
+                        with_history, with_user_info)
+            else:
+                tags = defaultdict(list)
+            reviews = parts['reviews'].take(skeleton_id) \
+                    if 'reviews' in parts else []
+            annotations = parts['annotations'].take(skeleton_id) \
+                    if 'annotations' in parts else []
+
+            yield skeleton_id, [nodes, connectors, tags, reviews, annotations]
+
+    return read_skeletons()
+
+
+def _json_chunks(parts):
+    """Yield the JSON encoding of a list of parts in chunks. RowStream parts are
+    encoded as arrays, one chunk of rows at a time.
+    """
+    def dumps(obj):
+        return json.dumps(obj, separators=(',', ':'), default=default)
+
+    yield '['
+    for i, part in enumerate(parts):
+        if i > 0:
+            yield ','
+        if isinstance(part, RowStream):
+            separator = '['
+            for rows in part.chunks():
+                # Strip the brackets of the encoded list.
+                yield separator + dumps(rows)[1:-1]
+                separator = ','
+            yield ']' if separator == ',' else '[]'
+        else:
+            yield dumps(part)
+    yield ']'
+
+
+def _msgpack_chunks(parts):
+    """Yield the msgpack encoding of a list of parts in chunks. Since msgpack
+    arrays are prefixed with their length, RowStream parts are counted before
+    their rows are encoded.
+    """
+    packer = msgpack.Packer()
+    yield packer.pack_array_header(len(parts))
+    for part in parts:
+        if isinstance(part, RowStream):
+            n_rows, chunks = part.counted_chunks()
+            yield packer.pack_array_header(n_rows)
+            for rows in chunks:
+                yield b''.join(map(packer.pack, rows))
+        else:
+            yield packer.pack(part)
+
+
+def compact_skeleton_response(parts, return_format='json'):
+    """Create a streaming response for the result of _compact_skeleton_parts()
+    or any other list of parts. Rows are read and sent in chunks, which keeps
+    memory use constant and allows clients to receive data right away.
+    """
+    if return_format == 'msgpack':
+        return StreamingHttpResponse(_stream_in_transaction(_msgpack_chunks(parts)),
+                content_type='application/octet-stream')
+    else:
+        return StreamingHttpResponse(_stream_in_transaction(_json_chunks(parts)),
+                content_type='application/json')
+
+
+def compact_skeletons_response(skeletons, n_skeletons, return_format='json'):
+    """Create a streaming response of the form {"skeletons": {skeletonID:
+    parts}} for a generator of (skeleton_id, parts) tuples, like the one
+    returned by _compact_skeletons(). Each skeleton is sent as soon as it has
+    been read. The number of skeletons is needed in advance for msgpack maps.
+    """
+    def dumps(obj):
+        return json.dumps(obj, separators=(',', ':'), default=default)
+
+    def json_chunks():
+        separator = '{"skeletons":{'
+        for skeleton_id, parts in skeletons:
+            yield '{}"{}":{}'.format(separator, skeleton_id, dumps(parts))
+            separator = ','
+        yield '}}' if separator == ',' else '{"skeletons":{}}'
+
+    def msgpack_chunks():
+        packer = msgpack.Packer()
+        yield packer.pack_map_header(1) + packer.pack("skeletons") + \
+                packer.pack_map_header(n_skeletons)
+        for skeleton_id, parts in skeletons:
+            yield packer.pack(skeleton_id) + packer.pack(parts)
+
+    if return_format == 'msgpack':
+        return StreamingHttpResponse(_stream_in_transaction(msgpack_chunks()),
+                content_type='application/octet-stream')
+    else:
+        return StreamingHttpResponse(_stream_in_transaction(json_chunks()),
+                content_type='application/json')
+
+
 def _compact_arbor(project_id=None, skeleton_id=None, with_nodes=None,
         with_connectors=None, with_tags=None, with_time=None):
     """
@@ -963,161 +1285,227 @@ def skeleton_with_metadata(request, project_id=None, skeleton_id=None):
             'default': default
         })
 
-def _measure_skeletons(skeleton_ids):
-    if not skeleton_ids:
-        raise Exception("Must provide the ID of at least one skeleton.")
+SkeletonMeasurement = namedtuple('SkeletonMeasurement', ['raw_cable',
+        'smooth_cable', 'principal_branch_cable', 'n_nodes', 'n_ends',
+        'n_branch', 'n_pre', 'n_post'])
 
-    skids_string = ",".join(map(str, skeleton_ids))
 
+def _measure_arbors(node_ids, parent_ids, skeleton_ids, locations):
+    """Measure all skeletons described by the passed in node arrays at once.
+    Each node is represented by its ID, its parent ID (-1 for root nodes), its
+    skeleton ID and a row in the N x 3 array <locations>. Returns a dictionary
+    of skeleton ID vs a dictionary with raw, smoothed and principal branch
+    cable length as well as node, end node and branch node counts.
+
+    For smoothing, each slab node (a node with exactly two neighbors) is moved
+    to 0.4 times its location plus 0.6 times the average location of its
+    neighbors, weighted by their distance. The principal branch is the path
+    from the root to the node with the most edges to the root.
+    """
+    order = np.argsort(node_ids, kind='stable')
+    node_ids = node_ids[order]
+    parent_ids = parent_ids[order]
+    locations = locations[order]
+    skeleton_list, skeleton_index = np.unique(skeleton_ids[order],
+            return_inverse=True)
+    n_nodes = len(node_ids)
+    n_skeletons = len(skeleton_list)
+
+    # Each edge connects a child to its parent, both referenced by index
+    is_root = parent_ids == -1
+    child = np.flatnonzero(~is_root)
+    parent = np.full(n_nodes, -1, np.int64)
+    parent[child] = np.searchsorted(node_ids, parent_ids[child])
+    edge_parent = parent[child]
+    edge_skeleton = skeleton_index[child]
+
+    edge_length = np.linalg.norm(locations[child] - locations[edge_parent], axis=1)
+    raw_cable = np.bincount(edge_skeleton, edge_length, n_skeletons)
+
+    # Root nodes with a single child are end nodes and root nodes with two
+    # children are slab nodes.
+    n_children = np.bincount(edge_parent, minlength=n_nodes)
+    n_neighbors = n_children + ~is_root
+    is_end = n_neighbors == 1
+    is_branch = n_neighbors > 2
+    is_slab = n_neighbors == 2
+
+    # Smooth slab nodes, the weight of each neighbor is the length of the edge
+    # to it.
+    distance_sum = np.bincount(child, edge_length, n_nodes) + \
+            np.bincount(edge_parent, edge_length, n_nodes)
+    weighted_sum = np.empty((n_nodes, 3))
+    for dim in range(3):
+        weighted_sum[:, dim] = \
+                np.bincount(child, edge_length * locations[edge_parent, dim], n_nodes) + \
+                np.bincount(edge_parent, edge_length * locations[child, dim], n_nodes)
+    smoothed = locations.copy()
+    moved = is_slab & (distance_sum > 0)
+    smoothed[moved] = 0.4 * locations[moved] + \
+            0.6 * weighted_sum[moved] / distance_sum[moved, np.newaxis]
+
+    smooth_length = np.linalg.norm(smoothed[child] - smoothed[edge_parent], axis=1)
+    smooth_cable = np.bincount(edge_skeleton, smooth_length, n_skeletons)
+
+    # Find the number of edges to the root for each node by pointer jumping:
+    # each node references an ancestor and knows the number of edges to it.
+    ancestor = np.where(is_root, np.arange(n_nodes), parent)
+    depth = (~is_root).astype(np.int64)
+    for _ in range(64):
+        next_ancestor = ancestor[ancestor]
+        if np.array_equal(next_ancestor, ancestor):
+            break
+        depth += depth[ancestor]
+        ancestor = next_ancestor
+
+    # Mark the paths from the deepest node of each skeleton to its root
+    by_depth = np.lexsort((depth, skeleton_index))
+    last_of_skeleton = np.flatnonzero(np.diff(np.append(skeleton_index[by_depth], n_skeletons)))
+    on_principal_branch = np.zeros(n_nodes, np.bool_)
+    current = by_depth[last_of_skeleton]
+    while len(current):
+        on_principal_branch[current] = True
+        current = parent[current]
+        current = current[current != -1]
+    principal_branch_cable = np.bincount(edge_skeleton,
+            np.where(on_principal_branch[child], smooth_length, 0), n_skeletons)
+
+    counts = {
+        'n_nodes': np.bincount(skeleton_index, minlength=n_skeletons),
+        'n_ends': np.bincount(skeleton_index, is_end, n_skeletons).astype(np.int64),
+        'n_branch': np.bincount(skeleton_index, is_branch, n_skeletons).astype(np.int64),
+    }
+
+    measurements = {}
+    for i, skeleton_id in enumerate(skeleton_list.tolist()):
+        measurements[skeleton_id] = {
+            'raw_cable': float(raw_cable[i]),
+            'smooth_cable': float(smooth_cable[i]),
+            'principal_branch_cable': float(principal_branch_cable[i]),
+            'n_nodes': int(counts['n_nodes'][i]),
+            'n_ends': int(counts['n_ends'][i]),
+            'n_branch': int(counts['n_branch'][i]),
+        }
+    return measurements
+
+
+def _measure_skeleton_batch(skeleton_ids):
+    """Measure the passed in skeletons using a fixed number of queries. Returns
+    a dictionary of skeleton ID vs SkeletonMeasurement. Skeletons without nodes
+    aren't included.
+    """
     cursor = connection.cursor()
     cursor.execute('''
-    SELECT id, parent_id, skeleton_id, location_x, location_y, location_z
-    FROM treenode
-    WHERE skeleton_id IN (%s)
-    ''' % skids_string)
-
-    # TODO should be all done with numpy,
-    # TODO  by partitioning the skeleton into sequences of x,y,z representing the slabs
-    # TODO  and then convolving them.
-
-    class Skeleton():
-        def __init__(self):
-            self.nodes = {}
-            self.raw_cable = 0
-            self.smooth_cable = 0
-            self.principal_branch_cable = 0
-            self.n_ends = 0
-            self.n_branch = 0
-            self.n_pre = 0
-            self.n_post = 0
-
-    class Node():
-        def __init__(self, parent_id, x, y, z):
-            self.parent_id = parent_id
-            self.x = x
-            self.y = y
-            self.z = z
-            self.wx = x # weighted average of itself and neighbors
-            self.wy = y
-            self.wz = z
-            self.children = {} # node ID vs distance
-
-    skeletons = defaultdict(dict) # skeleton ID vs (node ID vs Node)
-    for row in cursor.fetchall():
-        skeleton = skeletons.get(row[2])
-        if not skeleton:
-            skeleton = Skeleton()
-            skeletons[row[2]] = skeleton
-        skeleton.nodes[row[0]] = Node(row[1], row[3], row[4], row[5])
-
-    for skeleton in six.itervalues(skeletons):
-        nodes = skeleton.nodes
-        tree = nx.DiGraph()
-        root = None
-        # Accumulate children
-        for nodeID, node in six.iteritems(nodes):
-            if not node.parent_id:
-                root = nodeID
-                continue
-            tree.add_edge(node.parent_id, nodeID)
-            parent = nodes[node.parent_id]
-            distance = sqrt(  pow(node.x - parent.x, 2)
-                            + pow(node.y - parent.y, 2)
-                            + pow(node.z - parent.z, 2))
-            parent.children[nodeID] = distance
-            # Measure raw cable, given that we have the parent already
-            skeleton.raw_cable += distance
-        # Utilize accumulated children and the distances to them
-        for nodeID, node in six.iteritems(nodes):
-            # Count end nodes and branch nodes
-            n_children = len(node.children)
-            if not node.parent_id:
-                if 1 == n_children:
-                    skeleton.n_ends += 1
-                    continue
-                if n_children > 2:
-                    skeleton.n_branch += 1
-                    continue
-                # Else, if 2 == n_children, the root node is in the middle of the skeleton, being a slab node
-            elif 0 == n_children:
-                skeleton.n_ends += 1
-                continue
-            elif n_children > 1:
-                skeleton.n_branch += 1
-                continue
-            # Compute weighted position for slab nodes only
-            # (root, branch and end nodes do not move)
-            oids = node.children.copy()
-            if node.parent_id:
-                oids[node.parent_id] = skeleton.nodes[node.parent_id].children[nodeID]
-            sum_distances = sum(six.itervalues(oids))
-            wx, wy, wz = 0, 0, 0
-            for oid, distance in six.iteritems(oids):
-                other = skeleton.nodes[oid]
-                w = distance / sum_distances if sum_distances != 0 else 0
-                wx += other.x * w
-                wy += other.y * w
-                wz += other.z * w
-            node.wx = node.x * 0.4 + wx * 0.6
-            node.wy = node.y * 0.4 + wy * 0.6
-            node.wz = node.z * 0.4 + wz * 0.6
-        # Find out nodes that belong to the principal branch
-        principal_branch_nodes = set(sorted(partition(tree, root), key=len)[-1])
-        # Compute smoothed cable length, also for principal branch
-        for nodeID, node in six.iteritems(nodes):
-            if not node.parent_id:
-                # root node
-                continue
-            parent = nodes[node.parent_id]
-            length = sqrt(  pow(node.wx - parent.wx, 2)
-                          + pow(node.wy - parent.wy, 2)
-                          + pow(node.wz - parent.wz, 2))
-            skeleton.smooth_cable += length
-            if nodeID in principal_branch_nodes:
-                skeleton.principal_branch_cable += length
+        SELECT id, COALESCE(parent_id, -1), skeleton_id,
+            location_x, location_y, location_z
+        FROM treenode
+        WHERE skeleton_id = ANY(%(skeleton_ids)s::bigint[])
+    ''', {
+        'skeleton_ids': list(skeleton_ids),
+    })
+    rows = cursor.fetchall()
+    if not rows:
+        return {}
+
+    columns = list(zip(*rows))
+    del rows
+    measurements = _measure_arbors(np.array(columns[0], np.int64),
+            np.array(columns[1], np.int64), np.array(columns[2], np.int64),
+            np.array(columns[3:6], np.float64).T)
+    del columns
+
+    n_pre = defaultdict(int)
+    n_post = defaultdict(int)
 
     # Count inputs
     cursor.execute('''
-    SELECT tc.skeleton_id, count(tc.skeleton_id)
-    FROM treenode_connector tc,
-         relation r
-    WHERE tc.skeleton_id IN (%s)
-      AND tc.relation_id = r.id
-      AND r.relation_name = 'postsynaptic_to'
-    GROUP BY tc.skeleton_id
-    ''' % skids_string)
-
-    for row in cursor.fetchall():
-        skeletons[row[0]].n_pre = row[1]
+        SELECT tc.skeleton_id, count(tc.skeleton_id)
+        FROM treenode_connector tc,
+             relation r
+        WHERE tc.skeleton_id = ANY(%(skeleton_ids)s::bigint[])
+          AND tc.relation_id = r.id
+          AND r.relation_name = 'postsynaptic_to'
+        GROUP BY tc.skeleton_id
+    ''', {
+        'skeleton_ids': list(skeleton_ids),
+    })
+    n_pre.update(cursor.fetchall())
 
     # Count outputs
     cursor.execute('''
-    SELECT tc1.skeleton_id, count(tc1.skeleton_id)
-    FROM treenode_connector tc1,
-         treenode_connector tc2,
-         relation r1,
-         relation r2
-    WHERE tc1.skeleton_id IN (%s)
-      AND tc1.connector_id = tc2.connector_id
-      AND tc1.relation_id = r1.id
-      AND r1.relation_name = 'presynaptic_to'
-      AND tc2.relation_id = r2.id
-      AND r2.relation_name = 'postsynaptic_to'
-      GROUP BY tc1.skeleton_id
-    ''' % skids_string)
+        SELECT tc1.skeleton_id, count(tc1.skeleton_id)
+        FROM treenode_connector tc1,
+             treenode_connector tc2,
+             relation r1,
+             relation r2
+        WHERE tc1.skeleton_id = ANY(%(skeleton_ids)s::bigint[])
+          AND tc1.connector_id = tc2.connector_id
+          AND tc1.relation_id = r1.id
+          AND r1.relation_name = 'presynaptic_to'
+          AND tc2.relation_id = r2.id
+          AND r2.relation_name = 'postsynaptic_to'
+          GROUP BY tc1.skeleton_id
+    ''', {
+        'skeleton_ids': list(skeleton_ids),
+    })
+    n_post.update(cursor.fetchall())
+
+    return dict((skeleton_id, SkeletonMeasurement(n_pre=n_pre[skeleton_id],
+            n_post=n_post[skeleton_id], **m)) for skeleton_id, m in six.iteritems(measurements))
 
-    for row in cursor.fetchall():
-        skeletons[row[0]].n_post = row[1]
 
+def _measure_skeleton_batch_in_thread(skeleton_ids):
+    """Measure a batch of skeletons in a worker thread, which uses its own
+    database connection. It is closed once the batch is done.
+    """
+    try:
+        return _measure_skeleton_batch(skeleton_ids)
+    finally:
+        connection.close()
+
+
+def _measure_skeletons(skeleton_ids):
+    """Measure the passed in skeletons. Batches of SKELETON_MEASUREMENT_BATCH_SIZE
+    skeletons are measured in parallel by SKELETON_MEASUREMENT_WORKERS threads,
+    each with its own database connection. Within a transaction, all batches
+    are measured in the current thread, because other database connections
+    can't see its changes. Returns a dictionary of skeleton ID vs
+    SkeletonMeasurement.
+    """
+    if not skeleton_ids:
+        raise Exception("Must provide the ID of at least one skeleton.")
+
+    skeleton_ids = sorted(set(skeleton_ids))
+    batch_size = max(1, settings.SKELETON_MEASUREMENT_BATCH_SIZE)
+    batches = [skeleton_ids[i:i + batch_size]
+            for i in range(0, len(skeleton_ids), batch_size)]
+    n_workers = min(settings.SKELETON_MEASUREMENT_WORKERS, len(batches))
+
+    if n_workers > 1 and not connection.in_atomic_block:
+        pool = ThreadPool(n_workers)
+        try:
+            results = pool.map(_measure_skeleton_batch_in_thread, batches)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        results = [_measure_skeleton_batch(batch) for batch in batches]
+
+    skeletons = {}
+    for result in results:
+        skeletons.update(result)
     return skeletons
 
 
+# Skeletons are measured in parallel with separate database connections, which
+# is only possible outside of a transaction.
+@transaction.non_atomic_requests
 @requires_user_role([UserRole.Annotate, UserRole.Browse])
 def measure_skeletons(request, project_id=None):
     skeleton_ids = tuple(int(v) for k,v in six.iteritems(request.POST) if k.startswith('skeleton_ids['))
     def asRow(skid, sk):
-        return (skid, int(sk.raw_cable), int(sk.smooth_cable), sk.n_pre, sk.n_post, len(sk.nodes), sk.n_branch, sk.n_ends, sk.principal_branch_cable)
-    return JsonResponse([asRow(skid, sk) for skid, sk in _measure_skeletons(skeleton_ids).iteritems()], safe=False)
+        return (skid, int(sk.raw_cable), int(sk.smooth_cable), sk.n_pre, sk.n_post, sk.n_nodes, sk.n_branch, sk.n_ends, sk.principal_branch_cable)
+    return JsonResponse([asRow(skid, sk) for skid, sk in six.iteritems(_measure_skeletons(skeleton_ids))], safe=False)
 
 
 def _skeleton_neuroml_cell(skeleton_id, preID, postID):
@@ -4,21 +4,14 @@ from __future__ import unicode_literals
 import logging
 import six
 import numpy as np
-from numpy import array, float32
 from numpy.linalg import norm
-import networkx as nx
 from collections import namedtuple
 
 logger = logging.getLogger(__name__)
 
-try:
-    from scipy.sparse.csgraph import dijkstra
-except ImportError:
-    logger.warning("CATMAID was unable to load the scipy module. "
-        "Synapse clustering won't be available")
-
 from catmaid.control.common import get_relation_to_id_map
-from catmaid.models import Treenode, TreenodeConnector, ClassInstance, Relation
+from catmaid.control.tree_util import Arbor, load_arbor
+from catmaid.models import TreenodeConnector, ClassInstance, Relation
 
 
 def synapse_clustering( skeleton_id, h_list ):
@@ -29,86 +22,165 @@ def synapse_clustering( skeleton_id, h_list ):
     return tree_max_density(Gwud, synNodes, connector_ids, relations, h_list)
 
 
+SynapseGroup = namedtuple("SynapseGroup", ['node_ids', 'connector_ids', 'relations', 'local_max'])
+
+# Kernel values below this weight are ignored, which limits the path distance
+# up to which each synapse contributes to the density field to about 4.6 times
+# the bandwidth.
+KERNEL_MIN_WEIGHT = 1e-9
+
+# The maximum number of synapse nodes whose kernels are propagated through the
+# tree at the same time.
+KERNEL_BATCH_SIZE = 1024
+
+
 def tree_max_density(Gwud, synNodes, connector_ids, relations, h_list):
-    """ Gwud: networkx graph were the edges are weighted by length, and undirected.
+    """ Gwud: networkx graph were the edges are weighted by length, and undirected,
+        or an Arbor with node locations.
         synNodes: list of node IDs where there is a synapse.
         connector_ids: list of connector IDs.
         relations: list of the type of synapse, 'presynaptic_to' or 'postsynaptic_to'.
         The three lists are synchronized by index.
+
+        The synapse density at each node is the sum of Gaussian kernels of the
+        path distances to all synapse nodes. Starting from each synapse node,
+        the density field is climbed along the tree until a local maximum is
+        reached. All synapses reaching the same maximum form a group. Memory
+        use is linear in the number of nodes.
     """
+    nodeList, indptr, indices, weights = treeAdjacency(Gwud)
+    nodeArray = np.asarray(nodeList, np.int64)
+    sorter = np.argsort(nodeArray)
+    synIndices = sorter[np.searchsorted(nodeArray, np.asarray(synNodes, np.int64),
+            sorter=sorter)]
 
-    D, id2index = distanceMatrix( Gwud, synNodes )
+    h_list = list(h_list)
+    density = treeDensity(indptr, indices, weights, np.unique(synIndices), h_list)
 
-    SynapseGroup = namedtuple("SynapseGroup", ['node_ids', 'connector_ids', 'relations', 'local_max'])
     synapseGroups = {}
-
-    for h in h_list:
-        expDh = np.exp(-1 * np.multiply(D, D) / (h * h) )
-
-        targLoc = {}            # targLocs hosts the final destination nodes of the hill climbing
-        densityField = {}            # densityField stores the height of the hill to be climbed
-        for startNode in synNodes:
-            if startNode not in targLoc:
-                currNode = startNode
-                allOnPath = []
-
-                if startNode not in densityField:
-                    densityField[startNode] = 0
-                    densityField[startNode] = np.sum(expDh[:,id2index[startNode]])
-
-                while True:
-                    allOnPath.append(currNode)
-
-                    #Make sure I have densityField of all neighbors for comparison
-                    if currNode in targLoc:
-                        currNode = targLoc[ currNode ] # Jump right to the end already.
-                        break
-
-                    for nn in Gwud.neighbors( currNode ):
-                        if nn not in densityField:
-                            densityField[nn] = 0
-                            densityField[nn] = np.sum(expDh[:,id2index[nn]])
-
-                    prevNode = currNode
-                    for nn in Gwud.neighbors( currNode ):
-                        if densityField[nn] > densityField[currNode]:
-                            currNode = nn
-
-                    if currNode == prevNode:
-                        break
-
-                for node in allOnPath:
-                    targLoc[node] = currNode
-
-        uniqueTargs = set(targLoc[node] for node in synNodes)
+    for h, hDensity in zip(h_list, density):
+        # The final destination of the hill climbing for each synapse node
+        targets = climbDensity(indptr, indices, hDensity)[synIndices]
 
         loc2group = {}
-
         synapseGroups[h] = {}
-        for ind, val in enumerate(uniqueTargs):
+        for ind, val in enumerate(np.unique(targets).tolist()):
             loc2group[val] = ind
-            synapseGroups[h][ind] = SynapseGroup([], [], [], val)
+            synapseGroups[h][ind] = SynapseGroup([], [], [], int(nodeList[val]))
 
         for ind, node in enumerate(synNodes):
-            gi = loc2group[targLoc[node]]
+            gi = loc2group[targets[ind]]
             synapseGroups[h][ gi ].node_ids.append( node )
             synapseGroups[h][ gi ].connector_ids.append( connector_ids[ind] )
             synapseGroups[h][ gi ].relations.append( relations[ind] )
 
     return synapseGroups
 
-def distanceMatrix( G, synNodes ):
-    """ Given a nx graph, produce an all to all distance dict via scipy sparse matrix black magic.
-     Also, you get in 'id2index' the the mapping from a node id to the index in matrix scaledDistance. """
-    dmat = {}
+def treeAdjacency( G ):
+    """ Given a nx graph, return its node list along with the compressed
+    adjacency (indptr, indices, weights) of the nodes, referencing nodes by
+    their index in the node list. Neighbors are listed in the order of the
+    graph. An Arbor is treated as undirected graph, weighted by edge length. """
+    if isinstance(G, Arbor):
+        return arborAdjacency(G)
     nodeList = tuple(G.nodes())
-    synNodes = set(synNodes)
-    synIndices = tuple(i for i,node in enumerate(nodeList) if node in synNodes)
-
-    dmat = dijkstra(nx.to_scipy_sparse_matrix(G, nodeList),
-            directed=False, indices=synIndices)
-
-    return dmat, {node: i for i,node in enumerate(nodeList)}
+    id2index = {node: i for i, node in enumerate(nodeList)}
+    degrees = np.fromiter((len(G[node]) for node in nodeList), np.int64, len(nodeList))
+    indptr = np.zeros(len(nodeList) + 1, np.int64)
+    np.cumsum(degrees, out=indptr[1:])
+    indices = np.fromiter((id2index[nn] for node in nodeList for nn in G[node]),
+            np.int64, indptr[-1])
+    weights = np.fromiter((G[node][nn].get('weight', 1.0) for node in nodeList
+            for nn in G[node]), np.float64, indptr[-1])
+    return nodeList, indptr, indices, weights
+
+def arborAdjacency( arbor ):
+    """ Like treeAdjacency(), but for an Arbor with node locations, whose node
+    IDs array is returned as node list. The children of each node are listed
+    before its parent. """
+    n_nodes = len(arbor)
+    child = np.flatnonzero(arbor.parents != -1)
+    parent = arbor.parents[child]
+    edgeLength = norm(arbor.locations[child] - arbor.locations[parent], axis=1)
+    rows = np.concatenate((parent, child))
+    order = np.argsort(rows, kind='mergesort')
+    indptr = np.zeros(n_nodes + 1, np.int64)
+    np.cumsum(np.bincount(rows, minlength=n_nodes), out=indptr[1:])
+    indices = np.concatenate((child, parent))[order]
+    weights = np.concatenate((edgeLength, edgeLength))[order]
+    return arbor.node_ids, indptr, indices, weights
+
+def treeDensity( indptr, indices, weights, sources, h_list ):
+    """ Return an array with the density field of each bandwidth in h_list, with
+    one value per node. The density at a node is the sum of the Gaussian kernel
+    values of its path distances to all source nodes. Kernels are truncated at
+    KERNEL_MIN_WEIGHT: starting from all sources in a batch at once, kernels are
+    propagated away from their source through the tree, until the largest
+    bandwidth's kernel falls below this weight. This expects the graph to be a
+    tree (or forest), in which each path is unique. """
+    n_nodes = len(indptr) - 1
+    h2 = np.square(np.asarray(h_list, np.float64))[:, np.newaxis]
+    max_distance = np.sqrt(h2.max() * -np.log(KERNEL_MIN_WEIGHT)) if len(h2) else 0
+    density = np.zeros((len(h2), n_nodes))
+    degrees = np.diff(indptr)
+
+    for start in range(0, len(sources), KERNEL_BATCH_SIZE):
+        # Each front entry is a node that was reached from a source node,
+        # together with its predecessor on the path and the path length.
+        node = np.asarray(sources[start:start + KERNEL_BATCH_SIZE], np.int64)
+        prev = np.full(len(node), -1, np.int64)
+        dist = np.zeros(len(node))
+        # Paths can't be longer than the number of nodes, which protects
+        # against cycles of zero length edges.
+        for _ in range(n_nodes):
+            if not len(node):
+                break
+            kernel = np.exp(-np.square(dist) / h2)
+            for i in range(len(h2)):
+                density[i] += np.bincount(node, kernel[i], n_nodes)
+
+            # Advance the front to all neighbors, except the predecessor
+            counts = degrees[node]
+            total = counts.sum()
+            offsets = np.repeat(indptr[node] - (np.cumsum(counts) - counts), counts)
+            edges = offsets + np.arange(total)
+            nextNode = indices[edges]
+            nextDist = np.repeat(dist, counts) + weights[edges]
+            keep = (nextNode != np.repeat(prev, counts)) & (nextDist <= max_distance)
+            prev = np.repeat(node, counts)[keep]
+            node = nextNode[keep]
+            dist = nextDist[keep]
+
+    return density
+
+def climbDensity( indptr, indices, density ):
+    """ Return for each node the local maximum of the density field that is
+    reached by repeatedly moving to the neighbor with the highest density, as
+    long as it is higher than the current node's density. """
+    n_nodes = len(indptr) - 1
+    degrees = np.diff(indptr)
+    rows = np.repeat(np.arange(n_nodes), degrees)
+    neighborDensity = density[indices]
+
+    step = np.arange(n_nodes)
+    connected = np.flatnonzero(degrees)
+    if len(connected):
+        best = np.full(n_nodes, -np.inf)
+        best[connected] = np.maximum.reduceat(neighborDensity, indptr[connected])
+        # The first neighbor with the highest density of each node
+        isBest = np.flatnonzero(neighborDensity == best[rows])
+        bestNodes, first = np.unique(rows[isBest], return_index=True)
+        ascending = best[bestNodes] > density[bestNodes]
+        step[bestNodes[ascending]] = indices[isBest[first[ascending]]]
+
+    # Follow the steps to their end by pointer jumping. The density strictly
+    # increases along each path, which makes sure there are no cycles.
+    target = step
+    while True:
+        nextTarget = target[target]
+        if np.array_equal(nextTarget, target):
+            return target
+        target = nextTarget
 
 def countTargets( skeleton_id ):
     nTargets = {}
@@ -121,19 +193,8 @@ def countTargets( skeleton_id ):
     return nTargets
 
 def createSpatialGraphFromSkeletonID(sid):
-    # retrieve all nodes of the skeleton
-    treenode_qs = Treenode.objects.filter(skeleton_id=sid).values_list(
-        'id', 'parent_id', 'location_x', 'location_y', 'location_z')
-    # build the networkx graph from it
-    G = nx.Graph()
-    locations = {}
-    for tnid, parent_id, location_x, location_y, location_z in treenode_qs:
-        if parent_id:
-            G.add_edge(parent_id, tnid)
-        locations[tnid] = array((location_x, location_y, location_z), dtype=float32)
-    for iFrom, iTo in G.edges(data=False):
-        G[iFrom][iTo]['weight'] = norm(locations[iFrom] - locations[iTo])
-    return G
+    """ Return the Arbor of a skeleton, including node locations. """
+    return load_arbor(sid, with_locations=True)
 
 def synapseNodesFromSkeletonID(sid):
     sk = ClassInstance.objects.get(pk=sid)
@@ -2,24 +2,259 @@
 from __future__ import unicode_literals
 
 # A 'tree' is a networkx.DiGraph with a single root node (a node without parents)
+# or an Arbor, a compact representation of the same backed by NumPy arrays. The
+# functions below accept both, unless noted otherwise.
 
+import copy
 import six
+import numpy as np
 
 from operator import itemgetter
 from networkx import Graph, DiGraph
 from collections import defaultdict
 from math import sqrt
-from itertools import islice
+from django.db import connection
 from catmaid.models import Treenode
 from six.moves import range
 
 from six.moves import zip as izip
 
 
+LOCATION_FIELDS = ('location_x', 'location_y', 'location_z')
+
+class Arbor(object):
+    """ A compact representation of a tree (or forest) that keeps all nodes in
+    NumPy arrays rather than in one Python dictionary per node. Nodes are sorted
+    by ID and are referenced by their position in the node_ids array, the index.
+    For each node, parents stores the index of its parent node or -1 for root
+    nodes. Optionally, locations stores a row of x, y and z for each node and
+    properties maps names to arrays of additional values, one per node. """
+
+    def __init__(self, node_ids, parent_ids, locations=None, properties=None):
+        """ node_ids and parent_ids are synchronized by index, the parent ID of
+        root nodes is expected to be -1. All other parent IDs need to be part of
+        node_ids. locations and properties are synchronized by index as well. """
+        node_ids = np.asarray(node_ids, np.int64)
+        order = np.argsort(node_ids, kind='mergesort')
+        self.node_ids = node_ids[order]
+        parent_ids = np.asarray(parent_ids, np.int64)[order]
+        self.parents = np.full(len(order), -1, np.int64)
+        child = np.flatnonzero(parent_ids != -1)
+        self.parents[child] = self.index(parent_ids[child])
+        self.locations = None if locations is None else \
+                np.asarray(locations, np.float64)[order]
+        self.properties = {name: np.asarray(values)[order]
+                for name, values in six.iteritems(properties or {})}
+        self._children = None
+
+    def __len__(self):
+        return len(self.node_ids)
+
+    def __contains__(self, node_id):
+        i = np.searchsorted(self.node_ids, node_id)
+        return i < len(self.node_ids) and self.node_ids[i] == node_id
+
+    def copy(self):
+        """ Return a copy of this arbor that can be rerooted independently. """
+        arbor = copy.copy(self)
+        arbor.parents = self.parents.copy()
+        return arbor
+
+    def index(self, node_ids):
+        """ Return the index of each passed in node ID or the index of a single
+        node ID. Raises a KeyError if a node isn't part of the arbor. """
+        node_ids = np.asarray(node_ids, np.int64)
+        flat_ids = np.atleast_1d(node_ids)
+        index = np.searchsorted(self.node_ids, flat_ids)
+        found = index < len(self.node_ids)
+        found[found] = self.node_ids[index[found]] == flat_ids[found]
+        if not found.all():
+            raise KeyError('Unknown node ID(s): {}'.format(
+                    ', '.join(map(str, flat_ids[~found]))))
+        return int(index[0]) if 0 == node_ids.ndim else index
+
+    def property(self, name, node_id):
+        """ Return a single property value of a node as Python object. """
+        i = self.index(node_id)
+        return self.properties[name][i:i+1].tolist()[0]
+
+    def parent(self, node_id):
+        """ Return the parent ID of the passed in node or None for root nodes. """
+        p = self.parents[self.index(node_id)]
+        return None if -1 == p else int(self.node_ids[p])
+
+    def _child_index(self):
+        """ Return the compressed child lists of all nodes as (indptr, indices)
+        tuple, children of node i are indices[indptr[i]:indptr[i+1]]. """
+        if self._children is None:
+            child = np.flatnonzero(self.parents != -1)
+            indices = child[np.argsort(self.parents[child], kind='mergesort')]
+            indptr = np.zeros(len(self.node_ids) + 1, np.int64)
+            np.cumsum(np.bincount(self.parents[child],
+                    minlength=len(self.node_ids)), out=indptr[1:])
+            self._children = (indptr, indices)
+        return self._children
+
+    def children(self, node_id):
+        """ Return an array with the IDs of all child nodes of a node. """
+        indptr, indices = self._child_index()
+        i = self.index(node_id)
+        return self.node_ids[indices[indptr[i]:indptr[i+1]]]
+
+    def n_children(self):
+        """ Return an array with the number of children of each node. """
+        return np.diff(self._child_index()[0])
+
+    def find_root(self):
+        """ Return the ID of the first root node or None if there are no nodes. """
+        roots = np.flatnonzero(self.parents == -1)
+        return int(self.node_ids[roots[0]]) if len(roots) else None
+
+    def depths(self):
+        """ Return an array with the number of edges to the root of each node. """
+        n_nodes = len(self.node_ids)
+        is_root = self.parents == -1
+        # Pointer jumping: each node references an ancestor and knows the
+        # number of edges to it.
+        ancestor = np.where(is_root, np.arange(n_nodes), self.parents)
+        depth = (~is_root).astype(np.int64)
+        while True:
+            next_ancestor = ancestor[ancestor]
+            if np.array_equal(next_ancestor, ancestor):
+                return depth
+            depth += depth[ancestor]
+            ancestor = next_ancestor
+
+    def accumulate(self, values, ufunc=np.add):
+        """ Return a copy of values (one per node) in which the value of each
+        node is combined with the values of all its descendants using the passed
+        in NumPy ufunc. E.g. np.add applied to ones yields subtree sizes. The
+        tree is processed one level at a time, starting with the deepest. """
+        result = np.array(values)
+        depth = self.depths()
+        by_depth = np.argsort(depth, kind='mergesort')
+        levels = np.split(by_depth, np.flatnonzero(np.diff(depth[by_depth])) + 1)
+        # The first level contains only root nodes
+        for level in reversed(levels[1:]):
+            ufunc.at(result, self.parents[level], result[level])
+        return result
+
+    def path_to_root(self, node_id):
+        """ Return the indices of all nodes from the passed in node to its root,
+        both included. """
+        path = [self.index(node_id)]
+        parents = self.parents
+        parent = parents[path[0]]
+        while parent != -1:
+            path.append(parent)
+            parent = parents[parent]
+        return np.array(path, np.int64)
+
+    def reroot(self, new_root):
+        """ Reverse in place the direction of the edges from new_root to root. """
+        path = self.path_to_root(new_root)
+        if len(path) > 1:
+            self.parents[path[1:]] = path[:-1]
+            self.parents[path[0]] = -1
+            self._children = None
+
+    def partition(self):
+        """ Return a list of node ID arrays like partition(): each sequence runs
+        from an end node to either the root or a branch node, end nodes are
+        visited from highest to lowest distance to the root. Each node is part
+        of the sequence of the first visited end node downstream of it, branch
+        nodes are repeated as ends of the sequences of all other end nodes. """
+        n_nodes = len(self.node_ids)
+        if not n_nodes:
+            return []
+        depth = self.depths()
+        ends = np.flatnonzero(0 == self.n_children())
+        ends = ends[np.lexsort((ends, -depth[ends]))]
+        rank = np.full(n_nodes, len(ends), np.int64)
+        rank[ends] = np.arange(len(ends))
+        owner = self.accumulate(rank, np.minimum)
+
+        # Group nodes by owning end node, each group ordered towards the root,
+        # and append the parent of the last node of each group.
+        order = np.lexsort((-depth, owner))
+        group_end = np.append(np.flatnonzero(np.diff(owner[order])) + 1, n_nodes)
+        last_parent = self.parents[order[group_end - 1]]
+        has_parent = last_parent != -1
+        sequences = np.insert(order, group_end[has_parent], last_parent[has_parent])
+        splits = (group_end + np.cumsum(has_parent))[:-1]
+        return [s for s in np.split(self.node_ids[sequences], splits) if len(s) > 1]
+
+    def simplify(self, keepers):
+        """ Return a new Arbor with only the keepers and the branch nodes between
+        them, rooted at the first keeper. Unlike simplify(), this arbor remains
+        unchanged. keepers can't be empty. """
+        keep_index = self.index(np.asarray(list(keepers), np.int64))
+        arbor = self.copy()
+        arbor.reroot(self.node_ids[keep_index[0]])
+        parents = arbor.parents
+
+        kept = np.zeros(len(self.node_ids), np.bool_)
+        kept[keep_index] = True
+        # Branch nodes with keepers downstream of at least two children
+        has_keeper = arbor.accumulate(kept, np.maximum)
+        child = np.flatnonzero((parents != -1) & has_keeper)
+        kept |= np.bincount(parents[child], minlength=len(kept)) > 1
+
+        # Find the nearest kept ancestor of each node by pointer jumping
+        nearest = np.where(kept | (parents == -1), np.arange(len(kept)), parents)
+        while True:
+            next_nearest = nearest[nearest]
+            if np.array_equal(next_nearest, nearest):
+                break
+            nearest = next_nearest
+
+        kept_index = np.flatnonzero(kept)
+        kept_parents = parents[kept_index]
+        new_parents = np.full(len(kept_index), -1, np.int64)
+        has_parent = np.flatnonzero(kept_parents != -1)
+        ancestor = nearest[kept_parents[has_parent]]
+        has_kept_ancestor = kept[ancestor]
+        new_parents[has_parent[has_kept_ancestor]] = \
+                self.node_ids[ancestor[has_kept_ancestor]]
+
+        return Arbor(self.node_ids[kept_index], new_parents,
+                None if self.locations is None else self.locations[kept_index],
+                {name: values[kept_index] for name, values in six.iteritems(self.properties)})
+
+    def components(self, node_ids):
+        """ Return a list of node ID arrays, one for each connected component of
+        the subgraph made of the passed in nodes. """
+        index = np.unique(self.index(node_ids))
+        member = np.zeros(len(self.node_ids), np.bool_)
+        member[index] = True
+        # Each node of a component references the topmost node in it
+        top = np.arange(len(self.node_ids))
+        inner = index[self.parents[index] != -1]
+        inner = inner[member[self.parents[inner]]]
+        top[inner] = self.parents[inner]
+        while True:
+            next_top = top[top]
+            if np.array_equal(next_top, top):
+                break
+            top = next_top
+        order = np.argsort(top[index], kind='mergesort')
+        splits = np.flatnonzero(np.diff(top[index][order])) + 1
+        return np.split(self.node_ids[index[order]], splits)
+
+    def cable_length(self):
+        """ Return the sum of the lengths of all edges. Requires locations. """
+        child = np.flatnonzero(self.parents != -1)
+        return float(np.linalg.norm(self.locations[child] -
+                self.locations[self.parents[child]], axis=1).sum())
+
+
+
 def find_root(tree):
     """ Search and return the first node that has zero predecessors.
     Will be the root node in directed graphs.
     Avoids one database lookup. """
+    if isinstance(tree, Arbor):
+        return tree.find_root()
     for node in tree:
         if not next(tree.predecessors_iter(node), None):
             return node
@@ -68,6 +303,8 @@ def find_common_ancestors(tree, node_groups):
 
 def reroot(tree, new_root):
     """ Reverse in place the direction of the edges from the new_root to root. """
+    if isinstance(tree, Arbor):
+        return tree.reroot(new_root)
     parent = next(tree.predecessors_iter(new_root), None)
     if not parent:
         # new_root is already the root
@@ -83,7 +320,10 @@ def simplify(tree, keepers):
     """ Given a tree and a set of nodes to keep, create a new tree
     where only the nodes to keep and the branch points between them are preserved.
     WARNING: will reroot the tree at the first of the keepers.
-    WARNING: keepers can't be empty. """
+    WARNING: keepers can't be empty.
+    An Arbor results in a new Arbor, see Arbor.simplify(). """
+    if isinstance(tree, Arbor):
+        return tree.simplify(keepers)
     # Ensure no repeats
     keepers = set(keepers)
     # Add all keeper nodes to the minified graph
@@ -133,7 +373,12 @@ def partition(tree, root_node=None):
     """ Partition the tree as a list of sequences of node IDs,
     with branch nodes repeated as ends of all sequences except the longest
     one that finishes at the root.
-    Each sequence runs from an end node to either the root or a branch node. """
+    Each sequence runs from an end node to either the root or a branch node.
+    For an Arbor, root_node is ignored and sequences are arrays. """
+    if isinstance(tree, Arbor):
+        for sequence in tree.partition():
+            yield sequence
+        return
     distances = edge_count_to_root(tree, root_node=root_node) # distance in number of edges from root
     seen = set()
     # Iterate end nodes sorted from highest to lowest distance to root
@@ -194,41 +439,71 @@ def spanning_tree(tree, preserve):
 
 def cable_length(tree, locations):
     """ locations: a dictionary of nodeID vs iterable of node position (1d, 2d, 3d, ...)
-    Returns the total cable length. """
+    Returns the total cable length. An Arbor uses its own locations. """
+    if isinstance(tree, Arbor):
+        return tree.cable_length()
     return sum(sqrt(sum(pow(loc2 - loc1, 2) for loc1, loc2 in izip(locations[a], locations[b]))) for a,b in tree.edges_iter())
 
 
 def lazy_load_trees(skeleton_ids, node_properties):
-    """ Return a lazy collection of pairs of (long, DiGraph)
+    """ Return a lazy collection of pairs of (long, Arbor)
     representing (skeleton_id, tree).
     The node_properties is a list of strings, each being a name of a column
     in the django model of the Treenode table that is not the treenode id, parent_id
-    or skeleton_id. """
+    or skeleton_id. If all of location_x, location_y and location_z are
+    requested, they are stored as locations of the arbor, all other properties
+    are available from the properties dictionary of the arbor. """
 
     values_list = ('id', 'parent_id', 'skeleton_id')
-    props = tuple(set(node_properties) - set(values_list))
+    with_locations = set(LOCATION_FIELDS).issubset(node_properties)
+    if with_locations:
+        props = LOCATION_FIELDS + tuple(set(node_properties) -
+                set(values_list) - set(LOCATION_FIELDS))
+    else:
+        props = tuple(set(node_properties) - set(values_list))
     values_list += props
 
     ts = Treenode.objects.filter(skeleton__in=skeleton_ids) \
             .order_by('skeleton') \
-            .values_list(*values_list)
+            .values_list(*values_list) \
+            .iterator()
+
+    def make_arbor(rows):
+        columns = list(izip(*rows))
+        parent_ids = [-1 if p is None else p for p in columns[1]]
+        if with_locations:
+            return Arbor(columns[0], parent_ids, np.array(columns[3:6]).T,
+                    dict(izip(props[3:], columns[6:])))
+        return Arbor(columns[0], parent_ids, None, dict(izip(props, columns[3:])))
+
     skid = None
-    tree = None
+    rows = []
     for t in ts:
         if t[2] != skid:
-            if tree:
-                yield (skid, tree)
+            if rows:
+                yield (skid, make_arbor(rows))
             # Prepare for the next one
             skid = t[2]
-            tree = DiGraph()
-
-        fields = {k: v for k,v in izip(props, islice(t, 3, 3 + len(props)))}
-        tree.add_node(t[0], fields)
+            rows = []
+        rows.append(t)
 
-        if t[1]:
-            # From child to parent
-            tree.add_edge(t[0], t[1])
+    if rows:
+        yield (skid, make_arbor(rows))
 
-    if tree:
-        yield (skid, tree)
 
+def load_arbor(skeleton_id, with_locations=False):
+    """ Return the Arbor of a single skeleton, optionally with node locations.
+    Raises a ValueError if the skeleton has no nodes. """
+    cursor = connection.cursor()
+    cursor.execute('''
+        SELECT id, COALESCE(parent_id, -1) {}
+        FROM treenode
+        WHERE skeleton_id = %(skeleton_id)s
+    '''.format(', location_x, location_y, location_z' if with_locations else ''), {
+        'skeleton_id': skeleton_id,
+    })
+    columns = list(izip(*cursor.fetchall()))
+    if not columns:
+        raise ValueError("Skeleton {} has no nodes".format(skeleton_id))
+    return Arbor(columns[0], columns[1],
+            np.array(columns[2:5], np.float64).T if with_locations else None)
@@ -3,7 +3,7 @@ from __future__ import unicode_literals
 
 import itertools
 import math
-import networkx as nx
+import numpy as np
 import re
 import six
 
@@ -26,6 +26,7 @@ from catmaid.control.common import (get_relation_to_id_map,
 from catmaid.control.neuron import _delete_if_empty
 from catmaid.control.node import _fetch_location, _fetch_locations
 from catmaid.control.link import create_connector_link
+from catmaid.control.tree_util import load_arbor
 from catmaid.util import Point3D, is_collinear
 
 
@@ -1119,25 +1120,6 @@ def update_confidence(request, project_id=None, treenode_id=None):
     else:
         raise ValueError('Failed to update confidence at treenode %s.' % tnid)
 
-def _skeleton_as_graph(skeleton_id):
-    # Fetch all nodes of the skeleton
-    cursor = connection.cursor()
-    cursor.execute('''
-        SELECT id, parent_id
-        FROM treenode
-        WHERE skeleton_id=%s''', [skeleton_id])
-    # Create a directed graph of the skeleton
-    graph = nx.DiGraph()
-    for row in cursor.fetchall():
-        # row[0]: id
-        # row[1]: parent_id
-        graph.add_node(row[0])
-        if row[1]:
-            # Create directional edge from parent to child
-            graph.add_edge(row[1], row[0])
-    return graph
-
-
 def _find_first_interesting_node(sequence):
     """ Find the first node that:
     1. Has confidence lower than 5
@@ -1182,19 +1164,18 @@ def find_previous_branchnode_or_root(request, project_id=None, treenode_id=None)
         tnid = int(treenode_id)
         alt = 1 == int(request.POST['alt'])
         skid = Treenode.objects.get(pk=tnid).skeleton_id
-        graph = _skeleton_as_graph(skid)
+        arbor = load_arbor(skid)
+        n_children = arbor.n_children()
         # Travel upstream until finding a parent node with more than one child
         # or reaching the root node
         seq = [] # Does not include the starting node tnid
-        while True:
-            parents = graph.predecessors(tnid)
-            if parents: # list of parents is not empty
-                tnid = parents[0] # Can ony have one parent
-                seq.append(tnid)
-                if 1 != len(graph.successors(tnid)):
-                    break # Found a branch node
-            else:
-                break # Found the root node
+        path = arbor.path_to_root(tnid)[1:]
+        if len(path):
+            # Stop at the first branch node or at the root node
+            branch = np.flatnonzero(n_children[path[:-1]] != 1)
+            end = branch[0] + 1 if len(branch) else len(path)
+            seq = arbor.node_ids[path[:end]].tolist()
+            tnid = seq[-1]
 
         if seq and alt:
             tnid = _find_first_interesting_node(seq)
@@ -1209,9 +1190,9 @@ def find_next_branchnode_or_end(request, project_id=None, treenode_id=None):
     try:
         tnid = int(treenode_id)
         skid = Treenode.objects.get(pk=tnid).skeleton_id
-        graph = _skeleton_as_graph(skid)
+        arbor = load_arbor(skid)
 
-        children = graph.successors(tnid)
+        children = arbor.children(tnid).tolist()
         branches = []
         for child_node_id in children:
             # Travel downstream until finding a child node with more than one
@@ -1219,9 +1200,9 @@ def find_next_branchnode_or_end(request, project_id=None, treenode_id=None):
             seq = [child_node_id] # Does not include the starting node tnid
             branch_end = child_node_id
             while True:
-                branch_children = graph.successors(branch_end)
+                branch_children = arbor.children(branch_end)
                 if 1 == len(branch_children):
-                    branch_end = branch_children[0]
+                    branch_end = int(branch_children[0])
                     seq.append(branch_end)
                 else:
                     break # Found an end node or a branch node
@@ -1230,10 +1211,12 @@ def find_next_branchnode_or_end(request, project_id=None, treenode_id=None):
                              _find_first_interesting_node(seq),
                              branch_end])
 
-        # If more than one branch exists, sort based on downstream arbor size.
+        # If more than one branch exists, sort based on downstream arbor size,
+        # measured as the number of nodes with children.
         if len(children) > 1:
+            n_parents = arbor.accumulate((arbor.n_children() > 0).astype(np.int64))
             branches.sort(
-                   key=lambda b: len(nx.algorithms.traversal.depth_first_search.dfs_successors(graph, b[0])),
+                   key=lambda b: n_parents[arbor.index(b[0])],
                    reverse=True)
 
         # Leaf nodes will have no branches
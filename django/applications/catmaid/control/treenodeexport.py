@@ -13,7 +13,8 @@ from django.db.models import Count
 
 from catmaid.control.authentication import requires_user_role
 from catmaid.control.common import get_relation_to_id_map, id_generator
-from catmaid.control.cropping import CropJob, extract_substack, ImageRetrievalError
+from catmaid.control.cropping import CropJob, extract_substack, \
+        write_image, ImageRetrievalError
 from catmaid.models import ClassInstanceClassInstance, TreenodeConnector, \
         Message, User, UserRole, Treenode
 
@@ -174,7 +175,7 @@ class TreenodeExporter:
             # Save image in output path, named <treenode-id>.tiff
             image_name = "%s.tiff" % treenode.id
             treenode_image_path = os.path.join(output_path, image_name)
-            img.write(treenode_image_path)
+            write_image(img, treenode_image_path)
 
     def post_process(self, nodes):
         """ Create a meta data file for all the nodes passed (usually all of the
@@ -348,7 +349,7 @@ class ConnectorExporter(TreenodeExporter):
             z = int(z_min + i * crop_self.stacks[0].resolution.z  + 0.5)
             image_name = "%s_%s_%s.tiff" % (x, y, z)
             connector_image_path = os.path.join(connector_path, image_name)
-            img.write(connector_image_path)
+            write_image(img, connector_image_path)
 
     def post_process(self, nodes):
         pass
@@ -2,12 +2,12 @@
 from __future__ import unicode_literals
 
 import json
+import numpy as np
 import pytz
 import six
 
 from datetime import datetime, timedelta
 from collections import defaultdict, namedtuple
-from networkx import connected_components
 from functools import partial
 
 from django.db.models import Count
@@ -25,17 +25,10 @@ from six.moves import map
 
 def _find_nearest(tree, nodes, loc1):
     """ Returns a tuple of the closest node and the square of the distance. """
-    min_sqdist = float('inf')
-    for node in nodes:
-        loc2 = (tree.node[node]['location_x'],
-                tree.node[node]['location_y'],
-                tree.node[node]['location_z'])
-        dsq = pow(loc1[0] - loc2[0], 2) + pow(loc1[1] - loc2[1], 2) + pow(loc1[2] - loc2[2], 2)
-        if dsq < min_sqdist:
-            min_sqdist = dsq
-            closest = node
-
-    return node, min_sqdist
+    index = tree.index(nodes)
+    sqdists = np.square(tree.locations[index] - np.array(list(loc1))).sum(axis=1)
+    closest = np.argmin(sqdists)
+    return int(tree.node_ids[index[closest]]), float(sqdists[closest])
 
 def _parse_location(loc):
     return map(float, loc[1:-1].split(','))
@@ -94,18 +87,17 @@ def _evaluate_epochs(epochs, skeleton_id, tree, reviews, relations):
         newer_synapses_count = defaultdict(partial(defaultdict, int))
 
         for node in nodes:
-            props = tree.node[node]
             # Find out review date range for this epoch, based on most recent
             # reviews
             tr = reviews[node][0].review_time
             start_date = min(start_date, tr)
             end_date = max(end_date, tr)
             # Count nodes created by each user
-            user_id = props['user_id']
+            user_id = tree.property('user_id', node)
             user_node_counts[user_id] += 1
             # Find out date range for each user's created nodes
             u = user_ranges[user_id]
-            tc = props['creation_time']
+            tc = tree.property('creation_time', node)
             u['start'] = min(u['start'], tc)
             u['end'] = max(u['end'], tc)
             # Synapses
@@ -135,12 +127,12 @@ def _evaluate_epochs(epochs, skeleton_id, tree, reviews, relations):
             if pre:
                 for s in pre:
                     if in_range(s.creation_time):
-                        reviewer_n_pre[tree.node[s.treenode_id]['user_id']] += 1
+                        reviewer_n_pre[tree.property('user_id', s.treenode_id)] += 1
             post = reviewer_synapses.get(relations['postsynaptic_to'])
             if post:
                 for s in post:
                     if in_range(s.creation_time):
-                        reviewer_n_post[tree.node[s.treenode_id]['user_id']] += 1
+                        reviewer_n_post[tree.property('user_id', s.treenode_id)] += 1
 
 
         date_range = [start_date, end_date]
@@ -178,37 +170,35 @@ def _evaluate_epochs(epochs, skeleton_id, tree, reviews, relations):
             node, sqdist = _find_nearest(tree, nodes, _parse_location(location))
 
             if 'split_skeleton' == operation_type:
-                splits[tree.node[node]['user_id']] += 1
+                splits[tree.property('user_id', node)] += 1
 
             elif 'join_skeleton' == operation_type:
-                edges = tree[node]
-                if edges:
+                parent = tree.parent(node)
+                if parent:
                     # Replace node with its parent
-                    node = next(six.iterkeys(edges))
-                merges[tree.node[node]['user_id']] += 1
+                    node = parent
+                merges[tree.property('user_id', node)] += 1
 
         # Count nodes created by the reviewer, as well as
         # the number of connected arbors made by that nodes
         # which will add to the count of merges missed.
         def newlyAdded(node):
-            props = tree.node[node]
-            return props['user_id'] == reviewer_id and in_range(props['creation_time'])
+            return tree.property('user_id', node) == reviewer_id and \
+                    in_range(tree.property('creation_time', node))
 
-        owned = filter(newlyAdded, nodes)
+        owned = list(filter(newlyAdded, nodes))
 
         if owned:
-            sub = tree.subgraph(owned)
-            additions = connected_components(sub.to_undirected())
+            additions = tree.components(owned)
             for addition in additions:
                 # Find a node whose parent's creator is not the reviewer, if any
                 # (Could not find any if the reviewer had created that parent node
                 # outside of the review epoch, in which case it does not count
                 # as an error)
-                for node in addition:
-                    edges = tree[node]
-                    if edges:
-                        parent = next(six.iterkeys(edges))
-                        creator_id = tree.node[parent]['user_id']
+                for node in addition.tolist():
+                    parent = tree.parent(node)
+                    if parent:
+                        creator_id = tree.property('user_id', parent)
                         if creator_id != reviewer_id:
                             appended[creator_id].append(len(addition))
                             break
@@ -224,14 +214,12 @@ def _split_into_epochs(skeleton_id, tree, reviews, max_gap):
     given that different subsets of the arbor may have been joined at a later time. """
 
     # Sort nodes by date of most recent review (first in list)
-    def get_review_time(e):
-        return reviews[e[0]][0].review_time
-    nodes = sorted(tree.nodes_iter(data=True), key=get_review_time)
+    def get_review_time(node):
+        return reviews[node][0].review_time
+    nodes = sorted(tree.node_ids.tolist(), key=get_review_time)
 
     # Grab the oldest node
-    oldest = nodes[0]
-    last_id = oldest[0] # id of first node
-    last = oldest[1] # props of first node
+    last_id = nodes[0] # id of first node
 
     # First epoch contains the oldest node
     epoch = [last_id]
@@ -243,7 +231,7 @@ def _split_into_epochs(skeleton_id, tree, reviews, max_gap):
     epochs = [(last_review.reviewer_id, epoch)]
 
     # Iterate from second-oldest node forward in time
-    for node, props in nodes:
+    for node in nodes:
         # Most recent review of current node
         node_review = reviews[node][0]
         # Add to current epoch if same reviewer and we are within max_gap
@@ -0,0 +1,71 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import io
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from catmaid.control.bulk_maintenance import BulkMaintenanceSession
+from catmaid.models import Project
+
+import logging
+logger = logging.getLogger(__name__)
+
+
+class Command(BaseCommand):
+    help = "Run SQL scripts in a single bulk maintenance session, in which " + \
+            "summary table triggers are suspended. Edges, skeleton " + \
+            "summaries, synapse edges, the annotation closure and " + \
+            "statistics are rebuilt only for affected skeletons and the " + \
+            "project at the end. All changes are rolled back on error."
+
+    def add_arguments(self, parser):
+        parser.add_argument('scripts', nargs='*', help='SQL files that are ' +
+                'executed in order')
+        parser.add_argument('--project-id', dest='project_id', required=True,
+                type=int, help='The ID of the project the statistics are ' +
+                'updated for')
+        parser.add_argument('--skeleton-id', dest='skeleton_ids', nargs='+',
+                type=int, default=[], help='Rebuild summary information ' +
+                'of these skeletons, even if they are not changed')
+        parser.add_argument('--no-history', dest='track_history',
+                action='store_false', default=True, help='Suspend history ' +
+                'tracking of tracing data during the session')
+        parser.add_argument('--no-stats', dest='update_stats',
+                action='store_false', default=True, help='Don\'t update ' +
+                'project statistics at the end of the session')
+        parser.add_argument('--batch-size', dest='batch_size', type=int,
+                default=10000, help='The number of skeletons rebuilt by a ' +
+                'single set of queries')
+
+    def handle(self, *args, **options):
+        try:
+            project = Project.objects.get(pk=options['project_id'])
+        except Project.DoesNotExist as e:
+            raise CommandError(str(e))
+
+        if not options['scripts'] and not options['skeleton_ids']:
+            raise CommandError("Please provide SQL scripts or skeleton IDs")
+
+        scripts = []
+        for path in options['scripts']:
+            try:
+                with io.open(path, 'r', encoding='utf-8') as f:
+                    scripts.append((path, f.read()))
+            except IOError as e:
+                raise CommandError("Could not read {}: {}".format(path, e))
+
+        session = BulkMaintenanceSession(project.id,
+                track_history=options['track_history'],
+                update_stats=options['update_stats'],
+                batch_size=options['batch_size'],
+                log=lambda msg: logger.info(msg))
+        with session:
+            if options['skeleton_ids']:
+                session.add_skeletons(options['skeleton_ids'])
+            cursor = connection.cursor()
+            for path, sql in scripts:
+                logger.info("Executing {}".format(path))
+                cursor.execute(sql)
+
+        logger.info("Bulk update done")
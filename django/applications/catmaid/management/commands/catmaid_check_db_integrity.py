@@ -1,14 +1,89 @@
 # -*- coding: utf-8 -*-
 from __future__ import unicode_literals
 
+import json
+import os
 import sys
 
 import progressbar
 
+from multiprocessing.pool import ThreadPool
+
 from django.core.management.base import BaseCommand, CommandError
 from django.db import connection
+from django.utils.dateparse import parse_datetime
 from catmaid.models import Project
 
+
+def check_skeleton_batch(skeleton_ids):
+    """Run all skeleton checks for the passed in skeletons with one query per
+    check. Returns a dictionary that maps each check to a list of failing rows.
+    """
+    cursor = connection.cursor()
+    results = {}
+
+    # Treenodes with a parent in a different skeleton
+    cursor.execute('''
+            SELECT tn1.id, tn2.id
+            FROM treenode tn1
+            JOIN treenode tn2
+                ON tn2.id = tn1.parent_id
+            WHERE tn1.skeleton_id = ANY(%(skeleton_ids)s::bigint[])
+              AND tn1.skeleton_id <> tn2.skeleton_id
+            ''', {
+                'skeleton_ids': skeleton_ids,
+            })
+    results['parent_skeleton'] = cursor.fetchall()
+
+    # Skeletons without or with more than one root node
+    cursor.execute('''
+            SELECT t.skeleton_id, count(*) FILTER (WHERE t.parent_id IS NULL)
+            FROM treenode t
+            WHERE t.skeleton_id = ANY(%(skeleton_ids)s::bigint[])
+            GROUP BY t.skeleton_id
+              HAVING count(*) FILTER (WHERE t.parent_id IS NULL) <> 1
+            ''', {
+                'skeleton_ids': skeleton_ids,
+            })
+    results['root'] = cursor.fetchall()
+
+    # Treenodes that can't be reached from the root node of their skeleton.
+    # The first of these nodes is returned for each skeleton.
+    cursor.execute('''
+            WITH RECURSIVE nodes (id) AS (
+              SELECT t.id
+              FROM treenode t
+              WHERE t.parent_id IS NULL
+                AND t.skeleton_id = ANY(%(skeleton_ids)s::bigint[])
+              UNION ALL
+              SELECT t.id
+              FROM treenode t
+              JOIN nodes p ON t.parent_id = p.id)
+            SELECT DISTINCT ON (t.skeleton_id) t.id, t.skeleton_id
+            FROM treenode t
+            LEFT JOIN nodes n
+                ON n.id = t.id
+            WHERE t.skeleton_id = ANY(%(skeleton_ids)s::bigint[])
+              AND n.id IS NULL
+            ORDER BY t.skeleton_id, t.id
+            ''', {
+                'skeleton_ids': skeleton_ids,
+            })
+    results['path_to_root'] = cursor.fetchall()
+
+    return results
+
+
+def check_skeleton_batch_in_thread(skeleton_ids):
+    """Check a batch of skeletons in a worker thread, which uses its own
+    database connection. This connection is closed when done.
+    """
+    try:
+        return check_skeleton_batch(skeleton_ids)
+    finally:
+        connection.close()
+
+
 class Command(BaseCommand):
     help = '''
         Tests the integrity of the specified projects with several sanity checks
@@ -16,95 +91,174 @@ class Command(BaseCommand):
 
     def add_arguments(self, parser):
         parser.add_argument('--project_id', nargs='*', type=int, default=[])
+        parser.add_argument('--batch-size', dest='batch_size', type=int,
+                default=5000, help='The number of skeletons checked by a ' +
+                'single set of queries')
+        parser.add_argument('--workers', dest='workers', type=int, default=4,
+                help='The number of skeleton batches checked in parallel, ' +
+                'each using its own database connection')
+        parser.add_argument('--since', dest='since', default=None,
+                help='Only check skeletons that were changed since the ' +
+                'passed in date and time, e.g. "2018-05-01 22:00:00"')
+        parser.add_argument('--incremental', dest='incremental',
+                action='store_true', default=False, help='Only check ' +
+                'skeletons that were changed since the last successful ' +
+                'check of a project. The time of each successful check is ' +
+                'stored in the file passed in with --state-file.')
+        parser.add_argument('--state-file', dest='state_file',
+                default='catmaid-integrity-check-state.json', help='The file ' +
+                'to read and write the time of the last successful check ' +
+                'of each project in incremental mode')
 
     def handle(self, *args, **options):
         project_ids = options['project_id']
         if not len(project_ids):
             project_ids = Project.objects.all().values_list('id', flat=True)
 
+        self.batch_size = max(1, options['batch_size'])
+        self.workers = max(1, options['workers'])
+
+        since = None
+        if options['since']:
+            since = parse_datetime(options['since'])
+            if not since:
+                raise CommandError('Could not parse date: %s' % options['since'])
+
+        state = {}
+        state_file = options['state_file']
+        if options['incremental'] and os.path.exists(state_file):
+            with open(state_file, 'r') as f:
+                state = json.load(f)
+
         passed = True
         for project_id in project_ids:
-            passed = passed and self.check_project(project_id)
+            project_since = since
+            if options['incremental'] and not project_since:
+                last_check = state.get(str(project_id))
+                if last_check:
+                    project_since = parse_datetime(last_check)
+
+            # The start time of a check is stored, so that changes during
+            # the check are looked at again in the next run.
+            cursor = connection.cursor()
+            cursor.execute('SELECT now()')
+            start_time = cursor.fetchone()[0]
+
+            project_passed = self.check_project(project_id, project_since)
+            passed = passed and project_passed
+
+            if options['incremental'] and project_passed:
+                state[str(project_id)] = start_time.isoformat()
+                with open(state_file, 'w') as f:
+                    json.dump(state, f, indent=2, sort_keys=True)
 
         if not passed:
             sys.exit(1)
 
-    def check_project(self, project_id):
+    def get_skeleton_ids(self, project_id, since=None):
+        """Return the IDs of all skeletons with treenodes in the passed in
+        project. If a date is passed in, only skeletons with changes to their
+        treenodes since then are returned, based on the skeleton summary.
+        """
+        cursor = connection.cursor()
+        if since:
+            cursor.execute('''
+                    SELECT skeleton_id
+                    FROM catmaid_skeleton_summary
+                    WHERE project_id = %(project_id)s
+                      AND (last_summary_update >= %(since)s
+                       OR last_edition_time >= %(since)s)
+                    ORDER BY skeleton_id
+                    ''', {
+                        'project_id': project_id,
+                        'since': since,
+                    })
+        else:
+            cursor.execute('''
+                    SELECT DISTINCT skeleton_id
+                    FROM treenode
+                    WHERE project_id = %s
+                    ORDER BY skeleton_id
+                    ''', (project_id,))
+        return [row[0] for row in cursor.fetchall()]
+
+    def check_skeletons(self, skeleton_ids):
+        """Check the passed in skeletons in batches, which are processed in
+        parallel by worker threads. Inside a transaction all batches are
+        checked in the current thread, because other database connections
+        can't see its changes. Returns the merged failing rows of all checks.
+        """
+        results = {
+            'parent_skeleton': [],
+            'root': [],
+            'path_to_root': [],
+        }
+        if not skeleton_ids:
+            return results
+
+        batches = [skeleton_ids[i:i + self.batch_size]
+                for i in range(0, len(skeleton_ids), self.batch_size)]
+        n_workers = min(self.workers, len(batches))
+
+        with progressbar.ProgressBar(max_value=len(batches), redirect_stdout=True) as pbar:
+            if n_workers > 1 and not connection.in_atomic_block:
+                pool = ThreadPool(n_workers)
+                try:
+                    batch_results = pool.imap_unordered(
+                            check_skeleton_batch_in_thread, batches)
+                    for i, batch_result in enumerate(batch_results):
+                        pbar.update(i + 1)
+                        for check, rows in batch_result.items():
+                            results[check].extend(rows)
+                finally:
+                    pool.close()
+                    pool.join()
+            else:
+                for i, batch in enumerate(batches):
+                    for check, rows in check_skeleton_batch(batch).items():
+                        results[check].extend(rows)
+                    pbar.update(i + 1)
+
+        return results
+
+    def check_project(self, project_id, since=None):
         if not Project.objects.filter(id=project_id).exists():
             raise CommandError('Project with id %s does not exist.' % project_id)
         project_passed = True
         self.stdout.write('Checking integrity of project %s' % project_id)
 
+        skeleton_ids = self.get_skeleton_ids(project_id, since)
+        if since:
+            self.stdout.write('Checking %s skeletons changed since %s' % (
+                    len(skeleton_ids), since))
+        else:
+            self.stdout.write('Checking %s skeletons' % len(skeleton_ids))
+        results = self.check_skeletons(skeleton_ids)
+
         self.stdout.write('Check that no connected treenodes are in different skeletons...', ending='')
-        cursor = connection.cursor()
-        cursor.execute('''
-                SELECT tn1.id, tn2.id
-                FROM treenode tn1,
-                     treenode tn2
-                WHERE tn2.id = tn1.parent_id
-                  AND tn1.skeleton_id <> tn2.skeleton_id
-                  AND tn1.project_id = %s
-                ''', (project_id,))
-        if cursor.rowcount == 0:
+        if not results['parent_skeleton']:
             self.stdout.write('OK')
         else:
             project_passed = False
             self.stdout.write('')
-            self.stdout.write('FAILED: found %s rows (should be 0)' % cursor.rowcount)
+            self.stdout.write('FAILED: found %s rows (should be 0)' % len(results['parent_skeleton']))
 
         self.stdout.write('Check that each skeleton has exactly one root node...', ending='')
-        cursor.execute('''
-                SELECT t.skeleton_id, count(*)
-                FROM treenode t
-                WHERE t.parent_id IS NULL
-                  AND t.project_id = %s
-                GROUP BY t.skeleton_id
-                  HAVING count(*) <> 1
-                ''', (project_id,))
-        if cursor.rowcount == 0:
+        if not results['root']:
             self.stdout.write('OK')
         else:
             project_passed = False
             self.stdout.write('')
-            self.stdout.write('FAILED: found %s rows (should be 0)' % cursor.rowcount)
+            self.stdout.write('FAILED: found %s rows (should be 0)' % len(results['root']))
 
         self.stdout.write('Check that all treenodes in a skeleton are connected to the root node...', ending='')
-        cursor.execute('''
-                SELECT DISTINCT skeleton_id
-                FROM treenode
-                WHERE project_id = %s
-                ''', (project_id,))
-        skeleton_ids = cursor.fetchall()
-        if len(skeleton_ids):
-            self.stdout.write('')
-        test_passed = True
-        with progressbar.ProgressBar(max_value=len(skeleton_ids), redirect_stdout=True) as pbar:
-            for i, skeleton_id in enumerate(skeleton_ids):
-                pbar.update(i)
-                cursor.execute('''
-                        WITH RECURSIVE nodes (id) AS (
-                          SELECT t.id
-                          FROM treenode t
-                          WHERE t.parent_id IS NULL
-                            AND t.skeleton_id = %s
-                          UNION ALL
-                          SELECT t.id
-                          FROM treenode t
-                          JOIN nodes p ON t.parent_id = p.id)
-                        SELECT t.id, t.skeleton_id
-                        FROM treenode t
-                        WHERE t.skeleton_id = %s
-                          AND NOT EXISTS (SELECT n.id FROM nodes n WHERE n.id = t.id);
-                        ''', (skeleton_id, skeleton_id))
-                if cursor.rowcount:
-                    if test_passed:
-                        self.stdout.write('')
-                    test_passed = False
-                    project_passed = False
-                    row = cursor.fetchone()
-                    self.stdout.write('FAILED: node %s in skeleton %s has no path to root' % row)
-        if test_passed:
+        if not results['path_to_root']:
             self.stdout.write('OK')
+        else:
+            project_passed = False
+            self.stdout.write('')
+            for row in sorted(results['path_to_root'], key=lambda r: r[1]):
+                self.stdout.write('FAILED: node %s in skeleton %s has no path to root' % row)
 
         self.stdout.write('')
 
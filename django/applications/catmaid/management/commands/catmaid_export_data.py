@@ -1,14 +1,18 @@
 # -*- coding: utf-8 -*-
 from __future__ import unicode_literals
 
+import os
+
 from datetime import datetime
 from itertools import chain
-from django.db import connection
+from django.db import connection, transaction
 from django.core import serializers
 from django.core.management.base import BaseCommand, CommandError
 from catmaid.control.neuron_annotations import (get_annotated_entities,
         get_annotation_to_id_map)
 from django.contrib.auth.hashers import make_password
+from catmaid.control.copy_archive import export_table, get_table_columns, \
+        write_manifest
 from catmaid.control.tracing import check_tracing_setup
 from catmaid.models import (Class, ClassInstance, ClassInstanceClassInstance,
         Relation, Connector, Project, Treenode, TreenodeClassInstance,
@@ -51,23 +55,25 @@ class Exporter():
         self.required_annotations = options['required_annotations']
         self.excluded_annotations = options['excluded_annotations']
         self.original_placeholder_context = options['original_placeholder_context']
+        self.format = options.get('format') or 'json'
         self.target_file = options.get('file', None)
         if self.target_file:
             self.target_file = self.target_file.format(project.id)
         else:
             now = datetime.now().strftime('%Y-%m-%d-%H-%M')
-            self.target_file = 'catmaid-export-pid-{}-{}.json'.format(project.id, now)
+            self.target_file = 'catmaid-export-pid-{}-{}'.format(project.id, now)
+            if self.format == 'json':
+                self.target_file += '.json'
 
         self.show_traceback = True
-        self.format = 'json'
         self.indent = 2
 
         self.to_serialize = []
         self.seen = {}
 
-    def collect_data(self):
-        self.to_serialize = []
-
+    def get_semantic_ids(self):
+        """Return a tuple with the class and relation maps of the project.
+        """
         classes = dict(Class.objects.filter(
                 project=self.project).values_list('class_name', 'id'))
         relations = dict(Relation.objects.filter(
@@ -76,6 +82,15 @@ class Exporter():
         if not check_tracing_setup(self.project.id, classes, relations):
             raise CommandError("Project with ID %s is no tracing project." % self.project.id)
 
+        return classes, relations
+
+    def find_neurons(self, classes, relations):
+        """Find neurons and skeletons to export, based on required and excluded
+        annotations. Returned are querysets for neurons, skeletons and the links
+        between them along with a list of skeleton IDs if the export is
+        constrained by annotations (or None otherwise) and the set of IDs of
+        excluded skeletons.
+        """
         exclude_skeleton_id_constraints = set()
         exclude_neuron_id_constraint = set()
         if self.excluded_annotations:
@@ -160,6 +175,17 @@ class Exporter():
         if not start_export:
             raise CommandError("Canceled by user")
 
+        return (entities, skeletons, skeleton_links, skeleton_id_constraints,
+                exclude_skeleton_id_constraints)
+
+    def collect_data(self):
+        self.to_serialize = []
+
+        classes, relations = self.get_semantic_ids()
+        entities, skeletons, skeleton_links, skeleton_id_constraints, \
+                exclude_skeleton_id_constraints = self.find_neurons(classes,
+                relations)
+
         # Export classes and relations
         self.to_serialize.append(Class.objects.filter(project=self.project))
         self.to_serialize.append(Relation.objects.filter(project=self.project))
@@ -455,9 +481,228 @@ class Exporter():
             self.to_serialize.append(reduced_users)
 
 
+    def export_copy_archive(self):
+        """Write the exported data as a COPY archive: a directory with one gzip
+        compressed PostgreSQL COPY stream per table and a manifest. All rows
+        are selected by the database and streamed to disk, nothing is
+        instantiated as model object. Placeholder nodes aren't created for
+        partially exported connectors.
+        """
+        if os.path.exists(self.target_file):
+            raise CommandError("The target path exists already: {}".format(
+                    self.target_file))
+
+        classes, relations = self.get_semantic_ids()
+        entities, skeletons, skeleton_links, skeleton_id_constraints, \
+                exclude_skeleton_id_constraints = self.find_neurons(classes,
+                relations)
+
+        os.makedirs(self.target_file)
+
+        def columns(table_name, alias):
+            return ', '.join('{}.{}'.format(alias, c)
+                    for c in get_table_columns(table_name))
+
+        tables = []
+        def add_table(table_name, query, params=None):
+            table = export_table(cursor, self.target_file, table_name, query,
+                    params)
+            logger.info("Exported {} rows of table {}".format(table['rows'],
+                    table_name))
+            tables.append(table)
+
+        # Run all queries in one transaction to get a consistent snapshot. The
+        # IDs of all exported neurons, skeletons and other class instances are
+        # collected in temporary tables, which are dropped on commit. With the
+        # default isolation level READ COMMITTED, each statement would see
+        # the changes committed before it started, which could e.g. export
+        # links to treenodes that aren't exported. REPEATABLE READ lets all
+        # statements see the same snapshot. The isolation level can only be
+        # set for a new transaction, which is why an export run in an
+        # existing transaction relies on the isolation level of it.
+        new_transaction = not connection.in_atomic_block
+        with transaction.atomic():
+            cursor = connection.cursor()
+            if new_transaction:
+                cursor.execute("SET TRANSACTION ISOLATION LEVEL REPEATABLE READ")
+            for table_name, queryset in (('export_neuron', entities),
+                    ('export_skeleton', skeletons)):
+                query, params = queryset.values('id').query.sql_with_params()
+                cursor.execute("""
+                    CREATE TEMPORARY TABLE {} ON COMMIT DROP AS {}
+                """.format(table_name, query), params)
+
+            cursor.execute("""
+                CREATE TEMPORARY TABLE export_class_instance ON COMMIT DROP AS
+                SELECT id FROM export_neuron
+                UNION
+                SELECT id FROM export_skeleton;
+            """)
+
+            # Annotations of exported neurons, including all meta-annotations
+            if self.export_annotations and 'annotated_with' in relations:
+                cursor.execute("""
+                    WITH annotation AS (
+                        SELECT DISTINCT cici.class_instance_b AS id
+                        FROM class_instance_class_instance cici
+                        JOIN export_neuron en
+                            ON en.id = cici.class_instance_a
+                        WHERE cici.relation_id = %(annotated_with)s
+                    )
+                    INSERT INTO export_class_instance (id)
+                    SELECT id FROM annotation
+                    UNION
+                    SELECT ac.ancestor_id
+                    FROM catmaid_annotation_closure ac
+                    JOIN annotation a
+                        ON a.id = ac.descendant_id
+                    EXCEPT
+                    SELECT id FROM export_class_instance
+                """, {
+                    'annotated_with': relations['annotated_with'],
+                })
+
+            export_tags = self.export_treenodes and self.export_tags and \
+                    'labeled_as' in relations
+            if export_tags:
+                cursor.execute("""
+                    INSERT INTO export_class_instance (id)
+                    SELECT DISTINCT tci.class_instance_id
+                    FROM treenode_class_instance tci
+                    JOIN treenode t
+                        ON t.id = tci.treenode_id
+                    JOIN export_skeleton es
+                        ON es.id = t.skeleton_id
+                    JOIN class_instance ci
+                        ON ci.id = tci.class_instance_id
+                    WHERE tci.relation_id = %(labeled_as)s
+                      AND ci.class_id = %(label)s
+                    EXCEPT
+                    SELECT id FROM export_class_instance
+                """, {
+                    'labeled_as': relations['labeled_as'],
+                    'label': classes['label'],
+                })
+
+            cursor.execute("ANALYZE export_neuron")
+            cursor.execute("ANALYZE export_skeleton")
+            cursor.execute("ANALYZE export_class_instance")
+
+            for table_name in ('class', 'relation'):
+                add_table(table_name, """
+                    SELECT {} FROM {} t WHERE t.project_id = %(project_id)s
+                """.format(columns(table_name, 't'), table_name), {
+                    'project_id': self.project.id,
+                })
+
+            add_table('class_instance', """
+                SELECT {}
+                FROM class_instance ci
+                JOIN export_class_instance eci
+                    ON eci.id = ci.id
+            """.format(columns('class_instance', 'ci')))
+
+            # All links between exported class instances, which includes
+            # skeleton-neuron links and annotation links.
+            add_table('class_instance_class_instance', """
+                SELECT {}
+                FROM class_instance_class_instance cici
+                JOIN export_class_instance eci_a
+                    ON eci_a.id = cici.class_instance_a
+                JOIN export_class_instance eci_b
+                    ON eci_b.id = cici.class_instance_b
+            """.format(columns('class_instance_class_instance', 'cici')))
+
+            if self.export_treenodes:
+                add_table('treenode', """
+                    SELECT {}
+                    FROM treenode t
+                    JOIN export_skeleton es
+                        ON es.id = t.skeleton_id
+                """.format(columns('treenode', 't')))
+
+            if self.export_connectors:
+                if skeleton_id_constraints is None:
+                    add_table('connector', """
+                        SELECT {}
+                        FROM connector c
+                        WHERE c.project_id = %(project_id)s
+                    """.format(columns('connector', 'c')), {
+                        'project_id': self.project.id,
+                    })
+                else:
+                    add_table('connector', """
+                        SELECT {}
+                        FROM connector c
+                        WHERE c.id IN (
+                            SELECT tc.connector_id
+                            FROM treenode_connector tc
+                            JOIN export_skeleton es
+                                ON es.id = tc.skeleton_id
+                        )
+                    """.format(columns('connector', 'c')))
+
+                if self.export_treenodes:
+                    add_table('treenode_connector', """
+                        SELECT {}
+                        FROM treenode_connector tc
+                        JOIN export_skeleton es
+                            ON es.id = tc.skeleton_id
+                    """.format(columns('treenode_connector', 'tc')))
+
+            if export_tags:
+                add_table('treenode_class_instance', """
+                    SELECT {}
+                    FROM treenode_class_instance tci
+                    JOIN treenode t
+                        ON t.id = tci.treenode_id
+                    JOIN export_skeleton es
+                        ON es.id = t.skeleton_id
+                    JOIN export_class_instance eci
+                        ON eci.id = tci.class_instance_id
+                    WHERE tci.relation_id = %(labeled_as)s
+                """.format(columns('treenode_class_instance', 'tci')), {
+                    'labeled_as': relations['labeled_as'],
+                })
+
+        # Export users, either completely or in a reduced form
+        seen_user_ids = set(chain.from_iterable(t['user_ids'] for t in tables))
+        users = User.objects.filter(pk__in=seen_user_ids).order_by('id')
+        if self.export_users:
+            user_data = [{
+                'id': u.id,
+                'username': u.username,
+                'password': u.password,
+                'first_name': u.first_name,
+                'last_name': u.last_name,
+                'email': u.email,
+                'date_joined': u.date_joined.isoformat(),
+            } for u in users]
+            logger.info("Exporting {} users: {}".format(len(user_data),
+                    ", ".join([u['username'] for u in user_data])))
+        else:
+            user_data = [{
+                'id': u.id,
+                'username': u.username,
+                'password': make_password(User.objects.make_random_password()),
+            } for u in users]
+            logger.info("Exporting {} users in reduced form with random passwords: {}".format(
+                    len(user_data), ", ".join([u['username'] for u in user_data])))
+
+        write_manifest(self.target_file, self.project, tables, user_data)
+
     def export(self):
         """ Writes all objects matching
         """
+        if self.format == 'copy':
+            try:
+                self.export_copy_archive()
+            except Exception as e:
+                if self.show_traceback:
+                    raise
+                raise CommandError("Unable to export database: %s" % e)
+            return
+
         try:
             self.collect_data()
 
@@ -477,13 +722,18 @@ class Command(BaseCommand):
     """ Call e.g. like
         ./manage.py catmaid_export_data --source 1 --required-annotation "Kenyon cells"
     """
-    help = "Export CATMAID data into a JSON representation"
+    help = "Export CATMAID data into a JSON representation or a COPY archive"
 
     def add_arguments(self, parser):
         parser.add_argument('--source', default=None,
             help='The ID of the source project')
         parser.add_argument('--file', default=None,
             help='Output file name, "{}" will be replaced with project ID')
+        parser.add_argument('--format', default='json', choices=['json', 'copy'],
+            help='Export format: "json" writes a single Django fixture file, ' +
+            '"copy" writes a directory with one compressed PostgreSQL COPY ' +
+            'stream per table, which is faster and needs less memory for ' +
+            'large projects')
         parser.add_argument('--treenodes', dest='export_treenodes', default=True,
             action='store_true', help='Export treenodes from source')
         parser.add_argument('--notreenodes', dest='export_treenodes',
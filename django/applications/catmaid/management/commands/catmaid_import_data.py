@@ -8,11 +8,14 @@ import progressbar
 
 from collections import defaultdict
 from django.apps import apps
+from django.utils.dateparse import parse_datetime
 from django.core import serializers
 from django.core.management.base import BaseCommand, CommandError
 from django.db import connection, transaction
 from catmaid.control.annotationadmin import copy_annotations
-from catmaid.control.edge import rebuild_edge_tables
+from catmaid.control.bulk_maintenance import BulkMaintenanceSession
+from catmaid.control.copy_archive import (archive_table_index, COPY_NULL,
+        import_table, is_archive, read_manifest, unescape_copy_text)
 from catmaid.models import (Class, ClassClass, ClassInstance,
         ClassInstanceClassInstance, Project, Relation, User, Treenode,
         Connector, Concept, SkeletonSummary)
@@ -70,6 +73,19 @@ def ask_for_user(title):
         if u:
             return u
 
+def reset_id_sequences(cursor):
+    """Reset the concept, location and user ID sequences to the current
+    maximum IDs.
+    """
+    cursor.execute('''
+        SELECT setval('concept_id_seq', coalesce(max("id"), 1), max("id") IS NOT null)
+        FROM concept;
+        SELECT setval('location_id_seq', coalesce(max("id"), 1), max("id") IS NOT null)
+        FROM location;
+        SELECT setval('auth_user_id_seq', coalesce(max("id"), 1), max("id") IS NOT null)
+        FROM auth_user;
+    ''')
+
 class FileImporter:
     def __init__(self, source, target, user, options):
         self.source = source
@@ -293,12 +309,10 @@ class FileImporter:
         # Defer all constraint checks
         cursor.execute('SET CONSTRAINTS ALL DEFERRED')
 
-        # Drop summary table trigger to make insertion faster
-        cursor.execute("""
-            DROP TRIGGER on_edit_treenode_update_summary_and_edges ON treenode;
-            DROP TRIGGER on_insert_treenode_update_summary_and_edges ON treenode;
-            DROP TRIGGER on_delete_treenode_update_summary_and_edges ON treenode;
-        """)
+        # Suspend summary table triggers to make insertion faster
+        session = BulkMaintenanceSession(self.target.id,
+                log=lambda msg: logger.info(msg))
+        session.start()
 
         # Get all existing users so that we can map them basedon their username.
         mapped_user_ids = set()
@@ -502,40 +516,229 @@ class FileImporter:
                     deserialized_object.save()
 
         # Reset counters to current maximum IDs
-        cursor.execute('''
-            SELECT setval('concept_id_seq', coalesce(max("id"), 1), max("id") IS NOT null)
-            FROM concept;
-            SELECT setval('location_id_seq', coalesce(max("id"), 1), max("id") IS NOT null)
-            FROM location;
-            SELECT setval('auth_user_id_seq', coalesce(max("id"), 1), max("id") IS NOT null)
-            FROM auth_user;
-        ''')
-
-        cursor.execute("""
-            CREATE TRIGGER on_insert_treenode_update_summary_and_edges
-            AFTER INSERT ON treenode
-            REFERENCING NEW TABLE as inserted_treenode
-            FOR EACH STATEMENT EXECUTE PROCEDURE on_insert_treenode_update_summary_and_edges();
-
-            CREATE TRIGGER on_edit_treenode_update_summary_and_edges
-            AFTER UPDATE ON treenode
-            REFERENCING NEW TABLE as new_treenode OLD TABLE as old_treenode
-            FOR EACH STATEMENT EXECUTE PROCEDURE on_edit_treenode_update_summary_and_edges();
-
-            CREATE TRIGGER on_delete_treenode_update_summary_and_edges
-            AFTER DELETE ON treenode
-            REFERENCING OLD TABLE as deleted_treenode
-            FOR EACH STATEMENT EXECUTE PROCEDURE on_delete_treenode_update_summary_and_edges();
-        """)
-
-        logger.info("Updating edge tables")
-        rebuild_edge_tables(log=lambda msg: logger.info(msg))
-
-        logger.info("Updated skeleton summary tables")
-        cursor.execute("""
-            DELETE FROM catmaid_skeleton_summary;
-            SELECT refresh_skeleton_summary_table();
-        """)
+        reset_id_sequences(cursor)
+
+        session.finish()
+
+
+class CopyArchiveImporter:
+    """Import a COPY archive written by catmaid_export_data. The rows of each
+    table are streamed from the archive through an ID mapping and into a COPY
+    statement, without creating model objects, which keeps memory usage
+    constant regardless of the archive size.
+
+    Unless --preserve-ids is used, a contiguous block of IDs is reserved in the
+    concept and location sequences for the ID range of the archive and all
+    imported IDs are shifted into this block. Classes and relations are
+    reused if their names exist in the target project already, so are class
+    instances (except neurons and skeletons) with the same class and name.
+    """
+
+    def __init__(self, source, target, user, options):
+        self.source = source
+        self.target = target
+        self.options = options
+        self.user = user
+        self.preserve_ids = options['preserve_ids']
+
+    def map_users(self, manifest):
+        """Return a dictionary that maps each user ID of the archive to a user
+        ID in the target database. Users are either overridden, mapped by
+        username or created as inactive users.
+        """
+        archive_users = manifest['users']
+        if self.user:
+            return dict((u['id'], self.user.id) for u in archive_users)
+
+        existing_users = dict(User.objects.all().values_list('username', 'id'))
+        user_map = {}
+        created_users = []
+        for u in archive_users:
+            existing_user_id = existing_users.get(u['username'])
+            if existing_user_id is not None:
+                if not self.options['map_users']:
+                    raise CommandError("Referenced user \"{}\" exists "
+                            "both in database and in import data. If the "
+                            "existing user should be used, please use the "
+                            "--map-users option".format(u['username']))
+                user_map[u['id']] = existing_user_id
+            else:
+                user = User(username=u['username'], password=u['password'],
+                        first_name=u.get('first_name', ''),
+                        last_name=u.get('last_name', ''),
+                        email=u.get('email', ''), is_active=False)
+                if u.get('date_joined'):
+                    user.date_joined = parse_datetime(u['date_joined'])
+                user.save()
+                user_map[u['id']] = user.id
+                created_users.append(user.username)
+
+        if created_users:
+            logger.info("Created {} new inactive users: {}".format(
+                    len(created_users), ", ".join(sorted(created_users))))
+        else:
+            logger.info("No unmapped users imported")
+
+        return user_map
+
+    def reserve_ids(self, cursor, manifest):
+        """Return a dictionary that maps each ID sequence used in the archive
+        to the offset that is added to all imported IDs of it. The sequence is
+        advanced past the ID range of the archive in a single statement.
+        """
+        offsets = {}
+        for sequence, (min_id, max_id) in six.iteritems(manifest['id_ranges']):
+            if self.preserve_ids:
+                offsets[sequence] = 0
+                continue
+            cursor.execute("""
+                SELECT setval(%(sequence)s, nextval(%(sequence)s) + %(span)s)
+                    - %(span)s
+            """, {
+                'sequence': '{}_id_seq'.format(sequence),
+                'span': max_id - min_id,
+            })
+            offsets[sequence] = cursor.fetchone()[0] - min_id
+        return offsets
+
+    @transaction.atomic
+    def import_data(self):
+        manifest = read_manifest(self.source)
+        tables = manifest['tables']
+        if not any(t['rows'] for t in tables):
+            raise CommandError("Nothing to import, no importable data found")
+
+        logger.info("Importing {} rows of project \"{}\" (ID {}) from archive {}".format(
+                sum(t['rows'] for t in tables), manifest['project']['title'],
+                manifest['project']['id'], self.source))
+
+        cursor = connection.cursor()
+        cursor.execute('SET CONSTRAINTS ALL DEFERRED')
+        session = BulkMaintenanceSession(self.target.id,
+                log=lambda msg: logger.info(msg))
+        session.start()
+
+        user_map = dict((k, str(v)) for k,v in six.iteritems(self.map_users(manifest)))
+        offsets = self.reserve_ids(cursor, manifest)
+        project_id = str(self.target.id)
+
+        # Existing semantic data of the target project, which is reused. The
+        # concept map contains only reused IDs, all other concept IDs are
+        # shifted by the offset.
+        existing = {
+            'class': dict(Class.objects.filter(project_id=self.target.id) \
+                    .values_list('class_name', 'id')),
+            'relation': dict(Relation.objects.filter(project_id=self.target.id) \
+                    .values_list('relation_name', 'id')),
+        }
+        concept_map = {}
+        archive_class_ids = {}
+        archive_relation_ids = {}
+
+        skipped_tables = set()
+        if not self.options['import_treenodes']:
+            skipped_tables.update(('treenode', 'treenode_connector',
+                    'treenode_class_instance'))
+        if not self.options['import_connectors']:
+            skipped_tables.update(('connector', 'treenode_connector'))
+        if not self.options['import_tags']:
+            skipped_tables.add('treenode_class_instance')
+        skipped_concepts = set()
+
+        def shift(value, sequence):
+            return str(int(value) + offsets[sequence])
+
+        def map_concept(value):
+            if value == COPY_NULL:
+                return value
+            concept_id = int(value)
+            if concept_id in concept_map:
+                return str(concept_map[concept_id])
+            return shift(value, 'concept')
+
+        for table in tables:
+            name = table['name']
+            if name in skipped_tables or not table['rows']:
+                continue
+
+            sequence, column_kinds = archive_table_index[name]
+            column_kinds = dict(column_kinds)
+            kinds = [column_kinds[c] for c in table['columns']]
+            index = dict((c, i) for i,c in enumerate(table['columns']))
+
+            if name == 'class_instance':
+                # Classes are imported already, class instances of all
+                # classes except neurons and skeletons are reused.
+                unique_class_ids = list(Class.objects.filter(
+                        project_id=self.target.id).exclude(
+                        class_name__in=('neuron', 'skeleton')) \
+                        .values_list('id', flat=True))
+                existing['class_instance'] = dict(((ci[0], ci[1]), ci[2])
+                        for ci in ClassInstance.objects.filter(
+                            project_id=self.target.id,
+                            class_column_id__in=unique_class_ids) \
+                        .values_list('class_column_id', 'name', 'id'))
+                if not self.options['import_annotations']:
+                    skipped_concepts.add(archive_class_ids.get('annotation'))
+                if not self.options['import_tags']:
+                    skipped_concepts.add(archive_class_ids.get('label'))
+            elif name == 'class_instance_class_instance':
+                if not self.options['import_annotations']:
+                    skipped_concepts.add(archive_relation_ids.get('annotated_with'))
+
+            def map_row(fields):
+                if name == 'class':
+                    class_name = unescape_copy_text(fields[index['class_name']])
+                    archive_class_ids[class_name] = int(fields[index['id']])
+                    existing_id = existing['class'].get(class_name)
+                elif name == 'relation':
+                    relation_name = unescape_copy_text(fields[index['relation_name']])
+                    archive_relation_ids[relation_name] = int(fields[index['id']])
+                    existing_id = existing['relation'].get(relation_name)
+                elif name == 'class_instance':
+                    if int(fields[index['class_id']]) in skipped_concepts:
+                        skipped_concepts.add(int(fields[index['id']]))
+                        return None
+                    existing_id = existing['class_instance'].get((
+                            int(map_concept(fields[index['class_id']])),
+                            unescape_copy_text(fields[index['name']])))
+                else:
+                    existing_id = None
+
+                if existing_id is not None:
+                    concept_map[int(fields[index['id']])] = existing_id
+                    return None
+
+                mapped = []
+                for value, kind in zip(fields, kinds):
+                    if value == COPY_NULL or kind is None:
+                        mapped.append(value)
+                    elif kind == 'id':
+                        mapped.append(shift(value, sequence))
+                    elif kind == 'concept':
+                        if int(value) in skipped_concepts:
+                            return None
+                        mapped.append(map_concept(value))
+                    elif kind == 'location':
+                        mapped.append(shift(value, 'location'))
+                    elif kind == 'user':
+                        mapped.append(user_map[int(value)])
+                    elif kind == 'project':
+                        mapped.append(project_id)
+                return mapped
+
+            n_imported = import_table(cursor, self.source, table, map_row)
+            logger.info("- Imported {} of {} rows of table {}".format(
+                    n_imported, table['rows'], name))
+
+        if concept_map:
+            logger.info("Reused {} existing classes, relations and class "
+                    "instances".format(len(concept_map)))
+
+        if self.preserve_ids:
+            reset_id_sequences(cursor)
+
+        session.finish()
 
 
 class InternalImporter:
@@ -556,7 +759,8 @@ class Command(BaseCommand):
 
     def add_arguments(self, parser):
         parser.add_argument('--source', dest='source', default=None,
-            help='The ID of the source project or the path to a file to import')
+            help='The ID of the source project or the path to a file or ' +
+            'COPY archive directory to import')
         parser.add_argument('--target', dest='target', default=None,
             help='The ID of the target project')
         parser.add_argument('--user', dest='user', default=None,
@@ -641,8 +845,12 @@ class Command(BaseCommand):
                 Importer = InternalImporter
             except ValueError:
                 source = options['source']
-                logger.info("Using file importer")
-                Importer = FileImporter
+                if is_archive(source):
+                    logger.info("Using COPY archive importer")
+                    Importer = CopyArchiveImporter
+                else:
+                    logger.info("Using file importer")
+                    Importer = FileImporter
         else:
             source = self.ask_for_project('source')
 
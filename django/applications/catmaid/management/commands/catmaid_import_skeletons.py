@@ -0,0 +1,95 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import io
+import os
+
+import progressbar
+
+from django.core.management.base import BaseCommand, CommandError
+from catmaid.control.skeleton import (_import_skeletons, parse_swc,
+        parse_compact_skeleton)
+from catmaid.models import Project, User
+
+import logging
+logger = logging.getLogger(__name__)
+
+
+parsers = {
+    '.swc': parse_swc,
+    '.json': parse_compact_skeleton,
+}
+
+
+def find_skeleton_files(paths):
+    """Return a sorted list of all SWC and compact skeleton JSON files in the
+    passed in files and directories.
+    """
+    files = []
+    for path in paths:
+        if os.path.isdir(path):
+            for root, dirs, file_names in os.walk(path):
+                files.extend(os.path.join(root, f) for f in file_names
+                        if os.path.splitext(f)[1].lower() in parsers)
+        elif os.path.isfile(path):
+            files.append(path)
+        else:
+            raise CommandError("Could not find file: {}".format(path))
+    return sorted(files)
+
+
+class Command(BaseCommand):
+    help = "Import many skeletons from SWC or compact skeleton JSON files " + \
+            "into a project. Each file becomes a new neuron, named after " + \
+            "the file."
+
+    def add_arguments(self, parser):
+        parser.add_argument('paths', nargs='+', help='Files or directories ' +
+                'with .swc and .json files to import')
+        parser.add_argument('--project-id', dest='project_id', required=True,
+                type=int, help='The ID of the target project')
+        parser.add_argument('--user-id', dest='user_id', required=True,
+                type=int, help='The ID of the owner of all created objects')
+        parser.add_argument('--batch-size', dest='batch_size', type=int,
+                default=1000, help='The number of skeletons imported in ' +
+                'one transaction')
+
+    def handle(self, *args, **options):
+        try:
+            project = Project.objects.get(pk=options['project_id'])
+            user = User.objects.get(pk=options['user_id'])
+        except (Project.DoesNotExist, User.DoesNotExist) as e:
+            raise CommandError(str(e))
+
+        files = find_skeleton_files(options['paths'])
+        if not files:
+            raise CommandError("No skeleton files found")
+        logger.info("Importing {} skeletons into project {}".format(
+                len(files), project.id))
+
+        batch_size = max(1, options['batch_size'])
+        n_skeletons = 0
+        n_nodes = 0
+        with progressbar.ProgressBar(max_value=len(files), redirect_stdout=True) as pbar:
+            for i in range(0, len(files), batch_size):
+                skeletons = []
+                for path in files[i:i + batch_size]:
+                    name, extension = os.path.splitext(os.path.basename(path))
+                    parse = parsers.get(extension.lower())
+                    if not parse:
+                        raise CommandError("File type \"{}\" not understood: {}".format(
+                                extension, path))
+                    with io.open(path, 'r', encoding='utf-8') as f:
+                        try:
+                            nodes = parse(f.read())
+                        except ValueError as e:
+                            raise CommandError("Could not read {}: {}".format(path, e))
+                    skeletons.append({'name': name, 'nodes': nodes})
+
+                _import_skeletons(user, project.id, skeletons)
+                n_skeletons += len(skeletons)
+                n_nodes += sum(len(s['nodes']) for s in skeletons)
+                pbar.update(n_skeletons)
+
+        logger.info("Imported {} skeletons with {} nodes".format(n_skeletons,
+                n_nodes))
@@ -0,0 +1,28 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.core.management.base import BaseCommand, CommandError
+from catmaid.control.edge import rebuild_synapse_edge_table
+
+
+class Command(BaseCommand):
+    help = 'Rebuild the table of synapse counts between skeletons for all ' \
+           'skeletons in the specified projects. This table is normally kept ' \
+           'up to date by the database.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--project_id', dest='project_id', nargs='+',
+            help='Rebuild synapse edges for these projects only (otherwise all)')
+
+    def handle(self, *args, **options):
+        project_ids = options['project_id']
+        if not project_ids:
+            self.stdout.write('Since no project IDs were given, all projects will be updated')
+
+        try:
+            rebuild_synapse_edge_table(project_ids,
+                    log=lambda msg: self.stdout.write(msg))
+        except ValueError as e:
+            raise CommandError(str(e))
+
+        self.stdout.write('Successfully rebuilt synapse edge table')
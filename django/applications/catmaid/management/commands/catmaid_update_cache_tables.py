@@ -5,9 +5,12 @@ import psycopg2
 from django.core.management.base import BaseCommand, CommandError
 from django.conf import settings
 from django.db import connection
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
 
 from catmaid.control.node import (_node_list_tuples_query, update_cache,
-        Postgis2dNodeProvider, ORIENTATIONS, update_node_query_cache)
+        Postgis2dNodeProvider, ORIENTATIONS, update_node_query_cache,
+        update_grid_cache)
 from catmaid.models import Project
 
 
@@ -19,8 +22,9 @@ class Command(BaseCommand):
             default=False, help='Remove all existing cache data before update'),
         parser.add_argument('--project_id', dest='project_id', nargs='+',
             default=False, help='Compute only statistics for these projects only (otherwise all)'),
-        parser.add_argument('--type', dest='data_type', default="msgpack",
-            help='Which type of cache to populate: json, json_text, msgpack'),
+        parser.add_argument('--type', dest='data_type', nargs='+', default=["msgpack"],
+            help='Which types of cache to populate: json, json_text, msgpack, columnar. ' +
+            'Multiple types are stored side by side.'),
         parser.add_argument('--orientation', dest='orientations', nargs='+',
             default='xz', help='Which orientations should be generated: xy, xz, zy'),
         parser.add_argument('--step', dest='steps', nargs='+',
@@ -43,8 +47,30 @@ class Command(BaseCommand):
                 default=None, help='Only show treenodes of the N largest skeletons in the field of view'),
         parser.add_argument('--from-config', action="store_true", dest='from_config',
                 default=False, help="Update cache based on NODE_PROVIDERS variable in settings")
+        parser.add_argument('--jobs', dest='n_jobs', default=1, type=int,
+                help="Number of worker processes that compute sections in parallel"),
+        parser.add_argument('--resume-from', dest='resume_from', default=None,
+                help="Skip sections that have been updated at or after this " +
+                "ISO timestamp. Use the start time of an interrupted run to resume it."),
+        parser.add_argument('--cell-width', dest='cell_width', default=None, type=float,
+                help="Populate a grid cache with cells of this width instead of a " +
+                "section cache. Requires --cell-height and --cell-depth as well."),
+        parser.add_argument('--cell-height', dest='cell_height', default=None, type=float,
+                help="Height of grid cache cells (in nm)"),
+        parser.add_argument('--cell-depth', dest='cell_depth', default=None, type=float,
+                help="Depth of grid cache cells (in nm)"),
+        parser.add_argument('--incremental', action="store_true", dest='incremental',
+                default=False, help="Only update sections that don't exist yet " +
+                "or that changed since their last update. Ignored with --clean.")
 
     def handle(self, *args, **options):
+        start_time = timezone.now().isoformat()
+        self.stdout.write('Started at {}, add --resume-from "{}" to resume '
+                'this update after an interruption'.format(start_time, start_time))
+
+        if options['resume_from'] and options['clean']:
+            raise CommandError('The --resume-from option can\'t be used with --clean')
+
         if options['from_config']:
             self.update_from_config(options)
         else:
@@ -52,8 +78,26 @@ class Command(BaseCommand):
 
         self.stdout.write('Done')
 
+    def get_updated_before(self, options):
+        """Parse the --resume-from timestamp, if any.
+        """
+        if not options['resume_from']:
+            return None
+        updated_before = parse_datetime(options['resume_from'])
+        if not updated_before:
+            raise CommandError('Could not parse --resume-from timestamp')
+        if timezone.is_naive(updated_before):
+            updated_before = timezone.make_aware(updated_before)
+        return updated_before
+
     def update_from_config(self, options):
-        update_node_query_cache(log=lambda x: self.stdout.write(x))
+        try:
+            update_node_query_cache(incremental=options['incremental'],
+                    n_jobs=options['n_jobs'],
+                    updated_before=self.get_updated_before(options),
+                    log=lambda x: self.stdout.write(x))
+        except ValueError as e:
+            raise CommandError(str(e))
 
     def update_from_options(self, options):
         cursor = connection.cursor()
@@ -69,10 +113,18 @@ class Command(BaseCommand):
         else:
             orientations = ['xy']
 
-        steps = options['steps']
-        if not steps:
-            raise CommandError('Need depth resolution per orientation (--step)')
-        steps = [float(s) for s in steps]
+        cell_dims = [options['cell_width'], options['cell_height'], options['cell_depth']]
+        use_grid = any(cell_dims)
+        if use_grid:
+            if not all(cell_dims):
+                raise CommandError('Need --cell-width, --cell-height and --cell-depth')
+            if options['resume_from']:
+                raise CommandError('The --resume-from option is only supported for section caches')
+        else:
+            steps = options['steps']
+            if not steps:
+                raise CommandError('Need depth resolution per orientation (--step)')
+            steps = [float(s) for s in steps]
 
         delete = False
         clean = options['clean']
@@ -81,7 +133,10 @@ class Command(BaseCommand):
                 delete = True
             else:
                 # Removing cache data for all projects is faster this way.
-                cursor.execute("TRUNCATE node_query_cache")
+                if use_grid:
+                    cursor.execute("TRUNCATE node_grid_cache CASCADE")
+                else:
+                    cursor.execute("TRUNCATE node_query_cache")
 
         bb_limits = [
             [float(options['min_x']), float(options['min_y']), float(options['min_z'])],
@@ -96,10 +151,29 @@ class Command(BaseCommand):
         if options['n_largest_skeletons_limit']:
             n_largest_skeletons_limit = int(options['n_largest_skeletons_limit'])
 
-        data_type = options['data_type']
+        updated_before = self.get_updated_before(options)
 
-        if data_type not in ('json', 'json_text', 'msgpack'):
-            raise CommandError('Type must be one of: json, json_text, msgpack')
+        data_type = options['data_type']
+        if type(data_type) not in (list, tuple):
+            data_type = [data_type]
+
+        if use_grid:
+            if not all(dt in ('json', 'msgpack', 'columnar') for dt in data_type):
+                raise CommandError('Grid cache type must be one of: json, msgpack, columnar')
+            for p in projects:
+                self.stdout.write('Updating grid cache for project {}'.format(p.id))
+                for o in orientations:
+                    update_grid_cache(p.id, data_type, o, *cell_dims,
+                            node_limit=node_limit,
+                            n_largest_skeletons_limit=n_largest_skeletons_limit,
+                            delete=delete, bb_limits=bb_limits,
+                            incremental=options['incremental'],
+                            n_jobs=options['n_jobs'], log=self.stdout.write)
+                self.stdout.write('Updated grid cache for project {}'.format(p.id))
+            return
+
+        if not all(dt in ('json', 'json_text', 'msgpack', 'columnar') for dt in data_type):
+            raise CommandError('Type must be one of: json, json_text, msgpack, columnar')
         if len(steps) != len(orientations):
             raise CommandError('Need one depth resolution flag per orientation')
 
@@ -107,5 +181,6 @@ class Command(BaseCommand):
             self.stdout.write('Updating cache for project {}'.format(p.id))
             update_cache(p.id, data_type, orientations, steps, node_limit,
                     n_largest_skeletons_limit, delete, bb_limits,
-                    log=self.stdout.write)
+                    incremental=options['incremental'], n_jobs=options['n_jobs'],
+                    updated_before=updated_before, log=self.stdout.write)
             self.stdout.write('Updated cache for project {}'.format(p.id))
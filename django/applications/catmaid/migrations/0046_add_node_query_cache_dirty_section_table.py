@@ -0,0 +1,230 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations
+
+
+forward = """
+    CREATE TABLE node_query_cache_dirty_section (
+        id bigserial PRIMARY KEY,
+        project_id integer NOT NULL REFERENCES project (id) ON DELETE CASCADE
+            DEFERRABLE INITIALLY DEFERRED,
+        edition_time timestamptz NOT NULL DEFAULT now(),
+        min_x real NOT NULL,
+        min_y real NOT NULL,
+        min_z real NOT NULL,
+        max_x real NOT NULL,
+        max_y real NOT NULL,
+        max_z real NOT NULL
+    );
+
+    CREATE INDEX node_query_cache_dirty_section_project_time_idx
+    ON node_query_cache_dirty_section (project_id, edition_time);
+
+
+    -- Record the 3D bounding box of all edges that are inserted, updated or
+    -- deleted by a statement. This is done for each project separately and
+    -- only if the respective project has cached data at all. Transition
+    -- tables are named uniformly for all edge tables (old_edge and new_edge),
+    -- the TG_OP branch makes sure only available transition tables are used.
+    CREATE FUNCTION on_change_edge_mark_node_query_cache_dirty() RETURNS trigger
+    LANGUAGE plpgsql AS
+    $$
+    BEGIN
+        IF TG_OP = 'INSERT' THEN
+            WITH changed_box AS (
+                SELECT e.project_id, ST_3DExtent(e.edge) AS box
+                FROM new_edge e
+                GROUP BY e.project_id
+            )
+            INSERT INTO node_query_cache_dirty_section (project_id, min_x,
+                min_y, min_z, max_x, max_y, max_z)
+            SELECT b.project_id, ST_XMin(b.box), ST_YMin(b.box), ST_ZMin(b.box),
+                ST_XMax(b.box), ST_YMax(b.box), ST_ZMax(b.box)
+            FROM changed_box b
+            WHERE EXISTS (
+                SELECT 1 FROM node_query_cache c
+                WHERE c.project_id = b.project_id
+            );
+        ELSIF TG_OP = 'UPDATE' THEN
+            WITH changed_box AS (
+                SELECT e.project_id, ST_3DExtent(e.edge) AS box
+                FROM (
+                    SELECT project_id, edge FROM new_edge
+                    UNION ALL
+                    SELECT project_id, edge FROM old_edge
+                ) e
+                GROUP BY e.project_id
+            )
+            INSERT INTO node_query_cache_dirty_section (project_id, min_x,
+                min_y, min_z, max_x, max_y, max_z)
+            SELECT b.project_id, ST_XMin(b.box), ST_YMin(b.box), ST_ZMin(b.box),
+                ST_XMax(b.box), ST_YMax(b.box), ST_ZMax(b.box)
+            FROM changed_box b
+            WHERE EXISTS (
+                SELECT 1 FROM node_query_cache c
+                WHERE c.project_id = b.project_id
+            );
+        ELSIF TG_OP = 'DELETE' THEN
+            WITH changed_box AS (
+                SELECT e.project_id, ST_3DExtent(e.edge) AS box
+                FROM old_edge e
+                GROUP BY e.project_id
+            )
+            INSERT INTO node_query_cache_dirty_section (project_id, min_x,
+                min_y, min_z, max_x, max_y, max_z)
+            SELECT b.project_id, ST_XMin(b.box), ST_YMin(b.box), ST_ZMin(b.box),
+                ST_XMax(b.box), ST_YMax(b.box), ST_ZMax(b.box)
+            FROM changed_box b
+            WHERE EXISTS (
+                SELECT 1 FROM node_query_cache c
+                WHERE c.project_id = b.project_id
+            );
+        END IF;
+
+        RETURN NULL;
+    END;
+    $$;
+
+
+    -- Like on_change_edge_mark_node_query_cache_dirty(), but for the
+    -- connector_geom table, which stores its geometry in the geom column.
+    CREATE FUNCTION on_change_geom_mark_node_query_cache_dirty() RETURNS trigger
+    LANGUAGE plpgsql AS
+    $$
+    BEGIN
+        IF TG_OP = 'INSERT' THEN
+            WITH changed_box AS (
+                SELECT g.project_id, ST_3DExtent(g.geom) AS box
+                FROM new_geom g
+                GROUP BY g.project_id
+            )
+            INSERT INTO node_query_cache_dirty_section (project_id, min_x,
+                min_y, min_z, max_x, max_y, max_z)
+            SELECT b.project_id, ST_XMin(b.box), ST_YMin(b.box), ST_ZMin(b.box),
+                ST_XMax(b.box), ST_YMax(b.box), ST_ZMax(b.box)
+            FROM changed_box b
+            WHERE EXISTS (
+                SELECT 1 FROM node_query_cache c
+                WHERE c.project_id = b.project_id
+            );
+        ELSIF TG_OP = 'UPDATE' THEN
+            WITH changed_box AS (
+                SELECT g.project_id, ST_3DExtent(g.geom) AS box
+                FROM (
+                    SELECT project_id, geom FROM new_geom
+                    UNION ALL
+                    SELECT project_id, geom FROM old_geom
+                ) g
+                GROUP BY g.project_id
+            )
+            INSERT INTO node_query_cache_dirty_section (project_id, min_x,
+                min_y, min_z, max_x, max_y, max_z)
+            SELECT b.project_id, ST_XMin(b.box), ST_YMin(b.box), ST_ZMin(b.box),
+                ST_XMax(b.box), ST_YMax(b.box), ST_ZMax(b.box)
+            FROM changed_box b
+            WHERE EXISTS (
+                SELECT 1 FROM node_query_cache c
+                WHERE c.project_id = b.project_id
+            );
+        ELSIF TG_OP = 'DELETE' THEN
+            WITH changed_box AS (
+                SELECT g.project_id, ST_3DExtent(g.geom) AS box
+                FROM old_geom g
+                GROUP BY g.project_id
+            )
+            INSERT INTO node_query_cache_dirty_section (project_id, min_x,
+                min_y, min_z, max_x, max_y, max_z)
+            SELECT b.project_id, ST_XMin(b.box), ST_YMin(b.box), ST_ZMin(b.box),
+                ST_XMax(b.box), ST_YMax(b.box), ST_ZMax(b.box)
+            FROM changed_box b
+            WHERE EXISTS (
+                SELECT 1 FROM node_query_cache c
+                WHERE c.project_id = b.project_id
+            );
+        END IF;
+
+        RETURN NULL;
+    END;
+    $$;
+
+
+    CREATE TRIGGER on_insert_treenode_edge_mark_node_query_cache_dirty
+    AFTER INSERT ON treenode_edge
+    REFERENCING NEW TABLE AS new_edge
+    FOR EACH STATEMENT EXECUTE PROCEDURE on_change_edge_mark_node_query_cache_dirty();
+
+    CREATE TRIGGER on_edit_treenode_edge_mark_node_query_cache_dirty
+    AFTER UPDATE ON treenode_edge
+    REFERENCING NEW TABLE AS new_edge OLD TABLE AS old_edge
+    FOR EACH STATEMENT EXECUTE PROCEDURE on_change_edge_mark_node_query_cache_dirty();
+
+    CREATE TRIGGER on_delete_treenode_edge_mark_node_query_cache_dirty
+    AFTER DELETE ON treenode_edge
+    REFERENCING OLD TABLE AS old_edge
+    FOR EACH STATEMENT EXECUTE PROCEDURE on_change_edge_mark_node_query_cache_dirty();
+
+    CREATE TRIGGER on_insert_treenode_connector_edge_mark_node_query_cache_dirty
+    AFTER INSERT ON treenode_connector_edge
+    REFERENCING NEW TABLE AS new_edge
+    FOR EACH STATEMENT EXECUTE PROCEDURE on_change_edge_mark_node_query_cache_dirty();
+
+    CREATE TRIGGER on_edit_treenode_connector_edge_mark_node_query_cache_dirty
+    AFTER UPDATE ON treenode_connector_edge
+    REFERENCING NEW TABLE AS new_edge OLD TABLE AS old_edge
+    FOR EACH STATEMENT EXECUTE PROCEDURE on_change_edge_mark_node_query_cache_dirty();
+
+    CREATE TRIGGER on_delete_treenode_connector_edge_mark_node_query_cache_dirty
+    AFTER DELETE ON treenode_connector_edge
+    REFERENCING OLD TABLE AS old_edge
+    FOR EACH STATEMENT EXECUTE PROCEDURE on_change_edge_mark_node_query_cache_dirty();
+
+    CREATE TRIGGER on_insert_connector_geom_mark_node_query_cache_dirty
+    AFTER INSERT ON connector_geom
+    REFERENCING NEW TABLE AS new_geom
+    FOR EACH STATEMENT EXECUTE PROCEDURE on_change_geom_mark_node_query_cache_dirty();
+
+    CREATE TRIGGER on_edit_connector_geom_mark_node_query_cache_dirty
+    AFTER UPDATE ON connector_geom
+    REFERENCING NEW TABLE AS new_geom OLD TABLE AS old_geom
+    FOR EACH STATEMENT EXECUTE PROCEDURE on_change_geom_mark_node_query_cache_dirty();
+
+    CREATE TRIGGER on_delete_connector_geom_mark_node_query_cache_dirty
+    AFTER DELETE ON connector_geom
+    REFERENCING OLD TABLE AS old_geom
+    FOR EACH STATEMENT EXECUTE PROCEDURE on_change_geom_mark_node_query_cache_dirty();
+"""
+
+backward = """
+    DROP TRIGGER on_insert_treenode_edge_mark_node_query_cache_dirty ON treenode_edge;
+    DROP TRIGGER on_edit_treenode_edge_mark_node_query_cache_dirty ON treenode_edge;
+    DROP TRIGGER on_delete_treenode_edge_mark_node_query_cache_dirty ON treenode_edge;
+    DROP TRIGGER on_insert_treenode_connector_edge_mark_node_query_cache_dirty ON treenode_connector_edge;
+    DROP TRIGGER on_edit_treenode_connector_edge_mark_node_query_cache_dirty ON treenode_connector_edge;
+    DROP TRIGGER on_delete_treenode_connector_edge_mark_node_query_cache_dirty ON treenode_connector_edge;
+    DROP TRIGGER on_insert_connector_geom_mark_node_query_cache_dirty ON connector_geom;
+    DROP TRIGGER on_edit_connector_geom_mark_node_query_cache_dirty ON connector_geom;
+    DROP TRIGGER on_delete_connector_geom_mark_node_query_cache_dirty ON connector_geom;
+
+    DROP FUNCTION on_change_edge_mark_node_query_cache_dirty();
+    DROP FUNCTION on_change_geom_mark_node_query_cache_dirty();
+
+    DROP TABLE node_query_cache_dirty_section;
+"""
+
+
+class Migration(migrations.Migration):
+    """Add the node_query_cache_dirty_section table, which keeps track of the
+    bounding boxes of all spatial changes in projects that have cached node
+    query data. This allows node query cache updates to only recompute
+    sections that actually changed since their last update. Like the edge
+    tables, this table doesn't need history tracking.
+    """
+
+    dependencies = [
+        ('catmaid', '0045_add_sampler_column_merge_limit'),
+    ]
+
+    operations = [
+        migrations.RunSQL(forward, backward)
+    ]
@@ -0,0 +1,113 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations
+
+
+# Both trigger functions share the same structure and differ only in the name
+# of the geometry column and the transition tables. The project check is moved
+# into its own function, so that additional cache types can be added without
+# replacing the trigger functions again.
+trigger_function_template = """
+    CREATE OR REPLACE FUNCTION on_change_{column}_mark_node_query_cache_dirty() RETURNS trigger
+    LANGUAGE plpgsql AS
+    $$
+    BEGIN
+        IF TG_OP = 'INSERT' THEN
+            WITH changed_box AS (
+                SELECT g.project_id, ST_3DExtent(g.{column}) AS box
+                FROM new_{column} g
+                GROUP BY g.project_id
+            )
+            INSERT INTO node_query_cache_dirty_section (project_id, min_x,
+                min_y, min_z, max_x, max_y, max_z)
+            SELECT b.project_id, ST_XMin(b.box), ST_YMin(b.box), ST_ZMin(b.box),
+                ST_XMax(b.box), ST_YMax(b.box), ST_ZMax(b.box)
+            FROM changed_box b
+            WHERE {condition};
+        ELSIF TG_OP = 'UPDATE' THEN
+            WITH changed_box AS (
+                SELECT g.project_id, ST_3DExtent(g.{column}) AS box
+                FROM (
+                    SELECT project_id, {column} FROM new_{column}
+                    UNION ALL
+                    SELECT project_id, {column} FROM old_{column}
+                ) g
+                GROUP BY g.project_id
+            )
+            INSERT INTO node_query_cache_dirty_section (project_id, min_x,
+                min_y, min_z, max_x, max_y, max_z)
+            SELECT b.project_id, ST_XMin(b.box), ST_YMin(b.box), ST_ZMin(b.box),
+                ST_XMax(b.box), ST_YMax(b.box), ST_ZMax(b.box)
+            FROM changed_box b
+            WHERE {condition};
+        ELSIF TG_OP = 'DELETE' THEN
+            WITH changed_box AS (
+                SELECT g.project_id, ST_3DExtent(g.{column}) AS box
+                FROM old_{column} g
+                GROUP BY g.project_id
+            )
+            INSERT INTO node_query_cache_dirty_section (project_id, min_x,
+                min_y, min_z, max_x, max_y, max_z)
+            SELECT b.project_id, ST_XMin(b.box), ST_YMin(b.box), ST_ZMin(b.box),
+                ST_XMax(b.box), ST_YMax(b.box), ST_ZMax(b.box)
+            FROM changed_box b
+            WHERE {condition};
+        END IF;
+
+        RETURN NULL;
+    END;
+    $$;
+"""
+
+old_condition = """EXISTS (
+                SELECT 1 FROM node_query_cache c
+                WHERE c.project_id = b.project_id
+            )"""
+
+new_condition = "is_node_query_cache_tracked(b.project_id)"
+
+forward = """
+    CREATE TABLE node_query_cache_dirty_tracking (
+        project_id integer PRIMARY KEY REFERENCES project (id) ON DELETE CASCADE
+            DEFERRABLE INITIALLY DEFERRED,
+        enabled_time timestamptz NOT NULL DEFAULT now()
+    );
+
+    -- Changes are tracked for projects that have cached sections or that
+    -- have tracking explicitly enabled, e.g. by node query result caches.
+    CREATE FUNCTION is_node_query_cache_tracked(project_id integer) RETURNS boolean
+    LANGUAGE sql STABLE AS
+    $$
+        SELECT EXISTS (
+            SELECT 1 FROM node_query_cache c
+            WHERE c.project_id = $1
+        ) OR EXISTS (
+            SELECT 1 FROM node_query_cache_dirty_tracking t
+            WHERE t.project_id = $1
+        );
+    $$;
+""" + trigger_function_template.format(column='edge', condition=new_condition) \
+    + trigger_function_template.format(column='geom', condition=new_condition)
+
+backward = trigger_function_template.format(column='edge', condition=old_condition) \
+    + trigger_function_template.format(column='geom', condition=old_condition) + """
+    DROP FUNCTION is_node_query_cache_tracked(integer);
+    DROP TABLE node_query_cache_dirty_tracking;
+"""
+
+
+class Migration(migrations.Migration):
+    """Allow to track spatial changes also for projects that don't have any
+    cached sections, by listing them in the new node_query_cache_dirty_tracking
+    table. This is used by process local node query result caches, which need
+    to invalidate their entries.
+    """
+
+    dependencies = [
+        ('catmaid', '0046_add_node_query_cache_dirty_section_table'),
+    ]
+
+    operations = [
+        migrations.RunSQL(forward, backward)
+    ]
@@ -0,0 +1,127 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import django.contrib.postgres.fields.jsonb
+from django.db import migrations, models
+import django.db.models.deletion
+import django.utils.timezone
+
+
+forward = """
+    CREATE TABLE node_grid_cache (
+        id serial PRIMARY KEY,
+        project_id integer NOT NULL REFERENCES project (id) ON DELETE CASCADE
+            DEFERRABLE INITIALLY DEFERRED,
+        orientation integer DEFAULT 0 NOT NULL,
+        cell_width real NOT NULL,
+        cell_height real NOT NULL,
+        cell_depth real NOT NULL,
+        update_time timestamptz NOT NULL DEFAULT now(),
+        CONSTRAINT node_grid_cache_project_orientation_cell_size_uniq
+            UNIQUE (project_id, orientation, cell_width, cell_height, cell_depth)
+    );
+
+    CREATE TABLE node_grid_cache_cell (
+        id bigserial PRIMARY KEY,
+        grid_id integer NOT NULL REFERENCES node_grid_cache (id) ON DELETE CASCADE
+            DEFERRABLE INITIALLY DEFERRED,
+        x_index integer NOT NULL,
+        y_index integer NOT NULL,
+        z_index integer NOT NULL,
+        update_time timestamptz NOT NULL DEFAULT now(),
+        json_data jsonb,
+        msgpack_data bytea,
+        CONSTRAINT node_grid_cache_cell_grid_index_uniq
+            UNIQUE (grid_id, z_index, y_index, x_index)
+    );
+
+    -- Changes are now also tracked for projects that only have grid caches.
+    CREATE OR REPLACE FUNCTION is_node_query_cache_tracked(project_id integer) RETURNS boolean
+    LANGUAGE sql STABLE AS
+    $$
+        SELECT EXISTS (
+            SELECT 1 FROM node_query_cache c
+            WHERE c.project_id = $1
+        ) OR EXISTS (
+            SELECT 1 FROM node_grid_cache g
+            WHERE g.project_id = $1
+        ) OR EXISTS (
+            SELECT 1 FROM node_query_cache_dirty_tracking t
+            WHERE t.project_id = $1
+        );
+    $$;
+"""
+
+backward = """
+    CREATE OR REPLACE FUNCTION is_node_query_cache_tracked(project_id integer) RETURNS boolean
+    LANGUAGE sql STABLE AS
+    $$
+        SELECT EXISTS (
+            SELECT 1 FROM node_query_cache c
+            WHERE c.project_id = $1
+        ) OR EXISTS (
+            SELECT 1 FROM node_query_cache_dirty_tracking t
+            WHERE t.project_id = $1
+        );
+    $$;
+
+    DROP TABLE node_grid_cache_cell;
+    DROP TABLE node_grid_cache;
+"""
+
+
+class Migration(migrations.Migration):
+    """Add the node_grid_cache and node_grid_cache_cell tables, which store
+    node query results for the cells of a regular 3D grid. Unlike the section
+    based node_query_cache, this allows to answer queries for small fields of
+    view by loading only the intersecting cells. Spatial changes are tracked
+    for projects with grid caches as well.
+    """
+
+    dependencies = [
+        ('catmaid', '0047_add_node_query_cache_dirty_tracking_table'),
+    ]
+
+    operations = [
+        migrations.RunSQL(forward, backward, [
+            migrations.CreateModel(
+                name='NodeGridCache',
+                fields=[
+                    ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                    ('orientation', models.IntegerField(default=0)),
+                    ('cell_width', models.FloatField()),
+                    ('cell_height', models.FloatField()),
+                    ('cell_depth', models.FloatField()),
+                    ('update_time', models.DateTimeField(default=django.utils.timezone.now)),
+                    ('project', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='catmaid.Project')),
+                ],
+                options={
+                    'db_table': 'node_grid_cache',
+                },
+            ),
+            migrations.AlterUniqueTogether(
+                name='nodegridcache',
+                unique_together=set([('project', 'orientation', 'cell_width', 'cell_height', 'cell_depth')]),
+            ),
+            migrations.CreateModel(
+                name='NodeGridCacheCell',
+                fields=[
+                    ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                    ('x_index', models.IntegerField()),
+                    ('y_index', models.IntegerField()),
+                    ('z_index', models.IntegerField()),
+                    ('update_time', models.DateTimeField(default=django.utils.timezone.now)),
+                    ('json_data', django.contrib.postgres.fields.jsonb.JSONField(blank=True, null=True)),
+                    ('msgpack_data', models.BinaryField(null=True)),
+                    ('grid', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='catmaid.NodeGridCache')),
+                ],
+                options={
+                    'db_table': 'node_grid_cache_cell',
+                },
+            ),
+            migrations.AlterUniqueTogether(
+                name='nodegridcachecell',
+                unique_together=set([('grid', 'z_index', 'y_index', 'x_index')]),
+            ),
+        ])
+    ]
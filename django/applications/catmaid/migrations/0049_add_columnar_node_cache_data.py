@@ -0,0 +1,40 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+forward = """
+    ALTER TABLE node_query_cache ADD COLUMN columnar_data bytea;
+    ALTER TABLE node_grid_cache_cell ADD COLUMN columnar_data bytea;
+"""
+
+backward = """
+    ALTER TABLE node_query_cache DROP COLUMN columnar_data;
+    ALTER TABLE node_grid_cache_cell DROP COLUMN columnar_data;
+"""
+
+
+class Migration(migrations.Migration):
+    """Allow node query caches to store data in the columnar node data format,
+    in which treenodes and connectors are encoded as typed column arrays.
+    """
+
+    dependencies = [
+        ('catmaid', '0048_add_node_grid_cache_tables'),
+    ]
+
+    operations = [
+        migrations.RunSQL(forward, backward, [
+            migrations.AddField(
+                model_name='nodequerycache',
+                name='columnar_data',
+                field=models.BinaryField(null=True),
+            ),
+            migrations.AddField(
+                model_name='nodegridcachecell',
+                name='columnar_data',
+                field=models.BinaryField(null=True),
+            ),
+        ])
+    ]
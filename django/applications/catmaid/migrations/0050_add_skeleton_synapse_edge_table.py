@@ -0,0 +1,227 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+# Count all synapses between the skeletons of the links in changed_link and all
+# other links of the same connectors. Each pair of a presynaptic_to and a
+# postsynaptic_to link of the same connector is one synapse, its confidence is
+# the minimum of both link confidences. The unchanged links of affected
+# connectors are read from the treenode_connector table, which doesn't contain
+# changed links anymore after a delete and contains their new version after an
+# insert or update. Pairs of two changed links are counted only once.
+synapse_delta_template = """
+            WITH changed_link AS (
+                {changed_link}
+            ), unchanged_link AS (
+                SELECT tc.id, tc.project_id, tc.skeleton_id, tc.connector_id,
+                    tc.relation_id, tc.confidence
+                FROM treenode_connector tc
+                WHERE tc.connector_id IN (SELECT connector_id FROM changed_link)
+                  AND NOT EXISTS (
+                    SELECT 1 FROM changed_link cl
+                    WHERE cl.id = tc.id
+                  )
+            ), link AS (
+                SELECT cl.*, TRUE AS changed FROM changed_link cl
+                UNION ALL
+                SELECT ul.*, FALSE AS changed FROM unchanged_link ul
+            ), synapse_delta AS (
+                SELECT pre.project_id, pre.skeleton_id AS pre_skeleton_id,
+                    post.skeleton_id AS post_skeleton_id,
+                    LEAST(pre.confidence, post.confidence) AS confidence,
+                    COUNT(*) AS n_synapses
+                FROM link pre
+                JOIN relation pre_r
+                    ON pre_r.id = pre.relation_id
+                JOIN link post
+                    ON post.connector_id = pre.connector_id
+                JOIN relation post_r
+                    ON post_r.id = post.relation_id
+                WHERE (pre.changed OR post.changed)
+                  AND pre_r.relation_name = 'presynaptic_to'
+                  AND post_r.relation_name = 'postsynaptic_to'
+                GROUP BY pre.project_id, pre.skeleton_id, post.skeleton_id,
+                    LEAST(pre.confidence, post.confidence)
+            )"""
+
+subtract_template = synapse_delta_template + """
+            UPDATE catmaid_skeleton_synapse_edge e
+            SET n_synapses = e.n_synapses - d.n_synapses
+            FROM synapse_delta d
+            WHERE e.pre_skeleton_id = d.pre_skeleton_id
+              AND e.post_skeleton_id = d.post_skeleton_id
+              AND e.confidence = d.confidence;
+
+            DELETE FROM catmaid_skeleton_synapse_edge
+            WHERE n_synapses < 1;
+"""
+
+add_template = synapse_delta_template + """
+            INSERT INTO catmaid_skeleton_synapse_edge (project_id,
+                pre_skeleton_id, post_skeleton_id, confidence, n_synapses)
+            SELECT d.project_id, d.pre_skeleton_id, d.post_skeleton_id,
+                d.confidence, d.n_synapses
+            FROM synapse_delta d
+            ORDER BY d.pre_skeleton_id, d.post_skeleton_id, d.confidence
+            ON CONFLICT (pre_skeleton_id, post_skeleton_id, confidence) DO UPDATE
+            SET n_synapses = catmaid_skeleton_synapse_edge.n_synapses + EXCLUDED.n_synapses;
+"""
+
+link_columns = "id, project_id, skeleton_id, connector_id, relation_id, confidence"
+
+# Only updates that change the skeleton, connector, relation or confidence of
+# a link need to be looked at.
+changed_link_template = """
+                SELECT {prefix}.id, {prefix}.project_id, {prefix}.skeleton_id,
+                    {prefix}.connector_id, {prefix}.relation_id, {prefix}.confidence
+                FROM old_link ol
+                JOIN new_link nl
+                    ON nl.id = ol.id
+                WHERE ol.skeleton_id != nl.skeleton_id
+                   OR ol.connector_id != nl.connector_id
+                   OR ol.relation_id != nl.relation_id
+                   OR ol.confidence != nl.confidence"""
+
+forward = """
+    CREATE TABLE catmaid_skeleton_synapse_edge (
+        id bigserial PRIMARY KEY,
+        project_id integer NOT NULL REFERENCES project (id) ON DELETE CASCADE
+            DEFERRABLE INITIALLY DEFERRED,
+        pre_skeleton_id bigint NOT NULL,
+        post_skeleton_id bigint NOT NULL,
+        confidence integer NOT NULL,
+        n_synapses integer NOT NULL,
+        CONSTRAINT catmaid_skeleton_synapse_edge_pre_post_confidence_uniq
+            UNIQUE (pre_skeleton_id, post_skeleton_id, confidence)
+    );
+
+    CREATE INDEX catmaid_skeleton_synapse_edge_post_pre_idx
+    ON catmaid_skeleton_synapse_edge (post_skeleton_id, pre_skeleton_id);
+
+    -- Allows to find emptied rows quickly after updates.
+    CREATE INDEX catmaid_skeleton_synapse_edge_empty_idx
+    ON catmaid_skeleton_synapse_edge (id) WHERE n_synapses < 1;
+
+
+    -- Rebuild the synapse edges of the passed in projects or of all projects,
+    -- if no project IDs are passed in.
+    CREATE FUNCTION refresh_skeleton_synapse_edge_table(project_ids integer[] DEFAULT NULL)
+    RETURNS void
+    LANGUAGE plpgsql AS
+    $$
+    BEGIN
+        IF project_ids IS NULL THEN
+            TRUNCATE catmaid_skeleton_synapse_edge;
+        ELSE
+            DELETE FROM catmaid_skeleton_synapse_edge
+            WHERE project_id = ANY(project_ids);
+        END IF;
+
+        INSERT INTO catmaid_skeleton_synapse_edge (project_id, pre_skeleton_id,
+            post_skeleton_id, confidence, n_synapses)
+        SELECT pre.project_id, pre.skeleton_id, post.skeleton_id,
+            LEAST(pre.confidence, post.confidence), COUNT(*)
+        FROM treenode_connector pre
+        JOIN relation pre_r
+            ON pre_r.id = pre.relation_id
+        JOIN treenode_connector post
+            ON post.connector_id = pre.connector_id
+        JOIN relation post_r
+            ON post_r.id = post.relation_id
+        WHERE pre_r.relation_name = 'presynaptic_to'
+          AND post_r.relation_name = 'postsynaptic_to'
+          AND (project_ids IS NULL OR pre.project_id = ANY(project_ids))
+        GROUP BY pre.project_id, pre.skeleton_id, post.skeleton_id,
+            LEAST(pre.confidence, post.confidence);
+    END;
+    $$;
+
+
+    -- Keep the synapse edge table up to date with all link changes. Updates
+    -- are handled like the removal of the old version of all changed links,
+    -- followed by the insertion of their new version.
+    CREATE FUNCTION on_change_treenode_connector_update_synapse_edges() RETURNS trigger
+    LANGUAGE plpgsql AS
+    $$
+    BEGIN
+        IF TG_OP = 'INSERT' THEN
+""" + add_template.format(changed_link="SELECT {} FROM new_link".format(link_columns)) + """
+        ELSIF TG_OP = 'UPDATE' THEN
+""" + subtract_template.format(changed_link=changed_link_template.format(prefix='ol')) \
+    + add_template.format(changed_link=changed_link_template.format(prefix='nl')) + """
+        ELSIF TG_OP = 'DELETE' THEN
+""" + subtract_template.format(changed_link="SELECT {} FROM old_link".format(link_columns)) + """
+        END IF;
+
+        RETURN NULL;
+    END;
+    $$;
+
+    CREATE TRIGGER on_insert_treenode_connector_update_synapse_edges
+    AFTER INSERT ON treenode_connector
+    REFERENCING NEW TABLE AS new_link
+    FOR EACH STATEMENT EXECUTE PROCEDURE on_change_treenode_connector_update_synapse_edges();
+
+    CREATE TRIGGER on_edit_treenode_connector_update_synapse_edges
+    AFTER UPDATE ON treenode_connector
+    REFERENCING NEW TABLE AS new_link OLD TABLE AS old_link
+    FOR EACH STATEMENT EXECUTE PROCEDURE on_change_treenode_connector_update_synapse_edges();
+
+    CREATE TRIGGER on_delete_treenode_connector_update_synapse_edges
+    AFTER DELETE ON treenode_connector
+    REFERENCING OLD TABLE AS old_link
+    FOR EACH STATEMENT EXECUTE PROCEDURE on_change_treenode_connector_update_synapse_edges();
+
+    SELECT refresh_skeleton_synapse_edge_table();
+"""
+
+backward = """
+    DROP TRIGGER on_insert_treenode_connector_update_synapse_edges ON treenode_connector;
+    DROP TRIGGER on_edit_treenode_connector_update_synapse_edges ON treenode_connector;
+    DROP TRIGGER on_delete_treenode_connector_update_synapse_edges ON treenode_connector;
+
+    DROP FUNCTION on_change_treenode_connector_update_synapse_edges();
+    DROP FUNCTION refresh_skeleton_synapse_edge_table(integer[]);
+
+    DROP TABLE catmaid_skeleton_synapse_edge;
+"""
+
+
+class Migration(migrations.Migration):
+    """Add the catmaid_skeleton_synapse_edge table, which stores the number of
+    synapses from one skeleton to another, binned by synapse confidence. It is
+    kept up to date by statement level triggers on the treenode_connector
+    table. This allows connectivity graphs and matrices to be read without
+    joining the treenode_connector table with itself. Like the other summary
+    tables, this table doesn't need history tracking.
+    """
+
+    dependencies = [
+        ('catmaid', '0049_add_columnar_node_cache_data'),
+    ]
+
+    operations = [
+        migrations.RunSQL(forward, backward, [
+            migrations.CreateModel(
+                name='SkeletonSynapseEdge',
+                fields=[
+                    ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                    ('pre_skeleton_id', models.BigIntegerField()),
+                    ('post_skeleton_id', models.BigIntegerField()),
+                    ('confidence', models.IntegerField()),
+                    ('n_synapses', models.IntegerField()),
+                    ('project', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='catmaid.Project')),
+                ],
+                options={
+                    'db_table': 'catmaid_skeleton_synapse_edge',
+                },
+            ),
+            migrations.AlterUniqueTogether(
+                name='skeletonsynapseedge',
+                unique_together=set([('pre_skeleton_id', 'post_skeleton_id', 'confidence')]),
+            ),
+        ])
+    ]
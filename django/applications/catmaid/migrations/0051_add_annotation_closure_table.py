@@ -0,0 +1,255 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+# Find all annotations that are transitively annotated with one of the
+# annotations matched by the seed filter. Both ends of each followed link have
+# to be annotations. The UNION makes sure annotation cycles terminate.
+closure_template = """
+            WITH RECURSIVE reach (project_id, ancestor_id, descendant_id) AS (
+                SELECT cici.project_id, cici.class_instance_b, cici.class_instance_a
+                FROM class_instance_class_instance cici
+                JOIN relation r
+                    ON r.id = cici.relation_id
+                JOIN class_instance ci_a
+                    ON ci_a.id = cici.class_instance_a
+                JOIN class c_a
+                    ON c_a.id = ci_a.class_id
+                JOIN class_instance ci_b
+                    ON ci_b.id = cici.class_instance_b
+                JOIN class c_b
+                    ON c_b.id = ci_b.class_id
+                WHERE r.relation_name = 'annotated_with'
+                  AND c_a.class_name = 'annotation'
+                  AND c_b.class_name = 'annotation'
+                  AND {seed_filter}
+                UNION
+                SELECT reach.project_id, reach.ancestor_id, cici.class_instance_a
+                FROM reach
+                JOIN class_instance_class_instance cici
+                    ON cici.class_instance_b = reach.descendant_id
+                JOIN relation r
+                    ON r.id = cici.relation_id
+                JOIN class_instance ci_a
+                    ON ci_a.id = cici.class_instance_a
+                JOIN class c_a
+                    ON c_a.id = ci_a.class_id
+                WHERE r.relation_name = 'annotated_with'
+                  AND c_a.class_name = 'annotation'
+            )
+            INSERT INTO catmaid_annotation_closure (project_id, ancestor_id,
+                descendant_id)
+            SELECT project_id, ancestor_id, descendant_id
+            FROM reach
+            ON CONFLICT (ancestor_id, descendant_id) DO NOTHING;
+"""
+
+# Every link between two annotations is part of the closure. Therefore only
+# removed links that have a closure entry can affect it, which doesn't require
+# the linked class instances to still exist. All closure entries of the parent
+# annotation of such a link and of its ancestors are computed again.
+remove_template = """
+            SELECT array_agg(DISTINCT a.id) INTO ancestor_ids
+            FROM (
+                SELECT rl.class_instance_b AS id
+                FROM ({removed_link}) rl
+                JOIN catmaid_annotation_closure ac
+                    ON ac.ancestor_id = rl.class_instance_b
+                    AND ac.descendant_id = rl.class_instance_a
+                UNION ALL
+                SELECT ac_p.ancestor_id
+                FROM ({removed_link}) rl
+                JOIN catmaid_annotation_closure ac
+                    ON ac.ancestor_id = rl.class_instance_b
+                    AND ac.descendant_id = rl.class_instance_a
+                JOIN catmaid_annotation_closure ac_p
+                    ON ac_p.descendant_id = rl.class_instance_b
+            ) a;
+
+            IF ancestor_ids IS NOT NULL THEN
+                DELETE FROM catmaid_annotation_closure
+                WHERE ancestor_id = ANY(ancestor_ids);
+""" + closure_template.format(seed_filter="cici.class_instance_b = ANY(ancestor_ids)") + """
+            END IF;
+"""
+
+# New links between two annotations connect the parent annotation and all its
+# ancestors with the child annotation and all its descendants. Links are added
+# one after the other, so that links between new links are found, too.
+add_template = """
+            FOR link IN
+                SELECT nl.project_id, nl.class_instance_a, nl.class_instance_b
+                FROM ({added_link}) nl
+                JOIN relation r
+                    ON r.id = nl.relation_id
+                JOIN class_instance ci_a
+                    ON ci_a.id = nl.class_instance_a
+                JOIN class c_a
+                    ON c_a.id = ci_a.class_id
+                JOIN class_instance ci_b
+                    ON ci_b.id = nl.class_instance_b
+                JOIN class c_b
+                    ON c_b.id = ci_b.class_id
+                WHERE r.relation_name = 'annotated_with'
+                  AND c_a.class_name = 'annotation'
+                  AND c_b.class_name = 'annotation'
+            LOOP
+                INSERT INTO catmaid_annotation_closure (project_id,
+                    ancestor_id, descendant_id)
+                SELECT link.project_id, a.id, d.id
+                FROM (
+                    SELECT link.class_instance_b AS id
+                    UNION
+                    SELECT ac.ancestor_id
+                    FROM catmaid_annotation_closure ac
+                    WHERE ac.descendant_id = link.class_instance_b
+                ) a, (
+                    SELECT link.class_instance_a AS id
+                    UNION
+                    SELECT ac.descendant_id
+                    FROM catmaid_annotation_closure ac
+                    WHERE ac.ancestor_id = link.class_instance_a
+                ) d
+                ON CONFLICT (ancestor_id, descendant_id) DO NOTHING;
+            END LOOP;
+"""
+
+# Only updates that change the relation or one of the linked class instances
+# need to be looked at.
+changed_link_template = """
+                    SELECT {prefix}.project_id, {prefix}.relation_id,
+                        {prefix}.class_instance_a, {prefix}.class_instance_b
+                    FROM old_cici ol
+                    JOIN new_cici nl
+                        ON nl.id = ol.id
+                    WHERE ol.relation_id != nl.relation_id
+                       OR ol.class_instance_a != nl.class_instance_a
+                       OR ol.class_instance_b != nl.class_instance_b"""
+
+link_columns = "project_id, relation_id, class_instance_a, class_instance_b"
+
+forward = """
+    CREATE TABLE catmaid_annotation_closure (
+        id bigserial PRIMARY KEY,
+        project_id integer NOT NULL REFERENCES project (id) ON DELETE CASCADE
+            DEFERRABLE INITIALLY DEFERRED,
+        ancestor_id bigint NOT NULL,
+        descendant_id bigint NOT NULL,
+        CONSTRAINT catmaid_annotation_closure_ancestor_descendant_uniq
+            UNIQUE (ancestor_id, descendant_id)
+    );
+
+    CREATE INDEX catmaid_annotation_closure_descendant_ancestor_idx
+    ON catmaid_annotation_closure (descendant_id, ancestor_id);
+
+    CREATE INDEX catmaid_annotation_closure_project_id_idx
+    ON catmaid_annotation_closure (project_id);
+
+
+    -- Rebuild the annotation closure of the passed in projects or of all
+    -- projects, if no project IDs are passed in.
+    CREATE FUNCTION refresh_annotation_closure(project_ids integer[] DEFAULT NULL)
+    RETURNS void
+    LANGUAGE plpgsql AS
+    $$
+    BEGIN
+        IF project_ids IS NULL THEN
+            TRUNCATE catmaid_annotation_closure;
+        ELSE
+            DELETE FROM catmaid_annotation_closure
+            WHERE project_id = ANY(project_ids);
+        END IF;
+""" + closure_template.format(seed_filter="(project_ids IS NULL OR cici.project_id = ANY(project_ids))") + """
+    END;
+    $$;
+
+
+    -- Keep the annotation closure up to date with all class instance link
+    -- changes. Updates are handled like the removal of the old version of all
+    -- changed links, followed by the insertion of their new version.
+    CREATE FUNCTION on_change_cici_update_annotation_closure() RETURNS trigger
+    LANGUAGE plpgsql AS
+    $$
+    DECLARE
+        ancestor_ids bigint[];
+        link record;
+    BEGIN
+        IF TG_OP = 'INSERT' THEN
+""" + add_template.format(added_link="SELECT {} FROM new_cici".format(link_columns)) + """
+        ELSIF TG_OP = 'UPDATE' THEN
+""" + remove_template.format(removed_link=changed_link_template.format(prefix='ol')) \
+    + add_template.format(added_link=changed_link_template.format(prefix='nl')) + """
+        ELSIF TG_OP = 'DELETE' THEN
+""" + remove_template.format(removed_link="SELECT {} FROM old_cici".format(link_columns)) + """
+        END IF;
+
+        RETURN NULL;
+    END;
+    $$;
+
+    CREATE TRIGGER on_insert_cici_update_annotation_closure
+    AFTER INSERT ON class_instance_class_instance
+    REFERENCING NEW TABLE AS new_cici
+    FOR EACH STATEMENT EXECUTE PROCEDURE on_change_cici_update_annotation_closure();
+
+    CREATE TRIGGER on_edit_cici_update_annotation_closure
+    AFTER UPDATE ON class_instance_class_instance
+    REFERENCING NEW TABLE AS new_cici OLD TABLE AS old_cici
+    FOR EACH STATEMENT EXECUTE PROCEDURE on_change_cici_update_annotation_closure();
+
+    CREATE TRIGGER on_delete_cici_update_annotation_closure
+    AFTER DELETE ON class_instance_class_instance
+    REFERENCING OLD TABLE AS old_cici
+    FOR EACH STATEMENT EXECUTE PROCEDURE on_change_cici_update_annotation_closure();
+
+    SELECT refresh_annotation_closure();
+"""
+
+backward = """
+    DROP TRIGGER on_insert_cici_update_annotation_closure ON class_instance_class_instance;
+    DROP TRIGGER on_edit_cici_update_annotation_closure ON class_instance_class_instance;
+    DROP TRIGGER on_delete_cici_update_annotation_closure ON class_instance_class_instance;
+
+    DROP FUNCTION on_change_cici_update_annotation_closure();
+    DROP FUNCTION refresh_annotation_closure(integer[]);
+
+    DROP TABLE catmaid_annotation_closure;
+"""
+
+
+class Migration(migrations.Migration):
+    """Add the catmaid_annotation_closure table, which stores for each
+    annotation all annotations that are transitively annotated with it
+    (sub-annotations). It is kept up to date by statement level triggers on the
+    class_instance_class_instance table. This allows meta-annotation
+    hierarchies to be expanded with a single indexed lookup. Like the other
+    summary tables, this table doesn't need history tracking.
+    """
+
+    dependencies = [
+        ('catmaid', '0050_add_skeleton_synapse_edge_table'),
+    ]
+
+    operations = [
+        migrations.RunSQL(forward, backward, [
+            migrations.CreateModel(
+                name='AnnotationClosure',
+                fields=[
+                    ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                    ('ancestor_id', models.BigIntegerField()),
+                    ('descendant_id', models.BigIntegerField()),
+                    ('project', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='catmaid.Project')),
+                ],
+                options={
+                    'db_table': 'catmaid_annotation_closure',
+                },
+            ),
+            migrations.AlterUniqueTogether(
+                name='annotationclosure',
+                unique_together=set([('ancestor_id', 'descendant_id')]),
+            ),
+        ])
+    ]
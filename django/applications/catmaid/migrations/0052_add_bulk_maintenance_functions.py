@@ -0,0 +1,199 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations
+
+
+# The recording trigger functions write into temporary tables, which are
+# created by a bulk maintenance session along with the triggers that use these
+# functions. They are not used outside of such a session.
+forward = """
+    -- Rebuild the treenode edges and skeleton summaries of the passed in
+    -- skeletons. Edges of treenodes that don't exist anymore are not removed.
+    CREATE FUNCTION refresh_skeleton_summary_and_edges(skeleton_ids bigint[])
+    RETURNS void
+    LANGUAGE plpgsql AS
+    $$
+    BEGIN
+        DELETE FROM treenode_edge e
+        USING treenode t
+        WHERE t.id = e.id
+          AND t.skeleton_id = ANY(skeleton_ids);
+
+        -- Root nodes get an edge to themselves
+        INSERT INTO treenode_edge (id, project_id, edge)
+        SELECT c.id, c.project_id, ST_MakeLine(
+            ST_MakePoint(c.location_x, c.location_y, c.location_z),
+            ST_MakePoint(COALESCE(p.location_x, c.location_x),
+                COALESCE(p.location_y, c.location_y),
+                COALESCE(p.location_z, c.location_z)))
+        FROM treenode c
+        LEFT JOIN treenode p
+            ON p.id = c.parent_id
+        WHERE c.skeleton_id = ANY(skeleton_ids);
+
+        DELETE FROM catmaid_skeleton_summary
+        WHERE skeleton_id = ANY(skeleton_ids);
+
+        INSERT INTO catmaid_skeleton_summary (skeleton_id, project_id,
+            last_summary_update, original_creation_time, last_edition_time,
+            num_nodes, cable_length)
+        SELECT t.skeleton_id, t.project_id, now(), MIN(t.creation_time),
+            MAX(t.edition_time), COUNT(*), SUM(ST_3DLength(e.edge))
+        FROM treenode t
+        JOIN treenode_edge e
+            ON e.id = t.id
+        WHERE t.skeleton_id = ANY(skeleton_ids)
+        GROUP BY t.skeleton_id, t.project_id;
+    END;
+    $$;
+
+
+    -- Rebuild all synapse edges from or to the passed in skeletons.
+    CREATE FUNCTION refresh_skeleton_synapse_edges(skeleton_ids bigint[])
+    RETURNS void
+    LANGUAGE plpgsql AS
+    $$
+    BEGIN
+        DELETE FROM catmaid_skeleton_synapse_edge
+        WHERE pre_skeleton_id = ANY(skeleton_ids)
+           OR post_skeleton_id = ANY(skeleton_ids);
+
+        WITH link AS (
+            SELECT tc.project_id, tc.skeleton_id, tc.connector_id,
+                tc.relation_id, tc.confidence
+            FROM treenode_connector tc
+            WHERE tc.connector_id IN (
+                SELECT connector_id
+                FROM treenode_connector
+                WHERE skeleton_id = ANY(skeleton_ids)
+            )
+        )
+        INSERT INTO catmaid_skeleton_synapse_edge (project_id, pre_skeleton_id,
+            post_skeleton_id, confidence, n_synapses)
+        SELECT pre.project_id, pre.skeleton_id, post.skeleton_id,
+            LEAST(pre.confidence, post.confidence), COUNT(*)
+        FROM link pre
+        JOIN relation pre_r
+            ON pre_r.id = pre.relation_id
+        JOIN link post
+            ON post.connector_id = pre.connector_id
+        JOIN relation post_r
+            ON post_r.id = post.relation_id
+        WHERE pre_r.relation_name = 'presynaptic_to'
+          AND post_r.relation_name = 'postsynaptic_to'
+          AND (pre.skeleton_id = ANY(skeleton_ids)
+           OR post.skeleton_id = ANY(skeleton_ids))
+        GROUP BY pre.project_id, pre.skeleton_id, post.skeleton_id,
+            LEAST(pre.confidence, post.confidence);
+    END;
+    $$;
+
+
+    -- Record the skeletons of changed treenodes and the IDs of deleted
+    -- treenodes during a bulk maintenance session.
+    CREATE FUNCTION on_change_treenode_record_bulk_change() RETURNS trigger
+    LANGUAGE plpgsql AS
+    $$
+    BEGIN
+        IF TG_OP = 'INSERT' THEN
+            INSERT INTO bulk_treenode_skeleton (skeleton_id)
+            SELECT DISTINCT skeleton_id FROM new_rows
+            ON CONFLICT DO NOTHING;
+        ELSIF TG_OP = 'UPDATE' THEN
+            INSERT INTO bulk_treenode_skeleton (skeleton_id)
+            SELECT skeleton_id FROM new_rows
+            UNION
+            SELECT skeleton_id FROM old_rows
+            ON CONFLICT DO NOTHING;
+        ELSIF TG_OP = 'DELETE' THEN
+            INSERT INTO bulk_treenode_skeleton (skeleton_id)
+            SELECT DISTINCT skeleton_id FROM old_rows
+            ON CONFLICT DO NOTHING;
+
+            INSERT INTO bulk_deleted_treenode (id)
+            SELECT id FROM old_rows;
+        END IF;
+
+        RETURN NULL;
+    END;
+    $$;
+
+
+    -- Record the skeletons of changed connector links during a bulk
+    -- maintenance session.
+    CREATE FUNCTION on_change_treenode_connector_record_bulk_change() RETURNS trigger
+    LANGUAGE plpgsql AS
+    $$
+    BEGIN
+        IF TG_OP = 'INSERT' THEN
+            INSERT INTO bulk_link_skeleton (skeleton_id)
+            SELECT DISTINCT skeleton_id FROM new_rows
+            ON CONFLICT DO NOTHING;
+        ELSIF TG_OP = 'UPDATE' THEN
+            INSERT INTO bulk_link_skeleton (skeleton_id)
+            SELECT skeleton_id FROM new_rows
+            UNION
+            SELECT skeleton_id FROM old_rows
+            ON CONFLICT DO NOTHING;
+        ELSIF TG_OP = 'DELETE' THEN
+            INSERT INTO bulk_link_skeleton (skeleton_id)
+            SELECT DISTINCT skeleton_id FROM old_rows
+            ON CONFLICT DO NOTHING;
+        END IF;
+
+        RETURN NULL;
+    END;
+    $$;
+
+
+    -- Record the projects of changed class instance links during a bulk
+    -- maintenance session.
+    CREATE FUNCTION on_change_cici_record_bulk_change() RETURNS trigger
+    LANGUAGE plpgsql AS
+    $$
+    BEGIN
+        IF TG_OP = 'INSERT' THEN
+            INSERT INTO bulk_cici_project (project_id)
+            SELECT DISTINCT project_id FROM new_rows
+            ON CONFLICT DO NOTHING;
+        ELSIF TG_OP = 'UPDATE' THEN
+            INSERT INTO bulk_cici_project (project_id)
+            SELECT project_id FROM new_rows
+            UNION
+            SELECT project_id FROM old_rows
+            ON CONFLICT DO NOTHING;
+        ELSIF TG_OP = 'DELETE' THEN
+            INSERT INTO bulk_cici_project (project_id)
+            SELECT DISTINCT project_id FROM old_rows
+            ON CONFLICT DO NOTHING;
+        END IF;
+
+        RETURN NULL;
+    END;
+    $$;
+"""
+
+backward = """
+    DROP FUNCTION refresh_skeleton_summary_and_edges(bigint[]);
+    DROP FUNCTION refresh_skeleton_synapse_edges(bigint[]);
+    DROP FUNCTION on_change_treenode_record_bulk_change();
+    DROP FUNCTION on_change_treenode_connector_record_bulk_change();
+    DROP FUNCTION on_change_cici_record_bulk_change();
+"""
+
+
+class Migration(migrations.Migration):
+    """Add functions to rebuild the treenode edges, skeleton summaries and
+    synapse edges of individual skeletons. Additionally, add trigger functions
+    that record changes during bulk maintenance sessions, in which the regular
+    summary table triggers are suspended.
+    """
+
+    dependencies = [
+        ('catmaid', '0051_add_annotation_closure_table'),
+    ]
+
+    operations = [
+        migrations.RunSQL(forward, backward)
+    ]
@@ -0,0 +1,291 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.conf import settings
+from django.db import migrations, models
+import django.contrib.postgres.fields
+import django.db.models.deletion
+
+
+# Group the reviewed nodes of all matching skeletons by the set of users who
+# reviewed them. Nodes reviewed by multiple users are only counted once this
+# way, which allows union, sub-union and exclusion counts to be summed up from
+# this table.
+review_summary_template = """
+            INSERT INTO catmaid_skeleton_review_summary (project_id,
+                skeleton_id, reviewer_ids, num_reviewed_nodes)
+            SELECT project_id, skeleton_id, reviewer_ids, COUNT(*)
+            FROM (
+                SELECT r.project_id, r.skeleton_id, r.treenode_id,
+                    array_agg(DISTINCT r.reviewer_id ORDER BY r.reviewer_id)
+                        AS reviewer_ids
+                FROM review r
+                WHERE {review_filter}
+                GROUP BY r.project_id, r.skeleton_id, r.treenode_id
+            ) node_review
+            GROUP BY project_id, skeleton_id, reviewer_ids;
+"""
+
+# Count the nodes of all matching skeletons that have been reviewed by a
+# whitelisted reviewer of a user after the respective accept_after date.
+whitelist_review_template = """
+            INSERT INTO catmaid_skeleton_whitelist_review (project_id,
+                user_id, skeleton_id, num_reviewed_nodes)
+            SELECT wl.project_id, wl.user_id, r.skeleton_id,
+                COUNT(DISTINCT r.treenode_id)
+            FROM review r
+            JOIN reviewer_whitelist wl
+                ON wl.project_id = r.project_id
+                AND wl.reviewer_id = r.reviewer_id
+                AND r.review_time >= wl.accept_after
+            WHERE {review_filter}
+              AND {whitelist_filter}
+            GROUP BY wl.project_id, wl.user_id, r.skeleton_id;
+"""
+
+# Whitelist changes affect all skeletons of a project for the changed user.
+whitelist_change_template = """
+            DELETE FROM catmaid_skeleton_whitelist_review swr
+            USING ({changed_whitelist}) cw
+            WHERE swr.project_id = cw.project_id
+              AND swr.user_id = cw.user_id;
+""" + whitelist_review_template.format(
+    review_filter="TRUE",
+    whitelist_filter="""(wl.project_id, wl.user_id) IN (
+                {changed_whitelist})""")
+
+forward = """
+    CREATE TABLE catmaid_skeleton_review_summary (
+        id bigserial PRIMARY KEY,
+        project_id integer NOT NULL REFERENCES project (id) ON DELETE CASCADE
+            DEFERRABLE INITIALLY DEFERRED,
+        skeleton_id bigint NOT NULL,
+        reviewer_ids integer[] NOT NULL,
+        num_reviewed_nodes integer NOT NULL,
+        CONSTRAINT catmaid_skeleton_review_summary_skeleton_reviewers_uniq
+            UNIQUE (skeleton_id, reviewer_ids)
+    );
+
+    CREATE INDEX catmaid_skeleton_review_summary_project_id_idx
+    ON catmaid_skeleton_review_summary (project_id);
+
+    CREATE TABLE catmaid_skeleton_whitelist_review (
+        id bigserial PRIMARY KEY,
+        project_id integer NOT NULL REFERENCES project (id) ON DELETE CASCADE
+            DEFERRABLE INITIALLY DEFERRED,
+        user_id integer NOT NULL REFERENCES auth_user (id) ON DELETE CASCADE
+            DEFERRABLE INITIALLY DEFERRED,
+        skeleton_id bigint NOT NULL,
+        num_reviewed_nodes integer NOT NULL,
+        CONSTRAINT catmaid_skeleton_whitelist_review_project_user_skeleton_uniq
+            UNIQUE (project_id, user_id, skeleton_id)
+    );
+
+    CREATE INDEX catmaid_skeleton_whitelist_review_skeleton_id_idx
+    ON catmaid_skeleton_whitelist_review (skeleton_id);
+
+
+    -- Rebuild the review summary tables of the passed in projects or of all
+    -- projects, if no project IDs are passed in.
+    CREATE FUNCTION refresh_review_summary(project_ids integer[] DEFAULT NULL)
+    RETURNS void
+    LANGUAGE plpgsql AS
+    $$
+    BEGIN
+        IF project_ids IS NULL THEN
+            TRUNCATE catmaid_skeleton_review_summary;
+            TRUNCATE catmaid_skeleton_whitelist_review;
+        ELSE
+            DELETE FROM catmaid_skeleton_review_summary
+            WHERE project_id = ANY(project_ids);
+            DELETE FROM catmaid_skeleton_whitelist_review
+            WHERE project_id = ANY(project_ids);
+        END IF;
+""" + review_summary_template.format(
+        review_filter="(project_ids IS NULL OR r.project_id = ANY(project_ids))") \
+    + whitelist_review_template.format(
+        review_filter="(project_ids IS NULL OR r.project_id = ANY(project_ids))",
+        whitelist_filter="TRUE") + """
+    END;
+    $$;
+
+
+    -- Rebuild the review summary of the passed in skeletons.
+    CREATE FUNCTION refresh_skeleton_review_summary(skeleton_ids bigint[])
+    RETURNS void
+    LANGUAGE plpgsql AS
+    $$
+    BEGIN
+        DELETE FROM catmaid_skeleton_review_summary
+        WHERE skeleton_id = ANY(skeleton_ids);
+        DELETE FROM catmaid_skeleton_whitelist_review
+        WHERE skeleton_id = ANY(skeleton_ids);
+""" + review_summary_template.format(
+        review_filter="r.skeleton_id = ANY(skeleton_ids)") \
+    + whitelist_review_template.format(
+        review_filter="r.skeleton_id = ANY(skeleton_ids)",
+        whitelist_filter="TRUE") + """
+    END;
+    $$;
+
+
+    -- Rebuild the review summary of all skeletons with changed reviews.
+    CREATE FUNCTION on_change_review_update_review_summary() RETURNS trigger
+    LANGUAGE plpgsql AS
+    $$
+    DECLARE
+        skeleton_ids bigint[];
+    BEGIN
+        IF TG_OP = 'INSERT' THEN
+            SELECT array_agg(DISTINCT skeleton_id) INTO skeleton_ids
+            FROM new_review;
+        ELSIF TG_OP = 'UPDATE' THEN
+            SELECT array_agg(DISTINCT skeleton_id) INTO skeleton_ids
+            FROM (
+                SELECT skeleton_id FROM new_review
+                UNION ALL
+                SELECT skeleton_id FROM old_review
+            ) changed_review;
+        ELSIF TG_OP = 'DELETE' THEN
+            SELECT array_agg(DISTINCT skeleton_id) INTO skeleton_ids
+            FROM old_review;
+        END IF;
+
+        IF skeleton_ids IS NOT NULL THEN
+            PERFORM refresh_skeleton_review_summary(skeleton_ids);
+        END IF;
+
+        RETURN NULL;
+    END;
+    $$;
+
+
+    -- Rebuild the whitelist review counts of all users with a changed
+    -- reviewer whitelist.
+    CREATE FUNCTION on_change_reviewer_whitelist_update_review_summary()
+    RETURNS trigger
+    LANGUAGE plpgsql AS
+    $$
+    BEGIN
+        IF TG_OP = 'INSERT' THEN
+""" + whitelist_change_template.format(
+        changed_whitelist="SELECT project_id, user_id FROM new_whitelist") + """
+        ELSIF TG_OP = 'UPDATE' THEN
+""" + whitelist_change_template.format(
+        changed_whitelist="""SELECT project_id, user_id FROM new_whitelist
+                    UNION ALL
+                    SELECT project_id, user_id FROM old_whitelist""") + """
+        ELSIF TG_OP = 'DELETE' THEN
+""" + whitelist_change_template.format(
+        changed_whitelist="SELECT project_id, user_id FROM old_whitelist") + """
+        END IF;
+
+        RETURN NULL;
+    END;
+    $$;
+
+    CREATE TRIGGER on_insert_review_update_review_summary
+    AFTER INSERT ON review
+    REFERENCING NEW TABLE AS new_review
+    FOR EACH STATEMENT EXECUTE PROCEDURE on_change_review_update_review_summary();
+
+    CREATE TRIGGER on_edit_review_update_review_summary
+    AFTER UPDATE ON review
+    REFERENCING NEW TABLE AS new_review OLD TABLE AS old_review
+    FOR EACH STATEMENT EXECUTE PROCEDURE on_change_review_update_review_summary();
+
+    CREATE TRIGGER on_delete_review_update_review_summary
+    AFTER DELETE ON review
+    REFERENCING OLD TABLE AS old_review
+    FOR EACH STATEMENT EXECUTE PROCEDURE on_change_review_update_review_summary();
+
+    CREATE TRIGGER on_insert_reviewer_whitelist_update_review_summary
+    AFTER INSERT ON reviewer_whitelist
+    REFERENCING NEW TABLE AS new_whitelist
+    FOR EACH STATEMENT EXECUTE PROCEDURE on_change_reviewer_whitelist_update_review_summary();
+
+    CREATE TRIGGER on_edit_reviewer_whitelist_update_review_summary
+    AFTER UPDATE ON reviewer_whitelist
+    REFERENCING NEW TABLE AS new_whitelist OLD TABLE AS old_whitelist
+    FOR EACH STATEMENT EXECUTE PROCEDURE on_change_reviewer_whitelist_update_review_summary();
+
+    CREATE TRIGGER on_delete_reviewer_whitelist_update_review_summary
+    AFTER DELETE ON reviewer_whitelist
+    REFERENCING OLD TABLE AS old_whitelist
+    FOR EACH STATEMENT EXECUTE PROCEDURE on_change_reviewer_whitelist_update_review_summary();
+
+    SELECT refresh_review_summary();
+"""
+
+backward = """
+    DROP TRIGGER on_insert_review_update_review_summary ON review;
+    DROP TRIGGER on_edit_review_update_review_summary ON review;
+    DROP TRIGGER on_delete_review_update_review_summary ON review;
+    DROP TRIGGER on_insert_reviewer_whitelist_update_review_summary ON reviewer_whitelist;
+    DROP TRIGGER on_edit_reviewer_whitelist_update_review_summary ON reviewer_whitelist;
+    DROP TRIGGER on_delete_reviewer_whitelist_update_review_summary ON reviewer_whitelist;
+
+    DROP FUNCTION on_change_review_update_review_summary();
+    DROP FUNCTION on_change_reviewer_whitelist_update_review_summary();
+    DROP FUNCTION refresh_skeleton_review_summary(bigint[]);
+    DROP FUNCTION refresh_review_summary(integer[]);
+
+    DROP TABLE catmaid_skeleton_review_summary;
+    DROP TABLE catmaid_skeleton_whitelist_review;
+"""
+
+
+class Migration(migrations.Migration):
+    """Add the catmaid_skeleton_review_summary table, which counts the
+    reviewed nodes of each skeleton by the set of users who reviewed them, and
+    the catmaid_skeleton_whitelist_review table, which counts the reviewed
+    nodes of each skeleton accepted by the reviewer whitelist of each user.
+    Both are kept up to date by statement level triggers on the review and
+    reviewer_whitelist tables, so that the review status of skeletons can be
+    computed without scanning the review table. Like the other summary tables,
+    these tables don't need history tracking.
+    """
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('catmaid', '0052_add_bulk_maintenance_functions'),
+    ]
+
+    operations = [
+        migrations.RunSQL(forward, backward, [
+            migrations.CreateModel(
+                name='SkeletonReviewSummary',
+                fields=[
+                    ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                    ('skeleton_id', models.BigIntegerField()),
+                    ('reviewer_ids', django.contrib.postgres.fields.ArrayField(base_field=models.IntegerField(), size=None)),
+                    ('num_reviewed_nodes', models.IntegerField()),
+                    ('project', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='catmaid.Project')),
+                ],
+                options={
+                    'db_table': 'catmaid_skeleton_review_summary',
+                },
+            ),
+            migrations.AlterUniqueTogether(
+                name='skeletonreviewsummary',
+                unique_together=set([('skeleton_id', 'reviewer_ids')]),
+            ),
+            migrations.CreateModel(
+                name='SkeletonWhitelistReview',
+                fields=[
+                    ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                    ('skeleton_id', models.BigIntegerField()),
+                    ('num_reviewed_nodes', models.IntegerField()),
+                    ('project', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='catmaid.Project')),
+                    ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to=settings.AUTH_USER_MODEL)),
+                ],
+                options={
+                    'db_table': 'catmaid_skeleton_whitelist_review',
+                },
+            ),
+            migrations.AlterUniqueTogether(
+                name='skeletonwhitelistreview',
+                unique_together=set([('project', 'user', 'skeleton_id')]),
+            ),
+        ])
+    ]
@@ -0,0 +1,73 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations
+
+
+# The tables whose changes invalidate a versioned cache, along with the trigger
+# events that are relevant. Only columns that permissions and edit domains
+# depend on are looked at for updates of users, groups and projects.
+cache_tables = [
+    ('permissions', 'guardian_userobjectpermission', 'INSERT OR UPDATE OR DELETE OR TRUNCATE'),
+    ('permissions', 'guardian_groupobjectpermission', 'INSERT OR UPDATE OR DELETE OR TRUNCATE'),
+    ('permissions', 'auth_user_groups', 'INSERT OR UPDATE OR DELETE OR TRUNCATE'),
+    ('permissions', 'auth_user', 'INSERT OR DELETE OR TRUNCATE OR UPDATE OF username, is_active, is_superuser'),
+    ('permissions', 'auth_group', 'INSERT OR DELETE OR TRUNCATE OR UPDATE OF name'),
+    ('permissions', 'project', 'INSERT OR DELETE OR TRUNCATE'),
+    ('id_maps', 'relation', 'INSERT OR UPDATE OR DELETE OR TRUNCATE'),
+    ('id_maps', 'class', 'INSERT OR UPDATE OR DELETE OR TRUNCATE'),
+]
+
+forward = """
+    CREATE TABLE catmaid_cache_version (
+        name text PRIMARY KEY,
+        version bigint NOT NULL DEFAULT 0,
+        txid bigint
+    );
+
+    INSERT INTO catmaid_cache_version (name)
+    VALUES ('permissions'), ('id_maps');
+
+    -- Increment the version of the cache passed in as trigger argument and
+    -- remember the transaction that did it.
+    CREATE FUNCTION increment_cache_version() RETURNS trigger
+    LANGUAGE plpgsql AS
+    $$
+    BEGIN
+        UPDATE catmaid_cache_version
+        SET version = version + 1, txid = txid_current()
+        WHERE name = TG_ARGV[0];
+
+        RETURN NULL;
+    END;
+    $$;
+""" + ''.join("""
+    CREATE TRIGGER increment_{0}_cache_version
+    AFTER {2} ON {1}
+    FOR EACH STATEMENT EXECUTE PROCEDURE increment_cache_version('{0}');
+""".format(*t) for t in cache_tables)
+
+backward = ''.join("""
+    DROP TRIGGER increment_{0}_cache_version ON {1};
+""".format(*t) for t in cache_tables) + """
+    DROP FUNCTION increment_cache_version();
+    DROP TABLE catmaid_cache_version;
+"""
+
+
+class Migration(migrations.Migration):
+    """Add the catmaid_cache_version table, which holds a version for each
+    process local cache of the back-end. Statement level triggers increment
+    the version of the permission cache and the relation and class ID map
+    cache when the respective tables change, which lets all processes
+    invalidate their entries once a change is committed. This table doesn't
+    need history tracking.
+    """
+
+    dependencies = [
+        ('catmaid', '0053_add_review_summary_tables'),
+    ]
+
+    operations = [
+        migrations.RunSQL(forward, backward)
+    ]
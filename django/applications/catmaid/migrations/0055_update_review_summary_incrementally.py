@@ -0,0 +1,385 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations
+
+
+# Advisory locks serialize writers of the review summary tables. Writers of
+# reviews lock the whitelist of their projects in shared mode and all changed
+# skeletons exclusively, always in ID order. Whitelist changes lock the
+# whitelist of their projects exclusively, because they rebuild the whitelist
+# review counts of all skeletons of a user. Whitelist locks use the two key
+# variant of advisory locks with the OID of the whitelist review table as
+# first key, which keeps them apart from skeleton locks.
+whitelist_lock_key = "'catmaid_skeleton_whitelist_review'::regclass::integer"
+
+lock_template = """
+            PERFORM pg_advisory_xact_lock_shared({whitelist_lock_key}, p.id)
+            FROM unnest(project_ids) p(id);
+
+            PERFORM pg_advisory_xact_lock(s.id)
+            FROM unnest(skeleton_ids) s(id);
+"""
+
+review_columns = "id, project_id, skeleton_id, treenode_id, reviewer_id, review_time"
+
+# Only updates that change the project, skeleton, node, reviewer or review time
+# of a review need to be looked at. Both the old and the new version of those
+# reviews are changed reviews.
+changed_review_templates = {
+    'INSERT': """
+                SELECT {}, FALSE AS is_old
+                FROM new_review""".format(review_columns),
+    'UPDATE': """
+                SELECT {new}, FALSE AS is_old
+                FROM old_review orv
+                JOIN new_review nrv
+                    ON nrv.id = orv.id
+                WHERE {changed}
+                UNION ALL
+                SELECT {old}, TRUE AS is_old
+                FROM old_review orv
+                JOIN new_review nrv
+                    ON nrv.id = orv.id
+                WHERE {changed}""".format(
+                    new=', '.join('nrv.' + c for c in review_columns.split(', ')),
+                    old=', '.join('orv.' + c for c in review_columns.split(', ')),
+                    changed="""orv.project_id != nrv.project_id
+                   OR orv.skeleton_id != nrv.skeleton_id
+                   OR orv.treenode_id != nrv.treenode_id
+                   OR orv.reviewer_id != nrv.reviewer_id
+                   OR orv.review_time IS DISTINCT FROM nrv.review_time"""),
+    'DELETE': """
+                SELECT {}, TRUE AS is_old
+                FROM old_review""".format(review_columns),
+}
+
+# Collect all reviews of the nodes with changed reviews, once in their current
+# state, which the review table has after the change, and once in their
+# previous state. The previous state is the current state without the new
+# version of changed reviews and with their old version.
+review_state_template = """
+            WITH changed_review AS ({changed_review}
+            ), changed_node AS (
+                SELECT DISTINCT skeleton_id, treenode_id
+                FROM changed_review
+            ), current_review AS (
+                SELECT r.id, r.project_id, r.skeleton_id, r.treenode_id,
+                    r.reviewer_id, r.review_time
+                FROM review r
+                JOIN changed_node cn
+                    ON cn.treenode_id = r.treenode_id
+                    AND cn.skeleton_id = r.skeleton_id
+            ), previous_review AS (
+                SELECT cr.id, cr.project_id, cr.skeleton_id, cr.treenode_id,
+                    cr.reviewer_id, cr.review_time
+                FROM current_review cr
+                WHERE NOT EXISTS (
+                    SELECT 1 FROM changed_review ch
+                    WHERE ch.id = cr.id
+                      AND NOT ch.is_old
+                )
+                UNION ALL
+                SELECT id, project_id, skeleton_id, treenode_id, reviewer_id,
+                    review_time
+                FROM changed_review
+                WHERE is_old
+            )"""
+
+# Each changed node moves from the group of its previous reviewer set to the
+# group of its current reviewer set.
+review_delta_template = review_state_template + """, review_delta AS (
+                SELECT project_id, skeleton_id, reviewer_ids,
+                    SUM(delta) AS num_reviewed_nodes
+                FROM (
+                    SELECT project_id, skeleton_id,
+                        array_agg(DISTINCT reviewer_id ORDER BY reviewer_id)
+                            AS reviewer_ids,
+                        1 AS delta
+                    FROM current_review
+                    GROUP BY project_id, skeleton_id, treenode_id
+                    UNION ALL
+                    SELECT project_id, skeleton_id,
+                        array_agg(DISTINCT reviewer_id ORDER BY reviewer_id)
+                            AS reviewer_ids,
+                        -1 AS delta
+                    FROM previous_review
+                    GROUP BY project_id, skeleton_id, treenode_id
+                ) node_delta
+                GROUP BY project_id, skeleton_id, reviewer_ids
+                HAVING SUM(delta) <> 0
+            )
+            INSERT INTO catmaid_skeleton_review_summary (project_id,
+                skeleton_id, reviewer_ids, num_reviewed_nodes)
+            SELECT project_id, skeleton_id, reviewer_ids, num_reviewed_nodes
+            FROM review_delta
+            ORDER BY skeleton_id, reviewer_ids
+            ON CONFLICT (skeleton_id, reviewer_ids) DO UPDATE
+            SET num_reviewed_nodes = catmaid_skeleton_review_summary.num_reviewed_nodes
+                + EXCLUDED.num_reviewed_nodes;
+"""
+
+# Each changed node is added to the count of all users whose whitelist accepts
+# one of its current reviews and removed from the count of all users whose
+# whitelist accepted one of its previous reviews.
+whitelist_delta_template = review_state_template + """, whitelist_delta AS (
+                SELECT project_id, user_id, skeleton_id,
+                    SUM(delta) AS num_reviewed_nodes
+                FROM (
+                    SELECT DISTINCT wl.project_id, wl.user_id, r.skeleton_id,
+                        r.treenode_id, 1 AS delta
+                    FROM current_review r
+                    JOIN reviewer_whitelist wl
+                        ON wl.project_id = r.project_id
+                        AND wl.reviewer_id = r.reviewer_id
+                        AND r.review_time >= wl.accept_after
+                    UNION ALL
+                    SELECT DISTINCT wl.project_id, wl.user_id, r.skeleton_id,
+                        r.treenode_id, -1 AS delta
+                    FROM previous_review r
+                    JOIN reviewer_whitelist wl
+                        ON wl.project_id = r.project_id
+                        AND wl.reviewer_id = r.reviewer_id
+                        AND r.review_time >= wl.accept_after
+                ) node_delta
+                GROUP BY project_id, user_id, skeleton_id
+                HAVING SUM(delta) <> 0
+            )
+            INSERT INTO catmaid_skeleton_whitelist_review (project_id,
+                user_id, skeleton_id, num_reviewed_nodes)
+            SELECT project_id, user_id, skeleton_id, num_reviewed_nodes
+            FROM whitelist_delta
+            ORDER BY project_id, user_id, skeleton_id
+            ON CONFLICT (project_id, user_id, skeleton_id) DO UPDATE
+            SET num_reviewed_nodes = catmaid_skeleton_whitelist_review.num_reviewed_nodes
+                + EXCLUDED.num_reviewed_nodes;
+"""
+
+update_review_summary_template = """
+            WITH changed_review AS ({changed_review}
+            )
+            SELECT array_agg(DISTINCT project_id ORDER BY project_id),
+                array_agg(DISTINCT skeleton_id ORDER BY skeleton_id)
+            INTO project_ids, skeleton_ids
+            FROM changed_review;
+
+            IF skeleton_ids IS NULL THEN
+                RETURN NULL;
+            END IF;
+""" + lock_template + \
+    review_delta_template + whitelist_delta_template + """
+            DELETE FROM catmaid_skeleton_review_summary
+            WHERE skeleton_id = ANY(skeleton_ids)
+              AND num_reviewed_nodes < 1;
+
+            DELETE FROM catmaid_skeleton_whitelist_review
+            WHERE skeleton_id = ANY(skeleton_ids)
+              AND num_reviewed_nodes < 1;
+"""
+
+# The rebuild templates of migration 0053, they are used by the rebuild of
+# single skeletons and by whitelist changes.
+review_summary_template = """
+            INSERT INTO catmaid_skeleton_review_summary (project_id,
+                skeleton_id, reviewer_ids, num_reviewed_nodes)
+            SELECT project_id, skeleton_id, reviewer_ids, COUNT(*)
+            FROM (
+                SELECT r.project_id, r.skeleton_id, r.treenode_id,
+                    array_agg(DISTINCT r.reviewer_id ORDER BY r.reviewer_id)
+                        AS reviewer_ids
+                FROM review r
+                WHERE {review_filter}
+                GROUP BY r.project_id, r.skeleton_id, r.treenode_id
+            ) node_review
+            GROUP BY project_id, skeleton_id, reviewer_ids;
+"""
+
+whitelist_review_template = """
+            INSERT INTO catmaid_skeleton_whitelist_review (project_id,
+                user_id, skeleton_id, num_reviewed_nodes)
+            SELECT wl.project_id, wl.user_id, r.skeleton_id,
+                COUNT(DISTINCT r.treenode_id)
+            FROM review r
+            JOIN reviewer_whitelist wl
+                ON wl.project_id = r.project_id
+                AND wl.reviewer_id = r.reviewer_id
+                AND r.review_time >= wl.accept_after
+            WHERE {review_filter}
+              AND {whitelist_filter}
+            GROUP BY wl.project_id, wl.user_id, r.skeleton_id;
+"""
+
+whitelist_change_template = """
+            DELETE FROM catmaid_skeleton_whitelist_review swr
+            USING ({changed_whitelist}) cw
+            WHERE swr.project_id = cw.project_id
+              AND swr.user_id = cw.user_id;
+""" + whitelist_review_template.format(
+    review_filter="TRUE",
+    whitelist_filter="""(wl.project_id, wl.user_id) IN (
+                {changed_whitelist})""")
+
+whitelist_lock_template = """
+            PERFORM pg_advisory_xact_lock({whitelist_lock_key}, p.id)
+            FROM (
+                SELECT DISTINCT project_id
+                FROM ({changed_whitelist}) cw
+                ORDER BY project_id
+            ) p(id);
+"""
+
+changed_whitelist_queries = {
+    'INSERT': "SELECT project_id, user_id FROM new_whitelist",
+    'UPDATE': """SELECT project_id, user_id FROM new_whitelist
+                    UNION ALL
+                    SELECT project_id, user_id FROM old_whitelist""",
+    'DELETE': "SELECT project_id, user_id FROM old_whitelist",
+}
+
+
+def whitelist_function(lock):
+    def change(op):
+        sql = whitelist_change_template.format(
+                changed_whitelist=changed_whitelist_queries[op])
+        if lock:
+            sql = whitelist_lock_template.format(
+                    whitelist_lock_key=whitelist_lock_key,
+                    changed_whitelist=changed_whitelist_queries[op]) + sql
+        return sql
+
+    return """
+    CREATE OR REPLACE FUNCTION on_change_reviewer_whitelist_update_review_summary()
+    RETURNS trigger
+    LANGUAGE plpgsql AS
+    $$
+    BEGIN
+        IF TG_OP = 'INSERT' THEN
+""" + change('INSERT') + """
+        ELSIF TG_OP = 'UPDATE' THEN
+""" + change('UPDATE') + """
+        ELSIF TG_OP = 'DELETE' THEN
+""" + change('DELETE') + """
+        END IF;
+
+        RETURN NULL;
+    END;
+    $$;
+"""
+
+
+def refresh_skeleton_function(lock):
+    return """
+    CREATE OR REPLACE FUNCTION refresh_skeleton_review_summary(skeleton_ids bigint[])
+    RETURNS void
+    LANGUAGE plpgsql AS
+    $$
+""" + ("""
+    DECLARE
+        project_ids integer[];
+    BEGIN
+        SELECT array_agg(DISTINCT project_id ORDER BY project_id)
+        INTO project_ids
+        FROM catmaid_skeleton_summary
+        WHERE skeleton_id = ANY(skeleton_ids);
+
+        SELECT array_agg(DISTINCT id ORDER BY id)
+        INTO skeleton_ids
+        FROM unnest(skeleton_ids) s(id);
+""" + lock_template.format(whitelist_lock_key=whitelist_lock_key)
+    if lock else """
+    BEGIN""") + """
+        DELETE FROM catmaid_skeleton_review_summary
+        WHERE skeleton_id = ANY(skeleton_ids);
+        DELETE FROM catmaid_skeleton_whitelist_review
+        WHERE skeleton_id = ANY(skeleton_ids);
+""" + review_summary_template.format(
+        review_filter="r.skeleton_id = ANY(skeleton_ids)") \
+    + whitelist_review_template.format(
+        review_filter="r.skeleton_id = ANY(skeleton_ids)",
+        whitelist_filter="TRUE") + """
+    END;
+    $$;
+"""
+
+
+def update_review_summary(op):
+    return update_review_summary_template.format(
+            changed_review=changed_review_templates[op],
+            whitelist_lock_key=whitelist_lock_key)
+
+
+forward = """
+    -- Apply the difference of the previous and the current reviewer set of
+    -- each node with changed reviews to the review summary tables.
+    CREATE OR REPLACE FUNCTION on_change_review_update_review_summary()
+    RETURNS trigger
+    LANGUAGE plpgsql AS
+    $$
+    DECLARE
+        project_ids integer[];
+        skeleton_ids bigint[];
+    BEGIN
+        IF TG_OP = 'INSERT' THEN
+""" + update_review_summary('INSERT') + """
+        ELSIF TG_OP = 'UPDATE' THEN
+""" + update_review_summary('UPDATE') + """
+        ELSIF TG_OP = 'DELETE' THEN
+""" + update_review_summary('DELETE') + """
+        END IF;
+
+        RETURN NULL;
+    END;
+    $$;
+""" + whitelist_function(True) + refresh_skeleton_function(True)
+
+backward = """
+    CREATE OR REPLACE FUNCTION on_change_review_update_review_summary()
+    RETURNS trigger
+    LANGUAGE plpgsql AS
+    $$
+    DECLARE
+        skeleton_ids bigint[];
+    BEGIN
+        IF TG_OP = 'INSERT' THEN
+            SELECT array_agg(DISTINCT skeleton_id) INTO skeleton_ids
+            FROM new_review;
+        ELSIF TG_OP = 'UPDATE' THEN
+            SELECT array_agg(DISTINCT skeleton_id) INTO skeleton_ids
+            FROM (
+                SELECT skeleton_id FROM new_review
+                UNION ALL
+                SELECT skeleton_id FROM old_review
+            ) changed_review;
+        ELSIF TG_OP = 'DELETE' THEN
+            SELECT array_agg(DISTINCT skeleton_id) INTO skeleton_ids
+            FROM old_review;
+        END IF;
+
+        IF skeleton_ids IS NOT NULL THEN
+            PERFORM refresh_skeleton_review_summary(skeleton_ids);
+        END IF;
+
+        RETURN NULL;
+    END;
+    $$;
+""" + whitelist_function(False) + refresh_skeleton_function(False)
+
+
+class Migration(migrations.Migration):
+    """Update the review summary tables incrementally. Instead of rebuilding
+    the summary of each skeleton with changed reviews, the review triggers
+    only move changed nodes from the group of their previous reviewer set to
+    the group of their current one and write the difference with INSERT ...
+    ON CONFLICT DO UPDATE. Advisory locks on changed skeletons and on the
+    whitelist of their projects serialize concurrent writers, which otherwise
+    could compute their differences from each other's uncommitted state or
+    fail with unique violations.
+    """
+
+    dependencies = [
+        ('catmaid', '0054_add_cache_version_table'),
+    ]
+
+    operations = [
+        migrations.RunSQL(forward, backward)
+    ]
@@ -0,0 +1,139 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations
+
+
+forward = """
+    -- Record the 3D bounding box of all treenodes whose radius, confidence,
+    -- user or edition time changed in an update that didn't change their
+    -- location, parent or skeleton. Those updates don't change any edge and
+    -- are therefore not seen by the edge triggers. A node is part of all node
+    -- query results that include its own edge or the edge of one of its
+    -- children, which is why the box of all these edges is recorded.
+    CREATE FUNCTION on_edit_treenode_mark_node_query_cache_dirty() RETURNS trigger
+    LANGUAGE plpgsql AS
+    $$
+    BEGIN
+        WITH changed_node AS (
+            SELECT nt.id, nt.project_id
+            FROM old_treenode ot
+            JOIN new_treenode nt
+                ON nt.id = ot.id
+            WHERE ot.location_x = nt.location_x
+              AND ot.location_y = nt.location_y
+              AND ot.location_z = nt.location_z
+              AND ot.parent_id IS NOT DISTINCT FROM nt.parent_id
+              AND ot.skeleton_id = nt.skeleton_id
+              AND (ot.radius != nt.radius
+                OR ot.confidence != nt.confidence
+                OR ot.user_id != nt.user_id
+                OR ot.edition_time != nt.edition_time)
+        ), changed_edge AS (
+            SELECT cn.project_id, e.edge
+            FROM changed_node cn
+            JOIN treenode_edge e
+                ON e.id = cn.id
+            UNION ALL
+            SELECT cn.project_id, e.edge
+            FROM changed_node cn
+            JOIN treenode c
+                ON c.parent_id = cn.id
+            JOIN treenode_edge e
+                ON e.id = c.id
+        ), changed_box AS (
+            SELECT g.project_id, ST_3DExtent(g.edge) AS box
+            FROM changed_edge g
+            GROUP BY g.project_id
+        )
+        INSERT INTO node_query_cache_dirty_section (project_id, min_x,
+            min_y, min_z, max_x, max_y, max_z)
+        SELECT b.project_id, ST_XMin(b.box), ST_YMin(b.box), ST_ZMin(b.box),
+            ST_XMax(b.box), ST_YMax(b.box), ST_ZMax(b.box)
+        FROM changed_box b
+        WHERE is_node_query_cache_tracked(b.project_id);
+
+        RETURN NULL;
+    END;
+    $$;
+
+    -- Record the 3D bounding box of all connectors whose confidence, user or
+    -- edition time changed in an update that didn't change their location,
+    -- along with the edges of their links.
+    CREATE FUNCTION on_edit_connector_mark_node_query_cache_dirty() RETURNS trigger
+    LANGUAGE plpgsql AS
+    $$
+    BEGIN
+        WITH changed_connector AS (
+            SELECT nc.id, nc.project_id
+            FROM old_connector oc
+            JOIN new_connector nc
+                ON nc.id = oc.id
+            WHERE oc.location_x = nc.location_x
+              AND oc.location_y = nc.location_y
+              AND oc.location_z = nc.location_z
+              AND (oc.confidence != nc.confidence
+                OR oc.user_id != nc.user_id
+                OR oc.edition_time != nc.edition_time)
+        ), changed_geom AS (
+            SELECT cc.project_id, g.geom
+            FROM changed_connector cc
+            JOIN connector_geom g
+                ON g.id = cc.id
+            UNION ALL
+            SELECT cc.project_id, e.edge
+            FROM changed_connector cc
+            JOIN treenode_connector tc
+                ON tc.connector_id = cc.id
+            JOIN treenode_connector_edge e
+                ON e.id = tc.id
+        ), changed_box AS (
+            SELECT g.project_id, ST_3DExtent(g.geom) AS box
+            FROM changed_geom g
+            GROUP BY g.project_id
+        )
+        INSERT INTO node_query_cache_dirty_section (project_id, min_x,
+            min_y, min_z, max_x, max_y, max_z)
+        SELECT b.project_id, ST_XMin(b.box), ST_YMin(b.box), ST_ZMin(b.box),
+            ST_XMax(b.box), ST_YMax(b.box), ST_ZMax(b.box)
+        FROM changed_box b
+        WHERE is_node_query_cache_tracked(b.project_id);
+
+        RETURN NULL;
+    END;
+    $$;
+
+    CREATE TRIGGER on_edit_treenode_mark_node_query_cache_dirty
+    AFTER UPDATE ON treenode
+    REFERENCING NEW TABLE AS new_treenode OLD TABLE AS old_treenode
+    FOR EACH STATEMENT EXECUTE PROCEDURE on_edit_treenode_mark_node_query_cache_dirty();
+
+    CREATE TRIGGER on_edit_connector_mark_node_query_cache_dirty
+    AFTER UPDATE ON connector
+    REFERENCING NEW TABLE AS new_connector OLD TABLE AS old_connector
+    FOR EACH STATEMENT EXECUTE PROCEDURE on_edit_connector_mark_node_query_cache_dirty();
+"""
+
+backward = """
+    DROP TRIGGER on_edit_treenode_mark_node_query_cache_dirty ON treenode;
+    DROP TRIGGER on_edit_connector_mark_node_query_cache_dirty ON connector;
+
+    DROP FUNCTION on_edit_treenode_mark_node_query_cache_dirty();
+    DROP FUNCTION on_edit_connector_mark_node_query_cache_dirty();
+"""
+
+
+class Migration(migrations.Migration):
+    """Mark node query cache sections and cached node query results as dirty
+    if the radius, confidence, user or edition time of treenodes and
+    connectors change. Such updates don't change edges or connector geometries
+    and were therefore missed by the existing dirty section triggers.
+    """
+
+    dependencies = [
+        ('catmaid', '0055_update_review_summary_incrementally'),
+    ]
+
+    operations = [
+        migrations.RunSQL(forward, backward)
+    ]
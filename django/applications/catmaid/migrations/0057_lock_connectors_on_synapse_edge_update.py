@@ -0,0 +1,153 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations
+
+
+# Count all synapses between the skeletons of the links in changed_link and all
+# other links of the same connectors. Each pair of a presynaptic_to and a
+# postsynaptic_to link of the same connector is one synapse, its confidence is
+# the minimum of both link confidences. The unchanged links of affected
+# connectors are read from the treenode_connector table, which doesn't contain
+# changed links anymore after a delete and contains their new version after an
+# insert or update. Pairs of two changed links are counted only once.
+synapse_delta_template = """
+            WITH changed_link AS (
+                {changed_link}
+            ), unchanged_link AS (
+                SELECT tc.id, tc.project_id, tc.skeleton_id, tc.connector_id,
+                    tc.relation_id, tc.confidence
+                FROM treenode_connector tc
+                WHERE tc.connector_id IN (SELECT connector_id FROM changed_link)
+                  AND NOT EXISTS (
+                    SELECT 1 FROM changed_link cl
+                    WHERE cl.id = tc.id
+                  )
+            ), link AS (
+                SELECT cl.*, TRUE AS changed FROM changed_link cl
+                UNION ALL
+                SELECT ul.*, FALSE AS changed FROM unchanged_link ul
+            ), synapse_delta AS (
+                SELECT pre.project_id, pre.skeleton_id AS pre_skeleton_id,
+                    post.skeleton_id AS post_skeleton_id,
+                    LEAST(pre.confidence, post.confidence) AS confidence,
+                    COUNT(*) AS n_synapses
+                FROM link pre
+                JOIN relation pre_r
+                    ON pre_r.id = pre.relation_id
+                JOIN link post
+                    ON post.connector_id = pre.connector_id
+                JOIN relation post_r
+                    ON post_r.id = post.relation_id
+                WHERE (pre.changed OR post.changed)
+                  AND pre_r.relation_name = 'presynaptic_to'
+                  AND post_r.relation_name = 'postsynaptic_to'
+                GROUP BY pre.project_id, pre.skeleton_id, post.skeleton_id,
+                    LEAST(pre.confidence, post.confidence)
+            )"""
+
+subtract_template = synapse_delta_template + """
+            UPDATE catmaid_skeleton_synapse_edge e
+            SET n_synapses = e.n_synapses - d.n_synapses
+            FROM synapse_delta d
+            WHERE e.pre_skeleton_id = d.pre_skeleton_id
+              AND e.post_skeleton_id = d.post_skeleton_id
+              AND e.confidence = d.confidence;
+
+            DELETE FROM catmaid_skeleton_synapse_edge
+            WHERE n_synapses < 1;
+"""
+
+add_template = synapse_delta_template + """
+            INSERT INTO catmaid_skeleton_synapse_edge (project_id,
+                pre_skeleton_id, post_skeleton_id, confidence, n_synapses)
+            SELECT d.project_id, d.pre_skeleton_id, d.post_skeleton_id,
+                d.confidence, d.n_synapses
+            FROM synapse_delta d
+            ORDER BY d.pre_skeleton_id, d.post_skeleton_id, d.confidence
+            ON CONFLICT (pre_skeleton_id, post_skeleton_id, confidence) DO UPDATE
+            SET n_synapses = catmaid_skeleton_synapse_edge.n_synapses + EXCLUDED.n_synapses;
+"""
+
+# Without a lock, two transactions that link the same connector at the same
+# time don't see each other's links and both miss the synapse between them.
+# The affected connectors are therefore locked in ID order first, which makes
+# concurrent link changes of the same connectors wait for each other. Since
+# the delta is computed in a later statement, it sees all links committed in
+# the meantime. Row locks are used rather than advisory locks, because
+# connector IDs would share the advisory lock key space with the skeleton IDs
+# locked by the review summary triggers. FOR NO KEY UPDATE doesn't conflict
+# with the foreign key checks of new links.
+lock_template = """
+            PERFORM 1
+            FROM connector c
+            WHERE c.id IN ({connector_ids})
+            ORDER BY c.id
+            FOR NO KEY UPDATE OF c;
+"""
+
+link_columns = "id, project_id, skeleton_id, connector_id, relation_id, confidence"
+
+# Only updates that change the skeleton, connector, relation or confidence of
+# a link need to be looked at.
+changed_link_template = """
+                SELECT {prefix}.id, {prefix}.project_id, {prefix}.skeleton_id,
+                    {prefix}.connector_id, {prefix}.relation_id, {prefix}.confidence
+                FROM old_link ol
+                JOIN new_link nl
+                    ON nl.id = ol.id
+                WHERE ol.skeleton_id != nl.skeleton_id
+                   OR ol.connector_id != nl.connector_id
+                   OR ol.relation_id != nl.relation_id
+                   OR ol.confidence != nl.confidence"""
+
+
+def get_trigger_function(lock):
+    """Return the definition of the synapse edge trigger function, optionally
+    with connector locks.
+    """
+    def get_lock(connector_ids):
+        return lock_template.format(connector_ids=connector_ids) if lock else ''
+
+    return """
+    CREATE OR REPLACE FUNCTION on_change_treenode_connector_update_synapse_edges() RETURNS trigger
+    LANGUAGE plpgsql AS
+    $$
+    BEGIN
+        IF TG_OP = 'INSERT' THEN
+""" + get_lock("SELECT connector_id FROM new_link") \
+    + add_template.format(changed_link="SELECT {} FROM new_link".format(link_columns)) + """
+        ELSIF TG_OP = 'UPDATE' THEN
+""" + get_lock("SELECT connector_id FROM old_link UNION SELECT connector_id FROM new_link") \
+    + subtract_template.format(changed_link=changed_link_template.format(prefix='ol')) \
+    + add_template.format(changed_link=changed_link_template.format(prefix='nl')) + """
+        ELSIF TG_OP = 'DELETE' THEN
+""" + get_lock("SELECT connector_id FROM old_link") \
+    + subtract_template.format(changed_link="SELECT {} FROM old_link".format(link_columns)) + """
+        END IF;
+
+        RETURN NULL;
+    END;
+    $$;
+"""
+
+
+forward = get_trigger_function(lock=True)
+
+backward = get_trigger_function(lock=False)
+
+
+class Migration(migrations.Migration):
+    """Lock the connectors of changed links before the synapse edge table is
+    updated. Otherwise concurrent transactions that link the same connector
+    can miss synapses between their links, which lets the synapse counts drift
+    from the treenode_connector table.
+    """
+
+    dependencies = [
+        ('catmaid', '0056_mark_node_query_cache_dirty_on_node_edits'),
+    ]
+
+    operations = [
+        migrations.RunSQL(forward, backward)
+    ]
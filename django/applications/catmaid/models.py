@@ -12,7 +12,7 @@ from django import forms
 from django.conf import settings
 from django.contrib.auth.models import User, Group
 from django.contrib.gis.db import models as spatial_models
-from django.contrib.postgres.fields import JSONField
+from django.contrib.postgres.fields import ArrayField, JSONField
 from django.core.validators import RegexValidator
 from django.db import connection, models
 from django.db.models import Q
@@ -1191,6 +1191,98 @@ class StatsSummary(models.Model):
         return "Stats summary for {} on {}".format(
                     self.user, self.date)
 
+@python_2_unicode_compatible
+class SkeletonSynapseEdge(models.Model):
+    """Holds the number of synapses from one skeleton to another, for each
+    synapse confidence. The confidence of a synapse is the minimum confidence
+    of its presynaptic and postsynaptic link. Data insertion and updates are
+    managed by the database through triggers on the treenode_connector table.
+    """
+
+    class Meta:
+        db_table = "catmaid_skeleton_synapse_edge"
+        unique_together = (("pre_skeleton_id", "post_skeleton_id", "confidence"),)
+
+    id = models.BigAutoField(primary_key=True)
+    project = models.ForeignKey(Project, on_delete=models.CASCADE)
+    pre_skeleton_id = models.BigIntegerField()
+    post_skeleton_id = models.BigIntegerField()
+    confidence = models.IntegerField()
+    n_synapses = models.IntegerField()
+
+    def __str__(self):
+        return "{} synapses from skeleton {} to {} (confidence {})".format(
+                self.n_synapses, self.pre_skeleton_id, self.post_skeleton_id,
+                self.confidence)
+
+
+@python_2_unicode_compatible
+class AnnotationClosure(models.Model):
+    """Links each annotation to all annotations that are transitively annotated
+    with it, i.e. its sub-annotations. Data insertion and updates are managed
+    by the database through triggers on the class_instance_class_instance
+    table.
+    """
+
+    class Meta:
+        db_table = "catmaid_annotation_closure"
+        unique_together = (("ancestor_id", "descendant_id"),)
+
+    id = models.BigAutoField(primary_key=True)
+    project = models.ForeignKey(Project, on_delete=models.CASCADE)
+    ancestor_id = models.BigIntegerField()
+    descendant_id = models.BigIntegerField()
+
+    def __str__(self):
+        return "Annotation {} is a sub-annotation of {}".format(
+                self.descendant_id, self.ancestor_id)
+
+
+@python_2_unicode_compatible
+class SkeletonReviewSummary(models.Model):
+    """Counts the reviewed treenodes of a skeleton by the set of users who
+    reviewed them, i.e. each reviewed node is counted exactly once. Data
+    insertion and updates are managed by the database through triggers on the
+    review table.
+    """
+
+    class Meta:
+        db_table = "catmaid_skeleton_review_summary"
+        unique_together = (("skeleton_id", "reviewer_ids"),)
+
+    id = models.BigAutoField(primary_key=True)
+    project = models.ForeignKey(Project, on_delete=models.CASCADE)
+    skeleton_id = models.BigIntegerField()
+    reviewer_ids = ArrayField(models.IntegerField())
+    num_reviewed_nodes = models.IntegerField()
+
+    def __str__(self):
+        return "{} nodes of skeleton {} reviewed by users {}".format(
+                self.num_reviewed_nodes, self.skeleton_id,
+                ", ".join(str(r) for r in self.reviewer_ids))
+
+
+@python_2_unicode_compatible
+class SkeletonWhitelistReview(models.Model):
+    """Counts the reviewed treenodes of a skeleton that are accepted by the
+    reviewer whitelist of a user. Data insertion and updates are managed by the
+    database through triggers on the review and reviewer_whitelist tables.
+    """
+
+    class Meta:
+        db_table = "catmaid_skeleton_whitelist_review"
+        unique_together = (("project", "user", "skeleton_id"),)
+
+    id = models.BigAutoField(primary_key=True)
+    project = models.ForeignKey(Project, on_delete=models.CASCADE)
+    user = models.ForeignKey(User, on_delete=models.CASCADE)
+    skeleton_id = models.BigIntegerField()
+    num_reviewed_nodes = models.IntegerField()
+
+    def __str__(self):
+        return "{} nodes of skeleton {} reviewed by whitelist of user {}".format(
+                self.num_reviewed_nodes, self.skeleton_id, self.user_id)
+
 class NodeQueryCache(models.Model):
     project = models.ForeignKey(Project, on_delete=models.CASCADE)
     orientation = models.IntegerField(default=0, null=False)
@@ -1199,12 +1291,43 @@ class NodeQueryCache(models.Model):
     json_data = JSONField(blank=True, null=True)
     json_text_data = models.TextField(blank=True, null=True)
     msgpack_data = models.BinaryField(null=True)
+    columnar_data = models.BinaryField(null=True)
 
     class Meta:
         db_table = "node_query_cache"
         unique_together = (('project', 'orientation', 'depth'),)
 
 
+class NodeGridCache(models.Model):
+    project = models.ForeignKey(Project, on_delete=models.CASCADE)
+    orientation = models.IntegerField(default=0, null=False)
+    cell_width = models.FloatField()
+    cell_height = models.FloatField()
+    cell_depth = models.FloatField()
+    update_time = models.DateTimeField(default=timezone.now)
+
+    class Meta:
+        db_table = "node_grid_cache"
+        unique_together = (('project', 'orientation', 'cell_width',
+                'cell_height', 'cell_depth'),)
+
+
+class NodeGridCacheCell(models.Model):
+    id = models.BigAutoField(primary_key=True)
+    grid = models.ForeignKey(NodeGridCache, on_delete=models.CASCADE)
+    x_index = models.IntegerField()
+    y_index = models.IntegerField()
+    z_index = models.IntegerField()
+    update_time = models.DateTimeField(default=timezone.now)
+    json_data = JSONField(blank=True, null=True)
+    msgpack_data = models.BinaryField(null=True)
+    columnar_data = models.BinaryField(null=True)
+
+    class Meta:
+        db_table = "node_grid_cache_cell"
+        unique_together = (('grid', 'z_index', 'y_index', 'x_index'),)
+
+
 @python_2_unicode_compatible
 class UserProfile(models.Model):
     """ A class that stores a set of custom user preferences.
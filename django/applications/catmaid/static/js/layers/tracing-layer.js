@@ -198,10 +198,11 @@
       options: [
         ['json', 'JSON'],
         ['msgpack', 'Msgpack'],
+        ['columnar', 'Columnar'],
         ['gif', 'GIF image'],
         ['png', 'PNG image']
       ],
-      help: 'Transferring tracing data as msgpack or image can reduce its size and loading time. Image data doesn\'t allow much interaction.'
+      help: 'Transferring tracing data as msgpack, columnar arrays or image can reduce its size and loading time. Image data doesn\'t allow much interaction.'
     }, {
       name: 'nLargestSkeletonsLimit',
       displayName: 'Limit to N largest skeletons',
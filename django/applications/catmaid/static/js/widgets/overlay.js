@@ -730,7 +730,7 @@ SkeletonAnnotations.TracingOverlay = function(stackViewer, pixiLayer, options) {
   /** Current connector selection menu, if any */
   this.connectorTypeMenu = null;
   /** Transfer data as msgpack by default.
-   * Options: 'json', 'msgpack', 'gif', 'png' */
+   * Options: 'json', 'msgpack', 'columnar', 'gif', 'png' */
   this.transferFormat = SkeletonAnnotations.TracingOverlay.Settings.session.transfer_mode;
   /** Limit the requested skeletons to the N largest in terms of cable length */
   this.nLargestSkeletonsLimit = SkeletonAnnotations.TracingOverlay.Settings.session.n_largest_skeletons_limit;
@@ -2481,6 +2481,77 @@ CATMAID.createVirtualNode = function(graphics, child, parent, stackViewer) {
   return vn;
 };
 
+/**
+ * Typed array types for the column types of the columnar node data format.
+ */
+SkeletonAnnotations.TracingOverlay.COLUMNAR_TYPES = {
+  'uint8': Uint8Array,
+  'int32': Int32Array,
+  'uint32': Uint32Array,
+  'float32': Float32Array,
+  'float64': Float64Array
+};
+
+/**
+ * Read the passed in columns of a table in the columnar node data format as
+ * typed arrays. Column data is copied into a new buffer, because typed arrays
+ * require aligned offsets.
+ */
+SkeletonAnnotations.TracingOverlay.readColumnarTable = function(table, columns) {
+  let types = SkeletonAnnotations.TracingOverlay.COLUMNAR_TYPES;
+  return columns.map(function(name) {
+    let column = table.columns[name];
+    let Type = types[column[0]];
+    if (!Type) {
+      throw new CATMAID.ValueError("Unknown column type: " + column[0]);
+    }
+    let bytes = column[1];
+    return new Type(bytes.buffer.slice(bytes.byteOffset,
+        bytes.byteOffset + bytes.byteLength));
+  });
+};
+
+/**
+ * Convert a decoded node list in the columnar format into the regular node list
+ * tuple format.
+ */
+SkeletonAnnotations.TracingOverlay.fromColumnarNodeList = function(data) {
+  let read = SkeletonAnnotations.TracingOverlay.readColumnarTable;
+  let toTuples = function(result) {
+    let tn = read(result.treenodes, ['id', 'parent_id', 'x', 'y', 'z',
+        'confidence', 'radius', 'skeleton_id', 'edition_time', 'user_id']);
+    let treenodes = new Array(result.treenodes.n);
+    for (let i=0; i<treenodes.length; ++i) {
+      let parentId = tn[1][i];
+      treenodes[i] = [tn[0][i], parentId === -1 ? null : parentId, tn[2][i],
+          tn[3][i], tn[4][i], tn[5][i], tn[6][i], tn[7][i], tn[8][i], tn[9][i]];
+    }
+
+    let c = read(result.connectors, ['id', 'x', 'y', 'z', 'confidence',
+        'edition_time', 'user_id']);
+    let connectors = new Array(result.connectors.n);
+    for (let i=0; i<connectors.length; ++i) {
+      connectors[i] = [c[0][i], c[1][i], c[2][i], c[3][i], c[4][i], c[5][i],
+          c[6][i], []];
+    }
+
+    let l = read(result.links, ['connector_index', 'treenode_id',
+        'relation_id', 'confidence', 'edition_time', 'id']);
+    for (let i=0, max=result.links.n; i<max; ++i) {
+      connectors[l[0][i]][7].push([l[1][i], l[2][i], l[3][i], l[4][i], l[5][i]]);
+    }
+
+    return [treenodes, connectors, result.labels, result.limit_reached,
+        result.relation_map];
+  };
+
+  let tuples = toTuples(data);
+  if (data.extra && data.extra.length > 0) {
+    tuples.push(data.extra.map(toTuples));
+  }
+  return tuples;
+};
+
 /**
  * Recreate all nodes (or reuse existing ones if possible).
  *
@@ -3368,7 +3439,8 @@ SkeletonAnnotations.TracingOverlay.prototype.updateNodes = function (callback,
     self.old_height = stackViewer.viewHeight;
 
     // As regular transfer is considered what transfers vector data.
-    var regularTransfer = self.transferFormat == 'json' || self.transferFormat == 'msgpack';
+    var regularTransfer = self.transferFormat == 'json' ||
+        self.transferFormat == 'msgpack' || self.transferFormat == 'columnar';
 
     // No padding for image data
     var padding = regularTransfer ? self.padding : 0;
@@ -3487,6 +3559,9 @@ SkeletonAnnotations.TracingOverlay.prototype.updateNodes = function (callback,
           function(data, dataSize) {
             if (transferFormat === 'msgpack') {
               data = msgpack.decode(new Uint8Array(data));
+            } else if (transferFormat === 'columnar') {
+              data = SkeletonAnnotations.TracingOverlay.fromColumnarNodeList(
+                  msgpack.decode(new Uint8Array(data)));
             } else if (transferFormat === 'png' || transferFormat == 'gif') {
               data = new Uint8Array(data);
             } else {
@@ -989,6 +989,7 @@
           {
             'JSON': 'json',
             'Msgpack': 'msgpack',
+            'Columnar': 'columnar',
             'GIF image': 'gif',
             'PNG image': 'png'
           },
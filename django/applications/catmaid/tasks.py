@@ -31,5 +31,5 @@ def update_node_query_cache():
     """Update the query cache of changed sections for node providers defined in
     the NODE_PROVIDERS settings variable.
     """
-    do_update_node_query_cache()
+    do_update_node_query_cache(incremental=True)
     return "Updating node query cache"
@@ -2,9 +2,11 @@
 from __future__ import unicode_literals
 
 import json
+import mock
 import six
 
 from django.db import connection
+from django.test.utils import override_settings
 
 from catmaid.models import Connector, Treenode
 from catmaid.state import make_nocheck_state
@@ -91,6 +93,52 @@ class NodesApiTests(CatmaidApiTestCase):
         self.assertEqual(expected_result, parsed_response)
 
 
+    def test_node_nearest_in_project(self):
+        self.fake_authentication()
+        response = self.client.post(
+                '/%d/node/nearest' % self.test_project_id,
+                {
+                    'x': 5115,
+                    'y': 3835,
+                    'z': 0,
+                    })
+        self.assertEqual(response.status_code, 200)
+        parsed_response = json.loads(response.content.decode('utf-8'))
+        expected_result = {
+                "treenode_id": 2437,
+                "x": 5290,
+                "y": 3930,
+                "z": 279,
+                "skeleton_id": 2433}
+        self.assertEqual(expected_result, parsed_response)
+
+        response = self.client.post(
+                '/%d/node/nearest' % self.test_project_id,
+                {
+                    'x': 5115,
+                    'y': 3835,
+                    'z': 0,
+                    'limit': 2,
+                    'offset': 1,
+                    })
+        self.assertEqual(response.status_code, 200)
+        parsed_response = json.loads(response.content.decode('utf-8'))
+        expected_result = [{
+                "treenode_id": 417,
+                "x": 4990,
+                "y": 4200,
+                "z": 0,
+                "skeleton_id": 235
+            }, {
+                "treenode_id": 2447,
+                "x": 4910,
+                "y": 3260,
+                "z": 180,
+                "skeleton_id": 2440
+            }]
+        self.assertEqual(expected_result, parsed_response)
+
+
     def test_node_user_info(self):
         self.fake_authentication()
 
@@ -519,3 +567,253 @@ class NodesApiTests(CatmaidApiTestCase):
         self.assertEqual({}, parsed_response[2])
         self.assertEqual(False, parsed_response[3])
         self.assertEqual(expected_rel_response, parsed_response[4])
+
+
+    def test_node_list_columnar(self):
+        from catmaid.control.node import decode_columnar_node_data
+
+        self.fake_authentication()
+        params = {
+            'z1': 0,
+            'top': 4625,
+            'left': 2860,
+            'right': 12625,
+            'bottom': 8075,
+            'z2': 9,
+        }
+        response = self.client.post('/%d/node/list' % (self.test_project_id,), params)
+        self.assertEqual(response.status_code, 200)
+        expected_response = json.loads(response.content.decode('utf-8'))
+
+        params['format'] = 'columnar'
+        response = self.client.post('/%d/node/list' % (self.test_project_id,), params)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual('application/octet-stream', response['Content-Type'])
+        parsed_response = decode_columnar_node_data(response.content)
+
+        # Coordinates of the test data can be represented exactly with 32 bit
+        # floats.
+        six.assertCountEqual(self, expected_response[0], parsed_response[0])
+        self.assertEqual(len(expected_response[1]), len(parsed_response[1]))
+        for c in expected_response[1]:
+            c[7] = sorted(c[7])
+        for c in parsed_response[1]:
+            c[7] = sorted(c[7])
+        six.assertCountEqual(self, expected_response[1], parsed_response[1])
+        self.assertEqual(expected_response[3], parsed_response[3])
+
+    def test_node_list_png(self):
+        from io import BytesIO
+        from PIL import Image
+
+        self.fake_authentication()
+        response = self.client.post('/%d/node/list' % (self.test_project_id,), {
+            'z1': 0,
+            'top': 4625,
+            'left': 2860,
+            'right': 12625,
+            'bottom': 8075,
+            'z2': 9,
+            'format': 'png',
+            'view_width': 200,
+            'view_height': 100,
+        })
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual('image/png', response['Content-Type'])
+
+        image = Image.open(BytesIO(response.content))
+        self.assertEqual((200, 100), image.size)
+        # Treenode 2374 at (3310, 5190) is drawn at pixel (9, 16), the
+        # background stays transparent.
+        self.assertEqual((255, 0, 255, 255), image.getpixel((9, 16)))
+        self.assertTrue(any(p[3] == 0 for p in image.getdata()))
+
+    def test_render_nodes_level_of_detail(self):
+        from catmaid.control.node import render_nodes_xy
+
+        params = {'left': -100, 'right': 200, 'top': 0, 'bottom': 100,
+                'z1': 0, 'z2': 10}
+        # A child node and its root in the same square of 10 pixels, and a
+        # node left of the image, which must not hide a node of the row above.
+        node_data = [[
+            [1, 2, 5, 5, 0],
+            [2, None, 6, 5, 0],
+            [3, None, -1, 25, 0],
+            [4, None, 102, 15, 0],
+        ]]
+        image = render_nodes_xy(node_data, params, 105, 100, lod=10)
+
+        # The root is drawn instead of its child
+        self.assertEqual((255, 0, 0, 255), image.getpixel((6, 5)))
+        self.assertEqual((255, 0, 0, 0), image.getpixel((3, 5)))
+        # Node 4 is in a different square than node 3
+        self.assertEqual((255, 0, 0, 255), image.getpixel((102, 15)))
+
+    def test_render_nodes_cut_skeleton(self):
+        from catmaid.control.node import render_nodes_xy
+
+        params = {'left': 0, 'right': 100, 'top': 0, 'bottom': 100,
+                'z1': 0, 'z2': 10}
+        # The parents of nodes 1 and 2 are outside of the bounding box and
+        # not part of the data. Node 2 shares a square of 10 pixels with root
+        # node 3.
+        node_data = [[
+            [1, 10, 50, 55, 0],
+            [2, 11, 70, 75, 0],
+            [3, None, 72, 75, 0],
+        ]]
+        image = render_nodes_xy(node_data, params, 100, 100, lod=10)
+
+        # Node 1 isn't drawn as a root
+        self.assertEqual((255, 0, 255, 255), image.getpixel((50, 55)))
+        # Root node 3 is drawn instead of node 2
+        self.assertEqual((255, 0, 0, 0), image.getpixel((68, 75)))
+        self.assertEqual((255, 0, 0, 255), image.getpixel((74, 75)))
+
+    def test_node_provider_selector(self):
+        from catmaid.control.node import NodeProviderSelector
+
+        class FakeProvider(object):
+            def __init__(self, config_key):
+                self.config_key = config_key
+
+        slow, fast = FakeProvider('0:slow'), FakeProvider('1:fast')
+        selector = NodeProviderSelector(min_samples=2, exploration_rate=0)
+        params = {
+            'project_id': self.test_project_id,
+            'orientation': 'xy',
+            'left': 0,
+            'right': 1000,
+            'top': 0,
+            'bottom': 1000,
+        }
+
+        # Without enough samples, node providers are tried in configured order.
+        self.assertEqual([slow, fast], selector.order([slow, fast], params))
+        for i in range(2):
+            selector.record(params, slow, 1.0)
+        self.assertEqual([fast, slow], selector.order([slow, fast], params))
+        for i in range(2):
+            selector.record(params, fast, 0.1)
+
+        # With enough samples, the fastest node provider is asked first.
+        self.assertEqual([fast, slow], selector.order([slow, fast], params))
+
+        # Other size classes are independent
+        large_params = dict(params, right=100000, bottom=100000)
+        self.assertEqual([slow, fast], selector.order([slow, fast], large_params))
+
+        stats = selector.stats()
+        self.assertEqual(2, len(stats))
+        self.assertEqual(set(['0:slow', '1:fast']), set(s['provider'] for s in stats))
+
+    def test_node_list_result_cache(self):
+        from django.http import HttpResponse
+        from catmaid.control.node import NodeListResultCache
+
+        cursor = connection.cursor()
+        cache = NodeListResultCache(1024 * 1024, 600)
+        cache.enable_tracking(self.test_project_id, cursor)
+
+        params = {
+            'project_id': self.test_project_id,
+            'z1': 0,
+            'top': 4625,
+            'left': 2860,
+            'right': 12625,
+            'bottom': 8075,
+            'z2': 9,
+        }
+        query_time = cache.get_query_time(cursor)
+        cache.set('test', HttpResponse(b'[]', content_type='application/json'),
+                query_time)
+
+        entry = cache.get('test', params, [], cursor)
+        self.assertEqual(b'[]', entry['content'])
+        self.assertEqual('application/json', entry['content_type'])
+
+        # Changing a node in the bounding box of the cached result, makes it
+        # outdated.
+        cursor.execute("""
+            UPDATE treenode SET location_x = location_x + 10
+            WHERE id = 2465
+        """)
+        self.assertEqual(None, cache.get('test', params, [], cursor))
+
+        # Non-spatial changes make cached results outdated, too.
+        query_time = cache.get_query_time(cursor)
+        cache.set('test', HttpResponse(b'[]', content_type='application/json'),
+                query_time)
+        cursor.execute("""
+            UPDATE treenode SET radius = 42
+            WHERE id = 2465
+        """)
+        self.assertEqual(None, cache.get('test', params, [], cursor))
+
+        stats = cache.stats()
+        self.assertEqual(1, stats['hits'])
+        self.assertEqual(2, stats['misses'])
+        self.assertEqual(0, stats['entries'])
+
+        # Queries that reached the node limit are remembered without content
+        cache.set_limit_reached('limit', cache.get_query_time(cursor))
+        entry = cache.get('limit', params, [], cursor)
+        self.assertTrue(entry['limit_reached'])
+        self.assertEqual(b'', entry['content'])
+
+    def test_node_list_result_cache_node_limit(self):
+        from catmaid.control import node
+
+        def reset_result_cache():
+            node._node_list_result_cache = None
+        reset_result_cache()
+        self.addCleanup(reset_result_cache)
+
+        self.fake_authentication()
+        # A small bounding box around treenode 2374, its quantized version
+        # contains more nodes than the node limit allows.
+        params = {
+            'z1': 0,
+            'top': 5180,
+            'left': 3300,
+            'right': 3320,
+            'bottom': 5200,
+            'z2': 9,
+        }
+        url = '/%d/node/list' % (self.test_project_id,)
+        with override_settings(NODE_LIST_MAXIMUM_COUNT=5):
+            with override_settings(NODE_LIST_RESULT_CACHE_SIZE=0):
+                expected_response = json.loads(
+                        self.client.post(url, params).content.decode('utf-8'))
+            with override_settings(NODE_LIST_RESULT_CACHE_SIZE=1024 * 1024,
+                    NODE_LIST_RESULT_CACHE_QUANTUM=4096):
+                # Change tracking is only relied on once the transaction that
+                # enabled it is committed, which doesn't happen in tests.
+                cache = node.get_node_list_result_cache()
+                cache.enable_tracking(self.test_project_id, connection.cursor())
+                cache.tracked_projects.add(self.test_project_id)
+
+                # The quantized bounding box reaches the node limit, which is
+                # remembered, and the requested one is queried instead.
+                with mock.patch('catmaid.control.node.query_node_list',
+                        wraps=node.query_node_list) as query_node_list:
+                    response = self.client.post(url, params)
+                self.assertEqual(response.status_code, 200)
+                queried_params = [c[0][2] for c in query_node_list.call_args_list]
+                self.assertEqual([0, 3300], [p['left'] for p in queried_params])
+                self.assertEqual([4096, 5180], [p['top'] for p in queried_params])
+                self.assertEqual(2, cache.stats()['entries'])
+
+                # Both the limit entry of the quantized bounding box and the
+                # cached result of the requested one are used.
+                with mock.patch('catmaid.control.node.query_node_list',
+                        wraps=node.query_node_list) as query_node_list:
+                    response = self.client.post(url, params)
+                self.assertEqual(response.status_code, 200)
+                self.assertFalse(query_node_list.called)
+                self.assertEqual(2, cache.stats()['hits'])
+
+                parsed_response = json.loads(response.content.decode('utf-8'))
+                six.assertCountEqual(self, expected_response[0],
+                        parsed_response[0])
+                self.assertIn(2374, [tn[0] for tn in parsed_response[0]])
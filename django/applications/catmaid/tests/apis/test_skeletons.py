@@ -2,16 +2,23 @@
 from __future__ import unicode_literals
 
 import json
+import mock
+import msgpack
 import re
 import six
 import platform
 
+from django.db import connection
 from django.shortcuts import get_object_or_404
+from django.test import TransactionTestCase, override_settings
+from django.test.client import Client
 from guardian.shortcuts import assign_perm
+from multiprocessing.pool import ThreadPool
 
+from catmaid.control import tracing
 from catmaid.models import ClassInstance, ClassInstanceClassInstance
 from catmaid.models import Log, Review, Treenode, TreenodeConnector
-from catmaid.models import ReviewerWhitelist
+from catmaid.models import ReviewerWhitelist, SkeletonSummary, Project, User
 
 from .common import CatmaidApiTestCase
 
@@ -63,7 +70,7 @@ class SkeletonsApiTests(CatmaidApiTestCase):
         orig_skeleton_id = 235
         response = self.client.get('/%d/skeleton/%d/swc' % (self.test_project_id, orig_skeleton_id))
         self.assertEqual(response.status_code, 200)
-        orig_swc_string = response.content.decode('utf-8')
+        orig_swc_string = b''.join(response.streaming_content).decode('utf-8')
 
         # Try inserting without permission and expect fail
         response = self.client.post('/%d/skeletons/import' % (self.test_project_id,),
@@ -99,6 +106,54 @@ class SkeletonsApiTests(CatmaidApiTestCase):
             self.assertEqual(max(tn.radius, 0), max(new_tn.radius, 0))
 
 
+    def test_import_skeletons(self):
+        self.fake_authentication()
+        assign_perm('can_import', self.test_user, self.test_project)
+
+        swc_files = {}
+        for skeleton_id in (235, 373):
+            response = self.client.get('/%d/skeleton/%d/swc' % (self.test_project_id, skeleton_id))
+            self.assertEqual(response.status_code, 200)
+            swc_files[skeleton_id] = b''.join(response.streaming_content).decode('utf-8')
+
+        response = self.client.post('/%d/skeletons/import-many' % (self.test_project_id,), {
+            'skeleton-235.swc': StringIO(swc_files[235]),
+            'skeleton-373.swc': StringIO(swc_files[373]),
+            'with_node_id_map': 'true',
+        })
+        self.assertEqual(response.status_code, 200)
+        parsed_response = json.loads(response.content.decode('utf-8'))
+        imported = dict((s['file'], s) for s in parsed_response['skeletons'])
+        self.assertEqual(2, len(imported))
+
+        for orig_skeleton_id in (235, 373):
+            info = imported['skeleton-%s.swc' % orig_skeleton_id]
+            neuron = ClassInstance.objects.get(id=info['neuron_id'])
+            self.assertEqual('skeleton-%s' % orig_skeleton_id, neuron.name)
+            model_rel = ClassInstanceClassInstance.objects.get(
+                    class_instance_a=info['skeleton_id'],
+                    relation__relation_name='model_of')
+            self.assertEqual(neuron.id, model_rel.class_instance_b_id)
+
+            orig_nodes = Treenode.objects.filter(skeleton_id=orig_skeleton_id)
+            self.assertEqual(orig_nodes.count(), info['n_nodes'])
+            id_map = info['node_id_map']
+            for tn in orig_nodes:
+                new_tn = Treenode.objects.get(id=id_map[str(tn.id)])
+                self.assertEqual(info['skeleton_id'], new_tn.skeleton_id)
+                if tn.parent_id:
+                    self.assertEqual(id_map[str(tn.parent_id)], new_tn.parent_id)
+                else:
+                    self.assertIsNone(new_tn.parent_id)
+                self.assertEqual(tn.location_x, new_tn.location_x)
+                self.assertEqual(tn.location_y, new_tn.location_y)
+                self.assertEqual(tn.location_z, new_tn.location_z)
+
+            # Edges and summaries are maintained
+            summary = SkeletonSummary.objects.get(skeleton_id=info['skeleton_id'])
+            self.assertEqual(info['n_nodes'], summary.num_nodes)
+
+
     def test_skeleton_contributor_statistics(self):
         self.fake_authentication()
 
@@ -403,9 +458,28 @@ class SkeletonsApiTests(CatmaidApiTestCase):
                 {'treenode_id': treenode_id, 'distance': 2000, 'size_mode': 1})
         self.assertEqual(response.status_code, 200)
         parsed_response = json.loads(response.content.decode('utf-8'))
-        expected_result = [2462, 2433, 373]
+        expected_result = [2462, 2433]
         six.assertCountEqual(self, expected_result, parsed_response['skeletons'])
 
+        # Skeletons are ordered by distance and can be paged through
+        response = self.client.post(
+                '/%d/skeletons/within-spatial-distance' % (self.test_project_id,),
+                {'treenode_id': treenode_id, 'distance': 2000, 'size_mode': 0,
+                 'limit': 2})
+        self.assertEqual(response.status_code, 200)
+        parsed_response = json.loads(response.content.decode('utf-8'))
+        self.assertEqual([2411, 2364], parsed_response['skeletons'])
+        self.assertTrue(parsed_response['reached_limit'])
+
+        response = self.client.post(
+                '/%d/skeletons/within-spatial-distance' % (self.test_project_id,),
+                {'treenode_id': treenode_id, 'distance': 2000, 'size_mode': 0,
+                 'limit': 3, 'offset': 2})
+        self.assertEqual(response.status_code, 200)
+        parsed_response = json.loads(response.content.decode('utf-8'))
+        self.assertEqual([235, 2468, 2388], parsed_response['skeletons'])
+        self.assertFalse(parsed_response['reached_limit'])
+
 
     def test_skeleton_permissions(self):
         skeleton_id = 235
@@ -1009,7 +1083,7 @@ class SkeletonsApiTests(CatmaidApiTestCase):
 241 0 1340 2660 0 0 239
 239 0 1135 2800 0 0 237
 '''
-        self.compare_swc_data(response.content.decode('utf-8'), swc_output_for_skeleton_235)
+        self.compare_swc_data(b''.join(response.streaming_content).decode('utf-8'), swc_output_for_skeleton_235)
 
 
     def test_swc_file_linearized(self):
@@ -1049,7 +1123,122 @@ class SkeletonsApiTests(CatmaidApiTestCase):
 28 0 4990 4200 0 0 27
 '''
 
-        self.compare_swc_data(response.content.decode('utf-8'), swc_output_for_skeleton_235)
+        self.compare_swc_data(b''.join(response.streaming_content).decode('utf-8'), swc_output_for_skeleton_235)
+
+
+    def test_compact_skeleton_detail_streaming(self):
+        self.fake_authentication()
+        url = '/{}/skeletons/373/compact-detail'.format(self.test_project_id)
+        params = {
+            'with_connectors': 'true',
+            'with_tags': 'true',
+            'with_reviews': 'true',
+        }
+        response = self.client.get(url, params)
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.streaming)
+        parsed_response = json.loads(b''.join(response.streaming_content).decode('utf-8'))
+        expected_response = [
+                [[377, None, 3, 7620.0, 2890.0, 0.0, -1.0, 5],
+                 [403, 377, 3, 7840.0, 2380.0, 0.0, -1.0, 5],
+                 [405, 377, 3, 7390.0, 3510.0, 0.0, -1.0, 5],
+                 [407, 405, 3, 7080.0, 3960.0, 0.0, -1.0, 5],
+                 [409, 407, 3, 6630.0, 4330.0, 0.0, -1.0, 5]],
+                [[377, 356, 1, 6730.0, 2700.0, 0.0],
+                 [409, 421, 1, 6260.0, 3990.0, 0.0]],
+                {"uncertain end": [403]},
+                [],
+                []]
+        self.assertEqual(len(parsed_response), len(expected_response))
+        six.assertCountEqual(self, parsed_response[0], expected_response[0])
+        six.assertCountEqual(self, parsed_response[1], expected_response[1])
+        self.assertEqual(parsed_response[2], expected_response[2])
+        self.assertEqual(parsed_response[3], expected_response[3])
+        self.assertEqual(parsed_response[4], expected_response[4])
+
+        # The msgpack response needs to contain the same data
+        params['format'] = 'msgpack'
+        response = self.client.get(url, params)
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.streaming)
+        unpacked_response = msgpack.unpackb(b''.join(response.streaming_content),
+                raw=False)
+        self.assertEqual(unpacked_response, parsed_response)
+
+        # Unknown skeletons are reported before anything is streamed
+        response = self.client.get('/{}/skeletons/999999/compact-detail'.format(
+                self.test_project_id))
+        self.assertEqual(response.status_code, 200)
+        parsed_response = json.loads(response.content.decode('utf-8'))
+        self.assertIn('error', parsed_response)
+
+
+    def test_compact_skeleton_detail_many(self):
+        self.fake_authentication()
+        skeleton_ids = [373, 235, 373]
+        params = {
+            'with_connectors': 'true',
+            'with_tags': 'true',
+            'with_reviews': 'true',
+            'with_annotations': 'true',
+        }
+
+        # Get the expected result from the single skeleton endpoint
+        expected_skeletons = {}
+        for skeleton_id in skeleton_ids:
+            response = self.client.get('/{}/skeletons/{}/compact-detail'.format(
+                    self.test_project_id, skeleton_id), params)
+            self.assertEqual(response.status_code, 200)
+            expected_skeletons[str(skeleton_id)] = json.loads(
+                    b''.join(response.streaming_content).decode('utf-8'))
+
+        url = '/{}/skeletons/compact-detail'.format(self.test_project_id)
+        many_params = dict(params)
+        for i, skeleton_id in enumerate(skeleton_ids):
+            many_params['skeleton_ids[{}]'.format(i)] = skeleton_id
+        response = self.client.post(url, many_params)
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.streaming)
+        parsed_response = json.loads(b''.join(response.streaming_content).decode('utf-8'))
+        self.assertEqual(['skeletons'], list(parsed_response.keys()))
+        skeletons = parsed_response['skeletons']
+        six.assertCountEqual(self, skeletons.keys(), expected_skeletons.keys())
+        for skeleton_id, expected_skeleton in six.iteritems(expected_skeletons):
+            skeleton = skeletons[skeleton_id]
+            self.assertEqual(len(skeleton), len(expected_skeleton))
+            for part, expected_part in zip(skeleton[:2], expected_skeleton[:2]):
+                six.assertCountEqual(self, part, expected_part)
+            self.assertEqual(skeleton[2], expected_skeleton[2])
+            six.assertCountEqual(self, skeleton[3], expected_skeleton[3])
+            six.assertCountEqual(self, skeleton[4], expected_skeleton[4])
+
+        many_params['format'] = 'msgpack'
+        response = self.client.post(url, many_params)
+        self.assertEqual(response.status_code, 200)
+        unpacked_response = msgpack.unpackb(b''.join(response.streaming_content),
+                raw=False)
+        self.assertEqual(['skeletons'], list(unpacked_response.keys()))
+        six.assertCountEqual(self, unpacked_response['skeletons'].keys(), [235, 373])
+
+
+    def test_measure_skeletons(self):
+        self.fake_authentication()
+        response = self.client.post('/{}/skeletons/measure'.format(self.test_project_id), {
+            'skeleton_ids[0]': 373,
+            'skeleton_ids[1]': 235,
+        })
+        self.assertEqual(response.status_code, 200)
+        parsed_response = json.loads(response.content.decode('utf-8'))
+        rows = dict((row[0], row) for row in parsed_response)
+        self.assertEqual(sorted(rows.keys()), [235, 373])
+
+        # Skeleton ID, raw cable, smooth cable, inputs, outputs, nodes,
+        # branch nodes, end nodes and principal branch cable.
+        self.assertEqual(rows[373][:8], [373, 2345, 2324, 2, 0, 5, 0, 2])
+        self.assertAlmostEqual(rows[373][8], 1705.8585, places=3)
+        self.assertEqual(rows[235][1:3], [11243, 10640])
+        self.assertEqual(rows[235][5:8], [28, 2, 4])
+        self.assertAlmostEqual(rows[235][8], 7391.1291, places=3)
 
 
     def assert_skeletons_by_node_labels(self, label_ids, expected_response):
@@ -1089,3 +1278,65 @@ class SkeletonsApiTests(CatmaidApiTestCase):
         expected_result = [[351, [1, 235]], [2342, [373]]]
         self.assert_skeletons_by_node_labels([2342, 351], expected_result)
 
+
+class ParallelSkeletonMeasurementTests(TransactionTestCase):
+    """Test the parallel measurement of skeletons with requests that run in a
+    transaction, like they do with ATOMIC_REQUESTS in production.
+    """
+
+    def setUp(self):
+        self.atomic_requests = connection.settings_dict['ATOMIC_REQUESTS']
+        connection.settings_dict['ATOMIC_REQUESTS'] = True
+
+        admin = User.objects.create(username="admin", is_superuser=True)
+        self.project_id = Project.objects.create(title="Testproject").id
+        tracing.setup_tracing(self.project_id, admin)
+
+        user = User.objects.create(username="test")
+        project = Project.objects.get(pk=self.project_id)
+        assign_perm('can_browse', user, project)
+        assign_perm('can_annotate', user, project)
+
+        self.client = Client()
+        self.client.force_login(user)
+
+        # Create three skeletons with a different number of nodes each
+        self.skeleton_ids = []
+        for n_nodes in (1, 2, 3):
+            parent_id = -1
+            for x in range(n_nodes):
+                response = self.client.post('/%d/treenode/create' % self.project_id, {
+                    'x': 10 * x, 'y': 20, 'z': 30, 'confidence': 5,
+                    'parent_id': parent_id, 'radius': 2
+                })
+                self.assertEqual(response.status_code, 200)
+                parsed_response = json.loads(response.content.decode('utf-8'))
+                parent_id = parsed_response['treenode_id']
+            self.skeleton_ids.append(parsed_response['skeleton_id'])
+
+    def tearDown(self):
+        connection.settings_dict['ATOMIC_REQUESTS'] = self.atomic_requests
+
+    def measure(self):
+        response = self.client.post('/{}/skeletons/measure'.format(self.project_id),
+                dict(('skeleton_ids[{}]'.format(i), skeleton_id)
+                    for i, skeleton_id in enumerate(self.skeleton_ids)))
+        self.assertEqual(response.status_code, 200)
+        parsed_response = json.loads(response.content.decode('utf-8'))
+        return dict((row[0], row) for row in parsed_response)
+
+    def test_parallel_measurement(self):
+        with override_settings(SKELETON_MEASUREMENT_WORKERS=1):
+            expected_rows = self.measure()
+        self.assertEqual([expected_rows[s][5] for s in self.skeleton_ids],
+                [1, 2, 3])
+        self.assertEqual([expected_rows[s][1] for s in self.skeleton_ids],
+                [0, 10, 20])
+
+        with override_settings(SKELETON_MEASUREMENT_WORKERS=2,
+                SKELETON_MEASUREMENT_BATCH_SIZE=1):
+            with mock.patch('catmaid.control.skeletonexport.ThreadPool',
+                    wraps=ThreadPool) as pool:
+                rows = self.measure()
+            pool.assert_called_once_with(2)
+        self.assertEqual(expected_rows, rows)
@@ -806,7 +806,7 @@ class StatsApiTests(CatmaidApiTestCase):
         # Get SWC for a neuron
         response = self.client.get('/%d/skeleton/%d/swc' % (self.test_project_id, orig_skeleton_id))
         self.assertEqual(response.status_code, 200)
-        orig_swc_string = response.content.decode('utf-8')
+        orig_swc_string = b''.join(response.streaming_content).decode('utf-8')
 
         # Give user import permissions and Import SWC
         swc_file = StringIO(orig_swc_string)
@@ -342,7 +342,7 @@ class TreenodesApiTests(CatmaidApiTestCase):
         response = self.client.post(
                 '/%d/%d/1/1/compact-skeleton' % (self.test_project_id, skeleton_id))
         self.assertEqual(response.status_code, 200)
-        parsed_response = json.loads(response.content.decode('utf-8'))
+        parsed_response = json.loads(b''.join(response.streaming_content).decode('utf-8'))
         expected_response = [
                 [[377, None, 3, 7620.0, 2890.0, 0.0, -1.0, 5],
                  [403, 377, 3, 7840.0, 2380.0, 0.0, -1.0, 5],
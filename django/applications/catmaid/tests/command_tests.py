@@ -8,7 +8,7 @@ import mock
 from rest_framework.authtoken.models import Token
 from django.core.management import call_command
 from django.core.management.base import CommandError
-from django.test import TestCase
+from django.test import TestCase, override_settings
 from django.test.client import Client
 from django.utils.six import StringIO
 from guardian.shortcuts import assign_perm
@@ -49,6 +49,43 @@ class PruneSkeletonsTest(TestCase):
         self.assertIn('Deleted 4 nodes in project "%s"' % p.project.id, out.getvalue())
 
 
+class CheckDbIntegrityTest(TestCase):
+    """
+    Test CATMAID's database integrity check management command.
+    """
+
+    def setUp(self):
+        self.user = User.objects.create(username="test", password="test",
+                                        is_superuser=True)
+
+    def check(self, project_id, **options):
+        out = StringIO()
+        call_command('catmaid_check_db_integrity', project_id=[project_id],
+                stdout=out, **options)
+        return out.getvalue()
+
+    def test_skeleton_checks(self):
+        p = TestProject(self.user)
+        skeleton = p.create_neuron()
+        root = p.create_node(0, 0, 0, None, skeleton)
+        n1 = p.create_node(0, 0, 10, root.id, skeleton)
+        n2 = p.create_node(0, 0, 20, n1.id, skeleton)
+
+        out = self.check(p.project.id)
+        self.assertIn('Checking 1 skeletons', out)
+        self.assertNotIn('FAILED', out)
+
+        # Disconnect two nodes from the root by creating a cycle
+        Treenode.objects.filter(id=n1.id).update(parent_id=n2.id)
+        with self.assertRaises(SystemExit):
+            self.check(p.project.id)
+
+        # Only skeletons changed after the passed in time are checked
+        out = self.check(p.project.id, since='2100-01-01 00:00:00')
+        self.assertIn('Checking 0 skeletons', out)
+        self.assertNotIn('FAILED', out)
+
+
 class TestProject():
     """
     Create a new project, assign brows and annotate permissions to the test
@@ -143,3 +180,44 @@ class GetTokenTest(TestCase):
         self.user.save()
         with self.assertRaisesMessage(CommandError, 'account is disabled'):
             self.attempt_command(self.username, '--password', self.password)
+
+
+class UpdateCacheTablesTest(TestCase):
+    """
+    Test CATMAID's node query cache update management command.
+    """
+
+    def setUp(self):
+        self.user = User.objects.create(username="test", password="test",
+                                        is_superuser=True)
+        self.project = TestProject(self.user).project
+
+    def test_resume_update_from_config(self):
+        """
+        Test if an update based on the NODE_PROVIDERS setting can be resumed.
+        """
+        node_providers = [('cached_msgpack', {
+            'step': 40,
+            'project_id': self.project.id,
+        })]
+        with override_settings(NODE_PROVIDERS=node_providers), \
+                mock.patch('catmaid.control.node.update_cache') as update_cache:
+            call_command('catmaid_update_cache_tables', from_config=True,
+                    resume_from='2018-05-01T12:00:00+00:00', stdout=StringIO())
+        self.assertEqual(1, update_cache.call_count)
+        updated_before = update_cache.call_args[1]['updated_before']
+        self.assertEqual('2018-05-01T12:00:00+00:00', updated_before.isoformat())
+
+    def test_resume_grid_update_from_config(self):
+        """
+        Test if resuming an update of configured grid caches is refused.
+        """
+        node_providers = [('cached_grid_msgpack', {
+            'cell_width': 1000,
+            'cell_height': 1000,
+            'cell_depth': 40,
+        })]
+        with override_settings(NODE_PROVIDERS=node_providers):
+            with self.assertRaisesMessage(CommandError, 'only supported for section caches'):
+                call_command('catmaid_update_cache_tables', from_config=True,
+                        resume_from='2018-05-01T12:00:00+00:00', stdout=StringIO())
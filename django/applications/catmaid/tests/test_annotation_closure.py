@@ -0,0 +1,178 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from collections import defaultdict
+
+from django.db import connection
+
+from catmaid.models import (Class, ClassInstance, ClassInstanceClassInstance,
+        Relation, User)
+from catmaid.control.neuron_annotations import get_sub_annotation_ids
+from .common import CatmaidTestCase
+
+
+class AnnotationClosureTests(CatmaidTestCase):
+    """Test the trigger based update of the annotation closure table.
+    """
+
+    def setUp(self):
+        super(AnnotationClosureTests, self).setUp()
+        self.test_user = User.objects.get(username="test0")
+        self.annotation_class = Class.objects.get(project_id=self.test_project_id,
+                class_name='annotation')
+        self.annotated_with = Relation.objects.get(project_id=self.test_project_id,
+                relation_name='annotated_with')
+
+    def create_annotation(self, name):
+        return ClassInstance.objects.create(project_id=self.test_project_id,
+                user=self.test_user, class_column=self.annotation_class,
+                name=name).id
+
+    def annotate(self, annotation_id, meta_annotation_id):
+        return ClassInstanceClassInstance.objects.create(
+                project_id=self.test_project_id, user=self.test_user,
+                relation=self.annotated_with,
+                class_instance_a_id=annotation_id,
+                class_instance_b_id=meta_annotation_id).id
+
+    def get_closure(self, cursor):
+        cursor.execute("""
+            SELECT ancestor_id, descendant_id
+            FROM catmaid_annotation_closure
+            WHERE project_id = %(project_id)s
+        """, {
+            'project_id': self.test_project_id,
+        })
+        return set(cursor.fetchall())
+
+    def get_expected_closure(self, cursor):
+        cursor.execute("""
+            SELECT cici.class_instance_b, cici.class_instance_a
+            FROM class_instance_class_instance cici
+            JOIN class_instance ci_a
+                ON ci_a.id = cici.class_instance_a
+            JOIN class_instance ci_b
+                ON ci_b.id = cici.class_instance_b
+            WHERE cici.project_id = %(project_id)s
+              AND cici.relation_id = %(relation_id)s
+              AND ci_a.class_id = %(class_id)s
+              AND ci_b.class_id = %(class_id)s
+        """, {
+            'project_id': self.test_project_id,
+            'relation_id': self.annotated_with.id,
+            'class_id': self.annotation_class.id,
+        })
+        children = defaultdict(set)
+        for parent_id, child_id in cursor.fetchall():
+            children[parent_id].add(child_id)
+
+        closure = set()
+        for ancestor_id in list(children.keys()):
+            working_set = set(children[ancestor_id])
+            seen = set()
+            while working_set:
+                descendant_id = working_set.pop()
+                if descendant_id in seen:
+                    continue
+                seen.add(descendant_id)
+                closure.add((ancestor_id, descendant_id))
+                working_set.update(children[descendant_id])
+        return closure
+
+    def assertClosureUpToDate(self, cursor):
+        self.assertEqual(self.get_expected_closure(cursor),
+                self.get_closure(cursor))
+
+    def test_closure_changes(self):
+        cursor = connection.cursor()
+        self.assertClosureUpToDate(cursor)
+
+        a, b, c, d = [self.create_annotation(n) for n in ('A', 'B', 'C', 'D')]
+
+        # D is annotated with C, which is annotated with B, which is annotated
+        # with A.
+        self.annotate(d, c)
+        self.annotate(c, b)
+        b_a = self.annotate(b, a)
+        self.assertClosureUpToDate(cursor)
+        self.assertTrue((a, d) in self.get_closure(cursor))
+
+        # Links to neurons don't show up in the closure
+        self.annotate(233, b)
+        self.assertClosureUpToDate(cursor)
+        self.assertFalse(233 in [d_id for _, d_id in self.get_closure(cursor)])
+
+        # Cycles
+        d_a = self.annotate(a, d)
+        self.assertClosureUpToDate(cursor)
+        self.assertTrue((a, a) in self.get_closure(cursor))
+
+        ClassInstanceClassInstance.objects.filter(id=d_a).delete()
+        self.assertClosureUpToDate(cursor)
+        self.assertFalse((a, a) in self.get_closure(cursor))
+
+        # Move a link to a new parent
+        e = self.create_annotation('E')
+        cursor.execute("""
+            UPDATE class_instance_class_instance
+            SET class_instance_b = %(e)s
+            WHERE id = %(link_id)s
+        """, {
+            'e': e,
+            'link_id': b_a,
+        })
+        self.assertClosureUpToDate(cursor)
+        self.assertTrue((e, d) in self.get_closure(cursor))
+        self.assertFalse((a, d) in self.get_closure(cursor))
+
+        # Insert multiple chained links at once
+        f, g = self.create_annotation('F'), self.create_annotation('G')
+        cursor.execute("""
+            INSERT INTO class_instance_class_instance (user_id, creation_time,
+                edition_time, project_id, relation_id, class_instance_a,
+                class_instance_b)
+            VALUES (%(user_id)s, now(), now(), %(project_id)s, %(relation_id)s,
+                    %(g)s, %(f)s),
+                   (%(user_id)s, now(), now(), %(project_id)s, %(relation_id)s,
+                    %(f)s, %(d)s)
+        """, {
+            'user_id': self.test_user.id,
+            'project_id': self.test_project_id,
+            'relation_id': self.annotated_with.id,
+            'd': d,
+            'f': f,
+            'g': g,
+        })
+        self.assertClosureUpToDate(cursor)
+        self.assertTrue((e, g) in self.get_closure(cursor))
+
+        # Delete annotations
+        ClassInstance.objects.filter(id__in=[c, f]).delete()
+        self.assertClosureUpToDate(cursor)
+
+    def test_sub_annotation_ids(self):
+        a, b, c = [self.create_annotation(n) for n in ('A', 'B', 'C')]
+        self.annotate(b, a)
+        self.annotate(c, b)
+
+        sub_annotation_ids = get_sub_annotation_ids(self.test_project_id,
+                [frozenset([a]), frozenset([b, c])], None, None)
+        self.assertEqual(sorted(sub_annotation_ids[frozenset([a])]), [b, c])
+        self.assertEqual(sub_annotation_ids[frozenset([b, c])], [c])
+
+    def test_rebuild(self):
+        a, b = self.create_annotation('A'), self.create_annotation('B')
+        self.annotate(b, a)
+
+        cursor = connection.cursor()
+        expected_closure = self.get_closure(cursor)
+        self.assertTrue(expected_closure)
+        cursor.execute("TRUNCATE catmaid_annotation_closure")
+        self.assertEqual(set(), self.get_closure(cursor))
+
+        cursor.execute("SELECT refresh_annotation_closure(%s::integer[])",
+                ([self.test_project_id],))
+        self.assertEqual(expected_closure, self.get_closure(cursor))
+
+        cursor.execute("SELECT refresh_annotation_closure()")
+        self.assertEqual(expected_closure, self.get_closure(cursor))
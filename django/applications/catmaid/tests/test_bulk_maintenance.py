@@ -0,0 +1,138 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import connection
+
+from catmaid.control.bulk_maintenance import BulkMaintenanceSession
+from .common import CatmaidTestCase
+
+
+class BulkMaintenanceSessionTests(CatmaidTestCase):
+    """Test that summary information is rebuilt when a bulk maintenance
+    session is closed.
+    """
+
+    def get_summary(self, cursor, skeleton_id):
+        cursor.execute("""
+            SELECT num_nodes, cable_length
+            FROM catmaid_skeleton_summary
+            WHERE skeleton_id = %s
+        """, (skeleton_id,))
+        return cursor.fetchone()
+
+    def get_edge_start(self, cursor, treenode_id):
+        cursor.execute("""
+            SELECT ST_X(ST_StartPoint(edge))
+            FROM treenode_edge
+            WHERE id = %s
+        """, (treenode_id,))
+        row = cursor.fetchone()
+        return row[0] if row else None
+
+    def get_synapse_edges(self, cursor, skeleton_id):
+        cursor.execute("""
+            SELECT pre_skeleton_id, post_skeleton_id, n_synapses
+            FROM catmaid_skeleton_synapse_edge
+            WHERE pre_skeleton_id = %(skeleton_id)s
+               OR post_skeleton_id = %(skeleton_id)s
+        """, {
+            'skeleton_id': skeleton_id,
+        })
+        return sorted(cursor.fetchall())
+
+    def test_deferred_summary_update(self):
+        cursor = connection.cursor()
+        num_nodes, cable_length = self.get_summary(cursor, 235)
+        cursor.execute("""
+            SELECT t.id, ST_3DLength(e.edge)
+            FROM treenode t
+            JOIN treenode_edge e
+                ON e.id = t.id
+            WHERE t.skeleton_id = 235
+              AND t.parent_id IS NOT NULL
+              AND NOT EXISTS (SELECT 1 FROM treenode c WHERE c.parent_id = t.id)
+              AND NOT EXISTS (SELECT 1 FROM treenode_connector tc
+                  WHERE tc.treenode_id = t.id)
+              AND NOT EXISTS (SELECT 1 FROM treenode_class_instance tci
+                  WHERE tci.treenode_id = t.id)
+              AND NOT EXISTS (SELECT 1 FROM review r WHERE r.treenode_id = t.id)
+            ORDER BY t.id
+            LIMIT 1
+        """)
+        leaf_id, leaf_length = cursor.fetchone()
+        cursor.execute("""
+            SELECT id, location_x FROM treenode
+            WHERE skeleton_id = 235 AND id <> %s
+            ORDER BY id LIMIT 1
+        """, (leaf_id,))
+        node_id, node_x = cursor.fetchone()
+
+        with BulkMaintenanceSession(self.test_project_id, update_stats=False):
+            # Moving a whole skeleton doesn't change its cable length
+            cursor.execute("""
+                UPDATE treenode SET location_x = location_x + 10
+                WHERE skeleton_id = 235
+            """)
+            cursor.execute("DELETE FROM treenode WHERE id = %s", (leaf_id,))
+
+            # Summary tables are not updated during the session
+            self.assertEqual(self.get_edge_start(cursor, node_id), node_x)
+            self.assertEqual(self.get_summary(cursor, 235)[0], num_nodes)
+
+        self.assertEqual(self.get_edge_start(cursor, node_id), node_x + 10)
+        self.assertIsNone(self.get_edge_start(cursor, leaf_id))
+        new_num_nodes, new_cable_length = self.get_summary(cursor, 235)
+        self.assertEqual(new_num_nodes, num_nodes - 1)
+        self.assertAlmostEqual(new_cable_length, cable_length - leaf_length,
+                places=3)
+
+    def test_deferred_synapse_edge_update(self):
+        cursor = connection.cursor()
+        self.assertTrue(self.get_synapse_edges(cursor, 373))
+
+        with BulkMaintenanceSession(self.test_project_id, update_stats=False):
+            cursor.execute("DELETE FROM treenode_connector WHERE skeleton_id = 373")
+            self.assertTrue(self.get_synapse_edges(cursor, 373))
+
+        self.assertEqual(self.get_synapse_edges(cursor, 373), [])
+
+    def test_forced_rebuild(self):
+        cursor = connection.cursor()
+        expected_summary = self.get_summary(cursor, 235)
+        cursor.execute("""
+            UPDATE catmaid_skeleton_summary SET num_nodes = 0
+            WHERE skeleton_id = 235
+        """)
+
+        with BulkMaintenanceSession(self.test_project_id,
+                update_stats=False) as session:
+            session.add_skeletons([235])
+
+        summary = self.get_summary(cursor, 235)
+        self.assertEqual(summary[0], expected_summary[0])
+        self.assertAlmostEqual(summary[1], expected_summary[1], places=3)
+
+    def test_rollback(self):
+        cursor = connection.cursor()
+        expected_summary = self.get_summary(cursor, 235)
+
+        with self.assertRaises(ValueError):
+            with BulkMaintenanceSession(self.test_project_id,
+                    update_stats=False):
+                cursor.execute("UPDATE treenode SET skeleton_id = 373 "
+                        "WHERE skeleton_id = 235")
+                raise ValueError("Abort")
+
+        cursor.execute("SELECT COUNT(*) FROM treenode WHERE skeleton_id = 235")
+        self.assertEqual(cursor.fetchone()[0], expected_summary[0])
+        self.assertEqual(self.get_summary(cursor, 235), expected_summary)
+
+        # Regular triggers are active again
+        cursor.execute("UPDATE treenode SET location_x = location_x + 10 "
+                "WHERE skeleton_id = 235")
+        self.assertEqual(self.get_summary(cursor, 235)[0], expected_summary[0])
+        cursor.execute("""
+            SELECT COUNT(*) FROM pg_trigger
+            WHERE tgname = 'on_update_treenode_record_bulk_change'
+        """)
+        self.assertEqual(cursor.fetchone()[0], 0)
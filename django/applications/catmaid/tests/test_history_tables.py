@@ -233,6 +233,10 @@ class HistoryTableTests(TransactionTestCase):
 
         # Regular unversioned CATMAID tables
         'node_query_cache',
+        'node_query_cache_dirty_section',
+        'node_query_cache_dirty_tracking',
+        'node_grid_cache',
+        'node_grid_cache_cell',
         'log',
         'treenode_edge',
         'catmaid_history_table',
@@ -241,6 +245,11 @@ class HistoryTableTests(TransactionTestCase):
         'catmaid_transaction_info',
         'catmaid_stats_summary',
         'catmaid_skeleton_summary',
+        'catmaid_skeleton_synapse_edge',
+        'catmaid_annotation_closure',
+        'catmaid_skeleton_review_summary',
+        'catmaid_skeleton_whitelist_review',
+        'catmaid_cache_version',
 
         # Regular unversioned non-CATMAID tables
         'djkombu_queue',
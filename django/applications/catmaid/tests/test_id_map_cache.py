@@ -0,0 +1,85 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import connection, transaction
+from django.test import TransactionTestCase
+
+from catmaid.control import tracing
+from catmaid.control.common import (get_class_to_id_map, get_id_map_cache,
+        get_relation_to_id_map)
+from catmaid.models import Project, Relation, User
+
+
+class IdMapCacheTests(TransactionTestCase):
+    """Test the relation and class ID map cache in transactions, like requests
+    run with ATOMIC_REQUESTS.
+    """
+
+    def setUp(self):
+        self.admin = User.objects.create(username="admin", is_superuser=True)
+        self.project_id = Project.objects.create(title="Testproject").id
+        tracing.setup_tracing(self.project_id, self.admin)
+        self.cache = get_id_map_cache()
+        self.cache.invalidate()
+
+    def test_maps_are_cached_in_transactions(self):
+        with transaction.atomic():
+            relation_map = get_relation_to_id_map(self.project_id)
+            class_map = get_class_to_id_map(self.project_id)
+        self.assertIn('element_of', relation_map)
+        self.assertIn('skeleton', class_map)
+        self.assertIn(('relation', self.project_id), self.cache.cache)
+        self.assertIn(('class', self.project_id), self.cache.cache)
+
+        # Only the cache version is read
+        with transaction.atomic():
+            with self.assertNumQueries(1):
+                self.assertEqual(relation_map,
+                        get_relation_to_id_map(self.project_id))
+            with self.assertNumQueries(1):
+                self.assertEqual({'skeleton': class_map['skeleton']},
+                        get_class_to_id_map(self.project_id, ['skeleton']))
+
+    def test_missing_names(self):
+        get_relation_to_id_map(self.project_id)
+        with transaction.atomic():
+            self.assertEqual({}, get_relation_to_id_map(self.project_id,
+                    ['missing_relation']))
+            # Missing names are remembered and don't cause another reload,
+            # only the cache versions are read.
+            with self.assertNumQueries(2):
+                self.assertEqual({}, get_relation_to_id_map(self.project_id,
+                        ['missing_relation']))
+
+        # New relations are found
+        relation = Relation.objects.create(user=self.admin,
+                project_id=self.project_id, relation_name='missing_relation')
+        self.assertEqual({'missing_relation': relation.id},
+                get_relation_to_id_map(self.project_id, ['missing_relation']))
+
+    def test_changes_of_other_processes(self):
+        relation_id = get_relation_to_id_map(self.project_id)['element_of']
+
+        # Rename a relation without sending any signal to this process
+        cursor = connection.cursor()
+        cursor.execute("""
+            UPDATE relation SET relation_name = 'renamed_element_of'
+            WHERE id = %s
+        """, (relation_id,))
+
+        relation_map = get_relation_to_id_map(self.project_id)
+        self.assertNotIn('element_of', relation_map)
+        self.assertEqual(relation_map['renamed_element_of'], relation_id)
+
+    def test_uncommitted_changes(self):
+        get_relation_to_id_map(self.project_id)
+        try:
+            with transaction.atomic():
+                Relation.objects.filter(project_id=self.project_id,
+                        relation_name='element_of').delete()
+                self.assertNotIn('element_of',
+                        get_relation_to_id_map(self.project_id))
+                raise ValueError("Rollback")
+        except ValueError:
+            pass
+        self.assertIn('element_of', get_relation_to_id_map(self.project_id))
@@ -2,20 +2,29 @@
 from __future__ import unicode_literals
 
 import json
+import mock
+import os
+import shutil
 import six
+import tempfile
 import yaml
 
 from ast import literal_eval
 from guardian.shortcuts import assign_perm
 
+from django.core.management import call_command
+from django.db import connection
 from django.http import HttpResponse
 from django.test import TestCase
 from django.test.client import Client
 
-from catmaid.control import importer
+from catmaid.control import importer, tracing
 from catmaid.control.common import urljoin
-from catmaid.models import (Class, ClassInstance, Project, ProjectStack,
-        Relation, Stack, StackClassInstance, StackGroup, StackStackGroup, User)
+from catmaid.control.copy_archive import read_manifest
+from catmaid.models import (Class, ClassInstance, Connector, Project,
+        ProjectStack, Relation, Stack, StackClassInstance, StackGroup,
+        StackStackGroup, Treenode, TreenodeConnector, User)
+from .common import CatmaidTestCase
 
 
 class ImportExportTests(TestCase):
@@ -374,3 +383,114 @@ class ImportExportTests(TestCase):
         result_json = json.loads(response.content.decode('utf-8'),
                 object_hook=parse_list)
         test_result(result_json)
+
+
+class CopyArchiveTests(CatmaidTestCase):
+    """Test the export of tracing data into COPY archives and their import.
+    """
+
+    def setUp(self):
+        super(CopyArchiveTests, self).setUp()
+        archive_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, archive_dir)
+        self.archive_path = os.path.join(archive_dir, 'archive')
+
+    def export_archive(self):
+        with mock.patch('catmaid.management.commands.catmaid_export_data.ask_to_continue',
+                return_value=True):
+            call_command('catmaid_export_data', source=self.test_project_id,
+                    file=self.archive_path, format='copy')
+        return read_manifest(self.archive_path)
+
+    def import_archive(self, target_project_id):
+        call_command('catmaid_import_data', source=self.archive_path,
+                target=target_project_id, analyze_db=False)
+
+    def get_treenodes(self, project_id):
+        return list(Treenode.objects.filter(project_id=project_id).order_by('id') \
+                .values_list('id', 'parent_id', 'skeleton_id', 'location_x',
+                    'location_y', 'location_z', 'radius', 'confidence'))
+
+    def test_archive_round_trip(self):
+        manifest = self.export_archive()
+        tables = dict((t['name'], t) for t in manifest['tables'])
+        self.assertEqual(Treenode.objects.filter(
+                project_id=self.test_project_id).count(),
+                tables['treenode']['rows'])
+
+        target = Project.objects.create(title="Import target")
+        self.import_archive(target.id)
+
+        source_treenodes = self.get_treenodes(self.test_project_id)
+        target_treenodes = self.get_treenodes(target.id)
+        self.assertEqual(len(source_treenodes), len(target_treenodes))
+        for s, t in zip(source_treenodes, target_treenodes):
+            self.assertEqual(s[3:], t[3:])
+
+        self.assertEqual(
+                Connector.objects.filter(project_id=self.test_project_id).count(),
+                Connector.objects.filter(project_id=target.id).count())
+        self.assertEqual(
+                TreenodeConnector.objects.filter(project_id=self.test_project_id).count(),
+                TreenodeConnector.objects.filter(project_id=target.id).count())
+        self.assertEqual(
+                sorted(ClassInstance.objects.filter(project_id=self.test_project_id,
+                    class_column__class_name='neuron').values_list('name', flat=True)),
+                sorted(ClassInstance.objects.filter(project_id=target.id,
+                    class_column__class_name='neuron').values_list('name', flat=True)))
+
+        # Summary tables are rebuilt for imported skeletons
+        cursor = connection.cursor()
+        cursor.execute("""
+            SELECT project_id, SUM(num_nodes)
+            FROM catmaid_skeleton_summary
+            WHERE project_id IN %s
+            GROUP BY project_id
+        """, ((self.test_project_id, target.id),))
+        num_nodes = dict(cursor.fetchall())
+        self.assertEqual(num_nodes[self.test_project_id], num_nodes[target.id])
+
+    def test_id_offset_remapping(self):
+        manifest = self.export_archive()
+
+        # Classes and relations of a project set up for tracing are reused
+        target = Project.objects.create(title="Import target")
+        tracing.setup_tracing(target.id, self.user)
+        target_relations = dict(Relation.objects.filter(project_id=target.id) \
+                .values_list('id', 'relation_name'))
+        n_classes = Class.objects.filter(project_id=target.id).count()
+        self.import_archive(target.id)
+        self.assertEqual(n_classes, Class.objects.filter(project_id=target.id).count())
+        for relation_id in TreenodeConnector.objects.filter(project_id=target.id) \
+                .values_list('relation_id', flat=True):
+            self.assertIn(relation_id, target_relations)
+
+        # All imported location IDs are shifted by the same offset into a
+        # reserved block, which keeps the parent structure and skeletons
+        # intact.
+        source_treenodes = self.get_treenodes(self.test_project_id)
+        target_treenodes = self.get_treenodes(target.id)
+        location_offset = target_treenodes[0][0] - source_treenodes[0][0]
+        concept_offset = target_treenodes[0][2] - source_treenodes[0][2]
+        self.assertTrue(location_offset > 0)
+        self.assertTrue(concept_offset > 0)
+        for s, t in zip(source_treenodes, target_treenodes):
+            self.assertEqual(s[0] + location_offset, t[0])
+            if s[1] is None:
+                self.assertIsNone(t[1])
+            else:
+                self.assertEqual(s[1] + location_offset, t[1])
+            self.assertEqual(s[2] + concept_offset, t[2])
+
+        source_connector_ids = list(Connector.objects.filter(
+                project_id=self.test_project_id).order_by('id').values_list('id', flat=True))
+        target_connector_ids = list(Connector.objects.filter(
+                project_id=target.id).order_by('id').values_list('id', flat=True))
+        self.assertEqual([c + location_offset for c in source_connector_ids],
+                target_connector_ids)
+
+        # New locations get IDs after the reserved block
+        max_location_id = manifest['id_ranges']['location'][1] + location_offset
+        cursor = connection.cursor()
+        cursor.execute("SELECT nextval('location_id_seq')")
+        self.assertTrue(cursor.fetchone()[0] > max_location_id)
@@ -0,0 +1,74 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import json
+
+from django.db import connection, transaction
+from django.test import Client, TransactionTestCase
+from guardian.shortcuts import assign_perm, remove_perm
+
+from catmaid.control.authentication import (check_user_role,
+        get_permission_cache)
+from catmaid.models import Project, User, UserRole
+
+
+class PermissionCacheTests(TransactionTestCase):
+    """Test the permission cache with requests that run in a transaction, like
+    they do with ATOMIC_REQUESTS in production.
+    """
+
+    def setUp(self):
+        self.atomic_requests = connection.settings_dict['ATOMIC_REQUESTS']
+        connection.settings_dict['ATOMIC_REQUESTS'] = True
+
+        self.client = Client()
+        self.user = User.objects.create(username="test")
+        self.user.set_password("test")
+        self.user.save()
+        self.project = Project.objects.create(title="Testproject")
+        assign_perm('can_browse', self.user, self.project)
+        self.client.login(username="test", password="test")
+
+        self.cache = get_permission_cache()
+        self.cache.invalidate()
+        self.key = ('project', self.user.id, True, False, self.project.id)
+
+    def tearDown(self):
+        connection.settings_dict['ATOMIC_REQUESTS'] = self.atomic_requests
+
+    def can_browse(self):
+        response = self.client.get('/{}/stats/nodecount'.format(self.project.id))
+        parsed_response = json.loads(response.content.decode('utf-8'))
+        return not (isinstance(parsed_response, dict) and
+                parsed_response.get('type') == 'PermissionError')
+
+    def test_requests_use_cache(self):
+        self.assertTrue(self.can_browse())
+        self.assertIn(self.key, self.cache.cache)
+        hits = self.cache.cache.hits
+        self.assertTrue(self.can_browse())
+        self.assertGreater(self.cache.cache.hits, hits)
+
+    def test_changes_of_other_processes(self):
+        self.assertTrue(self.can_browse())
+        self.assertIn(self.key, self.cache.cache)
+
+        # Revoke the permission without sending any signal to this process
+        cursor = connection.cursor()
+        cursor.execute("""
+            DELETE FROM guardian_userobjectpermission
+            WHERE user_id = %s
+        """, (self.user.id,))
+        self.assertFalse(self.can_browse())
+
+    def test_uncommitted_changes(self):
+        self.assertTrue(self.can_browse())
+        try:
+            with transaction.atomic():
+                remove_perm('can_browse', self.user, self.project)
+                self.assertFalse(check_user_role(self.user, self.project.id,
+                        UserRole.Browse))
+                raise ValueError("Rollback")
+        except ValueError:
+            pass
+        self.assertTrue(self.can_browse())
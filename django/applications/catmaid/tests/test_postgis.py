@@ -115,6 +115,148 @@ class PostGISTests(CatmaidTestCase):
         test_returned_nodes(postgis_3d_nodes, postgis_3d_ps_nodes)
         test_returned_nodes(postgis_3d_nodes, postgis_2d_ps_nodes)
 
+    def test_node_grid_cache(self):
+        """Test if a grid cache provides all nodes a regular PostGIS query
+        returns for the same bounding box.
+        """
+        params = {
+            'limit': 5000,
+            'project_id': self.test_project_id,
+            'z1': 0,
+            'z2': 9,
+            'top': 4625.0,
+            'left': 2860.0,
+            'bottom': 8075.0,
+            'right': 10860.0,
+        }
+
+        grid_provider = node.CachedGridMsgpackNodeProvider()
+        result, data_type = grid_provider.get_tuples(params,
+                self.test_project_id, tuple(), tuple(), False, None)
+        self.assertEqual(None, result)
+
+        node.update_grid_cache(self.test_project_id, 'msgpack', 'xy', 1000,
+                1000, 10, log=lambda x: x)
+
+        postgis_nodes = node._node_list_tuples_query(params,
+                self.test_project_id, node.Postgis2dNodeProvider())
+        grid_nodes, data_type = grid_provider.get_tuples(params,
+                self.test_project_id, tuple(), tuple(), False, None)
+        self.assertEqual('json', data_type)
+
+        grid_treenode_ids = set(tn[0] for tn in grid_nodes[0])
+        self.assertEqual(len(grid_treenode_ids), len(grid_nodes[0]))
+        for tn in postgis_nodes[0]:
+            self.assertTrue(tn[0] in grid_treenode_ids)
+
+        grid_connector_ids = set(c[0] for c in grid_nodes[1])
+        for c in postgis_nodes[1]:
+            self.assertTrue(c[0] in grid_connector_ids)
+
+        # Only nodes with edges or links that intersect with the query
+        # bounding box are returned, even though cells cover more space.
+        cursor = connection.cursor()
+        cursor.execute("""
+            SELECT te.id
+            FROM treenode_edge te
+            WHERE te.edge && ST_MakeEnvelope(%(left)s, %(top)s, %(right)s, %(bottom)s)
+              AND floatrange(ST_ZMin(te.edge), ST_ZMax(te.edge), '[]') &&
+                  floatrange(%(z1)s, %(z2)s, '[)')
+              AND te.project_id = %(project_id)s
+            UNION
+            SELECT t.parent_id
+            FROM treenode_edge te
+            JOIN treenode t
+                ON t.id = te.id
+            WHERE te.edge && ST_MakeEnvelope(%(left)s, %(top)s, %(right)s, %(bottom)s)
+              AND floatrange(ST_ZMin(te.edge), ST_ZMax(te.edge), '[]') &&
+                  floatrange(%(z1)s, %(z2)s, '[)')
+              AND te.project_id = %(project_id)s
+            UNION
+            SELECT tc.treenode_id
+            FROM treenode_connector_edge tce
+            JOIN treenode_connector tc
+                ON tc.id = tce.id
+            WHERE tce.edge && ST_MakeEnvelope(%(left)s, %(top)s, %(right)s, %(bottom)s)
+              AND floatrange(ST_ZMin(tce.edge), ST_ZMax(tce.edge), '[]') &&
+                  floatrange(%(z1)s, %(z2)s, '[)')
+              AND tce.project_id = %(project_id)s
+        """, params)
+        intersecting_treenode_ids = set(r[0] for r in cursor.fetchall())
+        self.assertTrue(grid_treenode_ids.issubset(intersecting_treenode_ids))
+
+        # The node limit applies to the merged result, not to single cells.
+        limited_params = dict(params, limit=3)
+        grid_nodes, data_type = grid_provider.get_tuples(limited_params,
+                self.test_project_id, tuple(), tuple(), False, None)
+        self.assertEqual(3, len(grid_nodes[0]))
+        self.assertTrue(grid_nodes[3])
+
+    def test_node_grid_cache_bounding_box(self):
+        """Test if cells outside of the bounding box of an update are removed.
+        """
+        node.update_grid_cache(self.test_project_id, 'msgpack', 'xy', 1000,
+                1000, 10, log=lambda x: x)
+
+        cursor = connection.cursor()
+        def get_max_x_index():
+            cursor.execute("""
+                SELECT max(c.x_index)
+                FROM node_grid_cache_cell c
+                JOIN node_grid_cache g
+                    ON g.id = c.grid_id
+                WHERE g.project_id = %s
+            """, (self.test_project_id,))
+            return cursor.fetchone()[0]
+        self.assertTrue(get_max_x_index() > 5)
+
+        # Both full and incremental updates remove cells outside of their
+        # bounding box.
+        inf = float('inf')
+        for max_x, incremental in ((6000, False), (5000, True)):
+            node.update_grid_cache(self.test_project_id, 'msgpack', 'xy', 1000,
+                    1000, 10, bb_limits=[[-inf, -inf, -inf], [max_x, inf, inf]],
+                    incremental=incremental, log=lambda x: x)
+            self.assertLessEqual(get_max_x_index(), max_x // 1000 - 1)
+
+    def test_node_query_cache_side_by_side_formats(self):
+        """Test if multiple cached data types are stored side by side and if
+        cached node providers return data in the target format if available.
+        """
+        step = 40
+        node.update_cache(self.test_project_id, ['msgpack', 'json_text'],
+                ['xy'], [step], log=lambda x: x)
+
+        cursor = connection.cursor()
+        cursor.execute("""
+            SELECT COUNT(*) FROM node_query_cache
+            WHERE project_id = %s
+            AND (msgpack_data IS NULL OR json_text_data IS NULL
+                OR json_data IS NOT NULL)
+        """, (self.test_project_id,))
+        self.assertEqual(0, cursor.fetchone()[0])
+
+        cursor.execute("""
+            SELECT depth FROM node_query_cache
+            WHERE project_id = %s
+            ORDER BY depth LIMIT 1
+        """, (self.test_project_id,))
+        params = {
+            'z1': cursor.fetchone()[0],
+        }
+
+        provider = node.CachedMsgpackNodeProvder()
+        msgpack_data, data_type = provider.get_tuples(params,
+                self.test_project_id, tuple(), tuple(), False, None, 'msgpack')
+        self.assertEqual('msgpack', data_type)
+        json_data, data_type = provider.get_tuples(params,
+                self.test_project_id, tuple(), tuple(), False, None, 'json')
+        self.assertEqual('json_text', data_type)
+        msgpack_tuples = node.decode_node_query_data(msgpack_data, 'msgpack')
+        json_tuples = json.loads(json_data)
+        self.assertEqual(msgpack_tuples[0], json_tuples[0])
+        self.assertEqual(msgpack_tuples[1], json_tuples[1])
+
     def get_edges(self, cursor, tnid):
         cursor.execute("""
             SELECT edge FROM treenode_edge WHERE id=%s AND project_id=%s
@@ -155,3 +297,66 @@ class PostGISTests(CatmaidTestCase):
         self.assertEqual(1, len(to_edges_after))
         self.assertEqual(from_edges_before[0], from_edges_after[0])
         self.assertNotEqual(to_edges_before[0], to_edges_after[0])
+
+    def test_node_query_cache_dirty_sections(self):
+        """Test if changes to tracing data mark the intersecting cached
+        sections as outdated.
+        """
+        cursor = connection.cursor()
+        step = 40
+        node.update_cache(self.test_project_id, 'msgpack', ['xy'], [step],
+                log=lambda x: x)
+
+        cursor.execute("""
+            SELECT COUNT(*) FROM node_query_cache WHERE project_id = %s
+        """, (self.test_project_id,))
+        self.assertTrue(cursor.fetchone()[0] > 0)
+
+        # Without any changes, no section is outdated
+        outdated = node.get_outdated_cache_sections(self.test_project_id,
+                node.ORIENTATIONS['xy'], step, cursor)
+        self.assertEqual([], outdated)
+
+        # Moving a node in Z = 0 should mark at least the first section as
+        # outdated.
+        cursor.execute("""
+            UPDATE treenode SET location_x = location_x + 10
+            WHERE id = 2465
+        """)
+        outdated = node.get_outdated_cache_sections(self.test_project_id,
+                node.ORIENTATIONS['xy'], step, cursor)
+        self.assertTrue(len(outdated) > 0)
+        self.assertTrue(any(d <= 0 < d + step for d in outdated))
+
+    def test_node_query_cache_non_spatial_changes(self):
+        """Test if radius changes mark cached sections as outdated and if an
+        incremental update refreshes them.
+        """
+        cursor = connection.cursor()
+        step = 40
+        node.update_cache(self.test_project_id, 'msgpack', ['xy'], [step],
+                log=lambda x: x)
+        outdated = node.get_outdated_cache_sections(self.test_project_id,
+                node.ORIENTATIONS['xy'], step, cursor)
+        self.assertEqual([], outdated)
+
+        # Node 2465 is a leaf in Z = 0, changing its radius doesn't change any
+        # edge.
+        cursor.execute("""
+            UPDATE treenode SET radius = 42
+            WHERE id = 2465
+        """)
+        outdated = node.get_outdated_cache_sections(self.test_project_id,
+                node.ORIENTATIONS['xy'], step, cursor)
+        self.assertTrue(any(d <= 0 < d + step for d in outdated))
+
+        node.update_cache(self.test_project_id, 'msgpack', ['xy'], [step],
+                incremental=True, log=lambda x: x)
+
+        depth = next(d for d in outdated if d <= 0 < d + step)
+        provider = node.CachedMsgpackNodeProvder()
+        data, data_type = provider.get_tuples({'z1': depth},
+                self.test_project_id, tuple(), tuple(), False, None, 'msgpack')
+        treenodes = node.decode_node_query_data(data, data_type)[0]
+        radii = {tn[0]: tn[6] for tn in treenodes}
+        self.assertEqual(42, radii[2465])
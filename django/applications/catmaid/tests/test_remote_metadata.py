@@ -0,0 +1,112 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import json
+import threading
+import time
+
+from six.moves.BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+
+from django.test import SimpleTestCase
+
+from catmaid.control.remote_metadata import MetadataClient
+
+
+class StubMetadataHandler(BaseHTTPRequestHandler):
+    """Respond with the JSON registered for a path in the server's responses
+    dictionary and count requests per path.
+    """
+
+    def do_GET(self):
+        self.server.requests.append(self.path)
+        data = self.server.responses.get(self.path)
+        if data is None:
+            self.send_response(404)
+            self.end_headers()
+            return
+        content = json.dumps(data).encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class MetadataClientTests(SimpleTestCase):
+    """Test the remote metadata client against a local stub HTTP server.
+    """
+
+    def setUp(self):
+        self.server = HTTPServer(('127.0.0.1', 0), StubMetadataHandler)
+        self.server.responses = {}
+        self.server.requests = []
+        self.url = 'http://127.0.0.1:%s' % self.server.server_port
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        self.thread.join()
+
+    def n_requests(self, path):
+        return self.server.requests.count(path)
+
+    def test_responses_are_cached(self):
+        self.server.responses['/owners'] = ['a', 'b']
+        client = MetadataClient(max_age=60, stale_age=0)
+        self.assertEqual(client.get_json(self.url + '/owners'), ['a', 'b'])
+        self.assertEqual(client.get_json(self.url + '/owners'), ['a', 'b'])
+        self.assertEqual(self.n_requests('/owners'), 1)
+
+        client.invalidate()
+        self.assertEqual(client.get_json(self.url + '/owners'), ['a', 'b'])
+        self.assertEqual(self.n_requests('/owners'), 2)
+
+    def test_disabled_cache(self):
+        self.server.responses['/owners'] = ['a']
+        client = MetadataClient(max_age=0, stale_age=0)
+        client.get_json(self.url + '/owners')
+        client.get_json(self.url + '/owners')
+        self.assertEqual(self.n_requests('/owners'), 2)
+
+    def test_stale_entries_are_revalidated(self):
+        self.server.responses['/stack'] = {'version': 1}
+        client = MetadataClient(max_age=0, stale_age=60)
+        self.assertEqual(client.get_json(self.url + '/stack'), {'version': 1})
+
+        # The stale entry is returned right away and refreshed in the
+        # background.
+        self.server.responses['/stack'] = {'version': 2}
+        self.assertEqual(client.get_json(self.url + '/stack'), {'version': 1})
+        for _ in range(100):
+            if self.n_requests('/stack') == 2 and not client._refreshing:
+                break
+            time.sleep(0.05)
+        self.assertEqual(self.n_requests('/stack'), 2)
+        self.assertEqual(client.get_json(self.url + '/stack')['version'], 2)
+
+    def test_get_many(self):
+        for n in range(5):
+            self.server.responses['/project/%s/stacks' % n] = [n]
+        client = MetadataClient(max_age=60, stale_age=0, workers=3)
+        client.get_json(self.url + '/project/2/stacks')
+
+        urls = [self.url + '/project/%s/stacks' % n for n in range(5)]
+        self.assertEqual(client.get_many(urls), [[0], [1], [2], [3], [4]])
+        self.assertEqual(len(self.server.requests), 5)
+        self.assertEqual(client.get_many([]), [])
+
+    def test_errors_are_not_cached(self):
+        client = MetadataClient(max_age=60, stale_age=60)
+        self.assertRaises(ValueError, client.get_json, self.url + '/missing')
+        self.assertRaises(ValueError, client.get_many,
+                [self.url + '/missing', self.url + '/missing'])
+        self.assertEqual(self.n_requests('/missing'), 3)
+
+        self.server.responses['/missing'] = 'found'
+        self.assertEqual(client.get_json(self.url + '/missing'), 'found')
@@ -0,0 +1,256 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import json
+import threading
+import time
+
+from django.db import connection, transaction
+from django.test import TransactionTestCase
+from django.test.client import Client
+from guardian.shortcuts import assign_perm
+
+from catmaid.control import tracing
+from catmaid.control.review import get_review_count, get_review_status
+from catmaid.models import Project, Review, ReviewerWhitelist, User
+from .common import CatmaidTestCase
+
+
+class ReviewSummaryTableTests(CatmaidTestCase):
+    """Test the trigger based update of the review summary tables and the
+    review status computed from them.
+    """
+
+    skeleton_ids = [235, 2388]
+
+    def get_expected_review_status(self, cursor, user_ids=None,
+            excluding_user_ids=None, whitelist_id=None):
+        """Count reviewed nodes directly from the review table."""
+        conditions = ''
+        if user_ids:
+            conditions = 'AND r.reviewer_id = ANY(%(user_ids)s::int[])'
+        elif excluding_user_ids:
+            conditions = 'AND NOT (r.reviewer_id = ANY(%(excluding_user_ids)s::int[]))'
+        elif whitelist_id:
+            conditions = '''AND EXISTS (
+                SELECT 1 FROM reviewer_whitelist wl
+                WHERE wl.user_id = %(whitelist_id)s
+                  AND wl.project_id = r.project_id
+                  AND wl.reviewer_id = r.reviewer_id
+                  AND r.review_time >= wl.accept_after)'''
+        cursor.execute('''
+            SELECT s.skeleton_id, s.num_nodes, (
+                SELECT COUNT(DISTINCT r.treenode_id)
+                FROM review r
+                WHERE r.skeleton_id = s.skeleton_id
+                {}
+            )
+            FROM catmaid_skeleton_summary s
+            WHERE s.skeleton_id = ANY(%(skeleton_ids)s::bigint[])
+        '''.format(conditions), {
+            'skeleton_ids': self.skeleton_ids,
+            'user_ids': user_ids,
+            'excluding_user_ids': excluding_user_ids,
+            'whitelist_id': whitelist_id,
+        })
+        return {r[0]: [r[1], r[2]] for r in cursor.fetchall()}
+
+    def assertReviewStatusUpToDate(self, cursor):
+        self.assertEqual(self.get_expected_review_status(cursor),
+                get_review_status(self.skeleton_ids))
+        for user_ids in ([2], [3], [2, 3]):
+            self.assertEqual(
+                    self.get_expected_review_status(cursor, user_ids=user_ids),
+                    get_review_status(self.skeleton_ids, user_ids=user_ids))
+            self.assertEqual(
+                    self.get_expected_review_status(cursor,
+                        excluding_user_ids=user_ids),
+                    get_review_status(self.skeleton_ids,
+                        excluding_user_ids=user_ids))
+        self.assertEqual(
+                self.get_expected_review_status(cursor,
+                    whitelist_id=self.user.id),
+                get_review_status(self.skeleton_ids,
+                    project_id=self.test_project_id,
+                    whitelist_id=self.user.id))
+
+    def test_review_changes(self):
+        cursor = connection.cursor()
+        self.assertReviewStatusUpToDate(cursor)
+
+        review_time = "2014-03-17T00:00:00Z"
+        ReviewerWhitelist.objects.create(project_id=self.test_project_id,
+                user_id=self.user.id, reviewer_id=2,
+                accept_after=review_time)
+        self.assertReviewStatusUpToDate(cursor)
+
+        # A node reviewed by two users is counted once
+        Review.objects.create(project_id=self.test_project_id, reviewer_id=3,
+            review_time=review_time, skeleton_id=2388, treenode_id=2396)
+        Review.objects.create(project_id=self.test_project_id, reviewer_id=2,
+            review_time=review_time, skeleton_id=2388, treenode_id=2396)
+        Review.objects.create(project_id=self.test_project_id, reviewer_id=3,
+            review_time=review_time, skeleton_id=2388, treenode_id=2394)
+        self.assertReviewStatusUpToDate(cursor)
+        self.assertEqual(get_review_status([2388])[2388][1], 2)
+        self.assertEqual(get_review_count([2388])[2388], {2: 1, 3: 2})
+
+        # Reviews before the accept date of a whitelist don't count
+        Review.objects.filter(reviewer_id=2, treenode_id=2396).update(
+                review_time="2014-03-16T00:00:00Z")
+        self.assertReviewStatusUpToDate(cursor)
+
+        # Whitelist changes
+        ReviewerWhitelist.objects.filter(user_id=self.user.id).update(
+                accept_after="2014-03-01T00:00:00Z")
+        self.assertReviewStatusUpToDate(cursor)
+        ReviewerWhitelist.objects.filter(user_id=self.user.id).delete()
+        self.assertReviewStatusUpToDate(cursor)
+
+        # Reviews move with their skeleton
+        Review.objects.filter(skeleton_id=2388).update(skeleton_id=235)
+        self.assertReviewStatusUpToDate(cursor)
+
+        Review.objects.filter(reviewer_id=3).delete()
+        self.assertReviewStatusUpToDate(cursor)
+
+    def test_rebuild(self):
+        cursor = connection.cursor()
+        Review.objects.create(project_id=self.test_project_id, reviewer_id=3,
+            skeleton_id=2388, treenode_id=2396)
+        expected_status = get_review_status(self.skeleton_ids)
+
+        cursor.execute("TRUNCATE catmaid_skeleton_review_summary")
+        cursor.execute("SELECT refresh_review_summary(%s::integer[])",
+                ([self.test_project_id],))
+        self.assertEqual(expected_status, get_review_status(self.skeleton_ids))
+
+        cursor.execute("SELECT refresh_review_summary()")
+        self.assertEqual(expected_status, get_review_status(self.skeleton_ids))
+
+
+class ConcurrentReviewSummaryTests(TransactionTestCase):
+    """Test that concurrent review transactions keep the review summary tables
+    consistent.
+    """
+
+    def setUp(self):
+        admin = User.objects.create(username="admin", is_superuser=True)
+        self.project_id = Project.objects.create(title="Testproject").id
+        tracing.setup_tracing(self.project_id, admin)
+
+        self.reviewers = [User.objects.create(username="reviewer{}".format(i))
+                for i in range(2)]
+        self.user = User.objects.create(username="test")
+        assign_perm('can_browse', self.user, Project.objects.get(pk=self.project_id))
+        assign_perm('can_annotate', self.user, Project.objects.get(pk=self.project_id))
+
+        # Create a skeleton with two nodes
+        client = Client()
+        client.force_login(self.user)
+        self.treenode_ids = []
+        parent_id = -1
+        for x in (1, 2):
+            response = client.post('/%d/treenode/create' % self.project_id, {
+                'x': x, 'y': 2, 'z': 3, 'confidence': 5,
+                'parent_id': parent_id, 'radius': 2
+            })
+            self.assertEqual(response.status_code, 200)
+            parsed_response = json.loads(response.content.decode('utf-8'))
+            self.skeleton_id = parsed_response['skeleton_id']
+            parent_id = parsed_response['treenode_id']
+            self.treenode_ids.append(parent_id)
+
+    def review(self, treenode_id, reviewer, started, proceed, errors):
+        try:
+            with transaction.atomic():
+                Review.objects.create(project_id=self.project_id,
+                        reviewer=reviewer, skeleton_id=self.skeleton_id,
+                        treenode_id=treenode_id)
+                started.set()
+                proceed.wait(10)
+        except Exception as e:
+            errors.append(e)
+        finally:
+            started.set()
+            connection.close()
+
+    def review_concurrently(self, first_review, second_review):
+        """Let the second review wait for the first one to be committed."""
+        cursor = connection.cursor()
+        errors = []
+        first_started, proceed = threading.Event(), threading.Event()
+        first = threading.Thread(target=self.review,
+                args=first_review + (first_started, proceed, errors))
+        first.start()
+        first_started.wait(10)
+
+        second_proceed = threading.Event()
+        second_proceed.set()
+        second = threading.Thread(target=self.review,
+                args=second_review + (threading.Event(), second_proceed, errors))
+        second.start()
+
+        # Wait until the second transaction waits for a lock of the first one
+        for _ in range(100):
+            cursor.execute("SELECT COUNT(*) FROM pg_locks WHERE NOT granted")
+            if cursor.fetchone()[0] > 0:
+                break
+            time.sleep(0.1)
+        else:
+            self.fail("The second review didn't wait for the first one")
+
+        proceed.set()
+        first.join()
+        second.join()
+        self.assertEqual(errors, [])
+
+    def get_summary(self, cursor):
+        cursor.execute("""
+            SELECT reviewer_ids, num_reviewed_nodes
+            FROM catmaid_skeleton_review_summary
+            WHERE skeleton_id = %s
+            ORDER BY reviewer_ids
+        """, (self.skeleton_id,))
+        return cursor.fetchall()
+
+    def get_whitelist_review(self, cursor):
+        cursor.execute("""
+            SELECT num_reviewed_nodes
+            FROM catmaid_skeleton_whitelist_review
+            WHERE skeleton_id = %s
+              AND user_id = %s
+        """, (self.skeleton_id, self.user.id))
+        return cursor.fetchall()
+
+    def test_concurrent_reviews_of_different_nodes(self):
+        reviewer = self.reviewers[0]
+        self.review_concurrently((self.treenode_ids[0], reviewer),
+                (self.treenode_ids[1], reviewer))
+
+        cursor = connection.cursor()
+        self.assertEqual(self.get_summary(cursor), [([reviewer.id], 2)])
+        self.assertEqual(get_review_status([self.skeleton_id]),
+                {self.skeleton_id: [2, 2]})
+
+    def test_concurrent_reviews_of_same_node(self):
+        for reviewer in self.reviewers:
+            ReviewerWhitelist.objects.create(project_id=self.project_id,
+                    user=self.user, reviewer=reviewer)
+        self.review_concurrently((self.treenode_ids[0], self.reviewers[0]),
+                (self.treenode_ids[0], self.reviewers[1]))
+
+        cursor = connection.cursor()
+        self.assertEqual(self.get_summary(cursor),
+                [(sorted(r.id for r in self.reviewers), 1)])
+        self.assertEqual(self.get_whitelist_review(cursor), [(1,)])
+
+        # Removing one review keeps the node reviewed
+        Review.objects.filter(reviewer=self.reviewers[0]).delete()
+        self.assertEqual(self.get_summary(cursor),
+                [([self.reviewers[1].id], 1)])
+        self.assertEqual(self.get_whitelist_review(cursor), [(1,)])
+
+        Review.objects.all().delete()
+        self.assertEqual(self.get_summary(cursor), [])
+        self.assertEqual(self.get_whitelist_review(cursor), [])
@@ -0,0 +1,241 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import json
+import threading
+import time
+
+from django.db import connection, transaction
+from django.test import TransactionTestCase
+from django.test.client import Client
+from guardian.shortcuts import assign_perm
+
+from catmaid.control import tracing
+from catmaid.control.edge import rebuild_synapse_edge_table
+from catmaid.models import Project, Relation, TreenodeConnector, User
+from .common import CatmaidTestCase
+
+
+class SkeletonSynapseEdgeTableTests(CatmaidTestCase):
+    """Test the trigger based update of the skeleton synapse edge table.
+    """
+
+    def get_edges(self, cursor):
+        cursor.execute("""
+            SELECT pre_skeleton_id, post_skeleton_id, confidence, n_synapses
+            FROM catmaid_skeleton_synapse_edge
+            WHERE project_id = %(project_id)s
+        """, {
+            'project_id': self.test_project_id,
+        })
+        return {(r[0], r[1], r[2]): r[3] for r in cursor.fetchall()}
+
+    def get_expected_edges(self, cursor):
+        cursor.execute("""
+            SELECT pre.skeleton_id, post.skeleton_id,
+                LEAST(pre.confidence, post.confidence), COUNT(*)
+            FROM treenode_connector pre
+            JOIN relation pre_r
+                ON pre_r.id = pre.relation_id
+            JOIN treenode_connector post
+                ON post.connector_id = pre.connector_id
+            JOIN relation post_r
+                ON post_r.id = post.relation_id
+            WHERE pre.project_id = %(project_id)s
+              AND pre_r.relation_name = 'presynaptic_to'
+              AND post_r.relation_name = 'postsynaptic_to'
+            GROUP BY 1, 2, 3
+        """, {
+            'project_id': self.test_project_id,
+        })
+        return {(r[0], r[1], r[2]): r[3] for r in cursor.fetchall()}
+
+    def get_link(self, cursor, relation_name):
+        cursor.execute("""
+            SELECT tc.id, tc.skeleton_id
+            FROM treenode_connector tc
+            JOIN relation r
+                ON r.id = tc.relation_id
+            WHERE tc.project_id = %(project_id)s
+              AND r.relation_name = %(relation_name)s
+            ORDER BY tc.id
+            LIMIT 1
+        """, {
+            'project_id': self.test_project_id,
+            'relation_name': relation_name,
+        })
+        return cursor.fetchone()
+
+    def assertEdgesUpToDate(self, cursor):
+        expected_edges = self.get_expected_edges(cursor)
+        self.assertTrue(expected_edges)
+        self.assertEqual(expected_edges, self.get_edges(cursor))
+
+    def test_initial_edges(self):
+        cursor = connection.cursor()
+        self.assertEdgesUpToDate(cursor)
+        self.assertEqual(self.get_edges(cursor)[(235, 373, 5)], 2)
+
+    def test_link_changes(self):
+        cursor = connection.cursor()
+        post_link_id, post_skeleton_id = self.get_link(cursor, 'postsynaptic_to')
+        pre_link_id, pre_skeleton_id = self.get_link(cursor, 'presynaptic_to')
+
+        # Lower the confidence of a single link
+        cursor.execute("""
+            UPDATE treenode_connector SET confidence = 2 WHERE id = %s
+        """, (post_link_id,))
+        self.assertEdgesUpToDate(cursor)
+
+        # Only updates of other fields don't change edges
+        cursor.execute("""
+            UPDATE treenode_connector SET edition_time = now()
+        """)
+        self.assertEdgesUpToDate(cursor)
+
+        # Add a new postsynaptic link to the same connector from a node of
+        # another skeleton.
+        cursor.execute("""
+            INSERT INTO treenode_connector (user_id, creation_time,
+                edition_time, project_id, relation_id, treenode_id,
+                connector_id, skeleton_id, confidence)
+            SELECT tc.user_id, now(), now(), tc.project_id, tc.relation_id,
+                t.id, tc.connector_id, t.skeleton_id, 3
+            FROM treenode_connector tc, treenode t
+            WHERE tc.id = %(link_id)s
+              AND t.project_id = tc.project_id
+              AND t.skeleton_id NOT IN (%(pre_skeleton_id)s, %(post_skeleton_id)s)
+            LIMIT 1
+        """, {
+            'link_id': post_link_id,
+            'pre_skeleton_id': pre_skeleton_id,
+            'post_skeleton_id': post_skeleton_id,
+        })
+        self.assertEdgesUpToDate(cursor)
+
+        # Move a presynaptic link to another skeleton
+        cursor.execute("""
+            UPDATE treenode_connector SET skeleton_id = %(skeleton_id)s
+            WHERE id = %(link_id)s
+        """, {
+            'link_id': pre_link_id,
+            'skeleton_id': post_skeleton_id,
+        })
+        self.assertEdgesUpToDate(cursor)
+
+        # Remove links
+        cursor.execute("""
+            DELETE FROM treenode_connector WHERE id IN %s
+        """, ((pre_link_id, post_link_id),))
+        self.assertEdgesUpToDate(cursor)
+
+    def test_rebuild(self):
+        cursor = connection.cursor()
+        expected_edges = self.get_edges(cursor)
+        cursor.execute("TRUNCATE catmaid_skeleton_synapse_edge")
+        self.assertEqual({}, self.get_edges(cursor))
+
+        rebuild_synapse_edge_table([self.test_project_id])
+        self.assertEqual(expected_edges, self.get_edges(cursor))
+
+        rebuild_synapse_edge_table()
+        self.assertEqual(expected_edges, self.get_edges(cursor))
+
+
+class ConcurrentSynapseEdgeTableTests(TransactionTestCase):
+    """Test that concurrent link transactions keep the skeleton synapse edge
+    table consistent.
+    """
+
+    def setUp(self):
+        admin = User.objects.create(username="admin", is_superuser=True)
+        self.project_id = Project.objects.create(title="Testproject").id
+        tracing.setup_tracing(self.project_id, admin)
+
+        self.user = User.objects.create(username="test")
+        assign_perm('can_browse', self.user, Project.objects.get(pk=self.project_id))
+        assign_perm('can_annotate', self.user, Project.objects.get(pk=self.project_id))
+
+        # Create two single node skeletons and a connector
+        client = Client()
+        client.force_login(self.user)
+        self.nodes = []
+        for x in (1, 2):
+            response = client.post('/%d/treenode/create' % self.project_id, {
+                'x': x, 'y': 2, 'z': 3, 'confidence': 5, 'parent_id': -1,
+                'radius': 2
+            })
+            self.assertEqual(response.status_code, 200)
+            parsed_response = json.loads(response.content.decode('utf-8'))
+            self.nodes.append((parsed_response['treenode_id'],
+                    parsed_response['skeleton_id']))
+
+        response = client.post('/%d/connector/create' % self.project_id, {
+            'x': 3, 'y': 2, 'z': 3, 'confidence': 5
+        })
+        self.assertEqual(response.status_code, 200)
+        parsed_response = json.loads(response.content.decode('utf-8'))
+        self.connector_id = parsed_response['connector_id']
+
+    def link(self, node, relation_name, started, proceed, errors):
+        try:
+            with transaction.atomic():
+                TreenodeConnector.objects.create(user=self.user,
+                        project_id=self.project_id, treenode_id=node[0],
+                        skeleton_id=node[1], connector_id=self.connector_id,
+                        relation=Relation.objects.get(project_id=self.project_id,
+                            relation_name=relation_name))
+                started.set()
+                proceed.wait(10)
+        except Exception as e:
+            errors.append(e)
+        finally:
+            started.set()
+            connection.close()
+
+    def get_edges(self, cursor):
+        cursor.execute("""
+            SELECT pre_skeleton_id, post_skeleton_id, confidence, n_synapses
+            FROM catmaid_skeleton_synapse_edge
+            WHERE project_id = %s
+        """, (self.project_id,))
+        return cursor.fetchall()
+
+    def test_concurrent_links_of_same_connector(self):
+        """Let the postsynaptic link wait for the presynaptic one to be
+        committed.
+        """
+        cursor = connection.cursor()
+        errors = []
+        first_started, proceed = threading.Event(), threading.Event()
+        first = threading.Thread(target=self.link, args=(self.nodes[0],
+                'presynaptic_to', first_started, proceed, errors))
+        first.start()
+        first_started.wait(10)
+
+        second_proceed = threading.Event()
+        second_proceed.set()
+        second = threading.Thread(target=self.link, args=(self.nodes[1],
+                'postsynaptic_to', threading.Event(), second_proceed, errors))
+        second.start()
+
+        # Wait until the second transaction waits for a lock of the first one
+        for _ in range(100):
+            cursor.execute("SELECT COUNT(*) FROM pg_locks WHERE NOT granted")
+            if cursor.fetchone()[0] > 0:
+                break
+            time.sleep(0.1)
+        else:
+            self.fail("The second link didn't wait for the first one")
+
+        proceed.set()
+        first.join()
+        second.join()
+        self.assertEqual(errors, [])
+
+        self.assertEqual(self.get_edges(cursor),
+                [(self.nodes[0][1], self.nodes[1][1], 5, 1)])
+
+        # Removing a link removes the synapse
+        TreenodeConnector.objects.filter(treenode_id=self.nodes[1][0]).delete()
+        self.assertEqual(self.get_edges(cursor), [])
@@ -80,3 +80,133 @@ class UtilTests(TestCase):
 
         version = get_version()
         self.assertNotEqual(version, "unknown")
+
+    def test_lru_cache(self):
+        from catmaid.util import LRUCache
+
+        cache = LRUCache(10, size_fn=len)
+        cache.set('a', 'aaaa')
+        cache.set('b', 'bbbb')
+        self.assertEqual(cache.get('a'), 'aaaa')
+        self.assertEqual(cache.size, 8)
+
+        # Adding a third entry exceeds the size limit and evicts the least
+        # recently used entry, which is 'b'.
+        cache.set('c', 'cccc')
+        self.assertEqual(cache.get('b'), None)
+        self.assertEqual(cache.get('a'), 'aaaa')
+        self.assertEqual(cache.get('c'), 'cccc')
+        self.assertEqual(cache.size, 8)
+
+        # Entries larger than the limit aren't stored
+        cache.set('d', 'd' * 11)
+        self.assertEqual(cache.get('d'), None)
+
+        cache.remove('a')
+        self.assertEqual(len(cache), 1)
+        self.assertEqual(cache.size, 4)
+
+        stats = cache.stats()
+        self.assertEqual(stats['hits'], 3)
+        self.assertEqual(stats['misses'], 2)
+
+    def test_rotate_image(self):
+        import numpy as np
+        from catmaid.control.cropping import rotate_image
+
+        data = np.arange(6 * 8 * 3, dtype=np.uint8).reshape((6, 8, 3))
+        # Rotations by multiples of 90 degree match NumPy's counter-clockwise
+        # rotation.
+        for n in range(4):
+            expected = np.rot90(data, n)
+            rotated = rotate_image(data, 90 * n, expected.shape[1],
+                    expected.shape[0])
+            self.assertTrue(np.array_equal(expected, rotated))
+
+        # The result is centered and areas outside of the input are black
+        rotated = rotate_image(data, 0, 4, 2)
+        self.assertTrue(np.array_equal(data[2:4, 2:6], rotated))
+        rotated = rotate_image(np.full((4, 4), 7, dtype=np.uint8), 45, 8, 8)
+        self.assertEqual(rotated[0, 0], 0)
+        self.assertEqual(rotated[4, 4], 7)
+
+    def test_tree_max_density(self):
+        import networkx as nx
+        from catmaid.control.synapseclustering import tree_max_density
+
+        # A chain of nodes with one branch and two clusters of synapses at
+        # both of its ends.
+        graph = nx.Graph()
+        for node in range(1, 21):
+            graph.add_edge(node, node + 1, weight=1.0)
+        graph.add_edge(10, 100, weight=1.0)
+        syn_nodes = [1, 2, 3, 3, 19, 20, 21]
+        connector_ids = [501, 502, 503, 504, 505, 506, 507]
+        relations = [1, 1, 2, 2, 1, 2, 2]
+
+        groups = tree_max_density(graph, syn_nodes, connector_ids, relations,
+                [2.0, 100.0])
+        self.assertEqual(set(groups.keys()), {2.0, 100.0})
+
+        # Small bandwidth: two groups
+        small = sorted(groups[2.0].values(), key=lambda g: g.node_ids[0])
+        self.assertEqual(len(small), 2)
+        self.assertEqual(small[0].node_ids, [1, 2, 3, 3])
+        self.assertEqual(small[0].connector_ids, [501, 502, 503, 504])
+        self.assertEqual(small[0].relations, [1, 1, 2, 2])
+        self.assertEqual(small[0].local_max, 2)
+        self.assertEqual(small[1].node_ids, [19, 20, 21])
+        self.assertEqual(small[1].local_max, 20)
+
+        # Large bandwidth: all synapses are in one group
+        large = list(groups[100.0].values())
+        self.assertEqual(len(large), 1)
+        self.assertEqual(large[0].node_ids, syn_nodes)
+        self.assertEqual(large[0].connector_ids, connector_ids)
+
+    def test_arbor(self):
+        from catmaid.control.tree_util import Arbor, simplify, partition, \
+                cable_length
+
+        # A root (1) with a long branch (2-5) and a short branch (6-7), node 3
+        # branches off to node 8. Nodes are passed in unordered.
+        node_ids = [5, 1, 3, 2, 4, 6, 7, 8]
+        parent_ids = [4, -1, 2, 1, 3, 1, 6, 3]
+        locations = [[node_id, 0, 0] for node_id in node_ids]
+        locations[node_ids.index(6)] = [1, 1, 0]
+        locations[node_ids.index(7)] = [1, 2, 0]
+        locations[node_ids.index(8)] = [3, 2, 0]
+        arbor = Arbor(node_ids, parent_ids, locations)
+
+        self.assertEqual(len(arbor), 8)
+        self.assertIn(8, arbor)
+        self.assertNotIn(9, arbor)
+        self.assertRaises(KeyError, arbor.index, 9)
+        self.assertEqual(arbor.find_root(), 1)
+        self.assertEqual(arbor.parent(3), 2)
+        self.assertEqual(arbor.parent(1), None)
+        self.assertEqual(sorted(arbor.children(3).tolist()), [4, 8])
+        self.assertEqual(arbor.depths()[arbor.index(5)], 4)
+        self.assertEqual(arbor.accumulate([1] * 8)[arbor.index(2)], 5)
+        self.assertAlmostEqual(cable_length(arbor, None), 4 + 2 + 2)
+
+        self.assertEqual([s.tolist() for s in partition(arbor)],
+                [[5, 4, 3, 2, 1], [8, 3], [7, 6, 1]])
+
+        self.assertEqual(sorted(c.tolist() for c in arbor.components([2, 3, 5, 6, 7])),
+                [[2, 3], [5], [6, 7]])
+
+        # Simplifying doesn't change the original arbor
+        mini = simplify(arbor, [5, 7, 8])
+        self.assertEqual(arbor.find_root(), 1)
+        self.assertEqual(mini.find_root(), 5)
+        self.assertEqual(mini.node_ids.tolist(), [3, 5, 7, 8])
+        self.assertEqual(mini.parent(3), 5)
+        self.assertEqual(mini.parent(7), 3)
+        self.assertEqual(mini.parent(8), 3)
+
+        arbor.reroot(7)
+        self.assertEqual(arbor.find_root(), 7)
+        self.assertEqual(arbor.parent(1), 6)
+        self.assertEqual(arbor.parent(6), 7)
+        self.assertEqual(arbor.parent(2), 1)
@@ -0,0 +1,84 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import connection, transaction
+from django.test import TransactionTestCase
+
+from catmaid.util import VersionedCache
+
+
+class VersionedCacheTests(TransactionTestCase):
+    """Test the versioned cache outside of test transactions, because values
+    computed in a transaction that changed the cached data aren't stored.
+    """
+
+    def setUp(self):
+        self.n_computations = 0
+
+    def compute(self, value):
+        def compute_fn():
+            self.n_computations += 1
+            return value
+        return compute_fn
+
+    def change_permissions(self):
+        # Statement level triggers increment the cache version, even if no
+        # row is changed.
+        cursor = connection.cursor()
+        cursor.execute("DELETE FROM guardian_userobjectpermission WHERE FALSE")
+
+    def test_entries_are_reused(self):
+        cache = VersionedCache('permissions', 10, 60)
+        self.assertEqual(cache.get('a', self.compute({1})), {1})
+        self.assertEqual(cache.get('a', self.compute({2})), {1})
+        self.assertEqual(self.n_computations, 1)
+
+    def test_invalidation(self):
+        cache = VersionedCache('permissions', 10, 60)
+        cache.get('a', self.compute({1}))
+        cache.invalidate()
+        self.assertEqual(cache.get('a', self.compute({2})), {2})
+        self.assertEqual(self.n_computations, 2)
+
+        # Values computed during an invalidation aren't stored
+        def compute_and_invalidate():
+            cache.invalidate()
+            return {3}
+        self.assertEqual(cache.get('b', compute_and_invalidate), {3})
+        self.assertEqual(cache.get('b', self.compute({4})), {4})
+
+    def test_database_version(self):
+        cache = VersionedCache('permissions', 10, 60)
+        cache.get('a', self.compute({1}))
+
+        # A committed change, e.g. by another process
+        self.change_permissions()
+        self.assertEqual(cache.get('a', self.compute({2})), {2})
+        self.assertEqual(cache.get('a', self.compute({3})), {2})
+        self.assertEqual(self.n_computations, 2)
+
+    def test_transactions(self):
+        cache = VersionedCache('permissions', 10, 60)
+
+        # Values computed in a transaction are stored, unless the transaction
+        # changed the cached data itself.
+        with transaction.atomic():
+            self.assertEqual(cache.get('a', self.compute({1})), {1})
+        self.assertEqual(cache.get('a', self.compute({2})), {1})
+
+        try:
+            with transaction.atomic():
+                self.change_permissions()
+                self.assertEqual(cache.get('a', self.compute({3})), {3})
+                self.assertEqual(cache.get('b', self.compute({4})), {4})
+                raise ValueError("Rollback")
+        except ValueError:
+            pass
+        self.assertEqual(cache.get('a', self.compute({5})), {1})
+        self.assertEqual(cache.get('b', self.compute({6})), {6})
+
+    def test_expiration(self):
+        cache = VersionedCache('permissions', 10, 0)
+        cache.get('a', self.compute({1}))
+        self.assertEqual(cache.get('a', self.compute({2})), {2})
+        self.assertEqual(self.n_computations, 2)
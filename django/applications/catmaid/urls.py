@@ -225,6 +225,8 @@ urlpatterns += [
     url(r'^(?P<project_id>\d+)/node/get_location$', node.get_location),
     url(r'^(?P<project_id>\d+)/node/user-info$', node.user_info),
     url(r'^(?P<project_id>\d+)/nodes/find-labels$', node.find_labels),
+    url(r'^(?P<project_id>\d+)/nodes/result-cache/stats$', node.node_list_result_cache_stats),
+    url(r'^(?P<project_id>\d+)/nodes/provider-stats$', node.node_provider_stats),
     url(r'^(?P<project_id>\d+)/nodes/$', api_view(['POST'])(node.node_list_tuples)),
 ]
 
@@ -279,6 +281,7 @@ urlpatterns += [
     url(r'^(?P<project_id>\d+)/skeleton/reroot$', record_view("skeletons.reroot")(skeleton.reroot_skeleton)),
     url(r'^(?P<project_id>\d+)/skeleton/(?P<skeleton_id>\d+)/permissions$', skeleton.get_skeleton_permissions),
     url(r'^(?P<project_id>\d+)/skeletons/import$', record_view("skeletons.import")(skeleton.import_skeleton)),
+    url(r'^(?P<project_id>\d+)/skeletons/import-many$', record_view("skeletons.import_many")(skeleton.import_skeletons)),
     url(r'^(?P<project_id>\d+)/skeleton/annotationlist$', skeleton.annotation_list),
     url(r'^(?P<project_id>\d+)/skeletons/within-spatial-distance$', skeleton.within_spatial_distance),
     url(r'^(?P<project_id>\d+)/skeletons/node-labels$', skeleton.skeletons_by_node_labels),
@@ -2,7 +2,13 @@
 from __future__ import unicode_literals
 
 import math
+import threading
+import time
 
+from collections import OrderedDict
+
+from django.core.signals import request_finished, request_started
+from django.db import connection
 from django.utils.encoding import python_2_unicode_compatible
 
 
@@ -73,3 +79,180 @@ def is_collinear(a, b, c, between=False, eps=epsilon):
         return not (min(tx, ty, tz) < 0.0 or max(tx, ty, tz) > 1.0)
     else:
         return True
+
+
+class LRUCache(object):
+    """A thread safe cache that evicts least recently used entries once the
+    total size of all entries exceeds <max_size>. The size of each entry is
+    computed with <size_fn>, which by default counts each entry as one. Cache
+    hits and misses are counted.
+    """
+
+    def __init__(self, max_size, size_fn=None):
+        self.max_size = max_size
+        self.size_fn = size_fn or (lambda value: 1)
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key):
+        return key in self._entries
+
+    def get(self, key, default=None):
+        """Return the value stored for <key> and mark it as most recently used.
+        If there is no such entry, <default> is returned.
+        """
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is None:
+                self.misses += 1
+                return default
+            self._entries[key] = entry
+            self.hits += 1
+            return entry[0]
+
+    def set(self, key, value):
+        """Store <value> for <key> and evict least recently used entries until
+        the cache size limit is respected again. Values that are larger than the
+        size limit aren't stored.
+        """
+        size = self.size_fn(value)
+        with self._lock:
+            old_entry = self._entries.pop(key, None)
+            if old_entry is not None:
+                self.size -= old_entry[1]
+            if size > self.max_size:
+                return
+            self._entries[key] = (value, size)
+            self.size += size
+            while self.size > self.max_size:
+                _, (_, evicted_size) = self._entries.popitem(last=False)
+                self.size -= evicted_size
+
+    def remove(self, key):
+        """Remove the entry for <key>, if it exists.
+        """
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is not None:
+                self.size -= entry[1]
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.size = 0
+
+    def stats(self):
+        """Return a dictionary with the current entry count, size and the
+        number of hits and misses.
+        """
+        return {
+            'entries': len(self._entries),
+            'size': self.size,
+            'max_size': self.max_size,
+            'hits': self.hits,
+            'misses': self.misses,
+        }
+
+
+# The database versions of all named caches, which are read only once per
+# request and thread.
+_cache_versions = threading.local()
+
+
+def get_cache_versions():
+    """Return a dictionary that maps the names of all versioned caches to a
+    tuple of their current version in the database and whether this version
+    was set by the current transaction. Within a request, versions are read
+    only once per thread, unless a cache is invalidated.
+    """
+    versions = getattr(_cache_versions, 'versions', None)
+    if versions is None:
+        cursor = connection.cursor()
+        cursor.execute("""
+            SELECT name, version, txid = txid_current_if_assigned()
+            FROM catmaid_cache_version
+        """)
+        versions = dict((row[0], (row[1], bool(row[2])))
+                for row in cursor.fetchall())
+        if getattr(_cache_versions, 'in_request', False):
+            _cache_versions.versions = versions
+    return versions
+
+
+def start_cache_version_request(**kwargs):
+    _cache_versions.versions = None
+    _cache_versions.in_request = True
+
+
+def finish_cache_version_request(**kwargs):
+    _cache_versions.versions = None
+    _cache_versions.in_request = False
+
+
+request_started.connect(start_cache_version_request,
+        dispatch_uid='catmaid_cache_version_request_started')
+request_finished.connect(finish_cache_version_request,
+        dispatch_uid='catmaid_cache_version_request_finished')
+
+
+class VersionedCache(object):
+    """A process local, size bounded cache for values computed from rarely
+    changing database content. Each cache has a version in the
+    catmaid_cache_version table, which database triggers increment with every
+    change of the underlying tables. Entries are only used if they were stored
+    for the current version and are younger than <max_age> seconds. This way,
+    committed changes are visible to all processes right away.
+
+    Values computed in a transaction are stored, unless the transaction itself
+    changed the underlying data, which could still be rolled back. Otherwise
+    they are based on committed data of at least the version read before.
+    invalidate() has to be called if the data is changed in a request after
+    the cache was used, so that the version is read again.
+    """
+
+    def __init__(self, name, max_size, max_age):
+        self.name = name
+        self.max_age = max_age
+        self.cache = LRUCache(max_size)
+        self.generation = 0
+        self._lock = threading.Lock()
+
+    def get(self, key, compute_fn):
+        """Return the value stored for <key> or compute and store it using
+        <compute_fn>, if there is no valid entry.
+        """
+        version, own_change = get_cache_versions().get(self.name, (None, True))
+        entry = self.cache.get(key)
+        if entry is not None and not own_change:
+            value, entry_version, created = entry
+            if entry_version == version and \
+                    time.time() - created < self.max_age:
+                return value
+
+        generation = self.generation
+        created = time.time()
+        value = compute_fn()
+        if not own_change:
+            with self._lock:
+                if generation == self.generation:
+                    self.cache.set(key, (value, version, created))
+        return value
+
+    def remove(self, key):
+        self.cache.remove(key)
+
+    def invalidate(self):
+        """Drop all entries of this process and read the version from the
+        database again with the next lookup. Values that are computed
+        concurrently are not stored.
+        """
+        with self._lock:
+            self.generation += 1
+            self.cache.clear()
+        _cache_versions.versions = None
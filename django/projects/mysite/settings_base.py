@@ -187,6 +187,27 @@ NODE_PROVIDERS = [
     'postgis3d'
 ]
 
+# Node providers are by default asked in the order they are listed in
+# NODE_PROVIDERS. If this is set to 'adaptive', each process records the
+# latency of node queries for each node provider and bounding box size class.
+# Matching node providers that were fast for similar queries are then asked
+# first, all others are used as fallback in their configured order.
+NODE_PROVIDER_SELECTION = 'static'
+
+# With adaptive node provider selection, each node provider is tried first
+# this many times for every size class before its statistics are trusted.
+NODE_PROVIDER_SELECTION_MIN_SAMPLES = 5
+
+# With adaptive node provider selection, this is the fraction of queries for
+# which a random matching node provider is asked first. This allows to notice
+# changes in performance over time.
+NODE_PROVIDER_SELECTION_EXPLORATION_RATE = 0.05
+
+# Skeleton measurements are computed in batches of this many skeletons, using
+# up to SKELETON_MEASUREMENT_WORKERS threads in parallel.
+SKELETON_MEASUREMENT_BATCH_SIZE = 50
+SKELETON_MEASUREMENT_WORKERS = 4
+
 # By default, prepared statements are disabled. If connection pooling is used,
 # this can further improve performance.
 PREPARED_STATEMENTS = False
@@ -219,6 +240,47 @@ ROI_AUTO_CREATE_IMAGE = False
 # result; that will be between 1x and 2x this value.
 NODE_LIST_MAXIMUM_COUNT = 3500
 
+# Complete node query responses can be cached in memory by each process. This
+# setting defines the maximum size of this cache in bytes, a value of zero
+# disables it. Cached results are invalidated if tracing data in their bounding
+# box changes. Requests that include labels are not cached.
+NODE_LIST_RESULT_CACHE_SIZE = 0
+
+# To let similar views share cached node query results, the bounding box of a
+# query is extended to the next multiple of this value (in project space) in X
+# and Y. If the node limit is reached for a quantized bounding box, the
+# requested one is queried instead. A value of zero disables this.
+NODE_LIST_RESULT_CACHE_QUANTUM = 256
+
+# The maximum age in seconds of a cached node query result.
+NODE_LIST_RESULT_CACHE_MAX_AGE = 600
+
+# The maximum number of results a single proximity query (e.g. nearest nodes or
+# skeletons within a distance) can return. Larger limits requested by clients
+# are reduced to this value. A value of None disables this limit.
+NODE_PROXIMITY_QUERY_MAXIMUM_COUNT = 1000
+
+# The project permissions and the edit domain of users are cached by each
+# process for this many seconds, a value of zero disables the cache. Changes to
+# permissions, users and groups invalidate the cache of all processes once they
+# are committed.
+PERMISSION_CACHE_MAX_AGE = 60
+
+# The maximum number of entries in the permission cache of each process. There
+# is one entry per user and project and one per user edit domain.
+PERMISSION_CACHE_SIZE = 10000
+
+# Maps of relation and class names to their IDs are cached per project by each
+# process for this many seconds, a value of zero disables the cache. Changes
+# to relations and classes invalidate the cache of all processes once they are
+# committed. Names that aren't found in a cached map are always looked up
+# again.
+ID_MAP_CACHE_MAX_AGE = 300
+
+# The maximum number of entries in the relation and class ID map cache of each
+# process. There are up to two entries per project.
+ID_MAP_CACHE_SIZE = 1000
+
 # Default importer tile width, tile height and tile source type
 IMPORTER_DEFAULT_DATA_SOURCE = 'filesystem'
 IMPORTER_DEFAULT_TILE_WIDTH = 512
@@ -240,6 +302,11 @@ MEDIA_EXPORT_SUBDIRECTORY = 'export'
 CROPPING_OUTPUT_FILE_EXTENSION = "tiff"
 CROPPING_OUTPUT_FILE_PREFIX = "crop_"
 CROPPING_VERIFY_CERTIFICATES = True
+# The number of tiles the cropping tool fetches in parallel.
+CROPPING_FETCH_WORKERS = 8
+# The size in bytes of the cache for fetched tiles the cropping tool keeps in
+# each process. A value of zero disables the cache.
+CROPPING_TILE_CACHE_SIZE = 67108864
 
 # The maximum allowed size in Bytes for generated files. The cropping tool, for
 # instance, uses this to cancel a request if the generated file grows larger
@@ -329,6 +396,17 @@ VERSION = utils.get_version()
 # DVID_FORMAT = 'jpg:80'
 # DVID_SHOW_NONDISPLAYABLE_REPOS = True
 
+# Project and stack metadata of the Janelia Render service and DVID is cached
+# by each process. Entries younger than REMOTE_METADATA_CACHE_MAX_AGE seconds
+# are used as they are, entries that are up to REMOTE_METADATA_STALE_MAX_AGE
+# seconds older are used as well, but refreshed in the background.
+REMOTE_METADATA_CACHE_MAX_AGE = 60
+REMOTE_METADATA_STALE_MAX_AGE = 600
+# The timeout in seconds for metadata requests and the number of requests
+# that are made in parallel.
+REMOTE_METADATA_TIMEOUT = 30
+REMOTE_METADATA_WORKERS = 8
+
 # In order to make Django work with the unmanaged models from djsopnet in tests,
 # we use a custom testing runner to detect when running in a testing
 # environment. The custom PostgreSQL database wrapper uses this flag to change
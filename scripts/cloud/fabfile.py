@@ -136,10 +136,6 @@ def installDjangoBackend():
             'libxslt1-dev',
             'libjpeg-dev',
             'libtiff-dev',
-            'libgraphicsmagick++3',
-            'libgraphicsmagick++1-dev',
-            'libboost-python1.48.0',
-            'libboost-python1.48-dev',
             'ipython',	
             'python-h5py',	
         ]
@@ -148,7 +144,7 @@ def installDjangoBackend():
             print(each_package)
             run('sudo apt-get -y --force-yes install %s' % each_package, pty = True)
 
-        packagelist = ['python-numpy', 'python-h5py' ,'graphicsmagick']
+        packagelist = ['python-numpy', 'python-h5py']
         for each_package in packagelist:
             print(each_package)
             run('sudo apt-get -y --force-yes build-dep %s' % each_package, pty = True)
@@ -167,7 +163,6 @@ def installDjangoBackend():
                 run('pip install sqlparse==0.1.3')
                 run('pip install wsgiref==0.1.2')
                 run('pip install networkx==1.6')
-                run('pip install pgmagick==0.5.1')
                 run('pip install celery==2.4.6')
                 run('pip install django-celery==2.4.2')
                 run('pip install kombu==2.0.0')